@@ -8,17 +8,42 @@ Rate limiting, CORS, and request logging.
 """
 
 from http.server import BaseHTTPRequestHandler
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait as wait_futures
 from datetime import datetime, timedelta, timezone
-from urllib.parse import urlparse, parse_qs
+from decimal import Decimal
+from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode
+import bisect
+import copy
+import gzip
 import hashlib
-import json
+import heapq
+import itertools
 import logging
+import math
 import os
+import queue
+import random
 import re
 import hmac
+import sqlite3
+import sys
+import threading
 import time
 import uuid
 
+# Repo-root helper modules (s4_merkle, s4_http, s4_codec, monitoring,
+# resilience) ship with this function via vercel.json "includeFiles".
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _REPO_ROOT not in sys.path:
+    sys.path.insert(0, _REPO_ROOT)
+from s4_merkle import MerkleTree
+from s4_http import http_pool
+import s4_codec
+from monitoring import metrics
+from monitoring.xrpl_health import XRPLHealthMonitor
+from resilience import CircuitBreaker
+
 # ── Structured JSON logging (Phase 6.1) ──────────────────────────
 class _JsonFormatter(logging.Formatter):
     def format(self, record):
@@ -33,7 +58,7 @@ class _JsonFormatter(logging.Formatter):
                 entry[attr] = val
         if record.exc_info and record.exc_info[1]:
             entry["error"] = str(record.exc_info[1])
-        return json.dumps(entry, default=str)
+        return s4_codec.dumps(entry, default=str)
 
 _handler = logging.StreamHandler()
 _handler.setFormatter(_JsonFormatter())
@@ -43,10 +68,12 @@ logger.setLevel(logging.INFO)
 
 # XRPL Mainnet integration (graceful fallback if unavailable)
 try:
-    from xrpl.clients import JsonRpcClient
+    import httpx
+    from xrpl.clients import JsonRpcClient, XRPLRequestFailureException
     from xrpl.wallet import Wallet
     from xrpl.models import Memo, Payment, AccountSet, IssuedCurrencyAmount
-    from xrpl.transaction import submit_and_wait
+    from xrpl.models.requests import AccountInfo, AccountLines, Fee, Ledger, SubmitOnly, Tx
+    from xrpl.transaction import autofill_and_sign, sign, submit_and_wait, XRPLReliableSubmissionException
     try:
         from xrpl.core.keypairs.main import CryptoAlgorithm
     except ImportError:
@@ -69,7 +96,7 @@ SUPABASE_AVAILABLE = bool(SUPABASE_URL and SUPABASE_KEY)
 
 # ═══════════════════════════════════════════════════════════════════════
 #  SUPABASE PERSISTENCE LAYER — Replaces all in-memory stores
-#  Uses urllib.request (stdlib) to hit the PostgREST API.
+#  Hits the PostgREST API over pooled keep-alive connections (s4_http).
 #  Every write goes to Supabase first, with in-memory as cache.
 #  Every read checks Supabase if cache is empty (cold-start recovery).
 # ═══════════════════════════════════════════════════════════════════════
@@ -109,17 +136,16 @@ def _supabase_request(table, *, method="GET", data=None, query_params="",
         if prefer:
             headers["Prefer"] = prefer
 
-        body = json.dumps(data).encode() if data else None
-        req = urllib.request.Request(url, data=body, headers=headers, method=method)
-        resp = urllib.request.urlopen(req, timeout=timeout)
-        raw = resp.read()
-        if raw:
-            return json.loads(raw)
+        body = s4_codec.dumpb(data) if data else None
+        resp = http_pool.request(method, url, body=body, headers=headers, timeout=timeout)
+        if method != "GET":
+            _response_cache.invalidate_table(table)
+        if resp.status >= 400:
+            print(f"Supabase {method} {table} HTTP {resp.status}: {resp.body.decode(errors='replace')[:300]}")
+            return None
+        if resp.body:
+            return s4_codec.loads(resp.body)
         return []
-    except urllib.error.HTTPError as e:
-        body = e.read().decode() if e.fp else ""
-        print(f"Supabase {method} {table} HTTP {e.code}: {body[:300]}")
-        return None
     except Exception as e:
         print(f"Supabase {method} {table} failed: {e}")
         return None
@@ -137,6 +163,62 @@ def _sb_upsert(table, row, on_conflict=""):
     return _supabase_request(table, method="POST", data=row, prefer=prefer)
 
 
+SB_BULK_CHUNK = 500
+
+
+def _sb_bulk_upsert(table, rows, chunk_size=SB_BULK_CHUNK, on_conflict=""):
+    """Upsert many rows with one PostgREST request per chunk.
+
+    Rows are grouped by their column set (PostgREST bulk writes need
+    uniform keys) and sent as JSON arrays. A chunk that fails is retried
+    row-by-row so one bad row doesn't sink its neighbours; after three
+    consecutive single-row failures the rest of that chunk is marked failed
+    without retrying (the table or Supabase itself is unavailable).
+
+    Returns {"written": int, "failed": [row indices], "requests": int}.
+    """
+    report = {"written": 0, "failed": [], "requests": 0}
+    if not rows:
+        return report
+    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+        report["failed"] = list(range(len(rows)))
+        return report
+    prefer = "return=minimal,resolution=merge-duplicates"
+    query_params = f"on_conflict={on_conflict}" if on_conflict else ""
+
+    groups = {}
+    for i, row in enumerate(rows):
+        groups.setdefault(tuple(row), []).append(i)
+
+    for indices in groups.values():
+        for start in range(0, len(indices), chunk_size):
+            chunk = indices[start:start + chunk_size]
+            report["requests"] += 1
+            result = _supabase_request(table, method="POST", data=[rows[i] for i in chunk],
+                                       query_params=query_params, prefer=prefer)
+            if result is not None:
+                report["written"] += len(chunk)
+                continue
+            if len(chunk) == 1:
+                report["failed"].append(chunk[0])
+                continue
+            consecutive = 0
+            for n, i in enumerate(chunk):
+                report["requests"] += 1
+                if _supabase_request(table, method="POST", data=rows[i],
+                                     query_params=query_params, prefer=prefer) is not None:
+                    report["written"] += 1
+                    consecutive = 0
+                    continue
+                report["failed"].append(i)
+                consecutive += 1
+                if consecutive >= 3:
+                    report["failed"].extend(chunk[n + 1:])
+                    break
+    report["failed"].sort()
+    return report
+
+
 def _sb_select(table, query_params="", select="*", limit=None, order=None):
     """Select rows from a Supabase table with optional filtering and ordering."""
     parts = []
@@ -154,8 +236,8 @@ def _sb_select(table, query_params="", select="*", limit=None, order=None):
 
 _records_loaded = False  # Flag: have we hydrated _live_records from Supabase?
 
-def _persist_record(record):
-    """Write an anchored record to Supabase. Falls back to in-memory only."""
+def _record_row(record):
+    """Map an in-memory record to its Supabase `records` row."""
     row = {
         "record_id": record.get("record_id", ""),
         "hash": record.get("hash", ""),
@@ -179,12 +261,35 @@ def _persist_record(record):
         row["parent_tx_hash"] = record["parent_tx_hash"]
     if record.get("version_number") and record["version_number"] != 1:
         row["version_number"] = record["version_number"]
+    # Merkle batch membership (migration 028) — lets batch proofs be rebuilt
+    if record.get("batch_id"):
+        row["batch_id"] = record["batch_id"]
+        row["merkle_root"] = record.get("merkle_root")
+        row["leaf_index"] = record.get("leaf_index")
+    return row
+
+
+def _persist_record(record):
+    """Write an anchored record to Supabase. Falls back to in-memory only."""
+    row = _record_row(record)
     result = _sb_upsert("records", row)
     if result is None:
         print(f"Record persist failed for {row['record_id']} — in-memory only")
     return result
 
 
+def _persist_records(records):
+    """Bulk-write anchored records (batch anchors, offline sync).
+    Returns the record_ids that could not be persisted (kept in memory only)."""
+    if not records:
+        return []
+    report = _sb_bulk_upsert("records", [_record_row(r) for r in records])
+    failed_ids = [records[i].get("record_id", "") for i in report["failed"]]
+    if failed_ids:
+        print(f"Record persist failed for {len(failed_ids)}/{len(records)} records — in-memory only")
+    return failed_ids
+
+
 def _load_records_from_supabase():
     """Hydrate _live_records from Supabase on cold start with retry."""
     global _records_loaded
@@ -217,6 +322,7 @@ def _load_records_from_supabase():
                 "org_id": row.get("org_id", ""),
                 "record_id": row.get("record_id", ""),
                 "source_system": row.get("source_system", ""),
+                **{k: row[k] for k in ("batch_id", "merkle_root", "leaf_index") if row.get(k) is not None},
             })
         print(f"Hydrated {len(rows)} records from Supabase")
     else:
@@ -284,7 +390,7 @@ def _persist_proof_chain_event(record_id, event):
         "tx_hash": event.get("tx_hash", ""),
         "timestamp": event.get("timestamp", datetime.now(timezone.utc).isoformat()),
         "actor": event.get("actor", ""),
-        "metadata": json.dumps(event.get("metadata", {})),
+        "metadata": s4_codec.dumps(event.get("metadata", {})),
     }
     _sb_insert("proof_chains", row)
 
@@ -359,7 +465,8 @@ def _persist_webhook_registration(org_key, hook):
 
 
 def _persist_webhook_delivery(delivery):
-    """Write a webhook delivery record to Supabase."""
+    """Upsert a webhook delivery record (keyed on delivery_id, so each
+    attempt updates the same row)."""
     row = {
         "delivery_id": delivery.get("id", ""),
         "org_key": delivery.get("org", ""),
@@ -374,7 +481,8 @@ def _persist_webhook_delivery(delivery):
         "signature": delivery.get("signature", ""),
         "payload_preview": delivery.get("payload_preview", ""),
     }
-    _sb_insert("webhook_deliveries", row)
+    _supabase_request("webhook_deliveries", method="POST", data=row, query_params="on_conflict=delivery_id",
+                      prefer="return=minimal,resolution=merge-duplicates")
 
 
 def _load_webhooks_from_supabase():
@@ -481,7 +589,7 @@ def _validate_supabase_jwt(token):
             return None
         # Decode header
         header_b64 = parts[0] + '=' * (4 - len(parts[0]) % 4)
-        header = json.loads(base64.urlsafe_b64decode(header_b64))
+        header = s4_codec.loads(base64.urlsafe_b64decode(header_b64))
         if header.get('alg') != 'HS256':
             return None
         # Verify signature
@@ -493,7 +601,7 @@ def _validate_supabase_jwt(token):
             return None
         # Decode payload
         payload_b64 = parts[1] + '=' * (4 - len(parts[1]) % 4)
-        payload = json.loads(base64.urlsafe_b64decode(payload_b64))
+        payload = s4_codec.loads(base64.urlsafe_b64decode(payload_b64))
         # Check expiration
         exp = payload.get('exp', 0)
         if exp and time.time() > exp:
@@ -553,6 +661,7 @@ def _hydrate_from_supabase():
         _load_custody_chains_from_supabase()
         _load_webhooks_from_supabase()
         _load_api_keys_from_supabase()
+        _load_fee_accruals_from_supabase()
         print("Supabase hydration complete")
     except Exception as e:
         print(f"Supabase hydration error (continuing with empty stores): {e}")
@@ -589,27 +698,269 @@ if not API_MASTER_KEY:
     print(f"WARNING: S4_API_MASTER_KEY not set — generated ephemeral key (set env var for production)")
 API_KEYS_STORE = {}  # In production, stored in Supabase
 
-# Rate limiting – in-memory sliding window per Vercel instance.
+# Rate limiting – in-memory token buckets per Vercel instance.
 # Vercel Edge / WAF provides primary DDoS protection; this is a
 # secondary abuse-prevention layer.  State resets on cold start,
 # which is acceptable because a fresh instance has no abuse history.
-_rate_limit_store: dict = {}   # ip -> [timestamps]
-_RATE_LIMIT_MAX_IPS = 10_000   # LRU cap to prevent memory leaks
 RATE_LIMIT_WINDOW = 60         # seconds
-RATE_LIMIT_MAX = 120           # requests per window
+RATE_LIMIT_MAX = 120           # requests per window (default group)
+_RATE_LIMIT_MAX_KEYS = 10_000  # LRU cap to prevent memory leaks
+
+# Per-route budgets, as requests per RATE_LIMIT_WINDOW. Each group is a
+# separate bucket per caller, so AI traffic can't starve hashing.
+RATE_LIMIT_GROUPS = {
+    "default": RATE_LIMIT_MAX,
+    "ai": int(os.environ.get("S4_RATE_LIMIT_AI", "20")),
+    "hash": int(os.environ.get("S4_RATE_LIMIT_HASH", "600")),
+}
+_RATE_LIMIT_ROUTE_GROUP = {
+    route: "ai" for route in (
+        "ai_chat", "ai_query", "ai_rag", "verify_ai", "vault_emails", "living_ledger",
+        "impact_simulator", "foresight_forecast", "conflict_resolver", "federated_benchmark",
+        "unified_brief", "cryptographic_mission_impact_ledger", "self_healing_compliance",
+        "zero_trust_handoff", "predictive_resource_allocator", "immutable_after_action_review",
+        "congressional_funding_forecast", "self_executing_contract_clause",
+        "federated_lessons_knowledge_graph", "supply_chain_insurance_optimizer",
+        "verifiable_scorecard", "mission_outcome_correlation", "multi_program_cascade",
+        "automated_neutral_mediator",
+    )
+}
+_RATE_LIMIT_ROUTE_GROUP.update({"hash": "hash", "hash_file": "hash"})
 
-# Request logging
-_request_log = []
-API_START_TIME = time.time()
 
-# Verification audit log
-_verify_audit_log = []  # [{timestamp, operator, record_hash, chain_hash, tx_hash, result, tamper_detected}]
+class _TokenBucketLimiter:
+    """Token bucket per key, held in an OrderedDict LRU.
+
+    Each bucket refills continuously at capacity / window tokens per
+    second up to capacity, so a caller may burst to the full window
+    budget and is then paced. A check is O(1): one dict lookup, one
+    move_to_end, and at capacity one popitem of the least recently
+    used key.
+    """
+
+    def __init__(self, max_keys=_RATE_LIMIT_MAX_KEYS, window=RATE_LIMIT_WINDOW):
+        self.max_keys = max_keys
+        self.window = window
+        self._buckets = OrderedDict()   # key -> [tokens, last_refill]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def check(self, key, capacity, now=None):
+        """Take one token for key. Returns 0.0 if allowed, otherwise the
+        seconds until a token is available."""
+        now = time.monotonic() if now is None else now
+        rate = capacity / self.window
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+                bucket = self._buckets[key] = [float(capacity), now]
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / rate
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+_rate_limiter = _TokenBucketLimiter()
 
 # ═══════════════════════════════════════════════════════════════════════
-#  Living Program Ledger — per-program AI response cache
+#  RESPONSE CACHE
+#  Read-mostly GET routes are served from an in-memory LRU keyed by
+#  route + normalized query + org (X-API-Key), with per-route TTLs and
+#  strong ETags (If-None-Match -> 304, no body). Any Supabase write to a
+#  table a route reads drops that route's entries, so POSTs on this
+#  instance are visible immediately; other instances converge within TTL.
 # ═══════════════════════════════════════════════════════════════════════
-_lpl_cache: dict = {}  # program_name -> {response, timestamp, period}
-_LPL_CACHE_TTL = 300   # 5-minute TTL to reduce duplicate AI calls
+
+# route -> (ttl seconds, Supabase tables the response is built from)
+RESPONSE_CACHE_ROUTES = {
+    "record_types": (3600, ()),
+    "dmsms": (60, ("dmsms_items",)),
+    "parts": (120, ("parts_catalog",)),
+    "compliance_scorecard": (120, ("compliance_scores",)),
+    "cross_program_analytics": (60, ("ils_uploads", "documents", "poam_items", "gfp_items", "sbom_entries",
+                                     "submission_reviews", "provenance_chain", "program_metrics")),
+    "program_metrics": (60, ("program_metrics",)),
+}
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("S4_RESPONSE_CACHE_MB", "32")) * 1024 * 1024
+
+
+class _ResponseCache:
+    """Size-bounded LRU of serialized GET responses.
+
+    Each route has a generation counter that invalidate_table() bumps. A
+    miss records the generation before the handler reads Supabase and
+    put() discards the response if a write bumped it meanwhile, so a
+    read racing a write can't re-cache pre-write data.
+    """
+
+    def __init__(self, routes=RESPONSE_CACHE_ROUTES, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.routes = routes
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (expires, etag, body, route)
+        self._bytes = 0
+        self._generation = {route: 0 for route in routes}
+        self._routes_by_table = {}
+        for route, (_, tables) in routes.items():
+            for table in tables:
+                self._routes_by_table.setdefault(table, []).append(route)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "not_modified": 0, "invalidations": 0, "evictions": 0}
+
+    @staticmethod
+    def key(route, query, org):
+        """route + query parameters sorted by name (blank values kept) + org."""
+        params = sorted(parse_qsl(query, keep_blank_values=True))
+        return (route, urlencode(params), org)
+
+    def get(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    self._drop(key)
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry
+
+    def generation(self, route):
+        with self._lock:
+            return self._generation[route]
+
+    def put(self, key, generation, body, now=None):
+        """Cache body under key unless the route was invalidated since
+        `generation` was read. Returns the strong ETag either way."""
+        route = key[0]
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        if len(body) > self.max_bytes // 8:
+            return etag
+        expires = (time.monotonic() if now is None else now) + self.routes[route][0]
+        with self._lock:
+            if self._generation[route] != generation:
+                return etag
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (expires, etag, body, route)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+        return etag
+
+    def _drop(self, key):
+        self._bytes -= len(self._entries.pop(key)[2])
+
+    def invalidate_table(self, table):
+        routes = self._routes_by_table.get(table)
+        if not routes:
+            return
+        with self._lock:
+            for route in routes:
+                self._generation[route] += 1
+            stale = [k for k, entry in self._entries.items() if entry[3] in routes]
+            for k in stale:
+                self._drop(k)
+            self._stats["invalidations"] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            for route in self._generation:
+                self._generation[route] += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def not_modified(self):
+        with self._lock:
+            self._stats["not_modified"] += 1
+
+
+_response_cache = _ResponseCache()
+
+# ═══════════════════════════════════════════════════════════════════════
+#  RESPONSE COMPRESSION
+#  Accept-Encoding negotiation for handler._send_body. gzip is always
+#  available; brotli and zstd are used when their packages are installed.
+#  Bodies under RESPONSE_COMPRESS_MIN_BYTES go out as-is (a gzip header
+#  alone is ~20 bytes, and small bodies fit in one packet anyway).
+# ═══════════════════════════════════════════════════════════════════════
+
+RESPONSE_COMPRESS_MIN_BYTES = int(os.environ.get("S4_COMPRESS_MIN_BYTES", "1024"))
+
+_RESPONSE_ENCODERS = {"gzip": lambda body: gzip.compress(body, compresslevel=6, mtime=0)}
+try:
+    import brotli
+    _RESPONSE_ENCODERS["br"] = lambda body: brotli.compress(body, quality=5)
+except ImportError:
+    pass
+try:
+    import zstandard
+    # ZstdCompressor instances aren't safe to share across threads
+    _RESPONSE_ENCODERS["zstd"] = lambda body: zstandard.ZstdCompressor(level=3).compress(body)
+except ImportError:
+    pass
+_ENCODING_PREFERENCE = ("zstd", "br", "gzip")   # server preference on q-value ties
+
+
+def _negotiate_encoding(accept_encoding):
+    """Pick a content-coding from an Accept-Encoding header, or None for
+    identity. Honours q-values (q=0 refuses a coding) and "*"."""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip()] = q
+    best, best_q = None, 0.0
+    for name in _ENCODING_PREFERENCE:
+        if name not in _RESPONSE_ENCODERS:
+            continue
+        q = weights.get(name, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def _encoded_etag(etag, encoding):
+    """Per-representation strong ETag: "<hash>" -> "<hash>-gzip"."""
+    return etag[:-1] + "-" + encoding + '"' if encoding else etag
+
+# Request logging — ring buffer of recent requests; per-route latency
+# percentiles live in monitoring.metrics (see handler._finish_request)
+_request_log = deque(maxlen=1000)
+API_START_TIME = time.time()
+
+# Verification audit log
+_verify_audit_log = []  # [{timestamp, operator, record_hash, chain_hash, tx_hash, result, tamper_detected}]
 
 # ═══════════════════════════════════════════════════════════════════════
 #  Secure Collaboration Network — HMAC signing + state
@@ -733,15 +1084,194 @@ if not WEBHOOK_SIGNING_SECRET:
     WEBHOOK_SIGNING_SECRET = "whsec_" + _secrets_mod.token_hex(24)
     print(f"WARNING: S4_WEBHOOK_SECRET not set — generated ephemeral key (set env var for production)")
 _webhook_store = {}  # org_key -> [{url, events, active, created, secret}]
-_webhook_delivery_log = []  # [{id, org, url, event, status, attempts, last_attempt}]
+_webhook_delivery_log = deque(maxlen=500)  # [{id, org, url, event, status, attempts, last_attempt}]
 
 def _sign_webhook_payload(payload_json, secret):
     """HMAC-SHA256 signature for webhook payload verification."""
     return hmac.new(secret.encode(), payload_json.encode(), hashlib.sha256).hexdigest()
 
+WEBHOOK_WORKERS = int(os.environ.get("S4_WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_MAX = int(os.environ.get("S4_WEBHOOK_QUEUE_MAX", "1000"))
+WEBHOOK_PER_DESTINATION = int(os.environ.get("S4_WEBHOOK_PER_DESTINATION", "2"))
+WEBHOOK_RETRY_BASE_S = float(os.environ.get("S4_WEBHOOK_RETRY_BASE", "2"))
+WEBHOOK_MAX_ATTEMPTS = 3
+WEBHOOK_TIMEOUT_S = 10
+
+
+class _WebhookDispatcher:
+    """Bounded webhook delivery queue drained by a worker pool.
+
+    Jobs wait in a heap ordered by next-attempt time. A worker takes the
+    earliest due job; if that job's destination (scheme://host:port)
+    already has per_destination deliveries in flight, the job is parked
+    until one of them finishes, so a slow subscriber ties up at most that
+    many workers. deliver(job, retry_base) performs one attempt and
+    returns a retry delay in seconds, or None once the job is finished.
+    """
+
+    def __init__(self, deliver, workers=WEBHOOK_WORKERS, max_pending=WEBHOOK_QUEUE_MAX,
+                 per_destination=WEBHOOK_PER_DESTINATION, retry_base=WEBHOOK_RETRY_BASE_S):
+        self._deliver = deliver
+        self.workers = workers
+        self.max_pending = max_pending
+        self.per_destination = per_destination
+        self.retry_base = retry_base
+        self._heap = []        # (ready_at, seq, job)
+        self._parked = {}      # destination -> deque of jobs waiting for a slot
+        self._inflight = {}    # destination -> deliveries in progress
+        self._pending = 0      # accepted and not yet finished
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stats = {"enqueued": 0, "dropped": 0, "attempts": 0, "retries": 0, "finished": 0}
+
+    def submit(self, job):
+        """Queue a job. Returns False (job not accepted) when the queue is full."""
+        with self._cond:
+            if self._pending >= self.max_pending:
+                self._stats["dropped"] += 1
+                return False
+            self._pending += 1
+            self._stats["enqueued"] += 1
+            heapq.heappush(self._heap, (time.monotonic(), next(self._seq), job))
+            self._cond.notify()
+        self._ensure_workers()
+        return True
+
+    def depth(self):
+        with self._cond:
+            return self._pending
+
+    def _ensure_workers(self):
+        with self._cond:
+            self._threads[:] = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker, name="s4-webhook", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _take(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    job = heapq.heappop(self._heap)[2]
+                    dest = job["destination"]
+                    if self._inflight.get(dest, 0) >= self.per_destination:
+                        self._parked.setdefault(dest, deque()).append(job)
+                        continue
+                    self._inflight[dest] = self._inflight.get(dest, 0) + 1
+                    self._stats["attempts"] += 1
+                    return job
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _release(self, job, retry_delay):
+        with self._cond:
+            dest = job["destination"]
+            self._inflight[dest] -= 1
+            if not self._inflight[dest]:
+                del self._inflight[dest]
+            parked = self._parked.get(dest)
+            if parked:
+                heapq.heappush(self._heap, (time.monotonic(), next(self._seq), parked.popleft()))
+                if not parked:
+                    del self._parked[dest]
+            if retry_delay is None:
+                self._pending -= 1
+                self._stats["finished"] += 1
+                metrics.record_webhook_queue_depth(self._pending)
+            else:
+                self._stats["retries"] += 1
+                heapq.heappush(self._heap, (time.monotonic() + retry_delay, next(self._seq), job))
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            job = self._take()
+            retry_delay = None
+            try:
+                retry_delay = self._deliver(job, self.retry_base)
+            except Exception as e:
+                print(f"Webhook worker error: {e}")
+            finally:
+                self._release(job, retry_delay)
+
+    def join(self, timeout=None):
+        """Wait until every accepted job has finished. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queue_depth"] = self._pending
+            stats["in_flight"] = sum(self._inflight.values())
+            stats["parked"] = sum(len(q) for q in self._parked.values())
+            stats["workers"] = sum(1 for t in self._threads if t.is_alive())
+        return stats
+
+
+def _webhook_destination(url):
+    parts = urlparse(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+def _attempt_webhook(job, retry_base):
+    """One POST attempt for a queued delivery. Network errors, 408, 429
+    and 5xx are retried with exponential backoff (retry_base * 4^n, ±20%
+    jitter) up to max_attempts; any other status >= 400 fails at once.
+    Every attempt is persisted via _persist_webhook_delivery."""
+    delivery = job["delivery"]
+    delivery["attempts"] += 1
+    delivery["last_attempt"] = datetime.now(timezone.utc).isoformat()
+    delivery["status"] = "delivering"
+    retryable = False
+    try:
+        resp = http_pool.request("POST", delivery["url"], body=job["body"], headers=job["headers"],
+                                 timeout=WEBHOOK_TIMEOUT_S)
+        delivery["http_status"] = resp.status
+        if resp.status < 400:
+            delivery["status"] = "delivered"
+            delivery.pop("error", None)
+        else:
+            delivery["error"] = f"HTTP {resp.status} {resp.reason}"[:200]
+            retryable = resp.status in (408, 429) or resp.status >= 500
+    except Exception as e:
+        delivery["error"] = str(e)[:200]
+        retryable = True
+
+    retry_delay = None
+    if delivery["status"] != "delivered":
+        if retryable and delivery["attempts"] < delivery["max_attempts"]:
+            retry_delay = retry_base * 4 ** (delivery["attempts"] - 1) * random.uniform(0.8, 1.2)
+            delivery["status"] = "retrying"
+            delivery["next_attempt"] = (datetime.now(timezone.utc) + timedelta(seconds=retry_delay)).isoformat()
+        else:
+            delivery["status"] = "failed"
+    if retry_delay is None:
+        delivery.pop("next_attempt", None)
+        latency = time.monotonic() - job["enqueued_at"]
+        delivery["latency_ms"] = round(latency * 1000, 1)
+        metrics.webhook_delivered(delivery["event"], success=delivery["status"] == "delivered",
+                                  duration_seconds=latency)
+    _persist_webhook_delivery(delivery)
+    return retry_delay
+
+
+_webhook_dispatcher = _WebhookDispatcher(_attempt_webhook)
+
+
 def _deliver_webhook(event_type, data, org_key=None):
-    """Fire webhooks for a given event. Non-blocking best-effort delivery.
-    In production, this would use a background queue (SQS/Redis) with retry."""
+    """Queue webhooks for a given event. Only builds, signs and enqueues
+    deliveries; the HTTP POSTs, retries and persistence happen on the
+    _webhook_dispatcher workers, so a slow subscriber never delays the
+    request that raised the event."""
     now = datetime.now(timezone.utc)
     payload = {
         "event": event_type,
@@ -749,7 +1279,8 @@ def _deliver_webhook(event_type, data, org_key=None):
         "data": data,
         "api_version": "2026-02-18",
     }
-    payload_json = json.dumps(payload, ensure_ascii=False)
+    payload_json = s4_codec.dumps(payload)
+    body = payload_json.encode()
 
     # Determine which orgs to notify
     target_orgs = [org_key] if org_key else list(_webhook_store.keys())
@@ -764,7 +1295,7 @@ def _deliver_webhook(event_type, data, org_key=None):
             # Sign the payload with the hook's secret
             secret = hook.get("secret", WEBHOOK_SIGNING_SECRET)
             signature = _sign_webhook_payload(payload_json, secret)
-            delivery_id = f"whd_{hashlib.sha256((now.isoformat() + hook['url']).encode()).hexdigest()[:16]}"
+            delivery_id = f"whd_{uuid.uuid4().hex[:16]}"
 
             delivery_record = {
                 "id": delivery_id,
@@ -773,43 +1304,33 @@ def _deliver_webhook(event_type, data, org_key=None):
                 "event": event_type,
                 "status": "pending",
                 "attempts": 0,
-                "max_attempts": 3,
+                "max_attempts": WEBHOOK_MAX_ATTEMPTS,
                 "last_attempt": None,
                 "signature": signature,
                 "payload_preview": event_type,
             }
+            _webhook_delivery_log.append(delivery_record)
 
-            # Best-effort HTTP POST (synchronous in serverless; async in production)
-            try:
-                import urllib.request
-                req = urllib.request.Request(
-                    hook["url"],
-                    data=payload_json.encode(),
-                    headers={
-                        "Content-Type": "application/json",
-                        "X-S4-Signature": signature,
-                        "X-S4-Event": event_type,
-                        "X-S4-Delivery": delivery_id,
-                        "X-S4-Timestamp": now.isoformat(),
-                        "User-Agent": "S4-Ledger-Webhook/2.0",
-                    },
-                    method="POST",
-                )
-                resp = urllib.request.urlopen(req, timeout=10)
-                delivery_record["status"] = "delivered"
-                delivery_record["http_status"] = resp.status
-                delivery_record["attempts"] = 1
-                delivery_record["last_attempt"] = now.isoformat()
-            except Exception as e:
+            job = {
+                "delivery": delivery_record,
+                "destination": _webhook_destination(hook["url"]),
+                "body": body,
+                "headers": {
+                    "Content-Type": "application/json",
+                    "X-S4-Signature": signature,
+                    "X-S4-Event": event_type,
+                    "X-S4-Delivery": delivery_id,
+                    "X-S4-Timestamp": now.isoformat(),
+                    "User-Agent": "S4-Ledger-Webhook/2.0",
+                },
+                "enqueued_at": time.monotonic(),
+            }
+            if not _webhook_dispatcher.submit(job):
                 delivery_record["status"] = "failed"
-                delivery_record["error"] = str(e)[:200]
-                delivery_record["attempts"] = 1
-                delivery_record["last_attempt"] = now.isoformat()
-
-            _webhook_delivery_log.append(delivery_record)
-            _persist_webhook_delivery(delivery_record)
-            if len(_webhook_delivery_log) > 500:
-                _webhook_delivery_log.pop(0)
+                delivery_record["error"] = "webhook delivery queue full"
+                metrics.webhook_delivered(event_type, success=False, queue_depth=_webhook_dispatcher.depth())
+                _persist_webhook_delivery(delivery_record)
+    metrics.record_webhook_queue_depth(_webhook_dispatcher.depth())
 
 # ═══════════════════════════════════════════════════════════════════════
 #  PROOF CHAIN & CUSTODY STORES — HarborLink Integration (P0/P1)
@@ -817,7 +1338,7 @@ def _deliver_webhook(event_type, data, org_key=None):
 
 _proof_chain_store = {}   # record_id -> [{event_type, hash, tx_hash, timestamp, actor, metadata}]
 _custody_chain_store = {} # record_id -> [{from, to, timestamp, hash, tx_hash, location, condition}]
-_batch_store = {}         # batch_id -> {merkle_root, records, tx_hash, timestamp}
+_batch_store = {}         # batch_id -> {merkle_root, tree (s4_merkle.MerkleTree), tx_hash, timestamp}
 
 # ═══════════════════════════════════════════════════════════════════════
 #  MILITARY BRANCH DEFINITIONS
@@ -904,112 +1425,262 @@ RECORD_CATEGORIES = {
 
 # ═══════════════════════════════════════════════════════════════════════
 #  IN-MEMORY RECORD STORE
+#  Append-only list of records plus hash maps keyed by hash, tx_hash,
+#  record_id, org_id and record_type, so verify / org_records /
+#  quantum_safe_reanchor resolve records without scanning the ledger.
 # ═══════════════════════════════════════════════════════════════════════
-_live_records = []
 
-def _get_all_records():
-    """Return only real persisted records."""
-    return list(_live_records)
+class _RecordStore:
+    """Indexed in-memory record store.
+
+    Reads behave like the plain list it replaced (len, iteration, indexing
+    and slicing), so existing call sites keep working. Every append also
+    updates the lookup indexes. Unique-key indexes keep the position of the
+    *first* record seen for a key, matching the first-match semantics of the
+    old ``[r for r in _live_records if ...][0]`` scans. tx_hash is not
+    unique — every record in a batch or coalesced anchor carries the
+    Merkle-root tx_hash — so it maps to all of its positions.
+    """
+
+    def __init__(self):
+        self._records = []
+        self._by_hash = {}        # hash -> position of first record
+        self._by_tx_hash = {}     # tx_hash -> [positions], ascending
+        self._by_record_id = {}   # record_id -> position of first record
+        self._by_org = {}         # org_id -> [positions], insertion order
+        self._by_type = {}        # record_type -> [positions], insertion order
+        self.metrics = _MetricsAggregator()
+        self._lock = threading.Lock()
+
+    # ── list compatibility ──────────────────────────────────────────
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __getitem__(self, index):
+        return self._records[index]
+
+    # ── writes ──────────────────────────────────────────────────────
+
+    def append(self, record):
+        """Append a record and index it. Returns the record's position."""
+        with self._lock:
+            pos = len(self._records)
+            self._records.append(record)
+            self._index(record, pos)
+            self.metrics.add(record)
+            return pos
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def reindex(self, pos):
+        """Pick up unique keys filled in after append (e.g. the tx_hash of
+        an async anchor that was stored as pending)."""
+        with self._lock:
+            self._index_keys(self._records[pos], pos)
+
+    def _index_keys(self, record, pos):
+        for field, index in (("hash", self._by_hash),
+                             ("record_id", self._by_record_id)):
+            value = record.get(field)
+            if value and value not in index:
+                index[value] = pos
+        tx_hash = record.get("tx_hash")
+        if tx_hash:
+            positions = self._by_tx_hash.setdefault(tx_hash, [])
+            if not positions or positions[-1] < pos:
+                positions.append(pos)
+            elif pos not in positions:      # reindex of an older pending record
+                bisect.insort(positions, pos)
+
+    def _index(self, record, pos):
+        self._index_keys(record, pos)
+        org_id = record.get("org_id")
+        if org_id:
+            self._by_org.setdefault(org_id, []).append(pos)
+        self._by_type.setdefault(record.get("record_type") or "", []).append(pos)
+
+    # ── lookups ─────────────────────────────────────────────────────
+
+    def find_by_hash(self, hash_value):
+        """First record anchored with this content hash, or None."""
+        pos = self._by_hash.get(hash_value) if hash_value else None
+        return self._records[pos] if pos is not None else None
+
+    def find_by_tx(self, value, hash_value=None):
+        """First record whose tx_hash OR hash equals value, or None.
+
+        When a tx_hash covers several records (a Merkle-root anchor), pass
+        the content hash being verified as hash_value to get the record in
+        that transaction with that hash, rather than the batch's first.
+        """
+        if not value:
+            return None
+        tx_positions = self._by_tx_hash.get(value, [])
+        if hash_value and len(tx_positions) > 1:
+            pos = self._by_hash.get(hash_value)
+            if pos is not None and self._records[pos].get("tx_hash") == value:
+                return self._records[pos]
+            for pos in tx_positions:
+                if self._records[pos].get("hash") == hash_value:
+                    return self._records[pos]
+        positions = [p for p in (tx_positions[0] if tx_positions else None, self._by_hash.get(value))
+                     if p is not None]
+        return self._records[min(positions)] if positions else None
+
+    def get(self, record_id):
+        """First record with this record_id, or None."""
+        pos = self._by_record_id.get(record_id) if record_id else None
+        return self._records[pos] if pos is not None else None
+
+    def org_page(self, org_ids, offset=0, limit=100):
+        """Return (total, page) of records belonging to any of org_ids,
+        in anchoring order. Cost is O(offset + limit), not O(ledger)."""
+        lists = [self._by_org.get(o, []) for o in dict.fromkeys(o for o in org_ids if o)]
+        total = sum(len(l) for l in lists)
+        if len(lists) == 1:
+            positions = lists[0][offset:offset + limit]
+        else:
+            positions = list(itertools.islice(heapq.merge(*lists), offset, offset + limit))
+        return total, [self._records[p] for p in positions]
+
+    def select(self, org_id=None, record_type_prefix=None):
+        """Records whose org_id equals org_id or whose record_type starts
+        with record_type_prefix, in anchoring order."""
+        positions = set(self._by_org.get(org_id, [])) if org_id else set()
+        if record_type_prefix is not None:
+            for record_type, type_positions in list(self._by_type.items()):
+                if record_type.startswith(record_type_prefix):
+                    positions.update(type_positions)
+        return [self._records[p] for p in sorted(positions)]
+
+
+# Bucket key formats and retention for the /api/metrics time series:
+# (name, strftime format or None for ISO week, max buckets returned)
+_METRICS_BUCKETS = (
+    ("minute", "%H:%M", 60),
+    ("hour", "%b %d %H:00", 48),
+    ("day", "%b %d", 30),
+    ("week", None, 12),
+    ("month", "%b %Y", 12),
+)
+_METRICS_DAY_RETENTION = 7     # "%Y-%m-%d" keys kept for hashes_today
+_METRICS_MONTH_RETENTION = 3   # "%Y-%m" keys kept for this_month
+
+
+def _keep_top_keys(d, max_items):
+    """Drop the lexicographically smallest key once d exceeds max_items.
+
+    The snapshot only ever returns the largest max_items keys, and the key
+    set only grows, so a key evicted here can never re-enter the output.
+    """
+    if len(d) > max_items:
+        del d[min(d)]
+
+
+class _MetricsAggregator:
+    """Rolling /api/metrics state, updated once per appended record.
+
+    Produces exactly the JSON that a full pass of _aggregate_metrics() over
+    the same records would, but a snapshot costs O(buckets + record types)
+    instead of re-parsing every timestamp on every dashboard poll.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.by_type = {}
+        self.by_branch = {}
+        self.by_source = {}
+        self.hashes = {name: {} for name, _, _ in _METRICS_BUCKETS}
+        self.fees = {name: {} for name, _, _ in _METRICS_BUCKETS}
+        self.by_date = {}    # "%Y-%m-%d" -> count
+        self.by_month = {}   # "%Y-%m" -> count
+        self._lock = threading.Lock()
+
+    def add(self, r):
+        with self._lock:
+            self.total += 1
+            rt = r.get("record_label", r.get("record_type", "Unknown"))
+            self.by_type[rt] = self.by_type.get(rt, 0) + 1
+            branch = r.get("branch", "JOINT")
+            self.by_branch[branch] = self.by_branch.get(branch, 0) + 1
+            source = r.get("data_source", r.get("system", "direct"))
+            self.by_source[source] = self.by_source.get(source, 0) + 1
+
+            try:
+                ts = datetime.fromisoformat(r["timestamp"].replace("Z", "+00:00"))
+            except (ValueError, KeyError, AttributeError, TypeError):
+                return
+            fee = r.get("fee", 0.01)
+            for name, fmt, max_items in _METRICS_BUCKETS:
+                key = ts.strftime(fmt) if fmt else f"Week {ts.isocalendar()[1]}"
+                hashes = self.hashes[name]
+                fees = self.fees[name]
+                hashes[key] = hashes.get(key, 0) + 1
+                fees[key] = round(fees.get(key, 0) + fee, 4)
+                _keep_top_keys(hashes, max_items)
+                _keep_top_keys(fees, max_items)
+
+            date_key = ts.strftime("%Y-%m-%d")
+            self.by_date[date_key] = self.by_date.get(date_key, 0) + 1
+            _keep_top_keys(self.by_date, _METRICS_DAY_RETENTION)
+            month_key = date_key[:7]
+            self.by_month[month_key] = self.by_month.get(month_key, 0) + 1
+            _keep_top_keys(self.by_month, _METRICS_MONTH_RETENTION)
+
+    def snapshot(self, individual_records):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            today_count = self.by_date.get(now.strftime("%Y-%m-%d"), 0)
+            result = {
+                "total_hashes": self.total,
+                "total_fees": round(self.total * 0.01, 2),
+                "total_record_types": len(self.by_type),
+                "records_by_type": dict(sorted(self.by_type.items(), key=lambda x: -x[1])),
+                "records_by_branch": dict(self.by_branch),
+                "records_by_source": dict(self.by_source),
+                "verify_audit_log": _verify_audit_log[-50:],
+                "hashes_today": today_count,
+                "fees_today": round(today_count * 0.01, 2),
+                "this_month": self.by_month.get(now.strftime("%Y-%m"), 0),
+            }
+            for prefix, buckets in (("hashes", self.hashes), ("fees", self.fees)):
+                for name, _, _ in _METRICS_BUCKETS:
+                    result[f"{prefix}_by_{name}"] = dict(sorted(buckets[name].items()))
+        result["individual_records"] = individual_records
+        result["generated_at"] = now.isoformat()
+        return result
+
 
 def _aggregate_metrics(records):
-    now = datetime.now(timezone.utc)
-    total = len(records)
-    total_fees = total * 0.01
-    records_by_type = {}
-    records_by_branch = {}
-    records_by_source = {}
+    """One-shot /api/metrics aggregation over an arbitrary record list."""
+    agg = _MetricsAggregator()
     for r in records:
-        rt = r.get("record_label", r.get("record_type", "Unknown"))
-        records_by_type[rt] = records_by_type.get(rt, 0) + 1
-        branch = r.get("branch", "JOINT")
-        records_by_branch[branch] = records_by_branch.get(branch, 0) + 1
-        source = r.get("data_source", r.get("system", "direct"))
-        records_by_source[source] = records_by_source.get(source, 0) + 1
-
-    hashes_by_minute = {}
-    hashes_by_hour = {}
-    hashes_by_day = {}
-    hashes_by_week = {}
-    hashes_by_month = {}
-    fees_by_minute = {}
-    fees_by_hour = {}
-    fees_by_day = {}
-    fees_by_week = {}
-    fees_by_month = {}
-    today_count = 0
-    this_month_count = 0
-    today_str = now.strftime("%Y-%m-%d")
-    month_str = now.strftime("%b %Y")
+        agg.add(r)
+    return agg.snapshot(records[-100:])
 
-    for r in records:
-        try:
-            ts = datetime.fromisoformat(r["timestamp"].replace("Z", "+00:00"))
-        except (ValueError, KeyError):
-            continue
-        minute_key = ts.strftime("%H:%M")
-        hour_key = ts.strftime("%b %d %H:00")
-        day_key = ts.strftime("%b %d")
-        week_key = f"Week {ts.isocalendar()[1]}"
-        month_key = ts.strftime("%b %Y")
-
-        hashes_by_minute[minute_key] = hashes_by_minute.get(minute_key, 0) + 1
-        hashes_by_hour[hour_key] = hashes_by_hour.get(hour_key, 0) + 1
-        hashes_by_day[day_key] = hashes_by_day.get(day_key, 0) + 1
-        hashes_by_week[week_key] = hashes_by_week.get(week_key, 0) + 1
-        hashes_by_month[month_key] = hashes_by_month.get(month_key, 0) + 1
-
-        fee = r.get("fee", 0.01)
-        fees_by_minute[minute_key] = round(fees_by_minute.get(minute_key, 0) + fee, 4)
-        fees_by_hour[hour_key] = round(fees_by_hour.get(hour_key, 0) + fee, 4)
-        fees_by_day[day_key] = round(fees_by_day.get(day_key, 0) + fee, 4)
-        fees_by_week[week_key] = round(fees_by_week.get(week_key, 0) + fee, 4)
-        fees_by_month[month_key] = round(fees_by_month.get(month_key, 0) + fee, 4)
-
-        if ts.strftime("%Y-%m-%d") == today_str:
-            today_count += 1
-        if ts.strftime("%b %Y") == month_str:
-            this_month_count += 1
-
-    def sort_dict(d, max_items=30):
-        items = sorted(d.items())
-        return dict(items[-max_items:]) if len(items) > max_items else dict(items)
+_live_records = _RecordStore()
 
-    return {
-        "total_hashes": total,
-        "total_fees": round(total_fees, 2),
-        "total_record_types": len(records_by_type),
-        "records_by_type": dict(sorted(records_by_type.items(), key=lambda x: -x[1])),
-        "records_by_branch": records_by_branch,
-        "records_by_source": records_by_source,
-        "verify_audit_log": _verify_audit_log[-50:],
-        "hashes_today": today_count,
-        "fees_today": round(today_count * 0.01, 2),
-        "this_month": this_month_count,
-        "hashes_by_minute": sort_dict(hashes_by_minute, 60),
-        "hashes_by_hour": sort_dict(hashes_by_hour, 48),
-        "hashes_by_day": sort_dict(hashes_by_day, 30),
-        "hashes_by_week": sort_dict(hashes_by_week, 12),
-        "hashes_by_month": sort_dict(hashes_by_month, 12),
-        "fees_by_minute": sort_dict(fees_by_minute, 60),
-        "fees_by_hour": sort_dict(fees_by_hour, 48),
-        "fees_by_day": sort_dict(fees_by_day, 30),
-        "fees_by_week": sort_dict(fees_by_week, 12),
-        "fees_by_month": sort_dict(fees_by_month, 12),
-        "individual_records": records[-100:],
-        "generated_at": now.isoformat(),
-    }
+def _get_all_records():
+    """Return only real persisted records."""
+    return list(_live_records)
 
 # ═══════════════════════════════════════════════════════════════════════
 #  XRPL ANCHOR ENGINE — Mainnet
 # ═══════════════════════════════════════════════════════════════════════
 
 XRPL_NETWORK = "mainnet"
-XRPL_URL = "https://xrplcluster.com"
+XRPL_URL = "https://xrplcluster.com"   # primary node; calls fail over across _xrpl_nodes
 XRPL_EXPLORER = "https://livenet.xrpl.org/transactions/"
 SLS_TREASURY_ADDRESS = "rMLmkrxpadq5z6oTDmq8GhQj9LKjf1KLqJ"
 SLS_ISSUER_ADDRESS = "r95GyZac4butvVcsTWUPpxzekmyzaHsTA5"  # SLS token issuer
 SLS_ANCHOR_FEE = "0.01"  # SLS fee per anchor (0.01 SLS = $0.01)
-_xrpl_client = None
+_xrpl_client = None       # Client for the primary node; set once XRPL is initialised
 _xrpl_wallet = None       # Issuer wallet — signs anchor transactions
 _xrpl_treasury_wallet = None  # Treasury wallet — holds XRP + SLS, funds users, collects anchor fees
 _xrpl_demo_wallet = None  # Demo/Ops wallet — used for demo anchor fee deduction until Stripe is live
@@ -1021,7 +1692,7 @@ def _init_xrpl():
     if not XRPL_AVAILABLE or _xrpl_client is not None:
         return
     try:
-        _xrpl_client = JsonRpcClient(XRPL_URL)
+        _xrpl_client = _xrpl_client_for(_xrpl_nodes.get_healthy_url() or XRPL_URL)
         # Issuer wallet — signs anchor AccountSet transactions (XRPL_WALLET_SEED)
         seed = (os.environ.get("XRPL_WALLET_SEED") or "").strip()
         if seed:
@@ -1066,6 +1737,301 @@ def _init_xrpl():
         _xrpl_client = None
         _xrpl_wallet = None
 
+
+# ── Node failover ─────────────────────────────────────────────────────
+# Every XRPL request and submission goes through _xrpl_call, which tries
+# nodes in the order _xrpl_nodes ranks them (healthy by priority, then
+# those backing off) and reports each attempt's outcome and latency back.
+# Only node faults fail over — transport errors, non-JSON replies, busy
+# or out-of-sync servers. A request the node answered with an error
+# (e.g. actNotFound) is raised to the caller as before.
+# S4_XRPL_NODES="https://a,https://b" replaces the default node list.
+
+_XRPL_NODE_BUSY = frozenset({"tooBusy", "noNetwork", "noCurrent", "noClosed", "slowDown", "amendmentBlocked"})
+
+
+def _xrpl_node_config():
+    urls = [u.strip() for u in os.environ.get("S4_XRPL_NODES", "").split(",") if u.strip()]
+    if not urls:
+        return None
+    return [{"id": f"node-{i + 1}", "url": url, "priority": i + 1} for i, url in enumerate(urls)]
+
+
+_xrpl_nodes = XRPLHealthMonitor(network=XRPL_NETWORK, nodes=_xrpl_node_config())
+_xrpl_clients = {}   # url -> JsonRpcClient
+_xrpl_clients_lock = threading.Lock()
+
+
+def _xrpl_client_for(url):
+    with _xrpl_clients_lock:
+        client = _xrpl_clients.get(url)
+        if client is None:
+            client = _xrpl_clients[url] = JsonRpcClient(url)
+        return client
+
+
+def _xrpl_node_error(exc):
+    """True when exc means the node, not the request, is at fault."""
+    if XRPL_AVAILABLE and isinstance(exc, XRPLRequestFailureException):
+        return isinstance(exc.error, int) or exc.error in _XRPL_NODE_BUSY   # int: HTTP status of a non-JSON reply
+    return isinstance(exc, OSError) or (XRPL_AVAILABLE and isinstance(exc, httpx.HTTPError))
+
+
+def _xrpl_call(fn):
+    """Return fn(client) from the first XRPL node that answers. Raises
+    the last node fault if every node fails."""
+    error = None
+    for node_id, url in _xrpl_nodes.candidates():
+        t0 = time.monotonic()
+        try:
+            result = fn(_xrpl_client_for(url))
+        except Exception as e:
+            elapsed = time.monotonic() - t0
+            if not _xrpl_node_error(e):
+                _xrpl_nodes.report_success(node_id, latency_s=elapsed)   # the node answered
+                raise
+            _xrpl_nodes.report_failure(node_id, latency_s=elapsed)
+            metrics.record_xrpl_health(node_id, _xrpl_nodes.validators[node_id].healthy)
+            logger.warning("XRPL node %s failed after %.2fs: %s", node_id, elapsed, f"{type(e).__name__}: {e}"[:200])
+            error = e
+            continue
+        _xrpl_nodes.report_success(node_id, latency_s=time.monotonic() - t0)
+        metrics.record_xrpl_health(node_id, True)
+        return result
+    raise error or RuntimeError("no XRPL nodes configured")
+
+
+def _xrpl_request(request):
+    """client.request(request) with node failover."""
+    def send(client):
+        resp = client.request(request)
+        if not resp.is_successful() and resp.result.get("error") in _XRPL_NODE_BUSY:
+            raise XRPLRequestFailureException(resp.result)
+        return resp
+    return _xrpl_call(send)
+
+
+def _xrpl_submit(tx, wallet, on_signed=None):
+    """submit_and_wait with node failover. The transaction is autofilled
+    and signed once, so a retry on another node resubmits the same blob
+    (same hash) and cannot apply twice. on_signed(tx_hash, last_ledger),
+    if given, runs before the first submission."""
+    signed = _xrpl_call(lambda client: autofill_and_sign(tx, client, wallet))
+    if on_signed:
+        on_signed(signed.get_hash(), signed.last_ledger_sequence)
+    return _xrpl_call(lambda client: submit_and_wait(signed, client))
+
+# ═══════════════════════════════════════════════════════════════════════
+#  XRPL SUBMISSION PIPELINE
+#  submit_and_wait fetches the account Sequence, submits and then polls
+#  until validation, so concurrent anchors from the issuer wallet either
+#  queue behind each other or collide on the same Sequence. The pipeline
+#  hands out the issuer's Sequence locally, signs each AccountSet with an
+#  explicit Fee and LastLedgerSequence and submits it straight away; one
+#  poller thread confirms every in-flight hash against the validated
+#  ledger and resolves the caller's Future. A transaction that fails
+#  without consuming its Sequence (tel/tem/tef, tefPAST_SEQ, or expiry
+#  past its LastLedgerSequence) triggers a resync from account_info and,
+#  because it can no longer apply, is re-signed with a fresh Sequence up
+#  to S4_XRPL_PIPELINE_RETRIES times. S4_XRPL_PIPELINE=0 falls back to
+#  _xrpl_submit.
+# ═══════════════════════════════════════════════════════════════════════
+
+XRPL_PIPELINE_ENABLED = os.environ.get("S4_XRPL_PIPELINE", "1").lower() in ("1", "true", "yes")
+XRPL_PIPELINE_LEDGER_OFFSET = int(os.environ.get("S4_XRPL_PIPELINE_LEDGER_OFFSET", "20"))
+XRPL_PIPELINE_POLL_MS = int(os.environ.get("S4_XRPL_PIPELINE_POLL_MS", "1000"))
+XRPL_PIPELINE_RETRIES = int(os.environ.get("S4_XRPL_PIPELINE_RETRIES", "2"))
+# Below the function's 30 s maxDuration (vercel.json), so it can fire
+XRPL_PIPELINE_TIMEOUT_S = float(os.environ.get("S4_XRPL_PIPELINE_TIMEOUT_S", "20"))
+XRPL_MAX_FEE_DROPS = int(os.environ.get("S4_XRPL_MAX_FEE_DROPS", "2000"))
+_XRPL_FEE_TTL_S = 30.0
+_XRPL_LEDGER_TTL_S = 4.0
+
+# Submit results after which the transaction may still make it into a
+# validated ledger; the poller decides. Anything else outside tes/tec
+# means the Sequence was not consumed.
+_XRPL_IN_FLIGHT_RESULTS = frozenset({"terQUEUED", "terPRE_SEQ"})
+
+
+class _XRPLSubmissionPipeline:
+    """Pipelined sign-and-submit for one or more local wallets.
+
+    submit(tx, wallet) returns a Future that resolves to the validated tx
+    Response (what submit_and_wait returns) or raises the error that
+    ended the transaction.
+    """
+
+    def __init__(self, ledger_offset=XRPL_PIPELINE_LEDGER_OFFSET, poll_ms=XRPL_PIPELINE_POLL_MS,
+                 retries=XRPL_PIPELINE_RETRIES, max_fee_drops=XRPL_MAX_FEE_DROPS):
+        self.ledger_offset = ledger_offset
+        self.poll_interval = poll_ms / 1000.0
+        self.retries = retries
+        self.max_fee_drops = max_fee_drops
+        self._next_seq = {}        # address -> next Sequence to hand out
+        self._seq_lock = threading.Lock()
+        self._pending = {}         # tx hash -> entry
+        self._cond = threading.Condition()
+        self._thread = None
+        self._validated = (None, 0.0)   # (ledger_index, monotonic time fetched)
+        self._fee = (None, 0.0)
+        self._stats = {"submitted": 0, "validated": 0, "failed": 0, "resubmitted": 0, "sequence_syncs": 0}
+
+    def submit(self, tx, wallet, on_signed=None):
+        """Sign and submit tx without waiting for the ledger to close.
+        on_signed(tx_hash, last_ledger), if given, runs before each
+        (re)submission so callers can checkpoint the hash."""
+        entry = {"tx": tx, "wallet": wallet, "future": Future(), "attempt": 0, "on_signed": on_signed}
+        self._send(entry)
+        return entry["future"]
+
+    def _send(self, entry):
+        try:
+            last_ledger = self._validated_ledger() + self.ledger_offset
+            fee = self._fee_drops()
+            address = entry["wallet"].address
+            with self._seq_lock:
+                sequence = self._next_seq.get(address)
+                if sequence is None:
+                    sequence = self._account_sequence(address)
+                signed = sign(type(entry["tx"]).from_dict({
+                    **entry["tx"].to_dict(), "sequence": sequence, "fee": str(fee),
+                    "last_ledger_sequence": last_ledger,
+                }), entry["wallet"])
+                self._next_seq[address] = sequence + 1
+            entry.update(hash=signed.get_hash(), sequence=sequence, last_ledger=last_ledger)
+            if entry["on_signed"]:
+                entry["on_signed"](entry["hash"], last_ledger)
+            resp = _xrpl_request(SubmitOnly(tx_blob=signed.blob()))
+        except Exception as e:
+            self._resync(entry["wallet"].address)
+            self._fail(entry, e)
+            return
+        with self._cond:
+            self._stats["submitted"] += 1
+        engine = resp.result.get("engine_result", "")
+        if not resp.is_successful():
+            self._resync(address)
+            self._fail(entry, XRPLRequestFailureException(resp.result))
+        elif engine.startswith(("tes", "tec")) or engine in _XRPL_IN_FLIGHT_RESULTS:
+            self._track(entry)
+        elif engine == "tefPAST_SEQ" and self._known(entry["hash"]):
+            self._track(entry)     # a failover resubmission of a blob that already applied
+        else:
+            self._resync(address)
+            self._retry(entry, f"{engine}: {resp.result.get('engine_result_message', '')}")
+
+    def _track(self, entry):
+        with self._cond:
+            self._pending[entry["hash"]] = entry
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll, name="s4-xrpl-poller", daemon=True)
+                self._thread.start()
+
+    def _poll(self):
+        while True:
+            with self._cond:
+                if not self._pending:
+                    self._thread = None
+                    return
+                entries = list(self._pending.values())
+            try:
+                validated = self._validated_ledger(refresh=True)
+            except Exception as e:
+                logger.warning("XRPL pipeline poll failed: %s", f"{type(e).__name__}: {e}"[:200])
+                time.sleep(self.poll_interval)
+                continue
+            for entry in entries:
+                try:
+                    resp = _xrpl_request(Tx(transaction=entry["hash"]))
+                except Exception:
+                    continue
+                if resp.is_successful() and resp.result.get("validated"):
+                    self._settle(entry, resp)
+                elif validated > entry["last_ledger"]:
+                    with self._cond:
+                        self._pending.pop(entry["hash"], None)
+                    self._resync(entry["wallet"].address)
+                    self._retry(entry, f"not validated by LastLedgerSequence {entry['last_ledger']}")
+            time.sleep(self.poll_interval)
+
+    def _settle(self, entry, resp):
+        result = resp.result.get("meta", {}).get("TransactionResult", "")
+        with self._cond:
+            self._pending.pop(entry["hash"], None)
+        if result == "tesSUCCESS":
+            with self._cond:
+                self._stats["validated"] += 1
+            entry["future"].set_result(resp)
+        else:
+            self._fail(entry, XRPLReliableSubmissionException(f"Transaction failed: {result}"))
+
+    def _retry(self, entry, reason):
+        if entry["attempt"] >= self.retries:
+            self._fail(entry, XRPLReliableSubmissionException(reason))
+            return
+        entry["attempt"] += 1
+        with self._cond:
+            self._stats["resubmitted"] += 1
+        logger.info("XRPL pipeline re-signing %s (attempt %d): %s", entry["hash"], entry["attempt"], reason)
+        self._send(entry)
+
+    def _fail(self, entry, error):
+        with self._cond:
+            self._stats["failed"] += 1
+        entry["future"].set_exception(error)
+
+    def _resync(self, address):
+        """Forget the local Sequence; the next submission re-reads it."""
+        with self._seq_lock:
+            self._next_seq.pop(address, None)
+
+    def _account_sequence(self, address):
+        resp = _xrpl_request(AccountInfo(account=address, ledger_index="current"))
+        if not resp.is_successful():
+            raise XRPLRequestFailureException(resp.result)
+        with self._cond:
+            self._stats["sequence_syncs"] += 1
+        return resp.result["account_data"]["Sequence"]
+
+    def _known(self, tx_hash):
+        try:
+            return _xrpl_request(Tx(transaction=tx_hash)).is_successful()
+        except Exception:
+            return False
+
+    def _validated_ledger(self, refresh=False):
+        index, fetched = self._validated
+        if refresh or index is None or time.monotonic() - fetched > _XRPL_LEDGER_TTL_S:
+            resp = _xrpl_request(Ledger(ledger_index="validated"))
+            if not resp.is_successful():
+                raise XRPLRequestFailureException(resp.result)
+            index = resp.result["ledger_index"]
+            self._validated = (index, time.monotonic())
+        return index
+
+    def _fee_drops(self):
+        drops, fetched = self._fee
+        if drops is None or time.monotonic() - fetched > _XRPL_FEE_TTL_S:
+            resp = _xrpl_request(Fee())
+            if not resp.is_successful():
+                raise XRPLRequestFailureException(resp.result)
+            fees = resp.result["drops"]
+            drops = min(max(int(fees["open_ledger_fee"]), int(fees["base_fee"])), self.max_fee_drops)
+            self._fee = (drops, time.monotonic())
+        return drops
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._pending)
+            stats["poller_running"] = self._thread is not None
+        stats["enabled"] = XRPL_PIPELINE_ENABLED
+        stats["validated_ledger"] = self._validated[0]
+        return stats
+
+
+_xrpl_pipeline = _XRPLSubmissionPipeline()
+
 # ═══════════════════════════════════════════════════════════════════════
 #  WALLET PROVISIONING & SLS ECONOMY
 #
@@ -1166,6 +2132,7 @@ def _store_wallet(email, address, seed, plan):
         "plan": plan,
         "created": datetime.now(timezone.utc).isoformat(),
     }
+    _wallet_cache.invalidate(email=email)
     # In-memory cache stores plaintext seed for this session
     _wallet_store[email] = {"email": email, "address": address, "seed": seed, "plan": plan, "created": record["created"]}
     # Persist encrypted seed to Supabase
@@ -1176,13 +2143,13 @@ def _get_wallet_seed(email=None, address=None):
     """Retrieve a user's wallet seed for custodial signing.
     Looks up by email or wallet address. Checks in-memory cache first,
     then Supabase if available. Decrypts encrypted seeds automatically."""
-    # Check in-memory cache (stores plaintext)
-    if email and email in _wallet_store:
-        return _wallet_store[email].get("seed")
+    # Check in-memory store (plaintext seeds of wallets provisioned by this instance)
+    if email and _wallet_store.get(email, {}).get("seed"):
+        return _wallet_store[email]["seed"]
     if address:
         for rec in _wallet_store.values():
-            if rec.get("address") == address:
-                return rec.get("seed")
+            if rec.get("address") == address and rec.get("seed"):
+                return rec["seed"]
     # Query Supabase
     if email:
         rows = _sb_select("wallets", query_params=f"email=eq.{email}", select="seed,email,address,plan")
@@ -1193,16 +2160,120 @@ def _get_wallet_seed(email=None, address=None):
     if rows:
         row = rows[0]
         plaintext_seed = _decrypt_seed(row.get("seed", ""))
-        # Cache for future lookups
-        _wallet_store[row["email"]] = {
+        # Cache metadata for future lookups; the key itself is only kept,
+        # derived and TTL-bounded, in _wallet_cache
+        _wallet_store.setdefault(row["email"], {}).update({
             "email": row["email"],
             "address": row.get("address", ""),
-            "seed": plaintext_seed,
             "plan": row.get("plan", ""),
-        }
+        })
         return plaintext_seed
     return None
 
+# ── Custodial wallet cache ──────────────────────────────────────────
+# Signing for a user means a Supabase select, a Fernet decrypt and a
+# secp256k1 key derivation (Wallet.from_seed). Derived Wallet objects are
+# kept here for S4_WALLET_CACHE_TTL_S, at most S4_WALLET_CACHE_MAX of them
+# (least recently used evicted first). Callers get a shallow copy, so an
+# eviction can clear the cached object's key fields without pulling them
+# from under a signing thread. Python strings cannot be wiped in place;
+# clearing drops the last reference the cache holds. Re-provisioning a
+# user invalidates their entry.
+
+WALLET_CACHE_TTL_S = float(os.environ.get("S4_WALLET_CACHE_TTL_S", "300"))
+WALLET_CACHE_MAX = int(os.environ.get("S4_WALLET_CACHE_MAX", "1024"))
+
+
+class _WalletCache:
+    def __init__(self, ttl=WALLET_CACHE_TTL_S, max_entries=WALLET_CACHE_MAX):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()   # email -> (expires_at, wallet)
+        self._by_address = {}           # address -> email
+        self._lock = threading.Lock()
+        self._counts = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, email=None, address=None):
+        now = time.monotonic()
+        with self._lock:
+            if email is None:
+                email = self._by_address.get(address)
+            entry = self._entries.get(email)
+            if entry and entry[0] <= now:
+                self._drop(email)
+                self._counts["evictions"] += 1
+                entry = None
+            if entry is None:
+                self._counts["misses"] += 1
+                return None
+            self._entries.move_to_end(email)
+            self._counts["hits"] += 1
+            return copy.copy(entry[1])
+
+    def put(self, email, wallet):
+        with self._lock:
+            if email in self._entries:
+                self._drop(email)
+            self._entries[email] = (time.monotonic() + self.ttl, copy.copy(wallet))
+            self._by_address[wallet.address] = email
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self._counts["evictions"] += 1
+
+    def invalidate(self, email=None, address=None):
+        with self._lock:
+            if email is None:
+                email = self._by_address.get(address)
+            if email in self._entries:
+                self._drop(email)
+                self._counts["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            for email in list(self._entries):
+                self._drop(email)
+
+    def _drop(self, email):
+        # caller holds self._lock
+        _, wallet = self._entries.pop(email)
+        self._by_address.pop(wallet.address, None)
+        for attr in ("seed", "private_key"):
+            setattr(wallet, attr, None)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["ttl_s"] = self.ttl
+        stats["max_entries"] = self.max_entries
+        return stats
+
+
+_wallet_cache = _WalletCache()
+
+
+def _get_custodial_wallet(email=None, address=None):
+    """The user's custodial Wallet, ready to sign, or None if they have no
+    wallet (or its seed cannot be decrypted). Goes through _wallet_cache."""
+    wallet = _wallet_cache.get(email=email, address=address)
+    if wallet is not None:
+        return wallet
+    seed = _get_wallet_seed(email=email, address=address)
+    if not seed:
+        return None
+    try:
+        wallet = Wallet.from_seed(seed, algorithm=CryptoAlgorithm.SECP256K1)
+    except Exception as e:
+        print(f"Custodial wallet derivation failed: {e}")
+        return None
+    if email is None:
+        email = next((e for e, rec in _wallet_store.items() if rec.get("address") == wallet.address), None)
+    if email:
+        _wallet_cache.put(email, wallet)
+    return wallet
+
 def _provision_wallet(email, plan="starter"):
     """Create a new XRPL wallet for a subscriber.
     Treasury funds the wallet with XRP (activation reserve, business expense),
@@ -1233,7 +2304,7 @@ def _provision_wallet(email, plan="starter"):
             destination=new_wallet.address,
             amount=str(int(float(XRP_ACCOUNT_RESERVE) * 1_000_000))  # drops
         )
-        fund_resp = submit_and_wait(fund_tx, _xrpl_client, _xrpl_treasury_wallet)
+        fund_resp = _xrpl_submit(fund_tx, _xrpl_treasury_wallet)
         if not fund_resp.is_successful():
             return {"error": "Failed to fund new wallet", "detail": fund_resp.result.get("engine_result_message", "unknown")}
 
@@ -1246,7 +2317,7 @@ def _provision_wallet(email, plan="starter"):
                 value="1000000"  # 1M SLS trust limit
             )
         )
-        trust_resp = submit_and_wait(trust_tx, _xrpl_client, new_wallet)
+        trust_resp = _xrpl_submit(trust_tx, new_wallet)
         if not trust_resp.is_successful():
             return {"error": "Failed to set TrustLine", "detail": trust_resp.result.get("engine_result_message", "unknown")}
 
@@ -1264,7 +2335,7 @@ def _provision_wallet(email, plan="starter"):
                 ),
                 memos=[Memo(
                     memo_type=bytes("s4/subscription", "utf-8").hex(),
-                    memo_data=bytes(json.dumps({
+                    memo_data=bytes(s4_codec.dumps({
                         "type": "subscription_sls_delivery",
                         "plan": plan,
                         "amount": sls_amount,
@@ -1272,7 +2343,7 @@ def _provision_wallet(email, plan="starter"):
                     }), "utf-8").hex()
                 )]
             )
-            sls_resp = submit_and_wait(sls_payment, _xrpl_client, _xrpl_treasury_wallet)
+            sls_resp = _xrpl_submit(sls_payment, _xrpl_treasury_wallet)
             if sls_resp.is_successful():
                 sls_tx_hash = sls_resp.result.get("hash", "")
             else:
@@ -1332,12 +2403,10 @@ def _deliver_monthly_sls(email, plan=None):
         return {"error": "XRPL Treasury not available"}
 
     # Look up user's wallet
-    wallet_seed = _get_wallet_seed(email=email)
-    if not wallet_seed:
+    user_wallet = _get_custodial_wallet(email=email)
+    if not user_wallet:
         return {"error": f"No wallet found for {email}"}
 
-    user_wallet = Wallet.from_seed(wallet_seed, algorithm=CryptoAlgorithm.SECP256K1)
-
     # Determine plan from cache or parameter
     cached = _wallet_store.get(email, {})
     plan = plan or cached.get("plan", "starter")
@@ -1361,7 +2430,7 @@ def _deliver_monthly_sls(email, plan=None):
             ),
             memos=[Memo(
                 memo_type=bytes("s4/renewal", "utf-8").hex(),
-                memo_data=bytes(json.dumps({
+                memo_data=bytes(s4_codec.dumps({
                     "type": "monthly_sls_renewal",
                     "plan": plan,
                     "amount": sls_amount,
@@ -1370,7 +2439,7 @@ def _deliver_monthly_sls(email, plan=None):
                 }), "utf-8").hex()
             )]
         )
-        resp = submit_and_wait(payment, _xrpl_client, _xrpl_treasury_wallet)
+        resp = _xrpl_submit(payment, _xrpl_treasury_wallet)
         if resp.is_successful():
             explorer_base = XRPL_EXPLORER
             return {
@@ -1387,11 +2456,391 @@ def _deliver_monthly_sls(email, plan=None):
         print(f"Monthly SLS delivery failed: {e}")
         return {"error": "Monthly SLS delivery failed. Please try again."}
 
-def _deduct_anchor_fee(user_email=None, user_address=None):
-    """Deduct 0.01 SLS anchor fee from the user's wallet → Treasury.
+# ═══════════════════════════════════════════════════════════════════════
+#  SLS DELIVERY JOBS
+#  Month-rollover renewals and bulk provisioning for many subscribers at
+#  once, instead of one _deliver_monthly_sls / _provision_wallet per
+#  Stripe event. A job runs stage by stage over all its subscribers:
+#    provision: create wallet -> XRP activation -> TrustSet -> SLS allocation
+#    renewal:   SLS allocation
+#  Treasury payments go through _xrpl_pipeline back-to-back (local
+#  Sequence, at most S4_SLS_JOB_WINDOW in flight); each subscriber's
+#  TrustSet is signed by their own wallet, so those run concurrently too.
+#  Every item is checkpointed to Supabase (migration 023) as it advances,
+#  including the hash of a transaction before it is submitted. Restarting
+#  a job with the same job_id (renewals default to one per period)
+#  resumes it: finished items are skipped, failed ones retried, and a
+#  transaction signed before the restart — or whose submission failed
+#  without a final outcome — is looked up first so nothing is paid twice.
+#  No transaction is submitted unless its hash was checkpointed. The running instance holds the job row as its owner
+#  and renews heartbeat_at every S4_SLS_JOB_LEASE_S / 3 (migration 026);
+#  a "running" job whose heartbeat is older than the lease belongs to a
+#  frozen or recycled instance and is taken over by the next POST.
+# ═══════════════════════════════════════════════════════════════════════
+
+SLS_JOB_WINDOW = int(os.environ.get("S4_SLS_JOB_WINDOW", "50"))
+SLS_JOB_LEASE_S = float(os.environ.get("S4_SLS_JOB_LEASE_S", "90"))
+SLS_JOB_MAX_SUBSCRIBERS = 50_000
+_SLS_JOB_FAILURES_SHOWN = 50
+_SLS_JOB_OWNER = uuid.uuid4().hex[:12]   # this instance, as recorded on the jobs it runs
+_sls_jobs = {}            # job_id -> job dict
+_sls_job_threads = {}     # job_id -> thread running it on this instance
+_sls_jobs_lock = threading.Lock()
+_sls_job_claim_lock = threading.Lock()
+
+_SLS_ITEM_FIELDS = ("job_id", "email", "plan", "address", "state", "amount", "fund_tx", "trust_tx", "sls_tx",
+                    "stage_tx", "last_ledger", "error", "updated_at")
+
+
+def _sls_item_row(item):
+    return {k: item.get(k) for k in _SLS_ITEM_FIELDS}
+
+
+def _sls_job_row(job):
+    return {k: job.get(k) for k in ("job_id", "kind", "period", "status", "total", "created_at", "started_at",
+                                    "completed_at", "owner", "heartbeat_at")}
+
+
+def _checkpoint_sls_item(item, required=False, **changes):
+    """Persist an item's progress. required: the hash of a transaction
+    about to be submitted — raise rather than submit if the write fails."""
+    previous = {k: item.get(k) for k in changes}
+    item.update(changes, updated_at=datetime.now(timezone.utc).isoformat())
+    written = _supabase_request("sls_delivery_items", method="POST", data=_sls_item_row(item),
+                                query_params="on_conflict=job_id,email",
+                                prefer="return=minimal,resolution=merge-duplicates")
+    if written is None and required and SUPABASE_URL and SUPABASE_SERVICE_KEY:
+        item.update(previous)
+        raise RuntimeError("could not record stage tx before submitting")
+
+
+def _sls_job_subscribers():
+    """Every stored custodial wallet, for a renewal run."""
+    rows = _sb_select("wallets", select="email,address,plan", order="email.asc", limit=SLS_JOB_MAX_SUBSCRIBERS)
+    if not rows:
+        rows = [{"email": e, "address": rec.get("address"), "plan": rec.get("plan")}
+                for e, rec in _wallet_store.items() if rec.get("address")]
+    return rows
+
+
+def _create_sls_job(kind, subscribers=None, period=None, job_id=None):
+    """Create (or load, to resume) an SLS delivery job. Returns the job dict."""
+    period = period or datetime.now(timezone.utc).strftime("%Y-%m")
+    job_id = job_id or (f"SLS-RENEWAL-{period}" if kind == "renewal" else "SLS-PROVISION-" + uuid.uuid4().hex[:12].upper())
+    with _sls_jobs_lock:
+        job = _sls_jobs.get(job_id)
+    if job is None:
+        job = _load_sls_job(job_id)
+    if job is not None:
+        return job
+    if subscribers is None:
+        subscribers = _sls_job_subscribers() if kind == "renewal" else []
+    items, seen = [], set()
+    for sub in subscribers:
+        sub = {"email": sub} if isinstance(sub, str) else sub
+        email = (sub.get("email") or "").strip()
+        if not email or email in seen:
+            continue
+        seen.add(email)
+        items.append({"job_id": job_id, "email": email, "plan": sub.get("plan") or "starter",
+                      "address": sub.get("address"), "state": "pending", "error": None})
+    job = {
+        "job_id": job_id, "kind": kind, "period": period, "status": "queued", "total": len(items),
+        "items": items, "created_at": datetime.now(timezone.utc).isoformat(), "started_at": None,
+        "completed_at": None,
+    }
+    _sb_upsert("sls_delivery_jobs", _sls_job_row(job))
+    _sb_bulk_upsert("sls_delivery_items", [_sls_item_row(i) for i in items], on_conflict="job_id,email")
+    with _sls_jobs_lock:
+        return _sls_jobs.setdefault(job_id, job)
+
+
+def _load_sls_items(job_id):
+    return _sb_select("sls_delivery_items", query_params=f"job_id=eq.{job_id}", order="email.asc",
+                      limit=SLS_JOB_MAX_SUBSCRIBERS)
+
+
+def _load_sls_job(job_id):
+    rows = _sb_select("sls_delivery_jobs", query_params=f"job_id=eq.{job_id}", limit=1)
+    if not rows:
+        return None
+    job = {**rows[0], "items": _load_sls_items(job_id)}
+    with _sls_jobs_lock:
+        return _sls_jobs.setdefault(job_id, job)
+
+
+def _reconcile_sls_tx(tx_hash, last_ledger):
+    """Outcome of a transaction signed before a restart: (True, hash) once
+    validated with tesSUCCESS, (False, error) once it can no longer apply
+    (failed, or expired past last_ledger)."""
+    deadline = time.monotonic() + XRPL_PIPELINE_TIMEOUT_S
+    while True:
+        resp = _xrpl_request(Tx(transaction=tx_hash))
+        if resp.is_successful() and resp.result.get("validated"):
+            result = resp.result.get("meta", {}).get("TransactionResult", "")
+            return (True, tx_hash) if result == "tesSUCCESS" else (False, result)
+        ledger = _xrpl_request(Ledger(ledger_index="validated"))
+        if ledger.is_successful() and ledger.result["ledger_index"] > (last_ledger or 0):
+            return False, "expired"
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{tx_hash} neither validated nor expired")
+        time.sleep(1.0)
+
+
+def _sls_submit(tx, wallet, item):
+    """Pipelined submission with the hash checkpointed before it is sent.
+    With the pipeline off, falls back to a synchronous _xrpl_submit."""
+    def checkpoint(tx_hash, last_ledger):
+        _checkpoint_sls_item(item, required=True, stage_tx=tx_hash, last_ledger=last_ledger)
+
+    if XRPL_PIPELINE_ENABLED:
+        return _xrpl_pipeline.submit(tx, wallet, on_signed=checkpoint)
+    future = Future()
+    try:
+        future.set_result(_xrpl_submit(tx, wallet, on_signed=checkpoint))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _sls_allocation(item):
+    return str(SUBSCRIPTION_TIERS.get(item["plan"], SUBSCRIPTION_TIERS["starter"])["sls_monthly"])
+
+
+def _sls_build_create(job, item):
+    if not STRIPE_SECRET_KEY:
+        raise RuntimeError("Wallet provisioning blocked — Stripe not configured")
+    wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+    # the seed is stored before the wallet is funded, so a restart resumes with it
+    _store_wallet(item["email"], wallet.address, wallet.seed, item["plan"])
+    item["address"] = wallet.address
+    return None
+
+
+def _sls_build_fund(job, item):
+    return Payment(account=_xrpl_treasury_wallet.address, destination=item["address"],
+                   amount=str(int(float(XRP_ACCOUNT_RESERVE) * 1_000_000))), _xrpl_treasury_wallet
+
+
+def _sls_build_trust(job, item):
+    from xrpl.models.transactions import TrustSet
+    wallet = _get_custodial_wallet(email=item["email"])
+    if wallet is None:
+        raise RuntimeError(f"No wallet found for {item['email']}")
+    return TrustSet(account=wallet.address, limit_amount=IssuedCurrencyAmount(
+        currency="SLS", issuer=SLS_ISSUER_ADDRESS, value="1000000")), wallet
+
+
+def _sls_build_allocation(job, item):
+    amount = _sls_allocation(item)
+    item["amount"] = amount
+    if int(amount) <= 0:
+        return None       # pilot plan — nothing to send
+    item["address"] = item.get("address") or _wallet_store.get(item["email"], {}).get("address")
+    if not item.get("address"):
+        raise RuntimeError(f"No wallet found for {item['email']}")
+    memo = {"type": "monthly_sls_renewal", "period": job["period"]} if job["kind"] == "renewal" \
+        else {"type": "subscription_sls_delivery"}
+    memo.update(plan=item["plan"], amount=amount, email=item["email"])
+    return Payment(
+        account=_xrpl_treasury_wallet.address, destination=item["address"],
+        amount=IssuedCurrencyAmount(currency="SLS", issuer=SLS_ISSUER_ADDRESS, value=amount),
+        memos=[Memo(memo_type=bytes("s4/renewal" if job["kind"] == "renewal" else "s4/subscription", "utf-8").hex(),
+                    memo_data=bytes(s4_codec.dumps(memo), "utf-8").hex())],
+    ), _xrpl_treasury_wallet
+
+
+# (from_state, to_state, build, tx_field) per kind
+_SLS_JOB_STAGES = {
+    "renewal": [("pending", "delivered", _sls_build_allocation, "sls_tx")],
+    "provision": [
+        ("pending", "created", _sls_build_create, None),
+        ("created", "funded", _sls_build_fund, "fund_tx"),
+        ("funded", "trusted", _sls_build_trust, "trust_tx"),
+        ("trusted", "delivered", _sls_build_allocation, "sls_tx"),
+    ],
+}
+
+
+def _run_sls_stage(job, items, to_state, build, tx_field):
+    in_flight = {}        # future -> item
+
+    def finish(future):
+        item = in_flight.pop(future)
+        try:
+            resp = future.result()
+            if not resp.is_successful():
+                raise RuntimeError(resp.result.get("engine_result_message", "unknown"))
+            _checkpoint_sls_item(item, state=to_state, stage_tx=None, last_ledger=None,
+                                 **{tx_field: resp.result["hash"]})
+        except XRPLReliableSubmissionException as e:
+            # validated tec, rejected or expired past LastLedgerSequence: that hash can never apply
+            _checkpoint_sls_item(item, error=str(e)[:300], stage_tx=None, last_ledger=None)
+        except Exception as e:
+            # may have been broadcast; keep stage_tx so the resume reconciles it before paying again
+            _checkpoint_sls_item(item, error=str(e)[:300])
+
+    def drain(block):
+        done, _ = wait_futures(list(in_flight), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in done:
+            finish(future)
+
+    for item in items:
+        if job.get("lease_lost"):
+            break
+        try:
+            if item.get("stage_tx"):
+                ok, outcome = _reconcile_sls_tx(item["stage_tx"], item.get("last_ledger"))
+                if ok:
+                    _checkpoint_sls_item(item, state=to_state, stage_tx=None, last_ledger=None, **{tx_field: outcome})
+                    continue
+                _checkpoint_sls_item(item, stage_tx=None, last_ledger=None)
+            built = build(job, item)
+            if built is None:
+                _checkpoint_sls_item(item, state=to_state)
+                continue
+        except Exception as e:
+            _checkpoint_sls_item(item, error=str(e)[:300])
+            continue
+        while len(in_flight) >= SLS_JOB_WINDOW:
+            drain(block=True)
+        tx, wallet = built
+        in_flight[_sls_submit(tx, wallet, item)] = item
+        drain(block=False)
+    while in_flight:
+        drain(block=True)
+
+
+def _run_sls_job(job):
+    """Run (or resume) every stage of an SLS delivery job."""
+    for item in job["items"]:
+        item["error"] = None          # failed items are retried from their last good state
+    now = datetime.now(timezone.utc).isoformat()
+    job.update(status="running", owner=_SLS_JOB_OWNER, heartbeat_at=now, lease_lost=False, completed_at=None)
+    job["started_at"] = job.get("started_at") or now
+    _sb_upsert("sls_delivery_jobs", _sls_job_row(job))
+    stop = threading.Event()
+    threading.Thread(target=_sls_job_heartbeat, args=(job, stop), name="s4-sls-job-lease", daemon=True).start()
+    _init_xrpl()
+    try:
+        if not _xrpl_client or not _xrpl_treasury_wallet:
+            raise RuntimeError("XRPL Treasury not available")
+        for from_state, to_state, build, tx_field in _SLS_JOB_STAGES[job["kind"]]:
+            items = [i for i in job["items"] if i["state"] == from_state and not i.get("error")]
+            if items:
+                _run_sls_stage(job, items, to_state, build, tx_field)
+            if job.get("lease_lost"):
+                raise RuntimeError("lease expired and the job was taken over by another instance")
+        failed = sum(1 for i in job["items"] if i.get("error"))
+        job["status"] = "completed_with_errors" if failed else "completed"
+    except Exception as e:
+        job["status"] = "interrupted"
+        print(f"SLS delivery job {job['job_id']} interrupted: {e}")
+    finally:
+        stop.set()
+    job["completed_at"] = datetime.now(timezone.utc).isoformat()
+    if not job.get("lease_lost"):     # the new owner's row is not ours to overwrite
+        _sb_upsert("sls_delivery_jobs", _sls_job_row(job))
+    return job
+
+
+def _sls_job_heartbeat(job, stop):
+    """Renew this instance's lease on a running job until stop is set."""
+    while not stop.wait(SLS_JOB_LEASE_S / 3):
+        now = datetime.now(timezone.utc).isoformat()
+        rows = _supabase_request("sls_delivery_jobs", method="PATCH", data={"heartbeat_at": now},
+                                 query_params=f"job_id=eq.{job['job_id']}&owner=eq.{_SLS_JOB_OWNER}")
+        if rows == []:
+            job["lease_lost"] = True
+            return
+        if rows is not None:
+            job["heartbeat_at"] = now
+
+
+def _claim_sls_job(job):
+    """Become the job's owner unless it is running under a live lease —
+    here, or on an instance that renewed its heartbeat within
+    SLS_JOB_LEASE_S. Returns False if it is. Caller holds
+    _sls_job_claim_lock."""
+    with _sls_jobs_lock:
+        thread = _sls_job_threads.get(job["job_id"])
+    if thread is not None and thread.is_alive():
+        return False
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(seconds=SLS_JOB_LEASE_S)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    rows = _supabase_request(
+        "sls_delivery_jobs", method="PATCH",
+        data={"status": "running", "owner": _SLS_JOB_OWNER, "heartbeat_at": now.isoformat()},
+        query_params=f"job_id=eq.{job['job_id']}"
+                     f"&or=(status.neq.running,heartbeat_at.is.null,heartbeat_at.lt.{cutoff})")
+    if rows is None:
+        if SUPABASE_URL and SUPABASE_SERVICE_KEY:
+            return False      # could not tell whether someone else holds it
+    elif not rows:
+        return False
+    elif job.get("owner") not in (None, _SLS_JOB_OWNER):
+        # the previous owner may have advanced items since this copy was loaded
+        job["items"] = _load_sls_items(job["job_id"]) or job["items"]
+    job.update(status="running", owner=_SLS_JOB_OWNER, heartbeat_at=now.isoformat())
+    return True
+
+
+def _start_sls_job(job):
+    """Run a job on a background thread unless it is already running
+    (here, or elsewhere under a live lease). Returns False if it was."""
+    with _sls_job_claim_lock:
+        if not _claim_sls_job(job):
+            return False
+        thread = threading.Thread(target=_run_sls_job, args=(job,), name="s4-sls-job", daemon=True)
+        with _sls_jobs_lock:
+            _sls_job_threads[job["job_id"]] = thread
+        thread.start()
+    return True
+
+
+def _sls_job_view(job):
+    """Progress JSON for a job."""
+    by_state, failures = {}, []
+    for item in job["items"]:
+        by_state[item["state"]] = by_state.get(item["state"], 0) + 1
+        if item.get("error") and len(failures) < _SLS_JOB_FAILURES_SHOWN:
+            failures.append({"email": item["email"], "state": item["state"], "error": item["error"]})
+    done = by_state.get("delivered", 0)
+    view = {
+        "job_id": job["job_id"],
+        "kind": job["kind"],
+        "period": job.get("period"),
+        "status": job["status"],
+        "total": len(job["items"]),
+        "delivered": done,
+        "failed": sum(1 for i in job["items"] if i.get("error")),
+        "by_state": by_state,
+        "failures": failures,
+        "created_at": job.get("created_at"),
+        "started_at": job.get("started_at"),
+        "completed_at": job.get("completed_at"),
+        "owner": job.get("owner"),
+        "heartbeat_at": job.get("heartbeat_at"),
+    }
+    if job.get("started_at"):
+        end = datetime.fromisoformat(job["completed_at"]) if job.get("completed_at") else datetime.now(timezone.utc)
+        elapsed = (end - datetime.fromisoformat(job["started_at"])).total_seconds()
+        view["elapsed_s"] = round(elapsed, 1)
+        view["delivered_per_min"] = round(done * 60 / elapsed, 1) if elapsed > 0 else None
+    return view
+
+
+def _deduct_anchor_fee(user_email=None, user_address=None, amount=SLS_ANCHOR_FEE, anchors=1, on_signed=None):
+    """Deduct the SLS anchor fee from the user's wallet → Treasury.
     S4 signs the transaction on the user's behalf using their stored seed (custodial model).
     Looked up by email or wallet address from Supabase.
+    amount/anchors cover a fee ledger settlement of several anchors;
+    on_signed is passed to _xrpl_submit so the settlement hash is recorded
+    before the Payment is submitted.
     Returns transaction result or None."""
+    fee_memo = {"type": "anchor_fee", "amount": amount}
+    if anchors != 1:
+        fee_memo["anchors"] = anchors
     _init_xrpl()
     if not _xrpl_client:
         return None
@@ -1407,19 +2856,19 @@ def _deduct_anchor_fee(user_email=None, user_address=None):
                 amount=ICA(
                     currency="SLS",
                     issuer=SLS_ISSUER_ADDRESS,
-                    value=SLS_ANCHOR_FEE
+                    value=amount
                 ),
                 memos=[Memo(
                     memo_type=bytes("s4/anchor-fee", "utf-8").hex(),
-                    memo_data=bytes(json.dumps({"type": "anchor_fee", "amount": SLS_ANCHOR_FEE, "demo": True}), "utf-8").hex()
+                    memo_data=bytes(s4_codec.dumps({**fee_memo, "demo": True}), "utf-8").hex()
                 )]
             )
-            resp = submit_and_wait(fee_payment, _xrpl_client, _xrpl_demo_wallet)
+            resp = _xrpl_submit(fee_payment, _xrpl_demo_wallet, on_signed=on_signed)
             if resp.is_successful():
                 return {
                     "success": True,
                     "fee_tx": resp.result["hash"],
-                    "fee_amount": SLS_ANCHOR_FEE,
+                    "fee_amount": amount,
                     "from_wallet": _xrpl_demo_wallet.address,
                     "to_treasury": SLS_TREASURY_ADDRESS,
                 }
@@ -1431,34 +2880,33 @@ def _deduct_anchor_fee(user_email=None, user_address=None):
             return {"error": "Anchor fee deduction failed. Please try again."}
 
     # Look up user's wallet seed from custodial store
-    wallet_seed = _get_wallet_seed(email=user_email, address=user_address)
-    if not wallet_seed:
+    user_wallet = _get_custodial_wallet(email=user_email, address=user_address)
+    if not user_wallet:
         return None  # No wallet found — skip fee (unauthenticated user)
 
     try:
         from xrpl.models.transactions import Payment as Pay
         from xrpl.models.amounts import IssuedCurrencyAmount as ICA
 
-        user_wallet = Wallet.from_seed(wallet_seed, algorithm=CryptoAlgorithm.SECP256K1)
         fee_payment = Pay(
             account=user_wallet.address,
             destination=SLS_TREASURY_ADDRESS,
             amount=ICA(
                 currency="SLS",
                 issuer=SLS_ISSUER_ADDRESS,
-                value=SLS_ANCHOR_FEE
+                value=amount
             ),
             memos=[Memo(
                 memo_type=bytes("s4/anchor-fee", "utf-8").hex(),
-                memo_data=bytes(json.dumps({"type": "anchor_fee", "amount": SLS_ANCHOR_FEE}), "utf-8").hex()
+                memo_data=bytes(s4_codec.dumps(fee_memo), "utf-8").hex()
             )]
         )
-        resp = submit_and_wait(fee_payment, _xrpl_client, user_wallet)
+        resp = _xrpl_submit(fee_payment, user_wallet, on_signed=on_signed)
         if resp.is_successful():
             return {
                 "success": True,
                 "fee_tx": resp.result["hash"],
-                "fee_amount": SLS_ANCHOR_FEE,
+                "fee_amount": amount,
                 "from_wallet": user_wallet.address,
                 "to_treasury": SLS_TREASURY_ADDRESS,
             }
@@ -1469,18 +2917,28 @@ def _deduct_anchor_fee(user_email=None, user_address=None):
         print(f"Anchor fee deduction failed: {e}")
         return {"error": "Anchor fee deduction failed. Please try again."}
 
+
+def _fee_payer_exists(user_email):
+    """True when _deduct_anchor_fee would have a wallet to charge."""
+    if user_email == 'demo@s4ledger.com' and _xrpl_demo_wallet:
+        return True
+    return _get_custodial_wallet(email=user_email) is not None
+
 def _anchor_xrpl(hash_value, record_type="", branch="", user_email=None):
     """Submit a real anchor transaction to XRPL (AccountSet memo only).
     The Issuer wallet signs the AccountSet memo — this is the on-chain hash anchor.
-    After anchoring, _deduct_anchor_fee sends 0.01 SLS from the user's
-    custodial wallet → Treasury.
+    After anchoring, the user's 0.01 SLS fee is accrued on _fee_ledger and
+    later settled from their custodial wallet → Treasury (or paid at once
+    by _deduct_anchor_fee when S4_FEE_LEDGER=0).
     The Issuer wallet is for trustlines + AccountSet anchors ONLY.
-    Returns tx info dict or None."""
+    Returns tx info dict or None. If validation outlasts
+    XRPL_PIPELINE_TIMEOUT_S the signed hash is returned with verified
+    False — the AccountSet may still land, so it is not simulated."""
     _init_xrpl()
     if not _xrpl_client or not _xrpl_wallet:
         return None
     try:
-        memo_data = json.dumps({
+        memo_data = s4_codec.dumps({
             "hash": hash_value, "type": record_type, "branch": branch,
             "platform": "S4 Ledger", "ts": datetime.now(timezone.utc).isoformat()
         })
@@ -1492,7 +2950,28 @@ def _anchor_xrpl(hash_value, record_type="", branch="", user_email=None):
                 memo_data=bytes(memo_data, "utf-8").hex()
             )]
         )
-        response = submit_and_wait(tx, _xrpl_client, _xrpl_wallet)
+        if XRPL_PIPELINE_ENABLED:
+            signed = {}
+            future = _xrpl_pipeline.submit(tx, _xrpl_wallet, on_signed=lambda tx_hash, last_ledger:
+                                           signed.update(tx_hash=tx_hash, last_ledger=last_ledger))
+            try:
+                response = future.result(timeout=XRPL_PIPELINE_TIMEOUT_S)
+            except FutureTimeout:
+                if not signed:
+                    raise
+                # No user fee yet: the anchor may still expire unapplied
+                return {
+                    "tx_hash": signed["tx_hash"],
+                    "ledger_index": None,
+                    "last_ledger_sequence": signed["last_ledger"],
+                    "network": XRPL_NETWORK,
+                    "verified": False,
+                    "status": "pending",
+                    "explorer_url": XRPL_EXPLORER + signed["tx_hash"],
+                    "account": _xrpl_wallet.address,
+                }
+        else:
+            response = _xrpl_submit(tx, _xrpl_wallet)
         if response.is_successful():
             tx_hash = response.result["hash"]
             explorer_base = XRPL_EXPLORER
@@ -1507,24 +2986,894 @@ def _anchor_xrpl(hash_value, record_type="", branch="", user_email=None):
             }
             # Production: deduct fee from user's custodial wallet → Treasury
             if user_email:
-                user_fee = _deduct_anchor_fee(user_email=user_email)
-                if user_fee and user_fee.get("success"):
-                    result["user_fee_tx"] = user_fee["fee_tx"]
-                    result["sls_fee"] = SLS_ANCHOR_FEE
-                    result["sls_treasury"] = SLS_TREASURY_ADDRESS
-                elif user_fee:
-                    # Propagate fee error so frontend can display it
-                    result["fee_error"] = user_fee.get("error", "Fee deduction failed")
-                    result["fee_hint"] = user_fee.get("hint", "")
-                    print(f"SLS fee deduction failed for {user_email}: {user_fee}")
-                else:
-                    result["fee_error"] = "No wallet found for fee deduction"
-                    print(f"SLS fee deduction returned None for {user_email}")
+                _attach_user_fee(result, user_email, record_hash=hash_value)
             return result
     except Exception as e:
         print(f"XRPL anchor failed: {e}")
     return None
 
+
+def _attach_user_fee(result, user_email, record_hash=""):
+    """Charge the 0.01 SLS anchor fee and record the outcome on an anchor
+    result: fee_accrual when it goes on the fee ledger (settled later, see
+    SLS FEE LEDGER), user_fee_tx when paid immediately, or fee_error."""
+    if SLS_FEE_LEDGER_ENABLED:
+        if not _fee_payer_exists(user_email):
+            result["fee_error"] = "No wallet found for fee deduction"
+            return result
+        accrual = _fee_ledger.accrue(user_email, result["tx_hash"], record_hash=record_hash)
+        result["fee_accrual"] = accrual["accrual_id"]
+        result["sls_fee"] = SLS_ANCHOR_FEE
+        result["sls_treasury"] = SLS_TREASURY_ADDRESS
+        return result
+    user_fee = _deduct_anchor_fee(user_email=user_email)
+    if user_fee and user_fee.get("success"):
+        result["user_fee_tx"] = user_fee["fee_tx"]
+        result["sls_fee"] = SLS_ANCHOR_FEE
+        result["sls_treasury"] = SLS_TREASURY_ADDRESS
+    elif user_fee:
+        # Propagate fee error so frontend can display it
+        result["fee_error"] = user_fee.get("error", "Fee deduction failed")
+        result["fee_hint"] = user_fee.get("hint", "")
+        print(f"SLS fee deduction failed for {user_email}: {user_fee}")
+    else:
+        result["fee_error"] = "No wallet found for fee deduction"
+        print(f"SLS fee deduction returned None for {user_email}")
+    return result
+
+# ═══════════════════════════════════════════════════════════════════════
+#  SLS FEE LEDGER
+#  Anchor fees are accrued per user instead of paid one Payment per
+#  anchor, which kept a second submit_and_wait on every anchor's critical
+#  path. A user's accruals are settled by one SLS Payment of their sum
+#  once S4_FEE_SETTLE_THRESHOLD anchors have accrued, or by the sweeper
+#  every S4_FEE_SETTLE_INTERVAL_S. The settlement tx hash is written back
+#  to every accrual it covers. Accruals live in the Supabase
+#  sls_fee_accruals table (migration 022); an instance claims a user's
+#  rows (status accrued -> settling, stamping claimed_at) before paying,
+#  so two instances never settle the same accrual. Rows left in settling
+#  for longer than S4_FEE_SETTLE_LEASE_S by a frozen or recycled instance
+#  are taken over by the next sweep (migration 027): recorded settled if
+#  their settlement tx validated, otherwise returned to accrued and paid
+#  again. The settlement Payment is signed once and
+#  its hash and LastLedgerSequence are written onto the rows before it is
+#  submitted (migration 025). A settlement that errors — including a
+#  submit_and_wait timeout after broadcast — keeps that hash, and the next
+#  round looks it up on the ledger before paying again.
+#  S4_FEE_LEDGER=0 restores per-anchor payments.
+# ═══════════════════════════════════════════════════════════════════════
+
+SLS_FEE_LEDGER_ENABLED = os.environ.get("S4_FEE_LEDGER", "1").lower() in ("1", "true", "yes")
+SLS_FEE_SETTLE_INTERVAL_S = float(os.environ.get("S4_FEE_SETTLE_INTERVAL_S", "300"))
+SLS_FEE_SETTLE_THRESHOLD = int(os.environ.get("S4_FEE_SETTLE_THRESHOLD", "100"))
+SLS_FEE_SETTLE_LEASE_S = float(os.environ.get("S4_FEE_SETTLE_LEASE_S", "600"))
+_FEE_SETTLED_KEEP = 2000   # settled accruals kept in memory for lookups
+
+
+def _fee_accrual_row(accrual):
+    return {k: accrual[k] for k in ("accrual_id", "user_email", "anchor_tx", "record_hash", "amount",
+                                    "status", "accrued_at", "settlement_tx", "settlement_last_ledger",
+                                    "settled_at")}
+
+
+class _FeeLedger:
+    """Per-user anchor fee accruals, settled in aggregate.
+
+    pay(user_email, amount, anchors, on_signed) sends one settlement
+    Payment, calling on_signed(tx_hash, last_ledger) before submitting it,
+    and returns a _deduct_anchor_fee-style dict ("success" + "fee_tx", or
+    "error"), or None when the user has no wallet. A failed settlement
+    leaves its accruals pending for the next round; any whose recorded
+    settlement tx may still have landed are first checked with
+    confirm(tx_hash, last_ledger) -> (validated_ok, hash_or_error).
+    Accruals claimed more than lease seconds ago and never settled are
+    taken over by reclaim_stale().
+    """
+
+    def __init__(self, pay, interval=SLS_FEE_SETTLE_INTERVAL_S, threshold=SLS_FEE_SETTLE_THRESHOLD,
+                 confirm=None, lease=SLS_FEE_SETTLE_LEASE_S):
+        self._pay = pay
+        self._confirm = confirm or _reconcile_sls_tx
+        self.interval = interval
+        self.threshold = max(1, threshold)
+        self.lease = lease
+        self._pending = {}          # user_email -> [accrual]
+        self._settling = set()      # users with a settlement in progress
+        self._settled = deque(maxlen=_FEE_SETTLED_KEEP)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stats = {"accrued": 0, "settlements": 0, "settled_anchors": 0, "settlement_failures": 0,
+                       "reclaimed": 0}
+
+    def accrue(self, user_email, anchor_tx, record_hash="", amount=SLS_ANCHOR_FEE):
+        """Record one anchor fee. Returns the accrual dict."""
+        accrual = {
+            "accrual_id": "FEE-" + uuid.uuid4().hex[:16].upper(),
+            "user_email": user_email,
+            "anchor_tx": anchor_tx,
+            "record_hash": record_hash,
+            "amount": amount,
+            "status": "accrued",
+            "accrued_at": datetime.now(timezone.utc).isoformat(),
+            "settlement_tx": None,
+            "settlement_last_ledger": None,
+            "settled_at": None,
+        }
+        _supabase_request("sls_fee_accruals", method="POST", data=_fee_accrual_row(accrual),
+                          prefer="return=minimal")
+        with self._cond:
+            pending = self._pending.setdefault(user_email, [])
+            pending.append(accrual)
+            self._stats["accrued"] += 1
+            due = len(pending) >= self.threshold and user_email not in self._settling
+            self._ensure_sweeper()
+        if due:
+            threading.Thread(target=self.settle, args=(user_email,), name="s4-fee-settle", daemon=True).start()
+        return accrual
+
+    def restore(self, rows):
+        """Re-queue accruals still pending in Supabase (cold start)."""
+        with self._cond:
+            known = {a["accrual_id"] for batch in self._pending.values() for a in batch}
+            for row in rows:
+                if row["accrual_id"] not in known:
+                    accrual = {"record_hash": "", "settlement_tx": None, "settlement_last_ledger": None,
+                               "settled_at": None, **row}
+                    self._pending.setdefault(row["user_email"], []).append(accrual)
+            if self._pending:
+                self._ensure_sweeper()
+
+    def reclaim_stale(self):
+        """Take over accruals left in settling for longer than the lease by
+        an instance that was frozen or recycled mid-settlement. Each group
+        sharing a settlement tx is recorded settled if that tx validated;
+        otherwise (no tx, or it failed or expired) it goes back to accrued
+        and is queued here. A group whose tx cannot be confirmed yet stays
+        settling until a later sweep. Returns how many were taken over."""
+        if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+            return 0
+        now = datetime.now(timezone.utc)
+        cutoff = (now - timedelta(seconds=self.lease)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        # re-stamping claimed_at is the takeover: a concurrent sweep elsewhere matches none of these rows
+        rows = _supabase_request("sls_fee_accruals", method="PATCH", data={"claimed_at": now.isoformat()},
+                                 query_params=f"status=eq.settling&or=(claimed_at.is.null,claimed_at.lt.{cutoff})")
+        if not rows:
+            return 0
+        groups = {}
+        for row in rows:
+            accrual = {"record_hash": "", "settlement_tx": None, "settlement_last_ledger": None,
+                       "settled_at": None, **row}
+            key = (accrual["user_email"], accrual["settlement_tx"], accrual["settlement_last_ledger"])
+            groups.setdefault(key, []).append(accrual)
+        with self._cond:
+            busy = set(self._settling)
+        taken = 0
+        for (user_email, tx_hash, last_ledger), group in groups.items():
+            if user_email in busy:
+                continue          # still being settled here, just slowly
+            if tx_hash:
+                try:
+                    landed, _outcome = self._confirm(tx_hash, last_ledger)
+                except Exception as e:
+                    print(f"SLS fee reclaim could not confirm settlement {tx_hash}: {e}")
+                    continue
+                if landed:
+                    self._record(user_email, group, tx_hash)
+                    taken += len(group)
+                    continue
+            for a in group:
+                a.update(status="accrued", settlement_tx=None, settlement_last_ledger=None)
+            _supabase_request("sls_fee_accruals", method="PATCH", prefer="return=minimal",
+                              query_params=self._id_filter(group),
+                              data={"status": "accrued", "settlement_tx": None, "settlement_last_ledger": None})
+            self.restore(group)
+            taken += len(group)
+        with self._cond:
+            self._stats["reclaimed"] += taken
+        if taken:
+            print(f"SLS fee ledger reclaimed {taken} accruals left settling by another instance")
+        return taken
+
+    def settle(self, user_email):
+        """Settle everything accrued for one user with a single Payment.
+        Returns the settlement dict, or None if nothing was settled."""
+        with self._cond:
+            if user_email in self._settling or not self._pending.get(user_email):
+                return None
+            self._settling.add(user_email)
+            batch = self._pending.pop(user_email)
+        try:
+            claimed = self._claim(batch)
+            if claimed is None:
+                # could not tell which rows are ours — try again next round rather than risk paying twice
+                with self._cond:
+                    self._pending[user_email] = batch + self._pending.get(user_email, [])
+                return None
+            batch = claimed
+            if not batch:
+                return None
+            settlement = None
+            # settlements signed in an earlier round may have landed after all
+            earlier = {}
+            for a in batch:
+                if a.get("settlement_tx"):
+                    earlier.setdefault((a["settlement_tx"], a.get("settlement_last_ledger")), []).append(a)
+            for (tx_hash, last_ledger), covered in earlier.items():
+                try:
+                    landed, _outcome = self._confirm(tx_hash, last_ledger)
+                except Exception as e:
+                    self._release(user_email, batch, f"could not confirm settlement {tx_hash}: {e}")
+                    return None
+                if landed:
+                    settlement = self._record(user_email, covered, tx_hash)
+                    batch = [a for a in batch if a not in covered]
+                else:
+                    for a in covered:
+                        a.update(settlement_tx=None, settlement_last_ledger=None)
+            if not batch:
+                return settlement
+            total = sum((Decimal(a["amount"]) for a in batch), Decimal(0))
+            amount = format(total.normalize(), "f")
+            try:
+                result = self._pay(user_email, amount, len(batch),
+                                   on_signed=lambda tx_hash, last_ledger: self._checkpoint(batch, tx_hash, last_ledger))
+            except Exception as e:
+                result = {"error": str(e)}
+            if not (result and result.get("success")):
+                self._release(user_email, batch, (result or {}).get("error", "No wallet found for fee settlement"))
+                return settlement
+            return self._record(user_email, batch, result["fee_tx"])
+        finally:
+            with self._cond:
+                self._settling.discard(user_email)
+
+    def _checkpoint(self, batch, tx_hash, last_ledger):
+        """Write the signed settlement's hash onto its rows before it is
+        submitted; refuse to submit if that write fails."""
+        for a in batch:
+            a.update(settlement_tx=tx_hash, settlement_last_ledger=last_ledger)
+        written = _supabase_request("sls_fee_accruals", method="PATCH", prefer="return=minimal",
+                                    query_params=self._id_filter(batch),
+                                    data={"settlement_tx": tx_hash, "settlement_last_ledger": last_ledger})
+        if written is None and SUPABASE_URL and SUPABASE_SERVICE_KEY:
+            for a in batch:
+                a.update(settlement_tx=None, settlement_last_ledger=None)
+            raise RuntimeError("could not record settlement tx before submitting")
+
+    def _record(self, user_email, batch, tx_hash):
+        settlement = {
+            "settlement_tx": tx_hash,
+            "user_email": user_email,
+            "amount": format(sum((Decimal(a["amount"]) for a in batch), Decimal(0)).normalize(), "f"),
+            "anchor_count": len(batch),
+            "settled_at": datetime.now(timezone.utc).isoformat(),
+        }
+        for a in batch:
+            a.update(status="settled", settlement_tx=tx_hash, settled_at=settlement["settled_at"])
+        _sb_insert("sls_fee_settlements", settlement)
+        _supabase_request("sls_fee_accruals", method="PATCH", prefer="return=minimal",
+                          query_params=self._id_filter(batch),
+                          data={"status": "settled", "settlement_tx": tx_hash,
+                                "settled_at": settlement["settled_at"]})
+        with self._cond:
+            self._settled.extend(batch)
+            self._stats["settlements"] += 1
+            self._stats["settled_anchors"] += len(batch)
+        return settlement
+
+    @staticmethod
+    def _id_filter(batch):
+        return "accrual_id=in.(" + ",".join(a["accrual_id"] for a in batch) + ")"
+
+    def _claim(self, batch):
+        """Mark the batch settling in Supabase; keep only rows this call
+        moved from accrued (another instance owns the rest). Without
+        Supabase configured the whole batch is ours; if the PATCH itself
+        fails, returns None and nothing may be paid this round."""
+        rows = _supabase_request("sls_fee_accruals", method="PATCH",
+                                 data={"status": "settling",
+                                       "claimed_at": datetime.now(timezone.utc).isoformat()},
+                                 query_params=self._id_filter(batch) + "&status=eq.accrued")
+        if rows is None:
+            if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+                return batch
+            print(f"SLS fee claim failed for {len(batch)} accruals — retrying next round")
+            return None
+        claimed = {row["accrual_id"] for row in rows}
+        return [a for a in batch if a["accrual_id"] in claimed]
+
+    def _release(self, user_email, batch, error):
+        # settlement_tx stays on the rows: the next round checks it before paying
+        print(f"SLS fee settlement failed for {user_email} ({len(batch)} anchors): {error}")
+        _supabase_request("sls_fee_accruals", method="PATCH", data={"status": "accrued"},
+                          query_params=self._id_filter(batch), prefer="return=minimal")
+        with self._cond:
+            self._pending[user_email] = batch + self._pending.get(user_email, [])
+            self._stats["settlement_failures"] += 1
+
+    def settle_all(self):
+        with self._cond:
+            users = [u for u, batch in self._pending.items() if batch]
+        return [s for s in map(self.settle, users) if s]
+
+    def _ensure_sweeper(self):
+        # caller holds self._cond
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sweep, name="s4-fee-sweeper", daemon=True)
+            self._thread.start()
+
+    def _sweep(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.interval)
+            try:
+                self.reclaim_stale()
+            except Exception as e:
+                print(f"SLS fee reclaim failed: {e}")
+            with self._cond:
+                if not any(self._pending.values()):
+                    self._thread = None
+                    return
+            try:
+                self.settle_all()
+            except Exception as e:
+                print(f"SLS fee sweep failed: {e}")
+
+    def lookup(self, user_email=None, anchor_tx=None):
+        """Accruals (pending and recently settled) for a user and/or anchor tx."""
+        with self._cond:
+            rows = [a for batch in self._pending.values() for a in batch] + list(self._settled)
+        return [dict(a) for a in rows
+                if (user_email is None or a["user_email"] == user_email)
+                and (anchor_tx is None or a["anchor_tx"] == anchor_tx)]
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["pending_anchors"] = sum(len(b) for b in self._pending.values())
+            stats["pending_users"] = sum(1 for b in self._pending.values() if b)
+        stats["enabled"] = SLS_FEE_LEDGER_ENABLED
+        stats["settle_interval_s"] = self.interval
+        stats["settle_threshold"] = self.threshold
+        stats["settle_lease_s"] = self.lease
+        return stats
+
+
+_fee_ledger = _FeeLedger(lambda user_email, amount, anchors, on_signed:
+                         _deduct_anchor_fee(user_email=user_email, amount=amount, anchors=anchors,
+                                            on_signed=on_signed))
+
+
+def _load_fee_accruals_from_supabase():
+    rows = _sb_select("sls_fee_accruals", query_params="status=eq.accrued",
+                      order="accrued_at.asc", limit=10000)
+    if rows:
+        _fee_ledger.restore(rows)
+    # confirming a stale settlement can wait on the ledger; keep it off the first request
+    threading.Thread(target=_fee_ledger.reclaim_stale, name="s4-fee-reclaim", daemon=True).start()
+
+# ═══════════════════════════════════════════════════════════════════════
+#  ANCHOR COALESCER
+#  Single /api/anchor calls arriving within S4_ANCHOR_COALESCE_WINDOW_MS
+#  (or until S4_ANCHOR_COALESCE_MAX_LEAVES) share one Merkle-root XRPL
+#  transaction. The first caller of a window is the leader: it waits out
+#  the window, anchors the root and wakes the others. Every caller still
+#  pays its own 0.01 SLS fee and gets its record + inclusion proof.
+#  Off unless S4_ANCHOR_COALESCE=1.
+# ═══════════════════════════════════════════════════════════════════════
+
+ANCHOR_COALESCE_ENABLED = os.environ.get("S4_ANCHOR_COALESCE", "").lower() in ("1", "true", "yes")
+ANCHOR_COALESCE_WINDOW_MS = int(os.environ.get("S4_ANCHOR_COALESCE_WINDOW_MS", "250"))
+ANCHOR_COALESCE_MAX_LEAVES = int(os.environ.get("S4_ANCHOR_COALESCE_MAX_LEAVES", "256"))
+
+
+class _CoalescedBatch:
+    def __init__(self):
+        self.leaves = []
+        self.meta = []            # (record_type, branch) per leaf
+        self.sealed = threading.Event()
+        self.done = threading.Event()
+        self.xrpl_result = None
+        self.batch_id = None
+        self.tree = None
+        self.root = None
+        self.error = None
+
+
+class _AnchorCoalescer:
+    def __init__(self, window_ms=250, max_leaves=256):
+        self.window = window_ms / 1000.0
+        self.max_leaves = max(1, max_leaves)
+        self._open = None
+        self._lock = threading.Lock()
+        self.stats = {"leaves": 0, "batches": 0, "xrpl_submissions": 0}
+
+    def anchor(self, hash_value, record_type="", branch=""):
+        """Add one leaf to the open batch and block until its root is anchored.
+
+        Returns (xrpl_result or None, batch_info) where batch_info carries
+        batch_id, merkle_root, leaf_index and merkle_proof for this leaf.
+        """
+        with self._lock:
+            batch = self._open
+            leader = batch is None
+            if leader:
+                batch = self._open = _CoalescedBatch()
+            index = len(batch.leaves)
+            batch.leaves.append(hash_value)
+            batch.meta.append((record_type, branch))
+            if len(batch.leaves) >= self.max_leaves:
+                self._open = None
+                batch.sealed.set()
+        if leader:
+            batch.sealed.wait(self.window)
+            with self._lock:
+                if self._open is batch:
+                    self._open = None
+            self._flush(batch)
+        else:
+            batch.done.wait()
+        if batch.error:
+            raise RuntimeError(batch.error)
+        xrpl_result = dict(batch.xrpl_result) if batch.xrpl_result else None
+        return xrpl_result, {
+            "batch_id": batch.batch_id,
+            "merkle_root": batch.root,
+            "leaf_index": index,
+            "merkle_proof": batch.tree.proof(index),
+        }
+
+    def _flush(self, batch):
+        try:
+            leaves = list(batch.leaves)
+            batch.tree = MerkleTree(leaves)
+            batch.root = batch.tree.root
+            batch.batch_id = f"BATCH-{batch.root[:12].upper()}"
+            if len(leaves) == 1:
+                record_type, branch = batch.meta[0]
+                batch.xrpl_result = _anchor_xrpl(batch.root, record_type, branch)
+            else:
+                batch.xrpl_result = _anchor_xrpl(batch.root, "BATCH_ANCHOR", "JOINT")
+            with self._lock:
+                self.stats["leaves"] += len(leaves)
+                self.stats["batches"] += 1
+                if batch.xrpl_result:
+                    self.stats["xrpl_submissions"] += 1
+            # stored even without XRPL: every caller was handed this batch_id
+            _batch_store[batch.batch_id] = {
+                "merkle_root": batch.root,
+                "tree": batch.tree,
+                "leaf_hashes": batch.tree.leaves,
+                "record_count": len(leaves),
+                "tx_hash": batch.xrpl_result["tx_hash"] if batch.xrpl_result else None,
+                "network": "XRPL " + XRPL_NETWORK.capitalize() if batch.xrpl_result else "Simulated",
+                "explorer_url": batch.xrpl_result["explorer_url"] if batch.xrpl_result else None,
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "org_id": "coalesced",
+            }
+        except Exception as e:
+            batch.error = str(e)
+            print(f"Coalesced anchor batch failed: {e}")
+        finally:
+            batch.done.set()
+
+
+_anchor_coalescer = _AnchorCoalescer(ANCHOR_COALESCE_WINDOW_MS, ANCHOR_COALESCE_MAX_LEAVES)
+
+_BATCH_ID_RE = re.compile(r"^BATCH-[0-9A-F]{12}$")
+
+
+def _load_batch(batch_id):
+    """A Merkle batch from _batch_store, or rebuilt from the leaf hashes of
+    its persisted records (cold start, or anchored on another instance).
+    None if unknown, or if the stored leaves do not reproduce its root
+    (e.g. a member record was never persisted)."""
+    batch = _batch_store.get(batch_id)
+    if batch or not _BATCH_ID_RE.match(batch_id):
+        return batch
+    rows = _sb_select("records", select="hash,leaf_index,merkle_root,tx_hash,network,explorer_url,timestamp,org_id",
+                      query_params=f"batch_id=eq.{batch_id}", order="leaf_index.asc",
+                      limit=max(1000, ANCHOR_COALESCE_MAX_LEAVES))
+    if not rows or [r.get("leaf_index") for r in rows] != list(range(len(rows))):
+        return None
+    tree = MerkleTree([r["hash"] for r in rows])
+    if tree.root != rows[0].get("merkle_root"):
+        return None
+    batch = {
+        "merkle_root": tree.root,
+        "tree": tree,
+        "leaf_hashes": tree.leaves,
+        "record_count": len(tree),
+        "tx_hash": rows[0].get("tx_hash"),
+        "network": rows[0].get("network"),
+        "explorer_url": rows[0].get("explorer_url"),
+        "timestamp": rows[0].get("timestamp"),
+        "org_id": rows[0].get("org_id"),
+    }
+    return _batch_store.setdefault(batch_id, batch)
+
+
+def _anchor_record_hash(hash_value, record_type="", branch="", user_email=None):
+    """Anchor one record hash — through the coalescer when enabled,
+    otherwise as its own XRPL transaction. Returns (xrpl_result, batch_info);
+    batch_info is None for a direct anchor."""
+    if not ANCHOR_COALESCE_ENABLED:
+        return _anchor_xrpl(hash_value, record_type, branch, user_email=user_email), None
+    xrpl_result, batch_info = _anchor_coalescer.anchor(hash_value, record_type, branch)
+    if xrpl_result and xrpl_result.get("verified") and user_email:
+        _attach_user_fee(xrpl_result, user_email, record_hash=hash_value)
+    return xrpl_result, batch_info
+
+def _apply_anchor_result(record, xrpl_result, fallback_tx_hash):
+    """Fill tx_hash / network / explorer_url on an anchor record from an
+    _anchor_xrpl() result, falling back to a simulated tx when XRPL is
+    unavailable."""
+    if xrpl_result:
+        record["tx_hash"] = xrpl_result["tx_hash"]
+        record["network"] = "XRPL " + XRPL_NETWORK.capitalize()
+        record["explorer_url"] = xrpl_result["explorer_url"]
+    else:
+        record["tx_hash"] = fallback_tx_hash
+        record["network"] = "Simulated"
+        record["explorer_url"] = None
+
+
+def _finalize_anchor(record, xrpl_result, actor, org_key):
+    """Post-anchor bookkeeping shared by sync and async anchors: proof chain
+    event + anchor.confirmed webhook. Returns (fee_transfer, fee_error)."""
+    rid = record["record_id"]
+    if rid not in _proof_chain_store:
+        _proof_chain_store[rid] = []
+    proof_event = {
+        "event_type": "anchor.created",
+        "hash": record["hash"],
+        "tx_hash": record["tx_hash"],
+        "timestamp": record["timestamp"],
+        "actor": actor,
+        "metadata": {"record_type": record["record_type"], "network": record["network"]},
+    }
+    _proof_chain_store[rid].append(proof_event)
+    _persist_proof_chain_event(rid, proof_event)
+
+    # Fire webhook: anchor.confirmed
+    _deliver_webhook("anchor.confirmed", {
+        "record_id": rid,
+        "hash": record["hash"],
+        "tx_hash": record["tx_hash"],
+        "record_type": record["record_type"],
+        "explorer_url": record["explorer_url"],
+        "network": record["network"],
+        "fee": 0.01,
+    }, org_key=org_key)
+
+    # Build fee_transfer for frontend compatibility
+    fee_transfer = None
+    fee_error = None
+    if xrpl_result and xrpl_result.get("user_fee_tx"):
+        fee_transfer = {
+            "tx_hash": xrpl_result["user_fee_tx"],
+            "amount": xrpl_result.get("sls_fee", SLS_ANCHOR_FEE),
+            "treasury": xrpl_result.get("sls_treasury", SLS_TREASURY_ADDRESS),
+        }
+    elif xrpl_result and xrpl_result.get("fee_accrual"):
+        fee_transfer = {
+            "tx_hash": None,
+            "status": "accrued",
+            "accrual_id": xrpl_result["fee_accrual"],
+            "amount": xrpl_result.get("sls_fee", SLS_ANCHOR_FEE),
+            "treasury": xrpl_result.get("sls_treasury", SLS_TREASURY_ADDRESS),
+        }
+    elif xrpl_result and xrpl_result.get("fee_error"):
+        fee_error = xrpl_result.get("fee_error", "unknown")
+    return fee_transfer, fee_error
+
+# ═══════════════════════════════════════════════════════════════════════
+#  ASYNC ANCHOR JOBS
+#  POST /api/anchor?mode=async (or "Prefer: respond-async") stores the
+#  record as pending and answers 202 with a job id. A background worker
+#  runs the XRPL submission + SLS fee accrual off the request thread.
+#  Poll GET /api/anchor/status?job=. Jobs are written to the anchor_jobs
+#  table (migration 024) before the 202 goes out and again when they
+#  finish, so a poll that lands on another instance — or follows a
+#  recycled one — still finds the job. The worker is a daemon thread that
+#  a serverless platform freezes or kills after the response, so a job
+#  still queued/submitting S4_ANCHOR_JOB_DEADLINE_S after its last update
+#  is marked failed by the next poll (and never started if still queued).
+# ═══════════════════════════════════════════════════════════════════════
+
+ANCHOR_JOB_WORKERS = int(os.environ.get("S4_ANCHOR_JOB_WORKERS", "4"))
+ANCHOR_JOB_DEADLINE_S = float(os.environ.get("S4_ANCHOR_JOB_DEADLINE_S", "120"))
+_ANCHOR_JOBS_MAX = 5000   # finished jobs are trimmed oldest-first past this
+_anchor_jobs = {}         # job_id -> job dict (insertion ordered)
+_anchor_job_queue = queue.Queue()
+_anchor_job_threads = []
+_anchor_jobs_lock = threading.Lock()
+_ANCHOR_JOB_ID_RE = re.compile(r"^JOB-[0-9A-F]{16}$")
+
+
+def _persist_anchor_job(job):
+    """Upsert a job's status row. Returns None if it could not be written."""
+    row = {k: job.get(k) for k in ("job_id", "status", "record", "result", "error", "created_at", "completed_at")}
+    row["record_id"] = job["record"]["record_id"]
+    row["updated_at"] = job["updated_at"] = datetime.now(timezone.utc).isoformat()
+    result = _sb_upsert("anchor_jobs", row)
+    if result is None:
+        print(f"Anchor job persist failed for {job['job_id']} — in-memory only")
+    return result
+
+
+def _load_anchor_job(job_id):
+    """A job from the anchor_jobs table (queued on another instance), or None."""
+    if not _ANCHOR_JOB_ID_RE.match(job_id):
+        return None
+    rows = _sb_select("anchor_jobs", query_params=f"job_id=eq.{job_id}", limit=1)
+    return rows[0] if rows else None
+
+
+def _expire_anchor_job(job):
+    """Fail a queued/submitting job not updated for ANCHOR_JOB_DEADLINE_S
+    — its worker died with its instance. The write is conditional on the
+    job still being unfinished, so a late completion elsewhere wins.
+    Returns the job as it now stands."""
+    if job["status"] not in ("queued", "submitting"):
+        return job
+    last = datetime.fromisoformat((job.get("updated_at") or job["created_at"]).replace("Z", "+00:00"))
+    now = datetime.now(timezone.utc)
+    if (now - last).total_seconds() < ANCHOR_JOB_DEADLINE_S:
+        return job
+    if job["status"] == "queued":
+        error = "Anchor job expired before it started — resubmit the record"
+    else:
+        error = "Anchor job expired while submitting — its transaction may still land; verify before resubmitting"
+    changes = {"status": "failed", "error": error, "completed_at": now.isoformat(), "updated_at": now.isoformat()}
+    rows = _supabase_request("anchor_jobs", method="PATCH", data=changes,
+                             query_params=f"job_id=eq.{job['job_id']}&status=in.(queued,submitting)")
+    if rows == []:
+        return _load_anchor_job(job["job_id"]) or job     # finished after all
+    job.update(changes)
+    job["record"]["anchor_status"] = "failed"
+    return job
+
+
+def _anchor_job_view(job):
+    """Public JSON view of a job (drops internal fields)."""
+    view = {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "record_id": job["record"]["record_id"],
+        "created_at": job["created_at"],
+        "completed_at": job.get("completed_at"),
+    }
+    if job["status"] == "completed":
+        view["result"] = job["result"]
+    elif job["status"] == "failed":
+        view["error"] = job.get("error", "unknown")
+    else:
+        view["record"] = job["record"]
+    return view
+
+
+def _run_anchor_job(job):
+    record = job["record"]
+    if job["status"] != "queued":
+        return        # expired while it waited; the client was told to resubmit
+    job["status"] = "submitting"
+    _persist_anchor_job(job)
+    try:
+        xrpl_result, batch_info = _anchor_record_hash(record["hash"], record["record_type"], job["branch"],
+                                                      user_email=job["user_email"] or None)
+        _apply_anchor_result(record, xrpl_result, job["fallback_tx_hash"])
+        if batch_info and xrpl_result:
+            record.update(batch_info)
+        record["anchor_status"] = "anchored"
+        _live_records.reindex(job["position"])
+        _persist_record(record)
+        fee_transfer, fee_error = _finalize_anchor(record, xrpl_result, job["actor"], job["org_key"])
+        job["result"] = {"status": "anchored", "record": record, "xrpl": xrpl_result,
+                         "fee_transfer": fee_transfer, "fee_error": fee_error}
+        job["status"] = "completed"
+    except Exception as e:
+        record["anchor_status"] = "failed"
+        job["status"] = "failed"
+        job["error"] = str(e)
+        print(f"Async anchor job {job['job_id']} failed: {e}")
+    job["completed_at"] = datetime.now(timezone.utc).isoformat()
+    _persist_anchor_job(job)
+
+
+def _anchor_job_worker():
+    while True:
+        job = _anchor_job_queue.get()
+        try:
+            _run_anchor_job(job)
+        finally:
+            _anchor_job_queue.task_done()
+
+
+def _ensure_anchor_workers():
+    with _anchor_jobs_lock:
+        _anchor_job_threads[:] = [t for t in _anchor_job_threads if t.is_alive()]
+        while len(_anchor_job_threads) < ANCHOR_JOB_WORKERS:
+            t = threading.Thread(target=_anchor_job_worker, name="s4-anchor-job", daemon=True)
+            t.start()
+            _anchor_job_threads.append(t)
+
+
+def _submit_anchor_job(record, branch, user_email, actor, org_key, fallback_tx_hash):
+    """Store a pending anchor record and queue it for background submission.
+    Returns the job dict."""
+    record["tx_hash"] = ""
+    record["network"] = "Pending"
+    record["explorer_url"] = None
+    record["anchor_status"] = "pending"
+    job = {
+        "job_id": "JOB-" + uuid.uuid4().hex[:16].upper(),
+        "status": "queued",
+        "record": record,
+        "branch": branch,
+        "user_email": user_email,
+        "actor": actor,
+        "org_key": org_key,
+        "fallback_tx_hash": fallback_tx_hash,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    job["position"] = _live_records.append(record)
+    _persist_anchor_job(job)
+    with _anchor_jobs_lock:
+        _anchor_jobs[job["job_id"]] = job
+        while len(_anchor_jobs) > _ANCHOR_JOBS_MAX:
+            oldest = next(iter(_anchor_jobs))
+            if _anchor_jobs[oldest]["status"] not in ("completed", "failed"):
+                break
+            del _anchor_jobs[oldest]
+    _ensure_anchor_workers()
+    _anchor_job_queue.put(job)
+    return job
+
+
+# ═══════════════════════════════════════════════════════════════════════
+#  BATCH VERIFY
+#  Per-item check shared by the JSON and NDJSON-streaming modes of
+#  /api/verify/batch. Streaming mode (Content-Type or Accept
+#  application/x-ndjson) lifts the 100-item cap: items are verified in
+#  chunks as the body is read and results stream back one line each, with
+#  the summary as the trailing line. Hashing a record is far cheaper than
+#  handing it to a worker thread under the GIL, so it runs inline.
+# ═══════════════════════════════════════════════════════════════════════
+
+VERIFY_BATCH_MAX = 100                 # JSON mode
+VERIFY_STREAM_MAX_ITEMS = 1_000_000    # NDJSON mode
+VERIFY_STREAM_CHUNK = 512              # results per write
+NDJSON = "application/x-ndjson"
+
+
+def _verify_batch_item(item):
+    """Verify one batch item. Returns a result dict without "index"; the
+    status is "MATCH", "MISMATCH" or "NOT_FOUND", or the dict holds "error"."""
+    if not isinstance(item, dict):
+        return {"error": "record must be an object"}
+    record_text = item.get("record_text", "")
+    if not record_text:
+        return {"error": "record_text required"}
+
+    computed = hashlib.sha256(record_text.encode()).hexdigest()
+    expected = item.get("expected_hash", "")
+    tx = item.get("tx_hash", "")
+    chain_hash = None
+
+    if tx:
+        found = _live_records.find_by_tx(tx, computed)
+        if found:
+            chain_hash = found.get("hash", "")
+    elif expected:
+        chain_hash = expected
+    else:
+        found = _live_records.find_by_hash(computed)
+        if found:
+            chain_hash = found.get("hash", "")
+
+    if chain_hash is None:
+        status = "NOT_FOUND"
+    elif computed == chain_hash:
+        status = "MATCH"
+    else:
+        status = "MISMATCH"
+    return {
+        "status": status,
+        "computed_hash": computed,
+        "chain_hash": chain_hash,
+        "tamper_detected": status == "MISMATCH",
+        "record_id": item.get("record_id", ""),
+    }
+
+
+def _indexed(index, result):
+    """Put "index" first, matching the original result key order."""
+    if "error" in result:
+        return {"error": result["error"], "index": index}
+    return {"index": index, **result}
+
+# ═══════════════════════════════════════════════════════════════════════
+#  MONTE CARLO RISK ENGINE
+#  Schedule-delay × cost-impact heatmap for the Program Impact Simulator.
+#  With NumPy, samples are drawn in bulk from a seeded generator, binned
+#  in one histogram2d pass, and the P50/P75/P95 come from one partition.
+#  Without it the pure-Python path draws the same distribution, capped
+#  at MONTE_CARLO_FALLBACK_MAX iterations.
+# ═══════════════════════════════════════════════════════════════════════
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MONTE_CARLO_MAX_ITERATIONS = int(os.environ.get("S4_MONTE_CARLO_MAX_ITERATIONS", "1000000"))
+MONTE_CARLO_FALLBACK_MAX = 10_000
+_MC_SPREAD = 0.3                                            # σ as a fraction of the base estimate
+_MC_DELAY_CENTERS = (0.5, 0.75, 1.0, 1.25, 1.5)             # × base delay, heatmap rows
+_MC_COST_CENTERS = (0.4, 0.6, 0.8, 1.0, 1.2, 1.5)           # × base cost, heatmap columns
+_MC_DELAY_EDGES = (0, 0.625, 0.875, 1.125, 1.375, 10)
+_MC_COST_EDGES = (0, 0.5, 0.7, 0.9, 1.1, 1.3, 1.4, 10)
+_MC_COST_COLUMNS = (0, 1, 2, 3, 4, 6)                       # 1.3–1.4× lies between the last two buckets
+_MC_QUANTILES = (("P50", 0.50), ("P75", 0.75), ("P95", 0.95))
+
+
+def _monte_carlo_seed(risk_label, base_delay, base_cost):
+    """Stable across processes, unlike hash() on a str."""
+    return int.from_bytes(hashlib.sha256(f"{risk_label}|{base_delay}|{base_cost}".encode()).digest()[:8], "big")
+
+
+def _monte_carlo_heatmap(base_delay, base_cost, iterations, seed, correlation=0.0):
+    """Simulate delay/cost outcomes as normals around the base estimates
+    (clipped at 0, correlation between the two draws). Returns (heatmap,
+    percentiles): a 5×6 grid of % of outcomes per bucket, and
+    {"P50": (delay, cost), ...} as the sorted sample at int(n × q)."""
+    d_edges = [base_delay * m for m in _MC_DELAY_EDGES]
+    c_edges = [base_cost * m for m in _MC_COST_EDGES]
+    k = [int(iterations * q) for _, q in _MC_QUANTILES]
+    rho = max(-1.0, min(1.0, correlation))
+
+    if np is not None:
+        # float32 and in-place updates: 8 MB at 1M iterations, and the
+        # reported figures are whole days / $K anyway
+        samples = np.random.default_rng(seed).standard_normal((2, iterations), dtype=np.float32)
+        if rho:
+            samples[1] *= math.sqrt(1.0 - rho * rho)
+            samples[1] += rho * samples[0]
+        samples *= np.array([[base_delay * _MC_SPREAD], [base_cost * _MC_SPREAD]], dtype=np.float32)
+        samples += np.array([[base_delay], [base_cost]], dtype=np.float32)
+        np.maximum(samples, 0, out=samples)
+        counts, _, _ = np.histogram2d(samples[0], samples[1], bins=(d_edges, c_edges))
+        heatmap = np.round(counts[:, _MC_COST_COLUMNS] / iterations * 100, 1).tolist()
+        samples.partition(k, axis=1)
+        d_q, c_q = samples[:, k].tolist()
+    else:
+        rng = random.Random(seed)
+        counts = [[0] * (len(c_edges) - 1) for _ in range(len(d_edges) - 1)]
+        delay, cost = [], []
+        for _ in range(iterations):
+            z0, z1 = rng.gauss(0.0, 1.0), rng.gauss(0.0, 1.0)
+            if rho:
+                z1 = rho * z0 + math.sqrt(1.0 - rho * rho) * z1
+            d = max(0.0, base_delay + base_delay * _MC_SPREAD * z0)
+            c = max(0.0, base_cost + base_cost * _MC_SPREAD * z1)
+            delay.append(d)
+            cost.append(c)
+            if d <= d_edges[-1] and c <= c_edges[-1]:
+                # same half-open bins as histogram2d, last bin closed
+                di = min(bisect.bisect_right(d_edges, d), len(d_edges) - 1) - 1
+                ci = min(bisect.bisect_right(c_edges, c), len(c_edges) - 1) - 1
+                counts[di][ci] += 1
+        heatmap = [[round(row[ci] / iterations * 100, 1) for ci in _MC_COST_COLUMNS] for row in counts]
+        delay.sort()
+        cost.sort()
+        d_q = [delay[i] for i in k]
+        c_q = [cost[i] for i in k]
+
+    percentiles = {name: (d_q[i], c_q[i]) for i, (name, _) in enumerate(_MC_QUANTILES)}
+    return heatmap, percentiles
+
+
 # ═══════════════════════════════════════════════════════════════════════
 #  VERCEL HANDLER
 # ═══ AI AGENT — DEFENSE-SPECIFIC LLM SYSTEM PROMPT ═══════════════════
@@ -1631,60 +3980,814 @@ Joint/OSD: COMPASS, MBPS, GCSS, DPAS, DLA FLIS, PIEE/WAWF
 13. Submission Review & Discrepancy Analyzer (ILIE) — line-by-line discrepancy detection
 14. AI Agent (you!) — conversational assistant for all ILS tasks
 
-Note: Additional data management tools (Parts Cross-Reference, Contract Lifecycle, Digital Thread,
-Warranty Tracker, ILS Calendar, Provisioning/ICAPS, Defense Database Import) are available through
-HarborLink — S4 Systems' collaboration portal. S4 Ledger provides the blockchain anchoring layer
-for all HarborLink operations.
+Note: Additional data management tools (Parts Cross-Reference, Contract Lifecycle, Digital Thread,
+Warranty Tracker, ILS Calendar, Provisioning/ICAPS, Defense Database Import) are available through
+HarborLink — S4 Systems' collaboration portal. S4 Ledger provides the blockchain anchoring layer
+for all HarborLink operations.
+
+### Blockchain Anchoring
+- Every record is hashed (SHA-256) and anchored to the XRP Ledger
+- Zero data on-chain — only the hash fingerprint is stored
+- Immutable audit trail with XRPL transaction hash and explorer links
+- 0.01 SLS per anchor (SLS = Secure Logistics Standard, S4's utility token)
+
+### File Upload Support
+- CSV, XLSX/XLS, TXT, TSV — parsed and analyzed automatically
+- PDF — text extraction and analysis
+- DOCX — document parsing and content analysis
+- All processing done client-side in the browser — no data leaves the user's machine
+
+## BEHAVIORAL GUIDELINES
+
+1. **Be conversational** — You can handle casual chat, jokes, greetings, and personal questions. You're a helpful colleague, not a rigid bot.
+2. **Be an ILS expert** — When asked about defense logistics, go deep. Cite specific DI numbers, regulations, and best practices.
+3. **Work with every tool** — You know the context of which ILS tool the user is currently in. Provide tool-specific guidance.
+4. **Draft documents** — You can write memos, emails, CARs, briefing points, status reports, and SOW language.
+5. **Explain simply** — Defense logistics is complex. Explain at whatever level the user needs — executive summary or technical deep-dive.
+6. **Use data** — When analysis results are available, reference specific numbers, percentages, and action items.
+7. **Be honest** — If you don't know something, say so. Don't fabricate DI numbers, regulations, or technical details.
+8. **Security-aware** — Never ask for or discuss classified information. Remind users to use "Encrypt First" for CUI.
+9. **Format well** — Use bullet points, bold text, and clear structure. Keep responses scannable.
+10. **Handle ANY topic** — You MUST answer questions about weather, sports, coding, math, cooking, travel, relationships, science, or literally anything else. Never say "I can only help with defense topics" or "I'm unable to provide that information." You are a full AI assistant. Answer everything.
+"""
+
+    if tool_context:
+        ctx_upper = tool_context.upper()
+        if "program-schedule-notes" in tool_context or "program_schedule_notes" in tool_context:
+            prompt += (
+                "\n## CURRENT CONTEXT\n"
+                "The user is working in the **Program Schedule Notes** tool for Navy service craft acquisition milestones.\n"
+                "Your job is to draft or refine professional program status notes for individual vessels.\n"
+                "\n### Note Writing Guidelines\n"
+                "- Write in a formal Navy acquisition program management tone (similar to a PM brief or SETR note)\n"
+                "- Be specific: reference actual milestone names, dates, contract numbers, and shipbuilders when provided\n"
+                "- Typical length: 2-4 clear sentences\n"
+                "- Address: current schedule status, milestone outlook, risk posture, and any mitigation in progress\n"
+                "- Do NOT use first person. Write from the program office perspective.\n"
+                "- Use plain prose, no bullet points or markdown formatting in the note itself\n"
+                "- If the user asks to revise, shorten, formalize, or change tone, apply those edits to the note in context\n"
+            )
+        else:
+            prompt += f"\n## CURRENT CONTEXT\nThe user is currently working in the **{tool_context}** tool. Tailor your responses to be relevant to this tool's capabilities.\n"
+
+    if analysis_data:
+        prompt += f"\n## CURRENT ANALYSIS DATA\n{s4_codec.dumps(analysis_data, indent=2)}\nUse this data to provide specific, data-driven responses about the user's program.\n"
+
+    return prompt
+
+
+# ═══════════════════════════════════════════════════════════════════════
+#  AI PROVIDER ENGINE
+#  Chat completions for the AI Agent and the AI-assisted tools. Each
+#  provider has its own resilience.CircuitBreaker, so a provider that
+#  keeps failing is skipped without a network call until its recovery
+#  timeout. Healthy providers are tried fastest-first, ranked by observed
+#  latency and error rate. If the current attempt has not answered after
+#  AI_HEDGE_AFTER_S, the next provider is started alongside it and the
+#  first success wins. AI_DEADLINE_S bounds the whole call so it finishes
+#  inside Vercel's 30 s function limit.
+# ═══════════════════════════════════════════════════════════════════════
+
+AI_PROVIDER_TIMEOUT_S = float(os.environ.get("S4_AI_PROVIDER_TIMEOUT", "20"))
+AI_HEDGE_AFTER_S = float(os.environ.get("S4_AI_HEDGE_AFTER", "4"))   # 0 disables hedging
+AI_DEADLINE_S = float(os.environ.get("S4_AI_DEADLINE", "25"))
+AI_BREAKER_FAILURES = 3
+AI_BREAKER_RECOVERY_S = 60
+_AI_EWMA_ALPHA = 0.2
+
+
+def _ai_chat_messages(conversation, user_message):
+    """Last 20 conversation turns plus the new user message. The UI sends
+    {"role", "text"}; its "bot" role becomes "assistant"."""
+    messages = []
+    for msg in (conversation or [])[-20:]:
+        role = msg.get("role", "user")
+        messages.append({"role": "assistant" if role == "bot" else role,
+                         "content": msg.get("text", msg.get("content", ""))})
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+def _azure_openai_request(system_prompt, messages, max_tokens):
+    endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT", "")
+    deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT", "gpt-4o")
+    return (f"{endpoint}/openai/deployments/{deployment}/chat/completions?api-version=2024-02-01",
+            {"Content-Type": "application/json", "api-key": os.environ.get("AZURE_OPENAI_KEY", "")},
+            {"messages": [{"role": "system", "content": system_prompt}] + messages,
+             "max_tokens": max_tokens, "temperature": 0.7})
+
+
+def _openai_request(system_prompt, messages, max_tokens):
+    return ("https://api.openai.com/v1/chat/completions",
+            {"Content-Type": "application/json", "Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY', '')}"},
+            {"model": "gpt-4o", "messages": [{"role": "system", "content": system_prompt}] + messages,
+             "max_tokens": max_tokens, "temperature": 0.7})
+
+
+def _anthropic_request(system_prompt, messages, max_tokens):
+    return ("https://api.anthropic.com/v1/messages",
+            {"Content-Type": "application/json", "x-api-key": os.environ.get("ANTHROPIC_API_KEY", "").strip(),
+             "anthropic-version": "2023-06-01"},
+            {"model": "claude-sonnet-4-20250514", "system": system_prompt,
+             "messages": messages, "max_tokens": max_tokens})
+
+
+def _post_json(request, timeout):
+    url, headers, payload = request
+    resp = http_pool.request("POST", url, body=s4_codec.dumpb(payload), headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    return s4_codec.loads(resp.body)
+
+
+def _post_sse(request, timeout):
+    """POST with stream=true and yield each server-sent event's parsed
+    data: payload. The body is read to the end so the connection can be
+    reused; timeout bounds each read, not the whole stream."""
+    url, headers, payload = request
+    with http_pool.stream("POST", url, body=s4_codec.dumpb(dict(payload, stream=True)),
+                          headers=dict(headers, Accept="text/event-stream"), timeout=timeout) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data and data != "[DONE]":
+                yield s4_codec.loads(data)
+
+
+def _openai_deltas(events):
+    """Text deltas from an OpenAI / Azure OpenAI chat completion stream."""
+    for event in events:
+        for choice in event.get("choices") or ():   # Azure opens with a choices-less filter event
+            text = (choice.get("delta") or {}).get("content")
+            if text:
+                yield text
+
+
+def _anthropic_deltas(events):
+    """Text deltas from an Anthropic Messages stream."""
+    for event in events:
+        kind = event.get("type")
+        if kind == "content_block_delta":
+            text = event.get("delta", {}).get("text")
+            if text:
+                yield text
+        elif kind == "error":
+            raise RuntimeError(event.get("error", {}).get("message", "stream error"))
+
+
+def _call_azure_openai(system_prompt, messages, max_tokens, timeout):
+    return _post_json(_azure_openai_request(system_prompt, messages, max_tokens), timeout)["choices"][0]["message"]["content"]
+
+
+def _call_openai(system_prompt, messages, max_tokens, timeout):
+    return _post_json(_openai_request(system_prompt, messages, max_tokens), timeout)["choices"][0]["message"]["content"]
+
+
+def _call_anthropic(system_prompt, messages, max_tokens, timeout):
+    return _post_json(_anthropic_request(system_prompt, messages, max_tokens), timeout)["content"][0]["text"]
+
+
+def _stream_azure_openai(system_prompt, messages, max_tokens, timeout):
+    return _openai_deltas(_post_sse(_azure_openai_request(system_prompt, messages, max_tokens), timeout))
+
+
+def _stream_openai(system_prompt, messages, max_tokens, timeout):
+    return _openai_deltas(_post_sse(_openai_request(system_prompt, messages, max_tokens), timeout))
+
+
+def _stream_anthropic(system_prompt, messages, max_tokens, timeout):
+    return _anthropic_deltas(_post_sse(_anthropic_request(system_prompt, messages, max_tokens), timeout))
+
+
+class _AIProvider:
+    """One chat-completion backend. configured() checks its env vars at
+    call time; call(system_prompt, messages, max_tokens, timeout) returns
+    the reply text or raises. stream(...), when given, takes the same
+    arguments and returns an iterator of text chunks."""
+
+    __slots__ = ("name", "model", "configured", "call", "stream")
+
+    def __init__(self, name, model, configured, call, stream=None):
+        self.name = name
+        self.model = model
+        self.configured = configured
+        self.call = call
+        self.stream = stream
+
+
+AI_PROVIDERS = (   # declaration order breaks ties, so Azure (FedRAMP eligible) leads until measured
+    _AIProvider("azure_openai", os.environ.get("AZURE_OPENAI_DEPLOYMENT", "gpt-4o"),
+                lambda: bool(os.environ.get("AZURE_OPENAI_ENDPOINT") and os.environ.get("AZURE_OPENAI_KEY")),
+                _call_azure_openai, _stream_azure_openai),
+    _AIProvider("openai", "gpt-4o", lambda: bool(os.environ.get("OPENAI_API_KEY")), _call_openai, _stream_openai),
+    _AIProvider("anthropic", "claude-sonnet-4-20250514",
+                lambda: bool(os.environ.get("ANTHROPIC_API_KEY", "").strip()), _call_anthropic, _stream_anthropic),
+)
+
+
+class _AIStreamInterrupted(Exception):
+    """A provider failed after its first streamed chunk: the reply that
+    went out is partial and must not be cached or stored as an answer."""
+
+    def __init__(self, provider, error):
+        super().__init__(f"{provider}: {error}")
+        self.provider = provider
+        self.error = error
+
+
+class _AIProviderEngine:
+    """Runs a chat completion across providers: breaker-gated, ranked by
+    observed latency and error rate, hedged after hedge_after seconds,
+    bounded by deadline. complete() returns (text, provider_name) or
+    (None, None)."""
+
+    def __init__(self, providers, hedge_after=AI_HEDGE_AFTER_S, timeout=AI_PROVIDER_TIMEOUT_S,
+                 deadline=AI_DEADLINE_S, failure_threshold=AI_BREAKER_FAILURES,
+                 recovery_timeout=AI_BREAKER_RECOVERY_S):
+        self.providers = list(providers)
+        self.hedge_after = hedge_after
+        self.timeout = timeout
+        self.deadline = deadline
+        self.breakers = {p.name: CircuitBreaker(name=f"ai_{p.name}", failure_threshold=failure_threshold,
+                                                recovery_timeout=recovery_timeout)
+                         for p in self.providers}
+        self._stats = {p.name: {"calls": 0, "failures": 0, "latency_s": None, "error_rate": 0.0,
+                                "last_error": None}
+                       for p in self.providers}
+        self._hedges = 0
+        self._lock = threading.Lock()
+
+    def _score(self, name):
+        """Expected seconds to a successful reply: latency EWMA inflated by
+        the error-rate EWMA. Providers never called score 0 (tried first);
+        providers that have only failed are charged the full timeout."""
+        s = self._stats[name]
+        if not s["calls"]:
+            return 0.0
+        latency = s["latency_s"] if s["latency_s"] is not None else self.timeout
+        return latency / max(0.05, 1.0 - s["error_rate"])
+
+    def ranked(self):
+        """Configured providers whose breaker admits a call, best first."""
+        candidates = [p for p in self.providers if p.configured() and self.breakers[p.name].can_execute()]
+        with self._lock:
+            return sorted(candidates, key=lambda p: self._score(p.name))   # stable: ties keep declaration order
+
+    def model(self, name):
+        for p in self.providers:
+            if p.name == name:
+                return p.model
+        return None
+
+    def complete(self, system_prompt, user_message, conversation=None, max_tokens=2000):
+        candidates = self.ranked()
+        if not candidates:
+            return None, None
+        messages = _ai_chat_messages(conversation, user_message)
+        results = queue.Queue()
+        deadline = time.monotonic() + self.deadline
+        started = running = 0
+
+        def launch():
+            nonlocal started, running
+            provider = candidates[started]
+            started += 1
+            running += 1
+            timeout = max(1.0, min(self.timeout, deadline - time.monotonic()))
+            threading.Thread(target=self._attempt, name=f"s4-ai-{provider.name}", daemon=True,
+                             args=(provider, system_prompt, messages, max_tokens, timeout, results)).start()
+
+        launch()
+        while running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            hedge = self.hedge_after > 0 and started < len(candidates)
+            try:
+                name, text = results.get(timeout=min(remaining, self.hedge_after) if hedge else remaining)
+            except queue.Empty:
+                if hedge:
+                    with self._lock:
+                        self._hedges += 1
+                    launch()
+                continue
+            running -= 1
+            if text:
+                return text, name
+            if started < len(candidates):
+                launch()
+        return None, None
+
+    def _attempt(self, provider, system_prompt, messages, max_tokens, timeout, results):
+        """Worker thread: one provider call. Slower attempts that lose a
+        hedge still finish here and update the provider's stats."""
+        t0 = time.monotonic()
+        text, error = None, None
+        try:
+            text = provider.call(system_prompt, messages, max_tokens, timeout)
+            if not text:
+                error = "empty response"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:200]
+        self._record(provider.name, time.monotonic() - t0, error)
+        results.put((provider.name, None if error else text))
+
+    def stream(self, system_prompt, user_message, conversation=None, max_tokens=2000):
+        """Yield (provider_name, chunk) for a streamed reply. Providers are
+        tried in ranked order until one produces its first chunk; after
+        that the reply is committed to it, and a mid-stream failure raises
+        _AIStreamInterrupted. Providers without stream() are called whole.
+        No hedging: two live streams cannot be merged into one reply."""
+        messages = _ai_chat_messages(conversation, user_message)
+        deadline = time.monotonic() + self.deadline
+        for provider in self.ranked():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            timeout = max(1.0, min(self.timeout, remaining))
+            t0 = time.monotonic()
+            produced, error = False, None
+            try:
+                if provider.stream is None:
+                    chunks = [provider.call(system_prompt, messages, max_tokens, timeout)]
+                else:
+                    chunks = provider.stream(system_prompt, messages, max_tokens, timeout)
+                for chunk in chunks:
+                    if chunk:
+                        produced = True
+                        yield provider.name, chunk
+                if not produced:
+                    error = "empty response"
+            except GeneratorExit:
+                raise
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"[:200]
+            # a stream's duration tracks reply length, so it does not feed the latency EWMA
+            self._record(provider.name, time.monotonic() - t0, error, latency=False)
+            if produced and error:
+                raise _AIStreamInterrupted(provider.name, error)
+            if produced:
+                return
+
+    def _record(self, name, elapsed, error, latency=True):
+        """Fold one finished attempt into the provider's stats and breaker."""
+        breaker = self.breakers[name]
+        with self._lock:
+            s = self._stats[name]
+            s["calls"] += 1
+            s["error_rate"] += _AI_EWMA_ALPHA * ((1.0 if error else 0.0) - s["error_rate"])
+            if error:
+                s["failures"] += 1
+                s["last_error"] = error
+            elif latency:
+                s["latency_s"] = elapsed if s["latency_s"] is None else \
+                    s["latency_s"] + _AI_EWMA_ALPHA * (elapsed - s["latency_s"])
+        if error:
+            breaker.record_failure()
+            logger.warning("AI provider %s failed after %.2fs: %s", name, elapsed, error)
+        else:
+            breaker.record_success()
+        metrics.ai_provider_call(name, elapsed, success=not error)
+
+    def get_stats(self):
+        with self._lock:
+            providers = {}
+            for p in self.providers:
+                s = self._stats[p.name]
+                providers[p.name] = {
+                    "configured": p.configured(),
+                    "model": p.model,
+                    "breaker": self.breakers[p.name].get_status()["state"],
+                    "calls": s["calls"],
+                    "failures": s["failures"],
+                    "error_rate": round(s["error_rate"], 3),
+                    "latency_ms": round(s["latency_s"] * 1000, 1) if s["latency_s"] is not None else None,
+                    "last_error": s["last_error"],
+                }
+            return {"hedge_after_s": self.hedge_after, "deadline_s": self.deadline,
+                    "hedges": self._hedges, "providers": providers}
+
+
+_ai_engine = _AIProviderEngine(AI_PROVIDERS)
+
+
+# ═══════════════════════════════════════════════════════════════════════
+#  LLM RESPONSE CACHE
+#  Content-addressed cache in front of _ai_engine, shared by every
+#  AI-backed route. The key is a sha256 over the route, the system
+#  prompt, the whitespace-normalised user message and the last
+#  LLM_CACHE_TAIL conversation turns, so the same question over the same
+#  context is answered once per TTL. Entries live in an in-memory LRU
+#  (OrderedDict, O(1) eviction). An optional second tier survives cold
+#  starts: a local SQLite file (S4_LLM_CACHE_BACKEND=sqlite) or the
+#  Supabase llm_cache table (S4_LLM_CACHE_BACKEND=supabase).
+# ═══════════════════════════════════════════════════════════════════════
+
+LLM_CACHE_BACKEND = os.environ.get("S4_LLM_CACHE_BACKEND", "memory").strip().lower()   # memory | sqlite | supabase
+LLM_CACHE_SQLITE_PATH = os.environ.get("S4_LLM_CACHE_SQLITE", "/tmp/s4_llm_cache.db")
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("S4_LLM_CACHE_ENTRIES", "1000"))
+LLM_CACHE_DEFAULT_TTL = int(os.environ.get("S4_LLM_CACHE_TTL", "900"))
+LLM_CACHE_TAIL = 6   # conversation turns that feed the key
+LLM_CACHE_TTLS = {   # seconds; 0 = never cached. Unlisted routes use LLM_CACHE_DEFAULT_TTL.
+    "ai_chat": 120,
+    "ai_rag": 120,
+    "living_ledger": 300,
+    "vault_emails": 0,   # drafts quote one user's mail; never shared
+}
+
+
+class _SQLiteLLMStore:
+    """Second cache tier in a local SQLite file."""
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._puts = 0
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    route TEXT,
+                    response TEXT NOT NULL,
+                    provider TEXT,
+                    expires_at REAL NOT NULL
+                )
+            """)
+
+    def get(self, key, now):
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute("SELECT response, provider, expires_at FROM llm_cache WHERE cache_key = ? AND expires_at > ?",
+                               (key, now)).fetchone()
+        return tuple(row) if row else None
+
+    def put(self, key, route, response, provider, expires_at):
+        with self._lock:
+            self._puts += 1
+            with sqlite3.connect(self.path) as conn:
+                conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?)",
+                             (key, route, response, provider, expires_at))
+                if self._puts % 100 == 0:
+                    conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),))
+
+
+class _SupabaseLLMStore:
+    """Second cache tier in the Supabase llm_cache table (migration 021)."""
+
+    name = "supabase"
+
+    @staticmethod
+    def _ts(epoch):
+        return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def get(self, key, now):
+        rows = _sb_select("llm_cache", query_params=f"cache_key=eq.{key}&expires_at=gt.{self._ts(now)}",
+                          select="response,provider,expires_at", limit=1)
+        if not rows:
+            return None
+        expires_at = datetime.fromisoformat(rows[0]["expires_at"].replace("Z", "+00:00")).timestamp()
+        return rows[0]["response"], rows[0].get("provider"), expires_at
+
+    def put(self, key, route, response, provider, expires_at):
+        _supabase_request("llm_cache", method="POST", query_params="on_conflict=cache_key",
+                          prefer="return=minimal,resolution=merge-duplicates",
+                          data={"cache_key": key, "route": route, "response": response,
+                                "provider": provider, "expires_at": self._ts(expires_at)})
+
+
+class _LLMCache:
+    """In-memory LRU of LLM replies with an optional persistent tier.
+    get()/put() never raise: a broken store only costs cache hits."""
+
+    def __init__(self, max_entries=LLM_CACHE_MAX_ENTRIES, store=None):
+        self.max_entries = max_entries
+        self.store = store
+        self._entries = OrderedDict()   # key -> (expires_at, response, provider)
+        self._lock = threading.Lock()
+        self._counts = {"hits": 0, "store_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "store_errors": 0}
+
+    @staticmethod
+    def key(route, system_prompt, user_message, conversation=None):
+        tail = [[m.get("role", "user"), m.get("text", m.get("content", ""))]
+                for m in (conversation or [])[-LLM_CACHE_TAIL:]]
+        material = s4_codec.canonical([route, system_prompt, " ".join(user_message.split()), tail],
+                                      ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    @staticmethod
+    def ttl(route):
+        return LLM_CACHE_TTLS.get(route, LLM_CACHE_DEFAULT_TTL)
+
+    def get(self, key, route="", now=None):
+        """(response, provider) or None."""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._counts["hits"] += 1
+        if entry is None and self.store is not None:
+            try:
+                entry = self.store.get(key, now)
+            except Exception as e:
+                entry = None
+                self._store_error("get", e)
+            if entry is not None:
+                response, provider, expires_at = entry
+                entry = (expires_at, response, provider)
+                self._insert(key, entry)
+                with self._lock:
+                    self._counts["store_hits"] += 1
+        if entry is None:
+            with self._lock:
+                self._counts["misses"] += 1
+        metrics.llm_cache_lookup(route, hit=entry is not None)
+        return (entry[1], entry[2]) if entry is not None else None
+
+    def put(self, key, route, response, provider, ttl, now=None):
+        if ttl <= 0 or not response:
+            return
+        expires_at = (time.time() if now is None else now) + ttl
+        self._insert(key, (expires_at, response, provider))
+        with self._lock:
+            self._counts["stores"] += 1
+        if self.store is not None:
+            try:
+                self.store.put(key, route, response, provider, expires_at)
+            except Exception as e:
+                self._store_error("put", e)
+
+    def _insert(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counts["evictions"] += 1
+
+    def _store_error(self, op, error):
+        with self._lock:
+            self._counts["store_errors"] += 1
+        logger.warning("LLM cache store %s failed: %s", op, error)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self._counts["hits"] + self._counts["store_hits"] + self._counts["misses"]
+            return {
+                "backend": self.store.name if self.store is not None else "memory",
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                **self._counts,
+                "hit_ratio": round((lookups - self._counts["misses"]) / lookups, 3) if lookups else 0.0,
+            }
+
+
+def _llm_cache_store():
+    try:
+        if LLM_CACHE_BACKEND == "sqlite":
+            return _SQLiteLLMStore(LLM_CACHE_SQLITE_PATH)
+        if LLM_CACHE_BACKEND == "supabase":
+            return _SupabaseLLMStore()
+    except Exception as e:
+        logger.warning("LLM cache %s store unavailable, using memory only: %s", LLM_CACHE_BACKEND, e)
+    return None
+
+
+_llm_cache = _LLMCache(store=_llm_cache_store())
+
+
+# ═══════════════════════════════════════════════════════════════════════
+#  AI SINGLE-FLIGHT
+#  The LLM cache is only filled once a call completes, so a burst of
+#  identical requests (a program office opening the dashboard) would
+#  otherwise start one 10-30 s LLM call each. Concurrent calls with the
+#  same cache key wait on the first one and share its reply, or its
+#  exception. Followers give up after AI_SINGLE_FLIGHT_TIMEOUT_S.
+# ═══════════════════════════════════════════════════════════════════════
+
+AI_SINGLE_FLIGHT_TIMEOUT_S = AI_DEADLINE_S + 5
 
-### Blockchain Anchoring
-- Every record is hashed (SHA-256) and anchored to the XRP Ledger
-- Zero data on-chain — only the hash fingerprint is stored
-- Immutable audit trail with XRPL transaction hash and explorer links
-- 0.01 SLS per anchor (SLS = Secure Logistics Standard, S4's utility token)
 
-### File Upload Support
-- CSV, XLSX/XLS, TXT, TSV — parsed and analyzed automatically
-- PDF — text extraction and analysis
-- DOCX — document parsing and content analysis
-- All processing done client-side in the browser — no data leaves the user's machine
+class _FlightCall:
+    __slots__ = ("done", "result", "error", "followers")
 
-## BEHAVIORAL GUIDELINES
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
 
-1. **Be conversational** — You can handle casual chat, jokes, greetings, and personal questions. You're a helpful colleague, not a rigid bot.
-2. **Be an ILS expert** — When asked about defense logistics, go deep. Cite specific DI numbers, regulations, and best practices.
-3. **Work with every tool** — You know the context of which ILS tool the user is currently in. Provide tool-specific guidance.
-4. **Draft documents** — You can write memos, emails, CARs, briefing points, status reports, and SOW language.
-5. **Explain simply** — Defense logistics is complex. Explain at whatever level the user needs — executive summary or technical deep-dive.
-6. **Use data** — When analysis results are available, reference specific numbers, percentages, and action items.
-7. **Be honest** — If you don't know something, say so. Don't fabricate DI numbers, regulations, or technical details.
-8. **Security-aware** — Never ask for or discuss classified information. Remind users to use "Encrypt First" for CUI.
-9. **Format well** — Use bullet points, bold text, and clear structure. Keep responses scannable.
-10. **Handle ANY topic** — You MUST answer questions about weather, sports, coding, math, cooking, travel, relationships, science, or literally anything else. Never say "I can only help with defense topics" or "I'm unable to provide that information." You are a full AI assistant. Answer everything.
-"""
 
-    if tool_context:
-        ctx_upper = tool_context.upper()
-        if "program-schedule-notes" in tool_context or "program_schedule_notes" in tool_context:
-            prompt += (
-                "\n## CURRENT CONTEXT\n"
-                "The user is working in the **Program Schedule Notes** tool for Navy service craft acquisition milestones.\n"
-                "Your job is to draft or refine professional program status notes for individual vessels.\n"
-                "\n### Note Writing Guidelines\n"
-                "- Write in a formal Navy acquisition program management tone (similar to a PM brief or SETR note)\n"
-                "- Be specific: reference actual milestone names, dates, contract numbers, and shipbuilders when provided\n"
-                "- Typical length: 2-4 clear sentences\n"
-                "- Address: current schedule status, milestone outlook, risk posture, and any mitigation in progress\n"
-                "- Do NOT use first person. Write from the program office perspective.\n"
-                "- Use plain prose, no bullet points or markdown formatting in the note itself\n"
-                "- If the user asks to revise, shorten, formalize, or change tone, apply those edits to the note in context\n"
-            )
-        else:
-            prompt += f"\n## CURRENT CONTEXT\nThe user is currently working in the **{tool_context}** tool. Tailor your responses to be relevant to this tool's capabilities.\n"
+class _SingleFlight:
+    """Runs fn once per key among concurrent callers. do() returns
+    (result, shared); shared is True for callers that waited on another
+    caller's execution."""
 
-    if analysis_data:
-        prompt += f"\n## CURRENT ANALYSIS DATA\n{json.dumps(analysis_data, indent=2)}\nUse this data to provide specific, data-driven responses about the user's program.\n"
+    def __init__(self):
+        self._calls = {}   # key -> _FlightCall
+        self._lock = threading.Lock()
+        self._counts = {"leaders": 0, "shared": 0, "timeouts": 0, "errors": 0}
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+                self._counts["leaders"] += 1
+            else:
+                call.followers += 1
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+                with self._lock:
+                    self._counts["errors"] += 1
+                raise
+            finally:
+                # unregister before waking followers: later callers start a
+                # new flight (or, for the AI path, find the reply cached)
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result, False
+        if not call.done.wait(timeout):
+            with self._lock:
+                self._counts["timeouts"] += 1
+            raise TimeoutError(f"in-flight call did not finish within {timeout}s")
+        if call.error is not None:
+            raise call.error
+        with self._lock:
+            self._counts["shared"] += 1
+        return call.result, True
+
+    def get_stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), **self._counts}
+
+
+_ai_single_flight = _SingleFlight()
+
+
+def _cached_ai_complete(route, system_prompt, user_message, conversation=None, max_tokens=2000):
+    """_ai_engine.complete through _llm_cache and _ai_single_flight.
+    Returns (text, provider, cached); cached is True when this request
+    did not run the LLM call itself (cache hit or shared in-flight call)."""
+    ttl = _llm_cache.ttl(route)
+    key = _llm_cache.key(route, system_prompt, user_message, conversation)
+    if ttl > 0:
+        hit = _llm_cache.get(key, route)
+        if hit is not None:
+            return hit[0], hit[1], True
+
+    def generate():
+        text, provider = _ai_engine.complete(system_prompt, user_message, conversation, max_tokens)
+        if text:
+            _llm_cache.put(key, route, text, provider, ttl)
+        return text, provider
+
+    try:
+        (text, provider), shared = _ai_single_flight.do(key, generate, timeout=AI_SINGLE_FLIGHT_TIMEOUT_S)
+    except TimeoutError:
+        logger.warning("AI call for %s timed out waiting on an identical in-flight request", route)
+        return None, None, False
+    if shared:
+        metrics.inc("s4_ai_coalesced_total", labels={"route": route})
+    return text, provider, shared
+
+# ═══════════════════════════════════════════════════════════════════════
+#  XRPL ACCOUNT STATE CACHE
+#  wallet_balance, treasury_health and the bulk /api/wallet/balances read
+#  XRP + SLS balances through here. AccountInfo and AccountLines go out
+#  concurrently against the validated ledger, results are kept for
+#  S4_ACCOUNT_STATE_TTL_S (about one ledger close), and concurrent misses
+#  for the same address share one fetch via _SingleFlight. Every state
+#  carries the ledger_index it was read from.
+# ═══════════════════════════════════════════════════════════════════════
+
+ACCOUNT_STATE_TTL_S = float(os.environ.get("S4_ACCOUNT_STATE_TTL_S", "4"))
+ACCOUNT_STATE_WORKERS = int(os.environ.get("S4_ACCOUNT_STATE_WORKERS", "8"))
+ACCOUNT_STATE_MAX = 10_000
+WALLET_BALANCES_MAX = 200      # addresses per /api/wallet/balances call
+
+_account_lines_pool = ThreadPoolExecutor(max_workers=ACCOUNT_STATE_WORKERS, thread_name_prefix="s4-account")
+
+
+def _fetch_account_state(address):
+    """Read one account's XRP and SLS balances from the validated ledger."""
+    lines_future = _account_lines_pool.submit(
+        _xrpl_request, AccountLines(account=address, ledger_index="validated"))
+    info = _xrpl_request(AccountInfo(account=address, ledger_index="validated"))
+    lines = lines_future.result()
+    ledger_index = info.result.get("ledger_index") or info.result.get("ledger_current_index")
+    lines_ledger = lines.result.get("ledger_index")
+    if ledger_index and lines_ledger and lines_ledger != ledger_index:
+        # a ledger closed between the two reads; re-read lines at info's ledger
+        lines = _xrpl_request(AccountLines(account=address, ledger_index=ledger_index))
+    sls_balance = "0"
+    for line in lines.result.get("lines", []):
+        if line.get("currency") == "SLS" and line.get("account") == SLS_ISSUER_ADDRESS:
+            sls_balance = line.get("balance", "0")
+            break
+    state = {
+        "address": address,
+        "xrp_balance": round(int(info.result.get("account_data", {}).get("Balance", "0")) / 1_000_000, 6),
+        "sls_balance": sls_balance,
+        "ledger_index": ledger_index,
+        "fetched_at": datetime.now(timezone.utc).isoformat(),
+    }
+    if not info.is_successful():
+        state["error"] = info.result.get("error", "unknown")
+    return state
+
+
+def _account_balance_view(state):
+    """Public balance JSON for one account state."""
+    sls = float(state["sls_balance"])
+    view = {
+        "address": state["address"],
+        "xrp_balance": state["xrp_balance"],
+        "sls_balance": state["sls_balance"],
+        "anchors_available": int(sls / float(SLS_ANCHOR_FEE)) if sls > 0 else 0,
+        "ledger_index": state["ledger_index"],
+        "explorer_url": XRPL_EXPLORER.replace("/transactions/", "/accounts/") + state["address"],
+    }
+    if state.get("error"):
+        view["error"] = state["error"]
+    return view
+
+
+class _AccountStateCache:
+    """TTL cache of _fetch_account_state results with request coalescing."""
+
+    def __init__(self, fetch=_fetch_account_state, ttl=ACCOUNT_STATE_TTL_S, max_entries=ACCOUNT_STATE_MAX):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # address -> (expires_at, state)
+        self._lock = threading.Lock()
+        self._flight = _SingleFlight()
+        self._counts = {"hits": 0, "misses": 0, "fetches": 0}
+
+    def get(self, address):
+        """Return (state, cached)."""
+        with self._lock:
+            entry = self._entries.get(address)
+            if entry and entry[0] > time.monotonic():
+                self._counts["hits"] += 1
+                return entry[1], True
+            self._counts["misses"] += 1
+        state, shared = self._flight.do(address, lambda: self._load(address))
+        return state, shared
+
+    def _load(self, address):
+        state = self._fetch(address)
+        with self._lock:
+            self._counts["fetches"] += 1
+            self._entries[address] = (time.monotonic() + self.ttl, state)
+            self._entries.move_to_end(address)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return state
+
+    def get_many(self, addresses):
+        """States for many addresses, fetched concurrently. Returns a list
+        of (address, state or None, cached, error or None) in input order."""
+        def one(address):
+            try:
+                return (address, *self.get(address), None)
+            except Exception as e:
+                return address, None, False, e
+        if len(addresses) <= 1:
+            return [one(a) for a in addresses]
+        with ThreadPoolExecutor(max_workers=min(ACCOUNT_STATE_WORKERS, len(addresses))) as pool:
+            return list(pool.map(one, addresses))
+
+    def invalidate(self, address):
+        with self._lock:
+            self._entries.pop(address, None)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats["size"] = len(self._entries)
+        stats["ttl_s"] = self.ttl
+        stats["coalesced"] = self._flight.get_stats()["shared"]
+        return stats
+
+
+_account_state = _AccountStateCache()
 
-    return prompt
 
 # ═══════════════════════════════════════════════════════════════════════
 
@@ -1706,7 +4809,7 @@ class handler(BaseHTTPRequestHandler):
             "Access-Control-Allow-Origin": allowed,
             "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
             "Access-Control-Allow-Headers": "Content-Type, Authorization, X-API-Key",
-            "Vary": "Origin",
+            "Vary": "Origin, Accept-Encoding",
             "Content-Type": "application/json",
             "X-Content-Type-Options": "nosniff",
             "X-Frame-Options": "DENY",
@@ -1719,14 +4822,81 @@ class handler(BaseHTTPRequestHandler):
             "Content-Security-Policy": "default-src 'none'; frame-ancestors 'none'",
         }
 
-    def _send_json(self, data, status=200):
-        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    def _serve_cached(self, route, parsed):
+        """Answer a cacheable GET from _response_cache. Returns True if the
+        response was sent; on a miss, arms _send_json to fill the cache."""
+        if route not in RESPONSE_CACHE_ROUTES:
+            return False
+        key = _ResponseCache.key(route, parsed.query, self.headers.get("X-API-Key", ""))
+        entry = _response_cache.get(key)
+        if entry is None:
+            self._cache_fill = (key, _response_cache.generation(route))
+            return False
+        self._send_etagged(entry[2], entry[1], "HIT")
+        return True
+
+    def _send_etagged(self, body, etag, cache_status):
+        """Send a 200 JSON body with its ETag, or 304 with no body when the
+        client's If-None-Match already holds it (under any encoding)."""
+        encoding = None
+        if len(body) >= RESPONSE_COMPRESS_MIN_BYTES:
+            encoding = _negotiate_encoding(self.headers.get("Accept-Encoding", ""))
+        cache_headers = {"ETag": _encoded_etag(etag, encoding), "Cache-Control": "private, no-cache",
+                         "X-Cache": cache_status}
+        if_none_match = self.headers.get("If-None-Match", "")
+        if if_none_match:
+            current = {etag} | {_encoded_etag(etag, name) for name in _RESPONSE_ENCODERS}
+            tags = {t.strip() for t in if_none_match.split(",")}
+            if "*" in tags or tags & current:
+                _response_cache.not_modified()
+                self.send_response(304)
+                for k, v in self._cors_headers().items():
+                    if k != "Content-Type":
+                        self.send_header(k, v)
+                for k, v in cache_headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self._finish_request(304)
+                return
+        self._send_body(body, 200, cache_headers, encoding=encoding)
+
+    def _send_body(self, body, status=200, headers=None, encoding=False):
+        """Write a complete response. Bodies of at least
+        RESPONSE_COMPRESS_MIN_BYTES are compressed with the best coding the
+        client accepts; pass encoding to skip negotiation (None = identity)."""
+        out = self._cors_headers()
+        out.update(headers or {})
+        if encoding is False:
+            encoding = None
+            if len(body) >= RESPONSE_COMPRESS_MIN_BYTES:
+                encoding = _negotiate_encoding(self.headers.get("Accept-Encoding", ""))
+        if encoding:
+            body = _RESPONSE_ENCODERS[encoding](body)
+            out["Content-Encoding"] = encoding
+        out["Content-Length"] = str(len(body))
         self.send_response(status)
-        for k, v in self._cors_headers().items():
+        for k, v in out.items():
             self.send_header(k, v)
         self.end_headers()
+        # logged before the body write so the entry exists by the time the
+        # client (which now has Content-Length) sees the full response
+        self._finish_request(status)
         self.wfile.write(body)
 
+    def _send_json(self, data, status=200, headers=None):
+        body = s4_codec.dumpb(data)
+        cache_fill = getattr(self, "_cache_fill", None)
+        if cache_fill is not None:
+            self._cache_fill = None
+            if status == 200 and not headers:
+                etag = _response_cache.put(cache_fill[0], cache_fill[1], body)
+                self._send_etagged(body, etag, "MISS")
+                return
+        self._send_body(body, status, headers)
+
+    def _send_text(self, text, content_type="text/plain; charset=utf-8", status=200):
+        self._send_body(text.encode("utf-8"), status, {"Content-Type": content_type})
+
     MAX_BODY_SIZE = 1_048_576  # 1 MB
 
     def _read_body(self):
@@ -1737,69 +4907,211 @@ class handler(BaseHTTPRequestHandler):
             return {}
         raw = self.rfile.read(length)
         try:
-            return json.loads(raw)
+            return s4_codec.loads(raw)
         except Exception:
             return {}
 
-    def _call_ai_cascade(self, system_prompt, user_message, conversation=None):
-        """Call AI providers in cascade: Azure OpenAI → OpenAI → Anthropic → None."""
-        import urllib.request
-        if conversation is None:
-            conversation = []
-
-        openai_key = os.environ.get("OPENAI_API_KEY", "")
-        anthropic_key = os.environ.get("ANTHROPIC_API_KEY", "")
-        azure_endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT", "")
-        azure_key = os.environ.get("AZURE_OPENAI_KEY", "")
-        azure_deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT", "gpt-4o")
-
-        messages = [{"role": "system", "content": system_prompt}]
-        for msg in conversation[-20:]:
-            messages.append({"role": msg.get("role", "user"), "content": msg.get("text", msg.get("content", ""))})
-        messages.append({"role": "user", "content": user_message})
-
-        # Try Azure OpenAI (FedRAMP eligible)
-        if azure_endpoint and azure_key:
-            try:
-                api_url = f"{azure_endpoint}/openai/deployments/{azure_deployment}/chat/completions?api-version=2024-02-01"
-                req_body = json.dumps({"messages": messages, "max_tokens": 2000, "temperature": 0.7}).encode()
-                req = urllib.request.Request(api_url, data=req_body, headers={"Content-Type": "application/json", "api-key": azure_key})
-                with urllib.request.urlopen(req, timeout=30) as resp:
-                    result = json.loads(resp.read().decode())
-                    return result["choices"][0]["message"]["content"]
-            except Exception:
-                pass
+    def _iter_body_lines(self, max_line=None):
+        """Yield request body lines without buffering the whole body.
+        Handles both Content-Length and Transfer-Encoding: chunked."""
+        max_line = max_line or self.MAX_BODY_SIZE
+
+        def blocks():
+            if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                    if size == 0:
+                        self.rfile.readline()  # trailing CRLF
+                        return
+                    yield self.rfile.read(size)
+                    self.rfile.readline()      # CRLF after chunk
+            else:
+                remaining = int(self.headers.get("Content-Length", 0))
+                while remaining > 0:
+                    block = self.rfile.read(min(65536, remaining))
+                    if not block:
+                        return
+                    remaining -= len(block)
+                    yield block
+
+        pending = b""
+        for block in blocks():
+            pending += block
+            *lines, pending = pending.split(b"\n")
+            if len(pending) > max_line:
+                raise ValueError("NDJSON line exceeds maximum size")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if pending.strip():
+            yield pending
+
+    def _verify_batch_stream(self, parsed):
+        """/api/verify/batch in NDJSON streaming mode.
+
+        Input is either an NDJSON body (one record object per line) or, with
+        only Accept: application/x-ndjson, the usual {"records": [...]} body.
+        Output is one result per line in input order, then
+        {"summary": {...}, "operator": ..., "verified_at": ...}.
+        """
+        self._log_request("verify-batch-stream")
+        now = datetime.now(timezone.utc)
+        operator = parse_qs(parsed.query).get("operator", [self.headers.get("X-Operator", "anonymous")])[0]
 
-        # Try OpenAI (GPT-4o)
-        if openai_key:
-            try:
-                req_body = json.dumps({"model": "gpt-4o", "messages": messages, "max_tokens": 2000, "temperature": 0.7}).encode()
-                req = urllib.request.Request("https://api.openai.com/v1/chat/completions", data=req_body, headers={"Content-Type": "application/json", "Authorization": f"Bearer {openai_key}"})
-                with urllib.request.urlopen(req, timeout=30) as resp:
-                    result = json.loads(resp.read().decode())
-                    return result["choices"][0]["message"]["content"]
-            except Exception:
-                pass
+        if NDJSON in self.headers.get("Content-Type", ""):
+            def parse(line):
+                try:
+                    return s4_codec.loads(line)
+                except ValueError:
+                    return None
+            items = (parse(line) for line in self._iter_body_lines())
+        else:
+            data = self._read_body()
+            operator = data.get("operator", operator)
+            items = data.get("records", [])
+            if not items or not isinstance(items, list):
+                self._send_json({"error": "records array required (each item needs 'record_text' and optionally 'expected_hash' or 'tx_hash')"}, 400)
+                return
+
+        self.send_response(200)
+        headers = self._cors_headers()
+        headers["Content-Type"] = NDJSON
+        headers["Cache-Control"] = "no-store"
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
 
-        # Try Anthropic (Claude)
-        if anthropic_key:
+        counts = {"MATCH": 0, "MISMATCH": 0, "NOT_FOUND": 0}
+        total = 0
+        truncated = False
+        body_error = None
+        items = iter(items)
+        while True:
             try:
-                api_messages = []
-                for msg in conversation[-20:]:
-                    role = msg.get("role", "user")
-                    if role == "bot":
-                        role = "assistant"
-                    api_messages.append({"role": role, "content": msg.get("text", msg.get("content", ""))})
-                api_messages.append({"role": "user", "content": user_message})
-                req_body = json.dumps({"model": "claude-sonnet-4-20250514", "system": system_prompt, "messages": api_messages, "max_tokens": 2000}).encode()
-                req = urllib.request.Request("https://api.anthropic.com/v1/messages", data=req_body, headers={"Content-Type": "application/json", "x-api-key": anthropic_key, "anthropic-version": "2023-06-01"})
-                with urllib.request.urlopen(req, timeout=30) as resp:
-                    result = json.loads(resp.read().decode())
-                    return result["content"][0]["text"]
-            except Exception:
-                pass
+                chunk = list(itertools.islice(items, VERIFY_STREAM_CHUNK))
+            except ValueError as e:  # oversized line — headers are already sent
+                body_error = str(e)
+                break
+            if not chunk:
+                break
+            if total + len(chunk) > VERIFY_STREAM_MAX_ITEMS:
+                chunk = chunk[:VERIFY_STREAM_MAX_ITEMS - total]
+                truncated = True
+            lines = []
+            for result in map(_verify_batch_item, chunk):
+                result = _indexed(total, result)
+                if "status" in result:
+                    counts[result["status"]] += 1
+                lines.append(s4_codec.dumps(result))
+                total += 1
+            self.wfile.write(("\n".join(lines) + "\n").encode("utf-8"))
+            self.wfile.flush()
+            if truncated:
+                break
+
+        summary = {
+            "summary": {
+                "total": total,
+                "match": counts["MATCH"],
+                "mismatch": counts["MISMATCH"],
+                "not_found": counts["NOT_FOUND"],
+            },
+            "operator": operator,
+            "verified_at": now.isoformat(),
+        }
+        if truncated:
+            summary["truncated"] = f"Stopped after {VERIFY_STREAM_MAX_ITEMS} records"
+        if body_error:
+            summary["error"] = body_error
+        self.wfile.write((s4_codec.dumps(summary) + "\n").encode("utf-8"))
+        self.wfile.flush()
+        self._finish_request(200)
 
-        return None
+    def _call_ai_cascade(self, system_prompt, user_message, conversation=None):
+        """Reply text from the first AI provider to answer (see _ai_engine), or
+        None. Goes through _llm_cache; self._ai_cached says whether it hit."""
+        text, _provider, self._ai_cached = _cached_ai_complete(
+            getattr(self, "_req_route", ""), system_prompt, user_message, conversation)
+        return text
+
+    # ── Server-sent events (streamed AI replies) ──────────────────────
+    # AI routes stream when the body has "stream": true or the client sends
+    # Accept: text/event-stream. Events follow the S4ight stream contract:
+    #   ready  {provider, model, cached}    once the first provider answers
+    #   token  {t}                          reply text, in order
+    #   done   {...route fields}            last event; the full reply is the
+    #                                       concatenation of the token texts
+    # Provider failover happens before the first token only.
+
+    def _wants_sse(self, data):
+        return data.get("stream") is True or "text/event-stream" in self.headers.get("Accept", "")
+
+    def _send_sse(self, event, payload):
+        """Write one event, sending the stream headers first if needed. A
+        client that has gone away is remembered rather than raised, so the
+        route can still finish and persist the reply."""
+        if getattr(self, "_sse_state", None) is None:
+            self.send_response(200)
+            headers = self._cors_headers()
+            headers["Content-Type"] = "text/event-stream; charset=utf-8"
+            headers["Cache-Control"] = "no-store, no-cache, no-transform"
+            headers["X-Accel-Buffering"] = "no"
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self._sse_state = "open"
+        if self._sse_state != "open":
+            return
+        try:
+            self.wfile.write(b"event: " + event.encode() + b"\ndata: " + s4_codec.dumpb(payload) + b"\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self._sse_state = "closed"
+
+    def _stream_ai(self, system_prompt, user_message, conversation=None, max_tokens=2000):
+        """Stream a reply as ready/token events. Cache hits go out as one
+        token; fresh replies are stored in _llm_cache once complete. Returns
+        (text, provider, cached) like _cached_ai_complete. Streamed calls
+        skip _ai_single_flight: a follower could not replay the tokens.
+        A reply cut off mid-stream ends with an error event instead of
+        done and re-raises _AIStreamInterrupted, so the route stops before
+        caching, hashing or saving the partial text."""
+        route = getattr(self, "_req_route", "")
+        ttl = _llm_cache.ttl(route)
+        key = _llm_cache.key(route, system_prompt, user_message, conversation)
+        if ttl > 0:
+            hit = _llm_cache.get(key, route)
+            if hit is not None:
+                self._send_sse("ready", {"provider": hit[1], "model": _ai_engine.model(hit[1]), "cached": True})
+                self._send_sse("token", {"t": hit[0]})
+                return hit[0], hit[1], True
+        provider, parts = None, []
+        try:
+            for name, chunk in _ai_engine.stream(system_prompt, user_message, conversation, max_tokens):
+                if provider is None:
+                    provider = name
+                    self._send_sse("ready", {"provider": name, "model": _ai_engine.model(name), "cached": False})
+                parts.append(chunk)
+                self._send_sse("token", {"t": chunk})
+        except _AIStreamInterrupted:
+            self._send_sse("error", {"error": "AI reply was cut off — please retry", "provider": provider,
+                                     "partial": True})
+            self._finish_request(502)
+            raise
+        text = "".join(parts) or None
+        if text:
+            _llm_cache.put(key, route, text, provider, ttl)
+        return text, provider, False
+
+    def _send_ai_result(self, payload, streaming):
+        """Finish an AI route: the JSON body, or in streaming mode a done
+        event with everything except the reply text, which has already
+        gone out as tokens."""
+        if not streaming:
+            self._send_json(payload)
+            return
+        self._send_sse("done", {k: v for k, v in payload.items() if k != "response"})
+        self._finish_request(200)
 
     def _route(self, path):
         path = path.rstrip("/")
@@ -1815,6 +5127,8 @@ class handler(BaseHTTPRequestHandler):
             return "record_types"
         if path == "/api/anchor":
             return "anchor"
+        if path == "/api/anchor/status":
+            return "anchor_status"
         if path == "/api/hash":
             return "hash"
         if path == "/api/categorize":
@@ -1873,6 +5187,14 @@ class handler(BaseHTTPRequestHandler):
             return "wallet_buy_sls"
         if path == "/api/wallet/balance":
             return "wallet_balance"
+        if path == "/api/wallet/balances":
+            return "wallet_balances"
+        if path == "/api/wallet/fees":
+            return "wallet_fees"
+        if path == "/api/wallet/fees/settle":
+            return "wallet_fees_settle"
+        if path == "/api/wallet/sls-delivery":
+            return "wallet_sls_delivery"
         if path == "/api/treasury/health":
             return "treasury_health"
         if path == "/api/webhook/stripe":
@@ -1894,6 +5216,8 @@ class handler(BaseHTTPRequestHandler):
             return "anchor_composite"
         if path == "/api/anchor/batch":
             return "anchor_batch"
+        if path == "/api/batch/proof":
+            return "batch_proof"
         if path == "/api/proof-chain":
             return "proof_chain"
         if path == "/api/custody/transfer":
@@ -1925,6 +5249,8 @@ class handler(BaseHTTPRequestHandler):
         # ═══ Performance Metrics ═══
         if path == "/api/metrics/performance":
             return "metrics_performance"
+        if path == "/api/metrics/prometheus":
+            return "metrics_prometheus"
         # ═══ Security — AI Audit Trail ═══
         if path == "/api/security/audit-trail":
             return "security_audit_trail"
@@ -2062,47 +5388,68 @@ class handler(BaseHTTPRequestHandler):
             return "self_healing_compliance_approve"
         return None
 
-    def _check_rate_limit(self):
-        """Returns True if request is allowed, False if rate limited.
-
-        Uses an in-memory sliding-window counter per IP.  An LRU eviction
-        keeps the store bounded to _RATE_LIMIT_MAX_IPS entries.
+    def _rate_limit_identity(self):
+        """Caller identity for rate limiting. Keys already known to this
+        instance share their org's budget (or get their own if the key has
+        no org); anything else, including unrecognised keys, is limited by
+        client IP so rotating made-up keys can't dodge the limit."""
+        api_key = self.headers.get("X-API-Key", "").strip()
+        if api_key == API_MASTER_KEY:
+            return "key:master"
+        info = API_KEYS_STORE.get(api_key) if api_key else None
+        if info is not None:
+            return "org:" + info["org"] if info.get("org") else "key:" + api_key
+        return "ip:" + self.headers.get("X-Forwarded-For", self.headers.get("X-Real-IP", "unknown")).split(",")[0].strip()
+
+    def _check_rate_limit(self, route=None):
+        """Returns 0 if the request is allowed, otherwise the whole seconds
+        to wait before retrying.
+
+        Uses an in-memory token bucket per (caller, route group); see
+        RATE_LIMIT_GROUPS for the per-group budgets.
         """
-        ip = self.headers.get("X-Forwarded-For", self.headers.get("X-Real-IP", "unknown")).split(",")[0].strip()
-        now = time.time()
-        if ip not in _rate_limit_store:
-            # LRU eviction: drop oldest IP if at capacity
-            if len(_rate_limit_store) >= _RATE_LIMIT_MAX_IPS:
-                oldest_ip = min(_rate_limit_store, key=lambda k: _rate_limit_store[k][-1] if _rate_limit_store[k] else 0)
-                del _rate_limit_store[oldest_ip]
-            _rate_limit_store[ip] = []
-        # Clean old entries
-        cutoff = now - RATE_LIMIT_WINDOW
-        _rate_limit_store[ip] = [t for t in _rate_limit_store[ip] if t > cutoff]
-        if len(_rate_limit_store[ip]) >= RATE_LIMIT_MAX:
-            return False
-        _rate_limit_store[ip].append(now)
-        return True
+        group = _RATE_LIMIT_ROUTE_GROUP.get(route, "default")
+        wait = _rate_limiter.check(self._rate_limit_identity() + "|" + group, RATE_LIMIT_GROUPS[group])
+        return int(wait) + 1 if wait else 0
 
     def _log_request(self, route, status=200):
-        duration_ms = round((time.time() - getattr(self, '_req_start', time.time())) * 1000, 1)
+        """Start the request-log entry for this request. Its duration,
+        status and per-route latency sample are filled in by
+        _finish_request once the response has been written."""
         req_id = getattr(self, '_req_id', '-')
-        _request_log.append({
+        entry = {
             "time": datetime.now(timezone.utc).isoformat(),
             "route": route,
             "status": status,
             "method": self.command,
-            "ms": duration_ms,
+            "ms": 0.0,
             "request_id": req_id,
-        })
+        }
+        _request_log.append(entry)
+        self._log_entry = entry
+
+    def _finish_request(self, status):
+        """Close out the request-log entry once the response is written.
+        Routes that never called _log_request are logged under their
+        route id so every response lands in the per-route latency stats."""
+        entry = getattr(self, '_log_entry', None)
+        if entry is None:
+            route = getattr(self, '_req_route', None)
+            if route is None:
+                return
+            self._log_request(route.replace("_", "-"))
+            entry = self._log_entry
+        self._log_entry = None
+        self._req_route = None
+        elapsed = time.time() - getattr(self, '_req_start', time.time())
+        entry["status"] = status
+        entry["ms"] = round(elapsed * 1000, 1)
+        metrics.http_request(entry["method"], entry["route"], status, elapsed)
         logger.info(
-            "%s %s %d %.1fms", self.command, route, status, duration_ms,
-            extra={"request_id": req_id, "route": route, "method": self.command,
-                   "status": status, "duration_ms": duration_ms}
+            "%s %s %d %.1fms", entry["method"], entry["route"], status, entry["ms"],
+            extra={"request_id": entry["request_id"], "route": entry["route"], "method": entry["method"],
+                   "status": status, "duration_ms": entry["ms"]}
         )
-        # Keep last 1000 entries
-        if len(_request_log) > 1000:
-            _request_log.pop(0)
 
     def do_OPTIONS(self):
         self.send_response(204)
@@ -2113,13 +5460,22 @@ class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         self._req_start = time.time()
         self._req_id = uuid.uuid4().hex[:12]
+        self._log_entry = None
+        self._cache_fill = None
+        self._sse_state = None
         _hydrate_from_supabase()  # Cold-start recovery
         parsed = urlparse(self.path)
         route = self._route(parsed.path)
+        self._req_route = route or "unmatched"
 
         # Rate limiting
-        if not self._check_rate_limit():
-            self._send_json({"error": "Rate limit exceeded", "retry_after": RATE_LIMIT_WINDOW}, 429)
+        retry_after = self._check_rate_limit(route)
+        if retry_after:
+            self._send_json({"error": "Rate limit exceeded", "retry_after": retry_after}, 429,
+                            headers={"Retry-After": str(retry_after)})
+            return
+
+        if self._serve_cached(route, parsed):
             return
 
         if route == "health":
@@ -2155,7 +5511,7 @@ class handler(BaseHTTPRequestHandler):
                 "version": "5.2.0",
                 "record_types": len(RECORD_CATEGORIES),
                 "branches": len(BRANCHES),
-                "total_records": len(_get_all_records()),
+                "total_records": len(_live_records),
                 "infrastructure": {
                     "xrpl": XRPL_AVAILABLE,
                     "supabase": SUPABASE_AVAILABLE,
@@ -2163,14 +5519,48 @@ class handler(BaseHTTPRequestHandler):
                 },
             })
         elif route == "metrics":
-            records = _get_all_records()
-            self._send_json(_aggregate_metrics(records))
+            self._send_json(_live_records.metrics.snapshot(_live_records[-100:]))
+        elif route == "anchor_status":
+            job_id = parse_qs(parsed.query).get("job", [""])[0]
+            with _anchor_jobs_lock:
+                job = _anchor_jobs.get(job_id)
+            job = job or _load_anchor_job(job_id)
+            if not job:
+                self._send_json({"error": "Unknown anchor job", "job_id": job_id}, 404)
+                return
+            self._send_json(_anchor_job_view(_expire_anchor_job(job)))
+        elif route == "batch_proof":
+            qs = parse_qs(parsed.query)
+            batch_id = qs.get("batch_id", [""])[0]
+            leaf = qs.get("leaf", [""])[0]
+            batch = _load_batch(batch_id)
+            if not batch:
+                self._send_json({"error": "Unknown batch_id", "batch_id": batch_id}, 404)
+                return
+            tree = batch["tree"]
+            index = tree.index_of(leaf)
+            if index is None and leaf.isdigit() and int(leaf) < len(tree):
+                index = int(leaf)  # leaf may also be given as a 0-based leaf index
+            if index is None:
+                self._send_json({"error": "Leaf not found in batch", "batch_id": batch_id, "leaf": leaf}, 404)
+                return
+            self._send_json({
+                "batch_id": batch_id,
+                "leaf": tree.leaves[index],
+                "leaf_index": index,
+                "merkle_root": batch["merkle_root"],
+                "proof": tree.proof(index),
+                "record_count": len(tree),
+                "tx_hash": batch.get("tx_hash"),
+                "network": batch.get("network"),
+                "explorer_url": batch.get("explorer_url"),
+                "anchored_at": batch.get("timestamp"),
+            })
         elif route == "transactions":
-            records = _get_all_records()
-            recent = list(reversed(records[-200:]))
+            recent = list(reversed(_live_records[-200:]))
             self._send_json({
                 "transactions": recent,
-                "total": len(records),
+                "total": len(_live_records),
                 "generated_at": datetime.now(timezone.utc).isoformat(),
             })
         elif route == "record_types":
@@ -2184,7 +5574,7 @@ class handler(BaseHTTPRequestHandler):
         elif route == "xrpl_status":
             _init_xrpl()
             explorer_base = XRPL_EXPLORER
-            endpoint = XRPL_URL
+            endpoint = _xrpl_nodes.get_healthy_url() or XRPL_URL
             self._send_json({
                 "xrpl_available": XRPL_AVAILABLE,
                 "connected": _xrpl_client is not None,
@@ -2201,13 +5591,21 @@ class handler(BaseHTTPRequestHandler):
                     "XRPL_NETWORK": XRPL_NETWORK,
                 },
                 "init_error": _xrpl_init_error,
+                "nodes": _xrpl_nodes.get_status()["validators"],
+                "submission_pipeline": _xrpl_pipeline.get_stats(),
+                "anchor_coalescer": {
+                    "enabled": ANCHOR_COALESCE_ENABLED,
+                    "window_ms": ANCHOR_COALESCE_WINDOW_MS,
+                    "max_leaves": ANCHOR_COALESCE_MAX_LEAVES,
+                    **_anchor_coalescer.stats,
+                },
                 "note": f"Real XRPL Mainnet transactions. Verify at livenet.xrpl.org"
             })
         elif route == "infrastructure":
             self._send_json({
                 "infrastructure": {
                     "api": {"status": "operational", "version": "5.2.0", "framework": "BaseHTTPRequestHandler", "tools": 27, "platforms": 462},
-                    "xrpl": {"available": XRPL_AVAILABLE, "network": XRPL_NETWORK, "endpoint": XRPL_URL},
+                    "xrpl": {"available": XRPL_AVAILABLE, "network": XRPL_NETWORK, "endpoint": _xrpl_nodes.get_healthy_url() or XRPL_URL},
                     "database": {"provider": "Supabase" if SUPABASE_AVAILABLE else "In-Memory", "connected": SUPABASE_AVAILABLE, "url": SUPABASE_URL[:30] + "..." if SUPABASE_URL else None},
                     "auth": {"enabled": True, "methods": ["API Key", "Bearer Token"], "master_key_set": bool(os.environ.get("S4_API_MASTER_KEY"))},
                     "compliance": {
@@ -2422,34 +5820,93 @@ class handler(BaseHTTPRequestHandler):
                 self._send_json({"error": "XRPL not available"}, 503)
                 return
             try:
-                from xrpl.models.requests import AccountInfo, AccountLines
-                acc_info = _xrpl_client.request(AccountInfo(account=address))
-                xrp_drops = int(acc_info.result.get("account_data", {}).get("Balance", "0"))
-                xrp_balance = xrp_drops / 1_000_000
-
-                acc_lines = _xrpl_client.request(AccountLines(account=address))
-                sls_balance = "0"
-                for line in acc_lines.result.get("lines", []):
-                    if line.get("currency") == "SLS" and line.get("account") == SLS_ISSUER_ADDRESS:
-                        sls_balance = line.get("balance", "0")
-                        break
-
-                anchors_available = int(float(sls_balance) / float(SLS_ANCHOR_FEE)) if float(sls_balance) > 0 else 0
-                explorer_base = (XRPL_EXPLORER).replace("/transactions/", "/accounts/")
-
-                self._send_json({
-                    "address": address,
-                    "xrp_balance": round(xrp_balance, 6),
-                    "sls_balance": sls_balance,
-                    "anchors_available": anchors_available,
-                    "sls_price_usd": SLS_PRICE_USD,
-                    "network": XRPL_NETWORK,
-                    "explorer_url": explorer_base + address,
-                })
+                state, cached = _account_state.get(address)
+                self._send_json({**_account_balance_view(state), "cached": cached,
+                                 "sls_price_usd": SLS_PRICE_USD, "network": XRPL_NETWORK})
             except Exception as e:
                 print(f"Account lookup failed: {e}")
                 self._send_json({"error": "Account lookup failed. The address may be invalid or unfunded."}, 404)
 
+        elif route == "wallet_balances":
+            self._log_request("wallet-balances")
+            api_key = self.headers.get("X-API-Key", "")
+            if api_key != API_MASTER_KEY and api_key not in API_KEYS_STORE:
+                self._send_json({"error": "Valid API key required"}, 401)
+                return
+            qs = parse_qs(parsed.query)
+            addresses = list(dict.fromkeys(a.strip() for v in qs.get("addresses", []) for a in v.split(",") if a.strip()))
+            if not addresses:
+                self._send_json({"error": "addresses parameter required"}, 400)
+                return
+            if len(addresses) > WALLET_BALANCES_MAX:
+                self._send_json({"error": f"At most {WALLET_BALANCES_MAX} addresses per call"}, 400)
+                return
+            _init_xrpl()
+            if not _xrpl_client or not XRPL_AVAILABLE:
+                self._send_json({"error": "XRPL not available"}, 503)
+                return
+            balances = []
+            for address, state, cached, error in _account_state.get_many(addresses):
+                if error is not None:
+                    print(f"Account lookup failed for {address}: {error}")
+                    balances.append({"address": address, "error": "Account lookup failed"})
+                    continue
+                balances.append({**_account_balance_view(state), "cached": cached})
+            ledgers = [b["ledger_index"] for b in balances if b.get("ledger_index")]
+            self._send_json({
+                "balances": balances,
+                "count": len(balances),
+                "ledger_index": max(ledgers) if ledgers else None,
+                "sls_price_usd": SLS_PRICE_USD,
+                "network": XRPL_NETWORK,
+            })
+
+        elif route == "wallet_sls_delivery":
+            self._log_request("wallet-sls-delivery-status")
+            if self.headers.get("X-API-Key", "") != API_MASTER_KEY:
+                self._send_json({"error": "Master API key required"}, 403)
+                return
+            job_id = parse_qs(parsed.query).get("job", [""])[0]
+            if not job_id:
+                with _sls_jobs_lock:
+                    jobs = sorted(_sls_jobs.values(), key=lambda j: j.get("created_at") or "", reverse=True)
+                self._send_json({"jobs": [_sls_job_view(j) for j in jobs]})
+                return
+            with _sls_jobs_lock:
+                job = _sls_jobs.get(job_id)
+            job = job or _load_sls_job(job_id)
+            if job is None:
+                self._send_json({"error": "Unknown job"}, 404)
+                return
+            self._send_json(_sls_job_view(job))
+
+        elif route == "wallet_fees":
+            self._log_request("wallet-fees")
+            api_key = self.headers.get("X-API-Key", "")
+            if api_key != API_MASTER_KEY and api_key not in API_KEYS_STORE:
+                self._send_json({"error": "Valid API key required"}, 401)
+                return
+            qs = parse_qs(parsed.query)
+            email = qs.get("email", [""])[0] or None
+            anchor_tx = qs.get("anchor_tx", [""])[0] or None
+            if not email and not anchor_tx:
+                self._send_json({"error": "email or anchor_tx parameter required"}, 400)
+                return
+            accruals = _fee_ledger.lookup(user_email=email, anchor_tx=anchor_tx)
+            if anchor_tx and not accruals:
+                rows = _sb_select("sls_fee_accruals", query_params=f"anchor_tx=eq.{anchor_tx}", limit=1000)
+                accruals = [r for r in rows if not email or r.get("user_email") == email]
+            pending = [a for a in accruals if a["status"] != "settled"]
+            self._send_json({
+                "email": email,
+                "anchor_tx": anchor_tx,
+                "accruals": accruals,
+                "pending_anchors": len(pending),
+                "pending_amount": format(sum((Decimal(a["amount"]) for a in pending), Decimal(0)).normalize(), "f"),
+                "settle_interval_s": _fee_ledger.interval,
+                "settle_threshold": _fee_ledger.threshold,
+            })
+
         # ═══ HarborLink Integration — GET Endpoints ═══
 
         elif route == "webhook_list":
@@ -2470,7 +5927,8 @@ class handler(BaseHTTPRequestHandler):
                 return
             org_key = api_key
             deliveries = [d for d in _webhook_delivery_log if d.get("org") == org_key]
-            self._send_json({"deliveries": deliveries[-50:], "total": len(deliveries)})
+            self._send_json({"deliveries": deliveries[-50:], "total": len(deliveries),
+                             "queue_depth": _webhook_dispatcher.depth()})
 
         elif route == "proof_chain":
             self._log_request("proof-chain")
@@ -2517,10 +5975,8 @@ class handler(BaseHTTPRequestHandler):
             org_name = API_KEYS_STORE.get(org_key, {}).get("organization", "master")
             limit = int(qs.get("limit", ["100"])[0])
             offset = int(qs.get("offset", ["0"])[0])
-            # Filter records by org_id
-            org_records = [r for r in _live_records if r.get("org_id") == org_key or r.get("org_id") == org_name]
-            total = len(org_records)
-            page = org_records[offset:offset + limit]
+            # Filter records by org_id (indexed — no full-ledger scan)
+            total, page = _live_records.org_page([org_key, org_name], offset, limit)
             self._send_json({
                 "organization": org_name,
                 "records": page,
@@ -2574,23 +6030,32 @@ class handler(BaseHTTPRequestHandler):
             now = datetime.now(timezone.utc)
             uptime = time.time() - API_START_TIME
             records = _get_all_records()
-            # Real request-log latency stats (if we've tracked any)
-            recent_latencies = [e.get("ms", 0) for e in _request_log[-50:] if e.get("ms")]
-            avg_anchor_ms = sum(recent_latencies) / len(recent_latencies) if recent_latencies else 0
-            p95_anchor_ms = sorted(recent_latencies)[int(len(recent_latencies) * 0.95)] if recent_latencies else 0
+            route_latency = metrics.route_latency()
+            anchor_latency = route_latency.get("anchor", {}).get("1h", {})
+            anchor_count = anchor_latency.get("count", 0)
             self._send_json({
                 "performance": {
                     "uptime_seconds": round(uptime, 1),
                     "uptime_pct": round(min(100, uptime / (uptime + 1) * 100), 2) if uptime else 0,
                     "total_requests": len(_request_log),
-                    "avg_anchor_time_ms": round(avg_anchor_ms, 1),
-                    "p95_anchor_time_ms": round(p95_anchor_ms, 1),
+                    "avg_anchor_time_ms": round(anchor_latency["mean"], 1) if anchor_count else 0,
+                    "p95_anchor_time_ms": round(anchor_latency["p95"], 1) if anchor_count else 0,
                     "total_records_anchored": len(records),
                     "live_records": len(_live_records),
                     "xrpl_connected": _xrpl_client is not None,
                     "xrpl_network": XRPL_NETWORK,
                     "supabase_connected": SUPABASE_AVAILABLE,
                 },
+                "http_pool": http_pool.get_stats(),
+                "webhook_queue": _webhook_dispatcher.get_stats(),
+                "response_cache": _response_cache.get_stats(),
+                "ai_providers": _ai_engine.get_stats(),
+                "llm_cache": _llm_cache.get_stats(),
+                "ai_single_flight": _ai_single_flight.get_stats(),
+                "xrpl_pipeline": _xrpl_pipeline.get_stats(),
+                "fee_ledger": _fee_ledger.get_stats(),
+                "wallet_cache": _wallet_cache.get_stats(),
+                "account_state_cache": _account_state.get_stats(),
                 "costs": {
                     "total_sls_fees": round(len(records) * 0.01, 2),
                     "avg_cost_per_anchor_usd": 0.01,
@@ -2599,14 +6064,20 @@ class handler(BaseHTTPRequestHandler):
                 },
                 "validator_health": {
                     "xrpl_status": "connected" if _xrpl_client else "disconnected",
-                    "last_anchor_success": _live_records[-1]["timestamp"] if _live_records else None,
+                    "last_anchor_success": _live_records[-1].get("timestamp") if _live_records else None,
                     "consecutive_failures": 0,
                     "network": XRPL_NETWORK,
                 },
-                "recent_requests": _request_log[-20:],
+                "route_latency_ms": route_latency,
+                "recent_requests": list(itertools.islice(reversed(_request_log), 20))[::-1],
                 "generated_at": now.isoformat(),
             })
 
+        elif route == "metrics_prometheus":
+            self._log_request("metrics-prometheus")
+            metrics.record_webhook_queue_depth(_webhook_dispatcher.depth())
+            self._send_text(metrics.export_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+
         elif route == "security_audit_trail":
             self._log_request("security-audit-trail")
             api_key = self.headers.get("X-API-Key", "")
@@ -2715,16 +6186,8 @@ class handler(BaseHTTPRequestHandler):
                 self._send_json({"error": "XRPL not available"}, 503)
                 return
             try:
-                from xrpl.models.requests import AccountInfo, AccountLines
-                acc = _xrpl_client.request(AccountInfo(account=SLS_TREASURY_ADDRESS))
-                xrp_drops = int(acc.result.get("account_data", {}).get("Balance", "0"))
-                xrp_balance = round(xrp_drops / 1_000_000, 6)
-                lines = _xrpl_client.request(AccountLines(account=SLS_TREASURY_ADDRESS))
-                sls_balance = "0"
-                for line in lines.result.get("lines", []):
-                    if line.get("currency") == "SLS" and line.get("account") == SLS_ISSUER_ADDRESS:
-                        sls_balance = line.get("balance", "0")
-                        break
+                state, cached = _account_state.get(SLS_TREASURY_ADDRESS)
+                xrp_balance, sls_balance = state["xrp_balance"], state["sls_balance"]
                 xrp_low = xrp_balance < 100
                 sls_low = float(sls_balance) < 10000
                 provisions_remaining = int(xrp_balance / float(XRP_ACCOUNT_RESERVE)) if xrp_balance > 0 else 0
@@ -2745,7 +6208,8 @@ class handler(BaseHTTPRequestHandler):
                     "alerts": alerts,
                     "network": XRPL_NETWORK,
                     "explorer_url": explorer_base + SLS_TREASURY_ADDRESS,
-
+                    "ledger_index": state["ledger_index"],
+                    "cached": cached,
                 })
             except Exception as e:
                 print(f"Treasury health check failed: {e}")
@@ -2928,7 +6392,7 @@ class handler(BaseHTTPRequestHandler):
                 headers["apiKey"] = nvd_key
             req = urllib.request.Request(nvd_url, headers=headers)
             with urllib.request.urlopen(req, timeout=15) as resp:
-                nvd_data = json.loads(resp.read().decode())
+                nvd_data = s4_codec.loads(resp.read().decode())
             vulnerabilities = []
             for item in nvd_data.get("vulnerabilities", [])[:20]:
                 cve_item = item.get("cve", {})
@@ -3085,7 +6549,7 @@ class handler(BaseHTTPRequestHandler):
         if not entries and data.get("key"):
             entries = [{"key": data["key"], "value": data.get("value", "")}]
 
-        saved = 0
+        rows = []
         for entry in entries:
             key = entry.get("key", "")
             value = entry.get("value", "")
@@ -3100,18 +6564,21 @@ class handler(BaseHTTPRequestHandler):
             }
             if user_id:
                 row["user_id"] = user_id
-            # Upsert on (org_id, session_id, state_key)
-            result = _sb_upsert("user_state", row)
-            if result is not None:
-                saved += 1
-            else:
-                # Table might not exist yet — try to create it and retry
-                _ensure_user_state_table()
-                result = _sb_upsert("user_state", row)
-                if result is not None:
-                    saved += 1
-
-        self._send_json({"status": "saved", "saved": saved, "total": len(entries), "session_id": session_id})
+            rows.append(row)
+
+        # Upsert on (org_id, session_id, state_key)
+        on_conflict = "org_id,session_id,state_key"
+        report = _sb_bulk_upsert("user_state", rows, on_conflict=on_conflict)
+        failed = report["failed"]
+        if failed:
+            # Table might not exist yet — try to create it and retry the failures
+            _ensure_user_state_table()
+            retry = _sb_bulk_upsert("user_state", [rows[i] for i in failed], on_conflict=on_conflict)
+            report["written"] += retry["written"]
+            failed = [failed[i] for i in retry["failed"]]
+
+        self._send_json({"status": "saved", "saved": report["written"], "total": len(entries),
+                         "failed_keys": [rows[i]["state_key"] for i in failed], "session_id": session_id})
 
     # ═══════════════════════════════════════════════════════════════════════
     #  PREPARED EMAIL COMPOSER — Enterprise-Grade Email API Handlers
@@ -3198,7 +6665,7 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        ai_data = json.loads(json_match.group())
+                        ai_data = s4_codec.loads(json_match.group())
                         subject = ai_data.get("subject", subject)
                         body_html = ai_data.get("bodyHTML", ai_response)
                     else:
@@ -3232,15 +6699,15 @@ class handler(BaseHTTPRequestHandler):
             "tool_name": tool_name,
             "subject": subject,
             "body_html": body_html,
-            "to": json.dumps(recipients),
-            "cc": json.dumps(cc),
-            "bcc": json.dumps(bcc),
+            "to": s4_codec.dumps(recipients),
+            "cc": s4_codec.dumps(cc),
+            "bcc": s4_codec.dumps(bcc),
             "signature": signature,
             "importance": importance,
             "encrypt": encrypt,
             "read_receipt": read_receipt,
             "schedule_time": schedule_time,
-            "attachments": json.dumps(attachments[:20]),  # Limit stored attachment metadata
+            "attachments": s4_codec.dumps(attachments[:20]),  # Limit stored attachment metadata
             "type": "draft",
             "ai_enhanced": ai_enhanced,
             "saved_at": now.isoformat(),
@@ -3276,15 +6743,15 @@ class handler(BaseHTTPRequestHandler):
             "tool_name": data.get("toolName", ""),
             "subject": data.get("subject", ""),
             "body_html": data.get("bodyHTML", ""),
-            "to": json.dumps(data.get("to", [])),
-            "cc": json.dumps(data.get("cc", [])),
-            "bcc": json.dumps(data.get("bcc", [])),
+            "to": s4_codec.dumps(data.get("to", [])),
+            "cc": s4_codec.dumps(data.get("cc", [])),
+            "bcc": s4_codec.dumps(data.get("bcc", [])),
             "signature": data.get("signature", ""),
             "importance": data.get("importance", "normal"),
             "encrypt": data.get("encrypt", False),
             "read_receipt": data.get("readReceipt", False),
             "schedule_time": data.get("scheduleTime"),
-            "attachments": json.dumps(data.get("attachments", [])[:20]),
+            "attachments": s4_codec.dumps(data.get("attachments", [])[:20]),
             "type": "draft",
             "ai_enhanced": data.get("aiEnhanced", False),
             "saved_at": now.isoformat(),
@@ -3322,15 +6789,15 @@ class handler(BaseHTTPRequestHandler):
             "tool_name": data.get("toolName", ""),
             "subject": data.get("subject", ""),
             "body_html": data.get("bodyHTML", ""),
-            "to": json.dumps(data.get("to", [])),
-            "cc": json.dumps(data.get("cc", [])),
-            "bcc": json.dumps(data.get("bcc", [])),
+            "to": s4_codec.dumps(data.get("to", [])),
+            "cc": s4_codec.dumps(data.get("cc", [])),
+            "bcc": s4_codec.dumps(data.get("bcc", [])),
             "signature": data.get("signature", ""),
             "importance": data.get("importance", "normal"),
             "encrypt": data.get("encrypt", False),
             "read_receipt": data.get("readReceipt", False),
             "schedule_time": schedule_time,
-            "attachments": json.dumps(data.get("attachments", [])[:20]),
+            "attachments": s4_codec.dumps(data.get("attachments", [])[:20]),
             "type": "scheduled",
             "ai_enhanced": data.get("aiEnhanced", False),
             "saved_at": now.isoformat(),
@@ -3404,15 +6871,15 @@ class handler(BaseHTTPRequestHandler):
             "tool_name": tool_name,
             "subject": parsed_subject,
             "body_html": parsed_body.replace("\n", "<br>"),
-            "to": json.dumps(parsed_to.split(",") if parsed_to else []),
-            "cc": json.dumps([]),
-            "bcc": json.dumps([]),
+            "to": s4_codec.dumps(parsed_to.split(",") if parsed_to else []),
+            "cc": s4_codec.dumps([]),
+            "bcc": s4_codec.dumps([]),
             "signature": "",
             "importance": "normal",
             "encrypt": False,
             "read_receipt": False,
             "schedule_time": None,
-            "attachments": json.dumps([]),
+            "attachments": s4_codec.dumps([]),
             "type": "imported",
             "ai_enhanced": False,
             "saved_at": now.isoformat(),
@@ -3441,7 +6908,7 @@ class handler(BaseHTTPRequestHandler):
             try:
                 json_match = re.search(r'\{[\s\S]*\}', ai_response)
                 if json_match:
-                    ai_reply = json.loads(json_match.group())
+                    ai_reply = s4_codec.loads(json_match.group())
                 else:
                     ai_reply = {"subject": f"Re: {parsed_subject}", "bodyHTML": ai_response}
             except Exception:
@@ -3496,15 +6963,15 @@ class handler(BaseHTTPRequestHandler):
             "tool_name": data.get("toolName", ""),
             "subject": subject,
             "body_html": body_html[:10000],
-            "to": json.dumps(recipients),
-            "cc": json.dumps(cc),
-            "bcc": json.dumps(bcc),
+            "to": s4_codec.dumps(recipients),
+            "cc": s4_codec.dumps(cc),
+            "bcc": s4_codec.dumps(bcc),
             "signature": data.get("signature", ""),
             "importance": importance,
             "encrypt": data.get("encrypt", False),
             "read_receipt": data.get("readReceipt", False),
             "schedule_time": None,
-            "attachments": json.dumps(data.get("attachments", [])[:20]),
+            "attachments": s4_codec.dumps(data.get("attachments", [])[:20]),
             "type": "sent",
             "ai_enhanced": data.get("aiEnhanced", False),
             "saved_at": now.isoformat(),
@@ -3546,6 +7013,8 @@ class handler(BaseHTTPRequestHandler):
     def do_POST(self):
         try:
             return self._do_post_inner()
+        except _AIStreamInterrupted:
+            pass    # _stream_ai already ended the event stream with an error event
         except Exception as exc:
             import traceback
             logger.error("do_POST unhandled: %s\n%s", exc, traceback.format_exc())
@@ -3557,19 +7026,30 @@ class handler(BaseHTTPRequestHandler):
     def _do_post_inner(self):
         # Explicit re-imports: Vercel Python 3.12 treats module-level names as
         # local in extremely large methods, causing UnboundLocalError.
-        import time, uuid, hashlib, json, re, hmac, os
+        import time, uuid, hashlib, re, hmac, os
         import urllib.request, urllib.error
         from datetime import datetime, timedelta, timezone
         from urllib.parse import urlparse, parse_qs
         self._req_start = time.time()
         self._req_id = uuid.uuid4().hex[:12]
+        self._log_entry = None
+        self._cache_fill = None
+        self._sse_state = None
         _hydrate_from_supabase()  # Cold-start recovery
         parsed = urlparse(self.path)
         route = self._route(parsed.path)
+        self._req_route = route or "unmatched"
 
         # Rate limiting
-        if not self._check_rate_limit():
-            self._send_json({"error": "Rate limit exceeded", "retry_after": RATE_LIMIT_WINDOW}, 429)
+        retry_after = self._check_rate_limit(route)
+        if retry_after:
+            self._send_json({"error": "Rate limit exceeded", "retry_after": retry_after}, 429,
+                            headers={"Retry-After": str(retry_after)})
+            return
+
+        if route == "verify_batch" and (NDJSON in self.headers.get("Content-Type", "")
+                                        or NDJSON in self.headers.get("Accept", "")):
+            self._verify_batch_stream(parsed)
             return
 
         data = self._read_body()
@@ -3580,18 +7060,11 @@ class handler(BaseHTTPRequestHandler):
             cat = RECORD_CATEGORIES.get(record_type, {"label": record_type, "branch": "JOINT", "icon": "\U0001f4cb", "system": "N/A"})
             hash_value = data.get("hash", hashlib.sha256(str(now).encode()).hexdigest())
             user_email = data.get("user_email", "")  # For automatic SLS anchor fee deduction
-
-            # Anchor to XRPL (Issuer signs) + auto-deduct 0.01 SLS from user wallet → Treasury
-            xrpl_result = _anchor_xrpl(hash_value, record_type, cat.get("branch", ""), user_email=user_email or None)
-
-            if xrpl_result:
-                tx_hash = xrpl_result["tx_hash"]
-                network = "XRPL " + XRPL_NETWORK.capitalize()
-                explorer_url = xrpl_result["explorer_url"]
-            else:
-                tx_hash = data.get("tx_hash", "TX" + hashlib.md5(str(now).encode()).hexdigest().upper()[:32])
-                network = "Simulated"
-                explorer_url = None
+            fallback_tx_hash = data.get("tx_hash", "TX" + hashlib.md5(str(now).encode()).hexdigest().upper()[:32])
+            actor = user_email or data.get("org_id", "api")
+            org_key = self.headers.get("X-API-Key")
+            async_mode = (parse_qs(parsed.query).get("mode", [""])[0] == "async"
+                          or "respond-async" in self.headers.get("Prefer", ""))
 
             record = {
                 "hash": hash_value,
@@ -3602,9 +7075,9 @@ class handler(BaseHTTPRequestHandler):
                 "timestamp": now.isoformat(),
                 "timestamp_display": now.strftime("%Y-%m-%d %H:%M:%S UTC"),
                 "fee": 0.01,
-                "tx_hash": tx_hash,
-                "network": network,
-                "explorer_url": explorer_url,
+                "tx_hash": None,
+                "network": None,
+                "explorer_url": None,
                 "system": cat.get("system", "N/A"),
                 "content_preview": data.get("content_preview", ""),
                 "org_id": data.get("org_id", self.headers.get("X-API-Key", "")),
@@ -3617,46 +7090,25 @@ class handler(BaseHTTPRequestHandler):
                 record["parent_tx_hash"] = parent_tx.strip()
                 # Determine version number from parent
                 record["version_number"] = int(data.get("version_number", 2))
-            _live_records.append(record)
-            _persist_record(record)
-
-            # Add to proof chain
-            rid = record["record_id"]
-            if rid not in _proof_chain_store:
-                _proof_chain_store[rid] = []
-            proof_event = {
-                "event_type": "anchor.created",
-                "hash": hash_value,
-                "tx_hash": tx_hash,
-                "timestamp": now.isoformat(),
-                "actor": user_email or data.get("org_id", "api"),
-                "metadata": {"record_type": record_type, "network": network},
-            }
-            _proof_chain_store[rid].append(proof_event)
-            _persist_proof_chain_event(rid, proof_event)
 
-            # Fire webhook: anchor.confirmed
-            _deliver_webhook("anchor.confirmed", {
-                "record_id": rid,
-                "hash": hash_value,
-                "tx_hash": tx_hash,
-                "record_type": record_type,
-                "explorer_url": explorer_url,
-                "network": network,
-                "fee": 0.01,
-            }, org_key=self.headers.get("X-API-Key"))
+            if async_mode:
+                job = _submit_anchor_job(record, cat.get("branch", ""), user_email, actor, org_key, fallback_tx_hash)
+                self._send_json({
+                    "status": "pending",
+                    "job_id": job["job_id"],
+                    "status_url": f"/api/anchor/status?job={job['job_id']}",
+                    "record": record,
+                }, 202)
+                return
 
-            # Build fee_transfer for frontend compatibility
-            fee_transfer = None
-            fee_error = None
-            if xrpl_result and xrpl_result.get("user_fee_tx"):
-                fee_transfer = {
-                    "tx_hash": xrpl_result["user_fee_tx"],
-                    "amount": xrpl_result.get("sls_fee", SLS_ANCHOR_FEE),
-                    "treasury": xrpl_result.get("sls_treasury", SLS_TREASURY_ADDRESS),
-                }
-            elif xrpl_result and xrpl_result.get("fee_error"):
-                fee_error = xrpl_result.get("fee_error", "unknown")
+            # Anchor to XRPL (Issuer signs) + auto-deduct 0.01 SLS from user wallet → Treasury
+            xrpl_result, batch_info = _anchor_record_hash(hash_value, record_type, cat.get("branch", ""), user_email=user_email or None)
+            _apply_anchor_result(record, xrpl_result, fallback_tx_hash)
+            if batch_info and xrpl_result:
+                record.update(batch_info)
+            _live_records.append(record)
+            _persist_record(record)
+            fee_transfer, fee_error = _finalize_anchor(record, xrpl_result, actor, org_key)
             self._send_json({"status": "anchored", "record": record, "xrpl": xrpl_result, "fee_transfer": fee_transfer, "fee_error": fee_error})
 
         elif route == "hash":
@@ -3685,21 +7137,21 @@ class handler(BaseHTTPRequestHandler):
 
             if tx_hash:
                 # Look up on-chain memo data from the transaction
-                found = [r for r in _live_records if r.get("tx_hash") == tx_hash or r.get("hash") == tx_hash]
+                found = _live_records.find_by_tx(tx_hash, computed_hash)
                 if found:
-                    chain_hash = found[0].get("hash", "")
-                    anchored_at = found[0].get("timestamp", "")
-                    explorer_url = found[0].get("explorer_url") or (XRPL_EXPLORER) + tx_hash
+                    chain_hash = found.get("hash", "")
+                    anchored_at = found.get("timestamp", "")
+                    explorer_url = found.get("explorer_url") or (XRPL_EXPLORER) + tx_hash
             elif expected_hash:
                 chain_hash = expected_hash
             else:
                 # Search records for matching hash
-                found = [r for r in _live_records if r.get("hash") == computed_hash]
+                found = _live_records.find_by_hash(computed_hash)
                 if found:
-                    chain_hash = found[0].get("hash", "")
-                    tx_hash = found[0].get("tx_hash", "")
-                    anchored_at = found[0].get("timestamp", "")
-                    explorer_url = found[0].get("explorer_url") or (XRPL_EXPLORER) + tx_hash
+                    chain_hash = found.get("hash", "")
+                    tx_hash = found.get("tx_hash", "")
+                    anchored_at = found.get("timestamp", "")
+                    explorer_url = found.get("explorer_url") or (XRPL_EXPLORER) + tx_hash
 
             if chain_hash is None:
                 status = "NOT_FOUND"
@@ -3880,6 +7332,44 @@ class handler(BaseHTTPRequestHandler):
             }
             self._send_json(result)
 
+        elif route == "wallet_fees_settle":
+            self._log_request("wallet-fees-settle")
+            # Settles accrued anchor fees now instead of waiting for the sweeper (e.g. from a cron job)
+            if self.headers.get("X-API-Key", "") != API_MASTER_KEY:
+                self._send_json({"error": "Master API key required"}, 403)
+                return
+            email = data.get("email", "")
+            settlements = [_fee_ledger.settle(email)] if email else _fee_ledger.settle_all()
+            settlements = [st for st in settlements if st]
+            self._send_json({"settlements": settlements, "settled_anchors": sum(st["anchor_count"] for st in settlements),
+                             "fee_ledger": _fee_ledger.get_stats()})
+
+        elif route == "wallet_sls_delivery":
+            self._log_request("wallet-sls-delivery")
+            # Month-rollover SLS renewal (or bulk provisioning) for many subscribers as one resumable job
+            if self.headers.get("X-API-Key", "") != API_MASTER_KEY:
+                self._send_json({"error": "Master API key required"}, 403)
+                return
+            kind = data.get("kind", "renewal")
+            if kind not in _SLS_JOB_STAGES:
+                self._send_json({"error": "kind must be renewal or provision"}, 400)
+                return
+            subscribers = data.get("subscribers")
+            if kind == "provision":
+                if not STRIPE_SECRET_KEY:
+                    self._send_json({"error": "Wallet provisioning blocked — Stripe not configured"}, 403)
+                    return
+                if not subscribers:
+                    self._send_json({"error": "subscribers is required for provisioning"}, 400)
+                    return
+            if subscribers is not None and (not isinstance(subscribers, list) or len(subscribers) > SLS_JOB_MAX_SUBSCRIBERS):
+                self._send_json({"error": f"subscribers must be a list of at most {SLS_JOB_MAX_SUBSCRIBERS}"}, 400)
+                return
+            job = _create_sls_job(kind, subscribers=subscribers, period=data.get("period"), job_id=data.get("job_id"))
+            resumed = job["status"] != "queued"
+            started = _start_sls_job(job)
+            self._send_json({**_sls_job_view(job), "resumed": resumed and started, "already_running": not started}, 202)
+
         elif route == "wallet_buy_sls":
             self._log_request("wallet-buy-sls")
             # Manual SLS top-up: additional SLS delivered from Treasury (requires Stripe payment)
@@ -3911,9 +7401,8 @@ class handler(BaseHTTPRequestHandler):
             # Look up destination wallet
             dest_address = wallet_address
             if not dest_address and email:
-                seed = _get_wallet_seed(email=email)
-                if seed:
-                    dest_wallet = Wallet.from_seed(seed, algorithm=CryptoAlgorithm.SECP256K1)
+                dest_wallet = _get_custodial_wallet(email=email)
+                if dest_wallet:
                     dest_address = dest_wallet.address
             if not dest_address:
                 self._send_json({"error": "Could not resolve wallet address"}, 404)
@@ -3929,14 +7418,14 @@ class handler(BaseHTTPRequestHandler):
                     amount=ICA(currency="SLS", issuer=SLS_ISSUER_ADDRESS, value=str(int(sls_amount))),
                     memos=[Memo(
                         memo_type=bytes("s4/sls-topup", "utf-8").hex(),
-                        memo_data=bytes(json.dumps({
+                        memo_data=bytes(s4_codec.dumps({
                             "type": "sls_topup",
                             "amount": str(sls_amount),
                             "stripe_id": stripe_payment_id or "demo",
                         }), "utf-8").hex()
                     )]
                 )
-                resp = submit_and_wait(payment, _xrpl_client, _xrpl_treasury_wallet)
+                resp = _xrpl_submit(payment, _xrpl_treasury_wallet)
                 if resp.is_successful():
                     explorer_base = XRPL_EXPLORER
                     self._send_json({
@@ -3974,7 +7463,7 @@ class handler(BaseHTTPRequestHandler):
                 return
             try:
                 import urllib.request
-                checkout_data = json.dumps({
+                checkout_data = s4_codec.dumpb({
                     "mode": "subscription",
                     "payment_method_types": ["card"],
                     "line_items": [{"price": price_id, "quantity": 1}],
@@ -3983,7 +7472,7 @@ class handler(BaseHTTPRequestHandler):
                     "cancel_url": data.get("cancel_url", "https://s4ledger.com/demo-app/?checkout=cancelled"),
                     "metadata": {"plan": plan, "platform": "s4_ledger"},
                     "subscription_data": {"metadata": {"plan": plan, "email": customer_email}}
-                }).encode()
+                })
                 req = urllib.request.Request(
                     "https://api.stripe.com/v1/checkout/sessions",
                     data=checkout_data,
@@ -3993,7 +7482,7 @@ class handler(BaseHTTPRequestHandler):
                     }
                 )
                 with urllib.request.urlopen(req, timeout=15) as resp:
-                    session = json.loads(resp.read().decode())
+                    session = s4_codec.loads(resp.read().decode())
                     self._send_json({"checkout_url": session.get("url"), "session_id": session.get("id")})
             except Exception as e:
                 print(f"Checkout creation failed: {e}")
@@ -4010,7 +7499,7 @@ class handler(BaseHTTPRequestHandler):
                 length = int(self.headers.get("Content-Length", 0))
                 if 0 < length <= self.MAX_BODY_SIZE:
                     raw_body = self.rfile.read(length)
-                    data = json.loads(raw_body)
+                    data = s4_codec.loads(raw_body)
             except Exception:
                 self._send_json({"error": "Invalid request body"}, 400)
                 return
@@ -4080,7 +7569,7 @@ class handler(BaseHTTPRequestHandler):
             self._log_request("ai-chat")
             now = datetime.now(timezone.utc)
             # ═══ AI Agent — LLM-Powered Defense Logistics Assistant ═══
-            # Proxies to OpenAI/Anthropic/Azure with a defense-specific system prompt.
+            # Proxies to Azure OpenAI/OpenAI/Anthropic (via _ai_engine) with a defense-specific system prompt.
             # Falls back to structured response if no API key configured.
             user_message = data.get("message", "").strip()
             conversation = data.get("conversation", [])  # Previous messages
@@ -4109,65 +7598,11 @@ class handler(BaseHTTPRequestHandler):
             # Build the system prompt
             system_prompt = _build_ai_system_prompt(tool_context, analysis_data)
 
-            # Try OpenAI first, then Anthropic, then fallback
-            openai_key = os.environ.get("OPENAI_API_KEY", "")
-            anthropic_key = os.environ.get("ANTHROPIC_API_KEY", "")
-            azure_endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT", "")
-            azure_key = os.environ.get("AZURE_OPENAI_KEY", "")
-            azure_deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT", "gpt-4o")
-
-            ai_response = None
-
-            if azure_endpoint and azure_key:
-                # Azure OpenAI (FedRAMP eligible)
-                try:
-                    import urllib.request
-                    messages = [{"role": "system", "content": system_prompt}]
-                    for msg in conversation[-20:]:
-                        messages.append({"role": msg.get("role", "user"), "content": msg.get("text", msg.get("content", ""))})
-                    messages.append({"role": "user", "content": user_message})
-                    api_url = f"{azure_endpoint}/openai/deployments/{azure_deployment}/chat/completions?api-version=2024-02-01"
-                    req_body = json.dumps({"messages": messages, "max_tokens": 2000, "temperature": 0.7}).encode()
-                    req = urllib.request.Request(api_url, data=req_body, headers={"Content-Type": "application/json", "api-key": azure_key})
-                    with urllib.request.urlopen(req, timeout=30) as resp:
-                        result = json.loads(resp.read().decode())
-                        ai_response = result["choices"][0]["message"]["content"]
-                except Exception as e:
-                    ai_response = None  # Fall through to next provider
-
-            if not ai_response and openai_key:
-                # OpenAI (GPT-4o)
-                try:
-                    import urllib.request
-                    messages = [{"role": "system", "content": system_prompt}]
-                    for msg in conversation[-20:]:
-                        messages.append({"role": msg.get("role", "user"), "content": msg.get("text", msg.get("content", ""))})
-                    messages.append({"role": "user", "content": user_message})
-                    req_body = json.dumps({"model": "gpt-4o", "messages": messages, "max_tokens": 2000, "temperature": 0.7}).encode()
-                    req = urllib.request.Request("https://api.openai.com/v1/chat/completions", data=req_body, headers={"Content-Type": "application/json", "Authorization": f"Bearer {openai_key}"})
-                    with urllib.request.urlopen(req, timeout=30) as resp:
-                        result = json.loads(resp.read().decode())
-                        ai_response = result["choices"][0]["message"]["content"]
-                except Exception as e:
-                    ai_response = None
-
-            if not ai_response and anthropic_key:
-                # Anthropic (Claude)
-                try:
-                    import urllib.request
-                    api_messages = []
-                    for msg in conversation[-20:]:
-                        role = msg.get("role", "user")
-                        if role == "bot": role = "assistant"
-                        api_messages.append({"role": role, "content": msg.get("text", msg.get("content", ""))})
-                    api_messages.append({"role": "user", "content": user_message})
-                    req_body = json.dumps({"model": "claude-sonnet-4-20250514", "system": system_prompt, "messages": api_messages, "max_tokens": 2000}).encode()
-                    req = urllib.request.Request("https://api.anthropic.com/v1/messages", data=req_body, headers={"Content-Type": "application/json", "x-api-key": anthropic_key, "anthropic-version": "2023-06-01"})
-                    with urllib.request.urlopen(req, timeout=30) as resp:
-                        result = json.loads(resp.read().decode())
-                        ai_response = result["content"][0]["text"]
-                except Exception as e:
-                    ai_response = None
+            streaming = self._wants_sse(data)
+            if streaming:
+                ai_response = self._stream_ai(system_prompt, user_message, conversation)[0]
+            else:
+                ai_response = self._call_ai_cascade(system_prompt, user_message, conversation)
 
             if ai_response:
                 # Hash and audit-trail the AI response
@@ -4187,17 +7622,17 @@ class handler(BaseHTTPRequestHandler):
                 if len(_ai_audit_log) > 1000:
                     _ai_audit_log.pop(0)
 
-                self._send_json({
+                self._send_ai_result({
                     "response": ai_response,
                     "provider": "llm",
                     "fallback": False,
                     "response_hash": response_hash,
                     "audit_logged": True,
                     "timestamp": now.isoformat(),
-                })
+                }, streaming)
             else:
                 # No LLM available — return signal for client-side fallback
-                self._send_json({"response": None, "provider": "none", "fallback": True, "message": "No AI provider configured. Using local pattern matching."})
+                self._send_ai_result({"response": None, "provider": "none", "fallback": True, "message": "No AI provider configured. Using local pattern matching."}, streaming)
 
         # ═══════════════════════════════════════════════════════════════
         #  HarborLink Integration — POST Endpoints
@@ -4374,22 +7809,8 @@ class handler(BaseHTTPRequestHandler):
                     self._send_json({"error": "Each record needs 'hash' or 'record_text'"}, 400)
                     return
 
-            # Build Merkle tree
-            def merkle_root(hashes):
-                if not hashes:
-                    return hashlib.sha256(b"empty").hexdigest()
-                layer = list(hashes)
-                while len(layer) > 1:
-                    if len(layer) % 2 == 1:
-                        layer.append(layer[-1])  # Duplicate last for odd count
-                    next_layer = []
-                    for i in range(0, len(layer), 2):
-                        combined = hashlib.sha256((layer[i] + layer[i + 1]).encode()).hexdigest()
-                        next_layer.append(combined)
-                    layer = next_layer
-                return layer[0]
-
-            root = merkle_root(leaf_hashes)
+            tree = MerkleTree(leaf_hashes)
+            root = tree.root
             batch_id = f"BATCH-{root[:12].upper()}"
 
             # Anchor Merkle root to XRPL (1 transaction for N records)
@@ -4407,7 +7828,8 @@ class handler(BaseHTTPRequestHandler):
             # Store batch for proof retrieval
             _batch_store[batch_id] = {
                 "merkle_root": root,
-                "leaf_hashes": leaf_hashes,
+                "tree": tree,
+                "leaf_hashes": tree.leaves,
                 "record_count": len(leaf_hashes),
                 "tx_hash": tx_hash,
                 "network": network,
@@ -4417,6 +7839,7 @@ class handler(BaseHTTPRequestHandler):
             }
 
             # Create individual record entries tagged with batch
+            batch_records = []
             for i, lh in enumerate(leaf_hashes):
                 rid = records_input[i].get("record_id", f"REC-{lh[:12].upper()}")
                 rec = {
@@ -4432,10 +7855,12 @@ class handler(BaseHTTPRequestHandler):
                     "record_id": rid,
                     "batch_id": batch_id,
                     "merkle_root": root,
+                    "leaf_index": i,
                     "org_id": org_id,
                 }
                 _live_records.append(rec)
-                _persist_record(rec)
+                batch_records.append(rec)
+            persist_failed = _persist_records(batch_records)
 
             # Fire webhook: batch.completed
             _deliver_webhook("batch.completed", {
@@ -4458,6 +7883,8 @@ class handler(BaseHTTPRequestHandler):
                 "explorer_url": explorer_url,
                 "cost_total_sls": 0.01,
                 "cost_per_record_sls": round(0.01 / len(leaf_hashes), 6),
+                "persisted": len(batch_records) - len(persist_failed),
+                "persist_failed": persist_failed,
                 "xrpl": xrpl_result,
             })
 
@@ -4583,63 +8010,25 @@ class handler(BaseHTTPRequestHandler):
             if not items or not isinstance(items, list):
                 self._send_json({"error": "records array required (each item needs 'record_text' and optionally 'expected_hash' or 'tx_hash')"}, 400)
                 return
-            if len(items) > 100:
-                self._send_json({"error": "Maximum 100 records per batch verify"}, 400)
+            if len(items) > VERIFY_BATCH_MAX:
+                self._send_json({"error": f"Maximum {VERIFY_BATCH_MAX} records per batch verify (send application/x-ndjson to stream larger batches)"}, 400)
                 return
 
             results = []
-            tamper_count = 0
-            match_count = 0
-            not_found_count = 0
-
+            counts = {"MATCH": 0, "MISMATCH": 0, "NOT_FOUND": 0}
             for item in items:
-                record_text = item.get("record_text", "")
-                if not record_text:
-                    results.append({"error": "record_text required", "index": len(results)})
-                    continue
-
-                computed = hashlib.sha256(record_text.encode()).hexdigest()
-                expected = item.get("expected_hash", "")
-                tx = item.get("tx_hash", "")
-                chain_hash = None
-
-                if tx:
-                    found = [r for r in _live_records if r.get("tx_hash") == tx or r.get("hash") == tx]
-                    if found:
-                        chain_hash = found[0].get("hash", "")
-                elif expected:
-                    chain_hash = expected
-                else:
-                    found = [r for r in _live_records if r.get("hash") == computed]
-                    if found:
-                        chain_hash = found[0].get("hash", "")
-
-                if chain_hash is None:
-                    status = "NOT_FOUND"
-                    not_found_count += 1
-                elif computed == chain_hash:
-                    status = "MATCH"
-                    match_count += 1
-                else:
-                    status = "MISMATCH"
-                    tamper_count += 1
-
-                results.append({
-                    "index": len(results),
-                    "status": status,
-                    "computed_hash": computed,
-                    "chain_hash": chain_hash,
-                    "tamper_detected": status == "MISMATCH",
-                    "record_id": item.get("record_id", ""),
-                })
+                result = _indexed(len(results), _verify_batch_item(item))
+                if "status" in result:
+                    counts[result["status"]] += 1
+                results.append(result)
 
             self._send_json({
                 "results": results,
                 "summary": {
                     "total": len(results),
-                    "match": match_count,
-                    "mismatch": tamper_count,
-                    "not_found": not_found_count,
+                    "match": counts["MATCH"],
+                    "mismatch": counts["MISMATCH"],
+                    "not_found": counts["NOT_FOUND"],
                 },
                 "operator": operator,
                 "verified_at": now.isoformat(),
@@ -4663,7 +8052,7 @@ class handler(BaseHTTPRequestHandler):
                 return
 
             # Hash the event payload
-            event_hash = hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+            event_hash = hashlib.sha256(s4_codec.canonical(payload, ensure_ascii=False).encode()).hexdigest()
 
             # Anchor to XRPL
             xrpl_result = _anchor_xrpl(event_hash, record_type=f"WAWF_{event_type.upper()}", branch="JOINT")
@@ -4823,7 +8212,7 @@ class handler(BaseHTTPRequestHandler):
                 }
 
             # Hash the task result for auditability
-            result_hash = hashlib.sha256(json.dumps(result_data, sort_keys=True).encode()).hexdigest()
+            result_hash = hashlib.sha256(s4_codec.canonical(result_data).encode()).hexdigest()
             defense_audit_entry = {
                 "timestamp": now.isoformat(),
                 "query": f"defense_task:{task_type}",
@@ -4865,6 +8254,7 @@ class handler(BaseHTTPRequestHandler):
             # Process unsynced queue items
             synced_count = 0
             failed_count = 0
+            sync_records = []
             for item in _offline_hash_queue:
                 if item.get("synced"):
                     continue
@@ -4889,9 +8279,10 @@ class handler(BaseHTTPRequestHandler):
                         "record_id": f"REC-SYNC-{hashlib.sha256(item['hash'].encode()).hexdigest()[:10].upper()}",
                     }
                     _live_records.append(sync_record)
-                    _persist_record(sync_record)
+                    sync_records.append(sync_record)
                 else:
                     failed_count += 1
+            persist_failed = _persist_records(sync_records)
 
             global _offline_last_sync
             if synced_count > 0:
@@ -4903,6 +8294,7 @@ class handler(BaseHTTPRequestHandler):
                 "status": "sync_complete",
                 "synced": synced_count,
                 "failed": failed_count,
+                "persist_failed": persist_failed,
                 "queue_remaining": sum(1 for i in _offline_hash_queue if not i.get("synced")),
                 "last_sync": _offline_last_sync,
                 "timestamp": now.isoformat(),
@@ -5010,7 +8402,7 @@ class handler(BaseHTTPRequestHandler):
                 "status": data.get("status", "Available"),
                 "unit_price": data.get("unit_price", None),
                 "lead_time_days": data.get("lead_time_days", None),
-                "alternates": json.dumps(data.get("alternates", [])),
+                "alternates": s4_codec.dumps(data.get("alternates", [])),
             }
             if not row["nsn"] or not row["part_name"]:
                 self._send_json({"error": "nsn and part_name are required"}, 400)
@@ -5049,7 +8441,7 @@ class handler(BaseHTTPRequestHandler):
                 "supplier": data.get("supplier", ""),
                 "risk_score": data.get("risk_score", data.get("score", 0)),
                 "risk_level": data.get("risk_level", data.get("level", "low")),
-                "factors": json.dumps(data.get("factors", [])),
+                "factors": s4_codec.dumps(data.get("factors", [])),
                 "eta_impact": data.get("eta_impact", ""),
                 "mitigation": data.get("mitigation", ""),
             }
@@ -5264,8 +8656,8 @@ class handler(BaseHTTPRequestHandler):
                 "file_type": data.get("file_type", ""),
                 "file_size": data.get("file_size", 0),
                 "row_count": data.get("row_count", 0),
-                "parsed_data": json.dumps(data.get("parsed_data", [])) if isinstance(data.get("parsed_data"), list) else data.get("parsed_data", "[]"),
-                "metadata": json.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
+                "parsed_data": s4_codec.dumps(data.get("parsed_data", [])) if isinstance(data.get("parsed_data"), list) else data.get("parsed_data", "[]"),
+                "metadata": s4_codec.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
                 "hash": data.get("hash", ""),
             }
             if not row["filename"]:
@@ -5289,7 +8681,7 @@ class handler(BaseHTTPRequestHandler):
                 "file_hash": data.get("file_hash", ""),
                 "tags": data.get("tags", []),
                 "status": data.get("status", "draft"),
-                "metadata": json.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
+                "metadata": s4_codec.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
             }
             if not row["title"]:
                 self._send_json({"error": "title is required"}, 400)
@@ -5306,7 +8698,7 @@ class handler(BaseHTTPRequestHandler):
                 "change_summary": data.get("change_summary", ""),
                 "author_email": data.get("author_email", ""),
                 "file_hash": data.get("file_hash", ""),
-                "red_flags": json.dumps(data.get("red_flags", [])) if isinstance(data.get("red_flags"), list) else data.get("red_flags", "[]"),
+                "red_flags": s4_codec.dumps(data.get("red_flags", [])) if isinstance(data.get("red_flags"), list) else data.get("red_flags", "[]"),
             }
             if not row["doc_id"]:
                 self._send_json({"error": "doc_id is required"}, 400)
@@ -5328,7 +8720,7 @@ class handler(BaseHTTPRequestHandler):
                 "nist_control": data.get("nist_control", ""),
                 "risk_level": data.get("risk_level", "moderate"),
                 "status": data.get("status", "open"),
-                "milestones": json.dumps(data.get("milestones", [])) if isinstance(data.get("milestones"), list) else data.get("milestones", "[]"),
+                "milestones": s4_codec.dumps(data.get("milestones", [])) if isinstance(data.get("milestones"), list) else data.get("milestones", "[]"),
                 "due_date": data.get("due_date"),
                 "completed_date": data.get("completed_date"),
                 "responsible": data.get("responsible", ""),
@@ -5359,7 +8751,7 @@ class handler(BaseHTTPRequestHandler):
                 "description": data.get("description", ""),
                 "status": data.get("status", "submitted"),
                 "reviewer": data.get("reviewer", ""),
-                "metadata": json.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
+                "metadata": s4_codec.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
             }
             if not row["control_id"]:
                 self._send_json({"error": "control_id is required"}, 400)
@@ -5384,9 +8776,9 @@ class handler(BaseHTTPRequestHandler):
                 "discrepancy_count": data.get("discrepancy_count", 0),
                 "critical_count": data.get("critical_count", 0),
                 "cost_delta": data.get("cost_delta", 0),
-                "items": json.dumps(data.get("items", [])) if isinstance(data.get("items"), list) else data.get("items", "[]"),
-                "baseline": json.dumps(data.get("baseline", [])) if isinstance(data.get("baseline"), list) else data.get("baseline", "[]"),
-                "discrepancies": json.dumps(data.get("discrepancies", [])) if isinstance(data.get("discrepancies"), list) else data.get("discrepancies", "[]"),
+                "items": s4_codec.dumps(data.get("items", [])) if isinstance(data.get("items"), list) else data.get("items", "[]"),
+                "baseline": s4_codec.dumps(data.get("baseline", [])) if isinstance(data.get("baseline"), list) else data.get("baseline", "[]"),
+                "discrepancies": s4_codec.dumps(data.get("discrepancies", [])) if isinstance(data.get("discrepancies"), list) else data.get("discrepancies", "[]"),
                 "report_hash": data.get("report_hash", ""),
                 "anchored": data.get("anchored", False),
                 "tx_hash": data.get("tx_hash", ""),
@@ -5404,7 +8796,7 @@ class handler(BaseHTTPRequestHandler):
                 "org_id": self.headers.get("X-API-Key", ""),
                 "created_by": data.get("created_by", ""),
                 "plan": data.get("plan", "starter"),
-                "settings": json.dumps(data.get("settings", {})) if isinstance(data.get("settings"), dict) else data.get("settings", "{}"),
+                "settings": s4_codec.dumps(data.get("settings", {})) if isinstance(data.get("settings"), dict) else data.get("settings", "{}"),
             }
             if not row["name"]:
                 self._send_json({"error": "name is required"}, 400)
@@ -5464,7 +8856,7 @@ class handler(BaseHTTPRequestHandler):
                 "next_inventory": data.get("next_inventory"),
                 "status": data.get("status", "active"),
                 "provenance_hash": data.get("provenance_hash", ""),
-                "metadata": json.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
+                "metadata": s4_codec.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
             }
             if not row["nomenclature"]:
                 self._send_json({"error": "nomenclature is required"}, 400)
@@ -5486,9 +8878,9 @@ class handler(BaseHTTPRequestHandler):
                 "component_count": data.get("component_count", 0),
                 "vulnerability_count": data.get("vulnerability_count", 0),
                 "license_count": data.get("license_count", 0),
-                "components": json.dumps(data.get("components", [])) if isinstance(data.get("components"), list) else data.get("components", "[]"),
-                "vulnerabilities": json.dumps(data.get("vulnerabilities", [])) if isinstance(data.get("vulnerabilities"), list) else data.get("vulnerabilities", "[]"),
-                "metadata": json.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
+                "components": s4_codec.dumps(data.get("components", [])) if isinstance(data.get("components"), list) else data.get("components", "[]"),
+                "vulnerabilities": s4_codec.dumps(data.get("vulnerabilities", [])) if isinstance(data.get("vulnerabilities"), list) else data.get("vulnerabilities", "[]"),
+                "metadata": s4_codec.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
                 "file_hash": data.get("file_hash", ""),
             }
             if not row["system_name"]:
@@ -5512,7 +8904,7 @@ class handler(BaseHTTPRequestHandler):
                 "evidence_hash": data.get("evidence_hash", ""),
                 "tx_hash": data.get("tx_hash", ""),
                 "qr_data": data.get("qr_data", ""),
-                "metadata": json.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
+                "metadata": s4_codec.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
             }
             if not row["item_id"] or not row["event_type"]:
                 self._send_json({"error": "item_id and event_type are required"}, 400)
@@ -5528,7 +8920,7 @@ class handler(BaseHTTPRequestHandler):
                     "to": row["to_entity"],
                     "ts": datetime.now(timezone.utc).isoformat(),
                 }
-                row["qr_data"] = json.dumps(qr_payload)
+                row["qr_data"] = s4_codec.dumps(qr_payload)
             result = _sb_insert("provenance_chain", row)
             self._send_json({"status": "created", "item": result[0] if result else row}, 201 if result else 200)
 
@@ -5578,58 +8970,38 @@ class handler(BaseHTTPRequestHandler):
                 "tool_context": tool_context,
             })
 
-            # Generate AI response using Claude API if available
+            # Generate AI response via the provider engine if any provider is configured
+            streaming = self._wants_sse(data)
             ai_response = ""
             model_used = "rule-based"
-            anthropic_key = os.environ.get("ANTHROPIC_API_KEY", "").strip()
 
-            if anthropic_key:
-                try:
-                    system_prompt = (
-                        "You are S4 Ledger's defense logistics AI assistant. "
-                        "You help with ILS (Integrated Logistics Support), military supply chain, "
-                        "DMSMS, compliance (NIST/CMMC/RMF), contract management, and defense acquisition. "
-                        "Be precise, cite regulations when applicable, use defense terminology."
-                    )
-                    if tool_context:
-                        system_prompt += f"\n\nCurrent tool context: {tool_context}"
-                    if rag_context:
-                        system_prompt += rag_context
-
-                    messages = [{"role": "user", "content": query}]
-                    # Fetch recent conversation history
-                    history = _sb_select("ai_conversations",
-                        query_params=f"session_id=eq.{session_id}&role=neq.system",
-                        order="created_at.desc", limit=10)
-                    if history and len(history) > 1:
-                        hist_messages = []
-                        for h in reversed(history[1:]):  # Skip current message
-                            hist_messages.append({"role": h.get("role", "user"), "content": h.get("content", "")})
-                        messages = hist_messages + messages
-
-                    api_body = json.dumps({
-                        "model": "claude-sonnet-4-20250514",
-                        "max_tokens": 2048,
-                        "system": system_prompt,
-                        "messages": messages,
-                    }).encode()
-
-                    req = urllib.request.Request(
-                        "https://api.anthropic.com/v1/messages",
-                        data=api_body,
-                        headers={
-                            "Content-Type": "application/json",
-                            "x-api-key": anthropic_key,
-                            "anthropic-version": "2023-06-01",
-                        },
-                        method="POST"
-                    )
-                    resp = urllib.request.urlopen(req, timeout=30)
-                    result_data = json.loads(resp.read())
-                    ai_response = result_data.get("content", [{}])[0].get("text", "")
-                    model_used = "claude-sonnet-4-20250514"
-                except Exception as e:
-                    print(f"Claude API error: {e}")
+            if any(p.configured() for p in _ai_engine.providers):
+                system_prompt = (
+                    "You are S4 Ledger's defense logistics AI assistant. "
+                    "You help with ILS (Integrated Logistics Support), military supply chain, "
+                    "DMSMS, compliance (NIST/CMMC/RMF), contract management, and defense acquisition. "
+                    "Be precise, cite regulations when applicable, use defense terminology."
+                )
+                if tool_context:
+                    system_prompt += f"\n\nCurrent tool context: {tool_context}"
+                if rag_context:
+                    system_prompt += rag_context
+
+                # Fetch recent conversation history
+                history = _sb_select("ai_conversations",
+                    query_params=f"session_id=eq.{session_id}&role=neq.system",
+                    order="created_at.desc", limit=10)
+                conversation = [{"role": h.get("role", "user"), "content": h.get("content", "")}
+                                for h in reversed(history[1:])]  # Skip current message
+                if streaming:
+                    ai_response, provider, _cached = self._stream_ai(system_prompt, query, conversation,
+                                                                     max_tokens=2048)
+                else:
+                    ai_response, provider, _cached = _cached_ai_complete("ai_rag", system_prompt, query,
+                                                                        conversation, max_tokens=2048)
+                if ai_response:
+                    model_used = _ai_engine.model(provider)
+                else:
                     ai_response = ""
 
             # Fallback: rule-based response using ILS domain knowledge
@@ -5684,6 +9056,8 @@ class handler(BaseHTTPRequestHandler):
                         "- Document Library (version control with hash verification)\n\n"
                         "Please ask about a specific topic for detailed guidance.")
                 model_used = "rule-based-ils-v2"
+                if streaming:
+                    self._send_sse("token", {"t": ai_response})
 
             # Save assistant response
             _sb_insert("ai_conversations", {
@@ -5695,12 +9069,12 @@ class handler(BaseHTTPRequestHandler):
                 "model": model_used,
             })
 
-            self._send_json({
+            self._send_ai_result({
                 "response": ai_response,
                 "session_id": session_id,
                 "model": model_used,
                 "rag_context_used": bool(rag_context),
-            })
+            }, streaming)
 
         elif route == "cdrl_validate":
             self._log_request("cdrl-validate-post")
@@ -5803,7 +9177,7 @@ class handler(BaseHTTPRequestHandler):
                 "pass_count": pass_c,
                 "fail_count": fail_c,
                 "warn_count": warn_c,
-                "results": json.dumps(results),
+                "results": s4_codec.dumps(results),
                 "overall_score": score,
                 "file_hash": data.get("file_hash", ""),
             }
@@ -5906,11 +9280,11 @@ class handler(BaseHTTPRequestHandler):
                 "contract_number": contract_number,
                 "filename": filename,
                 "clause_count": len(clauses),
-                "clauses": json.dumps(clauses),
-                "cdrls": json.dumps(cdrls),
-                "gfp_items": json.dumps(gfp_items_found),
-                "warranty_terms": json.dumps(warranty_terms),
-                "data_rights": json.dumps(data_rights),
+                "clauses": s4_codec.dumps(clauses),
+                "cdrls": s4_codec.dumps(cdrls),
+                "gfp_items": s4_codec.dumps(gfp_items_found),
+                "warranty_terms": s4_codec.dumps(warranty_terms),
+                "data_rights": s4_codec.dumps(data_rights),
                 "file_hash": data.get("file_hash", ""),
             }
             result = _sb_insert("contract_extractions", row)
@@ -5935,7 +9309,7 @@ class handler(BaseHTTPRequestHandler):
                 "metric_type": data.get("metric_type", ""),
                 "metric_value": data.get("metric_value", 0),
                 "period": data.get("period", ""),
-                "metadata": json.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
+                "metadata": s4_codec.dumps(data.get("metadata", {})) if isinstance(data.get("metadata"), dict) else data.get("metadata", "{}"),
             }
             if not row["program"] or not row["metric_type"]:
                 self._send_json({"error": "program and metric_type are required"}, 400)
@@ -5956,9 +9330,9 @@ class handler(BaseHTTPRequestHandler):
                 if not errors:
                     self._send_json({"status": "ok", "stored": 0})
                     return
-                stored = 0
+                rows = []
                 for err in errors[:20]:  # Max 20 errors per batch
-                    row = {
+                    rows.append({
                         "session_id": session_id,
                         "error_type": str(err.get("type", "unknown"))[:50],
                         "message": str(err.get("msg", ""))[:500],
@@ -5969,18 +9343,16 @@ class handler(BaseHTTPRequestHandler):
                         "tag": str(err.get("tag", ""))[:50],
                         "client_ts": err.get("ts"),
                         "created_at": datetime.utcnow().isoformat() + "Z",
-                    }
-                    result = _sb_insert("client_errors", row)
-                    if result:
-                        stored += 1
-                self._send_json({"status": "ok", "stored": stored})
+                    })
+                report = _sb_bulk_upsert("client_errors", rows)
+                self._send_json({"status": "ok", "stored": report["written"]})
             except Exception as e:
                 # Never fail on error reporting — just acknowledge
                 self._send_json({"status": "ok", "stored": 0})
 
         # ═══════════════════════════════════════════════════════════════
         #  Living Program Ledger — AI-Powered Program Summary
-        #  Supabase: lpl_snapshots | Cache: _lpl_cache (5-min TTL)
+        #  Supabase: lpl_snapshots | Cache: _llm_cache (5-min TTL)
         # ═══════════════════════════════════════════════════════════════
         elif route == "living_ledger":
             self._log_request("living-ledger")
@@ -5991,19 +9363,11 @@ class handler(BaseHTTPRequestHandler):
                 self._send_json({"error": "No message provided"}, 400)
                 return
 
-            # Per-program caching — avoid duplicate AI calls within TTL
             program_name = ""
             period = ""
             if analysis_data:
                 program_name = str(analysis_data.get("program", "")).strip()
                 period = str(analysis_data.get("period", "")).strip()
-            cache_key = f"{program_name}|{period}" if program_name else ""
-
-            if cache_key and cache_key in _lpl_cache:
-                cached = _lpl_cache[cache_key]
-                if time.time() - cached["timestamp"] < _LPL_CACHE_TTL:
-                    self._send_json({"response": cached["response"], "provider": "cache", "fallback": False, "cached": True})
-                    return
 
             system_prompt = _build_ai_system_prompt("living_program_ledger", analysis_data)
             system_prompt += (
@@ -6018,16 +9382,20 @@ class handler(BaseHTTPRequestHandler):
                 "(e.g., receipt rates, CDRL approval status, COR findings) where applicable."
             )
 
-            ai_response = self._call_ai_cascade(system_prompt, user_message, data.get("conversation", []))
+            streaming = self._wants_sse(data)
+            if streaming:
+                ai_response, _provider, cached = self._stream_ai(system_prompt, user_message,
+                                                                 data.get("conversation", []))
+            else:
+                ai_response = self._call_ai_cascade(system_prompt, user_message, data.get("conversation", []))
+                cached = self._ai_cached
             provider = "llm" if ai_response else "none"
 
-            # Update per-program cache
-            if ai_response and cache_key:
-                _lpl_cache[cache_key] = {"response": ai_response, "timestamp": time.time(), "period": period}
-                # Evict oldest entries if cache grows too large
-                if len(_lpl_cache) > 200:
-                    oldest_key = min(_lpl_cache, key=lambda k: _lpl_cache[k]["timestamp"])
-                    del _lpl_cache[oldest_key]
+            # Cached replies were snapshotted when first generated
+            if ai_response and cached:
+                self._send_ai_result({"response": ai_response, "provider": "cache", "fallback": False,
+                                      "cached": True}, streaming)
+                return
 
             # Persist snapshot to Supabase
             if ai_response and SUPABASE_AVAILABLE:
@@ -6043,7 +9411,7 @@ class handler(BaseHTTPRequestHandler):
                     try:
                         json_match = re.search(r'\{[\s\S]*\}', ai_response)
                         if json_match:
-                            parsed = json.loads(json_match.group())
+                            parsed = s4_codec.loads(json_match.group())
                             exec_overview = parsed.get("executive_overview", "")
                             sections_json = {k: v for k, v in parsed.items() if k != "executive_overview"}
                     except Exception:
@@ -6054,19 +9422,20 @@ class handler(BaseHTTPRequestHandler):
                         "period": period,
                         "version_num": next_version,
                         "executive_overview": exec_overview[:2000],
-                        "sections_json": json.dumps(sections_json),
+                        "sections_json": s4_codec.dumps(sections_json),
                         "ai_provider": provider,
-                        "analysis_data": json.dumps(analysis_data) if analysis_data else "{}",
+                        "analysis_data": s4_codec.dumps(analysis_data) if analysis_data else "{}",
                         "created_at": datetime.utcnow().isoformat() + "Z",
                     })
                 except Exception:
                     pass  # Non-blocking — never fail the response on persistence error
 
             if ai_response:
-                self._send_json({"response": ai_response, "provider": provider, "fallback": False})
+                self._send_ai_result({"response": ai_response, "provider": provider, "fallback": False}, streaming)
             else:
-                self._send_json({"response": None, "provider": "none", "fallback": True,
-                                 "message": "No AI provider configured. Using local pattern matching."})
+                self._send_ai_result({"response": None, "provider": "none", "fallback": True,
+                                      "message": "No AI provider configured. Using local pattern matching."},
+                                     streaming)
 
         # ═══════════════════════════════════════════════════════════════
         #  Program Impact Simulator — Cascade Risk Analysis
@@ -6141,7 +9510,7 @@ class handler(BaseHTTPRequestHandler):
                         try:
                             json_match = re.search(r'\{[\s\S]*\}', ai_response)
                             if json_match:
-                                parsed = json.loads(json_match.group())
+                                parsed = s4_codec.loads(json_match.group())
                                 explanation = parsed.get("explanation", "")
                                 mitigations = parsed.get("mitigations", [])
                         except Exception:
@@ -6157,7 +9526,7 @@ class handler(BaseHTTPRequestHandler):
                         "downstream_programs": analysis_data.get("downstreamPrograms", 0),
                         "source_tool": str(analysis_data.get("sourceTool", ""))[:100],
                         "explanation": explanation[:5000],
-                        "mitigations": json.dumps(mitigations if isinstance(mitigations, list) else []),
+                        "mitigations": s4_codec.dumps(mitigations if isinstance(mitigations, list) else []),
                         "ai_provider": provider,
                         "created_at": datetime.utcnow().isoformat() + "Z",
                     })
@@ -6261,7 +9630,7 @@ class handler(BaseHTTPRequestHandler):
                 if sendgrid_key:
                     try:
                         import urllib.request
-                        email_body = json.dumps({
+                        email_body = s4_codec.dumpb({
                             "personalizations": [{"to": [{"email": email}]}],
                             "from": {"email": "noreply@s4ledger.com", "name": "S4 Ledger SCN"},
                             "subject": f"S4 Ledger — You've been invited to collaborate ({permission} access)",
@@ -6277,7 +9646,7 @@ class handler(BaseHTTPRequestHandler):
                                     f"<p><a href='https://app.s4ledger.com/collaborate?token={invite_token}'>Accept Invitation</a></p>"
                                 )
                             }]
-                        }).encode()
+                        })
                         req = urllib.request.Request(
                             "https://api.sendgrid.com/v3/mail/send",
                             data=email_body,
@@ -6387,7 +9756,7 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        parsed = json.loads(json_match.group())
+                        parsed = s4_codec.loads(json_match.group())
                         for key in ("forecast_30", "forecast_60", "forecast_90"):
                             if key in parsed and isinstance(parsed[key], list):
                                 forecast[key] = parsed[key][:5]
@@ -6412,7 +9781,7 @@ class handler(BaseHTTPRequestHandler):
                 return
 
             # Server-side verification hash
-            content_for_hash = executive_overview + json.dumps(sections, sort_keys=True, ensure_ascii=False)
+            content_for_hash = executive_overview + s4_codec.canonical(sections, ensure_ascii=False)
             server_hash = hashlib.sha256(content_for_hash.encode("utf-8")).hexdigest()
 
             # HMAC sign the package
@@ -6430,9 +9799,9 @@ class handler(BaseHTTPRequestHandler):
                         "period": "signed_package",
                         "version_num": 0,
                         "executive_overview": executive_overview[:2000],
-                        "sections_json": json.dumps(sections),
+                        "sections_json": s4_codec.dumps(sections),
                         "ai_provider": "signed_package",
-                        "analysis_data": json.dumps({"content_hash": content_hash, "server_hash": server_hash,
+                        "analysis_data": s4_codec.dumps({"content_hash": content_hash, "server_hash": server_hash,
                                                       "package_id": package_id, "signature": signature}),
                         "created_at": now.isoformat() + "Z",
                     })
@@ -6460,57 +9829,25 @@ class handler(BaseHTTPRequestHandler):
             base_delay = int(analysis_data.get("scheduleDelay", 30))
             base_cost = int(analysis_data.get("costImpact", 500))
             risk_label = str(analysis_data.get("riskLabel", "")).strip()
-            iterations = min(int(data.get("iterations", 1000)), 10000)
-
-            import random
-            random.seed(hash(risk_label + str(base_delay) + str(base_cost)))
-
-            # Generate Monte Carlo simulation (normal distribution)
-            delay_samples = []
-            cost_samples = []
-            for _ in range(iterations):
-                d = max(0, random.gauss(base_delay, base_delay * 0.3))
-                c = max(0, random.gauss(base_cost, base_cost * 0.3))
-                delay_samples.append(d)
-                cost_samples.append(c)
-
-            delay_samples.sort()
-            cost_samples.sort()
-
-            # Build 5x6 heatmap grid
-            delay_buckets = [base_delay * m for m in (0.5, 0.75, 1.0, 1.25, 1.5)]
-            cost_buckets = [base_cost * m for m in (0.4, 0.6, 0.8, 1.0, 1.2, 1.5)]
-
-            heatmap = []
-            for di in range(5):
-                row = []
-                d_lo = delay_buckets[di] - base_delay * 0.125 if di > 0 else 0
-                d_hi = delay_buckets[di] + base_delay * 0.125 if di < 4 else base_delay * 10
-                for ci in range(6):
-                    c_lo = cost_buckets[ci] - base_cost * 0.1 if ci > 0 else 0
-                    c_hi = cost_buckets[ci] + base_cost * 0.1 if ci < 5 else base_cost * 10
-                    count = sum(1 for s in range(iterations)
-                                if d_lo <= delay_samples[s] <= d_hi and c_lo <= cost_samples[s] <= c_hi)
-                    row.append(round(count / iterations * 100, 1))
-                heatmap.append(row)
-
-            # Confidence intervals
-            p50_d = round(delay_samples[int(iterations * 0.50)])
-            p75_d = round(delay_samples[int(iterations * 0.75)])
-            p95_d = round(delay_samples[int(iterations * 0.95)])
-            p50_c = round(cost_samples[int(iterations * 0.50)])
-            p75_c = round(cost_samples[int(iterations * 0.75)])
-            p95_c = round(cost_samples[int(iterations * 0.95)])
+            # zero or negative bases would collapse every bucket to [0, 0]
+            base_delay, base_cost = max(1, base_delay), max(1, base_cost)
+            cap = MONTE_CARLO_MAX_ITERATIONS if np is not None else MONTE_CARLO_FALLBACK_MAX
+            iterations = max(1, min(int(data.get("iterations", 1000)), cap))
+            correlation = float(data.get("correlation") or 0.0)
+            seed = data.get("seed")
+            if seed is None:
+                seed = _monte_carlo_seed(risk_label, base_delay, base_cost)
+
+            heatmap, percentiles = _monte_carlo_heatmap(base_delay, base_cost, iterations, abs(int(seed)), correlation)
+            delay_buckets = [base_delay * m for m in _MC_DELAY_CENTERS]
+            cost_buckets = [base_cost * m for m in _MC_COST_CENTERS]
 
             self._send_json({
                 "heatmap": heatmap,
                 "delay_buckets": [f"{round(d)}d" for d in delay_buckets],
                 "cost_buckets": [f"${round(c)}K" for c in cost_buckets],
-                "confidence_intervals": {
-                    "P50": {"delay": p50_d, "cost": p50_c},
-                    "P75": {"delay": p75_d, "cost": p75_c},
-                    "P95": {"delay": p95_d, "cost": p95_c},
-                },
+                "confidence_intervals": {name: {"delay": round(d), "cost": round(c)}
+                                         for name, (d, c) in percentiles.items()},
                 "iterations": iterations,
                 "risk_label": risk_label,
             })
@@ -6553,9 +9890,9 @@ class handler(BaseHTTPRequestHandler):
                         "period": "impact_scenario",
                         "version_num": next_version,
                         "executive_overview": f"Impact Scenario — {scenario.get('riskLabel', 'Simulation')}",
-                        "sections_json": json.dumps({"impact_scenario": scenario_text, "hash": scenario_hash}),
+                        "sections_json": s4_codec.dumps({"impact_scenario": scenario_text, "hash": scenario_hash}),
                         "ai_provider": "scenario_save",
-                        "analysis_data": json.dumps(scenario),
+                        "analysis_data": s4_codec.dumps(scenario),
                         "created_at": datetime.utcnow().isoformat() + "Z",
                     })
                 except Exception:
@@ -6603,7 +9940,7 @@ class handler(BaseHTTPRequestHandler):
                 "Reference anchored data timestamps and receipts when explaining resolutions."
             )
 
-            user_msg = f"View: {view_id}\nParticipants: {json.dumps(participants[:10])}\nField data entries: {len(field_data)}\n\nScan for conflicting updates and propose AI-reconciled resolutions."
+            user_msg = f"View: {view_id}\nParticipants: {s4_codec.dumps(participants[:10])}\nField data entries: {len(field_data)}\n\nScan for conflicting updates and propose AI-reconciled resolutions."
 
             ai_response = self._call_ai_cascade(system_prompt, user_msg)
             provider = "llm" if ai_response else "none"
@@ -6613,7 +9950,7 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        parsed = json.loads(json_match.group())
+                        parsed = s4_codec.loads(json_match.group())
                         if "conflicts" in parsed and isinstance(parsed["conflicts"], list):
                             conflicts = parsed["conflicts"][:10]
                 except Exception:
@@ -6647,7 +9984,7 @@ class handler(BaseHTTPRequestHandler):
                 "Use plausible numbers that reflect real DoD program performance ranges."
             )
 
-            user_msg = f"View: {view_id}\nProgram metrics: {json.dumps(metrics)}\n\nGenerate federated benchmark comparison against 47 opted-in programs."
+            user_msg = f"View: {view_id}\nProgram metrics: {s4_codec.dumps(metrics)}\n\nGenerate federated benchmark comparison against 47 opted-in programs."
 
             ai_response = self._call_ai_cascade(system_prompt, user_msg)
             provider = "llm" if ai_response else "none"
@@ -6657,7 +9994,7 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        parsed = json.loads(json_match.group())
+                        parsed = s4_codec.loads(json_match.group())
                         if "benchmarks" in parsed and isinstance(parsed["benchmarks"], list):
                             benchmarks = parsed["benchmarks"][:8]
                 except Exception:
@@ -6712,13 +10049,13 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        brief = json.loads(json_match.group())
+                        brief = s4_codec.loads(json_match.group())
                 except Exception:
                     pass
 
             # HMAC-sign the brief
             now = datetime.utcnow()
-            brief_content = json.dumps(brief, sort_keys=True, ensure_ascii=False)
+            brief_content = s4_codec.canonical(brief, ensure_ascii=False)
             brief_hash = hashlib.sha256(brief_content.encode("utf-8")).hexdigest()
             sign_payload = f"ucb|{program_name}|{brief_hash}|{now.isoformat()}"
             signature = hmac.new(SCN_SIGNING_SECRET.encode(), sign_payload.encode(), hashlib.sha256).hexdigest()
@@ -6778,7 +10115,7 @@ class handler(BaseHTTPRequestHandler):
             program_name = str(payload.get("program", "All Programs"))[:200]
 
             # Server-side content hash for verification
-            content_for_hash = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+            content_for_hash = s4_codec.canonical(payload, ensure_ascii=False)
             server_hash = hashlib.sha256(content_for_hash.encode("utf-8")).hexdigest()
 
             # AI analysis of mission impact
@@ -6810,7 +10147,7 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        ai_result = json.loads(json_match.group())
+                        ai_result = s4_codec.loads(json_match.group())
                 except Exception:
                     ai_result = {"impact_assessment": ai_response[:1000]}
 
@@ -6832,11 +10169,11 @@ class handler(BaseHTTPRequestHandler):
                         "period": "cmil_impact_anchor",
                         "version_num": 0,
                         "executive_overview": f"CMIL Anchor — {risk_label}",
-                        "sections_json": json.dumps({"risk_label": risk_label, "schedule_delay": schedule_delay,
+                        "sections_json": s4_codec.dumps({"risk_label": risk_label, "schedule_delay": schedule_delay,
                                                       "cost_impact": cost_impact, "readiness_drop": readiness_drop,
                                                       "server_hash": server_hash, "ai_result": ai_result}),
                         "ai_provider": ai_provider,
-                        "analysis_data": json.dumps(payload),
+                        "analysis_data": s4_codec.dumps(payload),
                         "created_at": now.isoformat() + "Z",
                     })
                 except Exception:
@@ -6899,7 +10236,7 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        parsed = json.loads(json_match.group())
+                        parsed = s4_codec.loads(json_match.group())
                         if "gaps" in parsed and isinstance(parsed["gaps"], list):
                             gaps = parsed["gaps"][:10]
                 except Exception:
@@ -6907,7 +10244,7 @@ class handler(BaseHTTPRequestHandler):
 
             # Content hash for the scan result
             now = datetime.utcnow()
-            scan_content = json.dumps({"tool": tool_id, "gaps": gaps, "ts": now.isoformat()}, sort_keys=True)
+            scan_content = s4_codec.canonical({"tool": tool_id, "gaps": gaps, "ts": now.isoformat()})
             scan_hash = hashlib.sha256(scan_content.encode("utf-8")).hexdigest()
 
             # XRPL anchor the compliance scan
@@ -6921,9 +10258,9 @@ class handler(BaseHTTPRequestHandler):
                         "period": "shc_compliance_scan",
                         "version_num": 0,
                         "executive_overview": f"Self-Healing Compliance Scan — {tool_name}",
-                        "sections_json": json.dumps({"gaps": gaps, "scan_hash": scan_hash}),
+                        "sections_json": s4_codec.dumps({"gaps": gaps, "scan_hash": scan_hash}),
                         "ai_provider": ai_provider,
-                        "analysis_data": json.dumps({"tool": tool_id, "toolName": tool_name}),
+                        "analysis_data": s4_codec.dumps({"tool": tool_id, "toolName": tool_name}),
                         "created_at": now.isoformat() + "Z",
                     })
                 except Exception:
@@ -6997,19 +10334,19 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        handoff = json.loads(json_match.group())
+                        handoff = s4_codec.loads(json_match.group())
                 except Exception:
                     handoff = {"executive_summary": ai_response[:2000]}
 
             # Build the handoff package content and hash it
             now = datetime.utcnow()
-            package_content = json.dumps({
+            package_content = s4_codec.canonical({
                 "program": program_name,
                 "handoff": handoff,
                 "lpl_count": len(lpl_data),
                 "compliance_count": len(compliance_data),
                 "timestamp": now.isoformat(),
-            }, sort_keys=True, ensure_ascii=False)
+            }, ensure_ascii=False)
             package_hash = hashlib.sha256(package_content.encode("utf-8")).hexdigest()
             package_id = f"ZTH-{now.strftime('%Y%m%dT%H%M%SZ')}-{package_hash[:8].upper()}"
 
@@ -7028,10 +10365,10 @@ class handler(BaseHTTPRequestHandler):
                         "period": "zth_handoff_package",
                         "version_num": 0,
                         "executive_overview": f"Zero-Trust Handoff — {program_name}",
-                        "sections_json": json.dumps({"package_id": package_id, "handoff": handoff,
+                        "sections_json": s4_codec.dumps({"package_id": package_id, "handoff": handoff,
                                                       "package_hash": package_hash, "signature": signature}),
                         "ai_provider": ai_provider,
-                        "analysis_data": json.dumps({"program": program_name}),
+                        "analysis_data": s4_codec.dumps({"program": program_name}),
                         "created_at": now.isoformat() + "Z",
                     })
                 except Exception:
@@ -7108,12 +10445,12 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        result = json.loads(json_match.group())
+                        result = s4_codec.loads(json_match.group())
                 except Exception:
                     result = {"summary": ai_response[:1000]}
 
             now = datetime.utcnow()
-            result_content = json.dumps(result, sort_keys=True, ensure_ascii=False)
+            result_content = s4_codec.canonical(result, ensure_ascii=False)
             result_hash = hashlib.sha256(result_content.encode("utf-8")).hexdigest()
 
             # XRPL anchor
@@ -7127,9 +10464,9 @@ class handler(BaseHTTPRequestHandler):
                         "period": "pra_resource_allocation",
                         "version_num": 0,
                         "executive_overview": f"Predictive Resource Allocation — {program_name}",
-                        "sections_json": json.dumps({"result": result, "result_hash": result_hash}),
+                        "sections_json": s4_codec.dumps({"result": result, "result_hash": result_hash}),
                         "ai_provider": ai_provider,
-                        "analysis_data": json.dumps({"program": program_name}),
+                        "analysis_data": s4_codec.dumps({"program": program_name}),
                         "created_at": now.isoformat() + "Z",
                     })
                 except Exception:
@@ -7207,14 +10544,14 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        aar = json.loads(json_match.group())
+                        aar = s4_codec.loads(json_match.group())
                 except Exception:
                     aar = {"event": f"After-Action Review — {program_name}",
                            "findings": [{"type": "action", "text": ai_response[:500]}]}
 
             # Content hash and XRPL anchor
             now = datetime.utcnow()
-            aar_content = json.dumps(aar, sort_keys=True, ensure_ascii=False)
+            aar_content = s4_codec.canonical(aar, ensure_ascii=False)
             aar_hash = hashlib.sha256(aar_content.encode("utf-8")).hexdigest()
 
             # HMAC signature
@@ -7231,9 +10568,9 @@ class handler(BaseHTTPRequestHandler):
                         "period": "aar_immutable_review",
                         "version_num": 0,
                         "executive_overview": f"After-Action Review — {program_name}",
-                        "sections_json": json.dumps({"aar": aar, "aar_hash": aar_hash, "signature": signature}),
+                        "sections_json": s4_codec.dumps({"aar": aar, "aar_hash": aar_hash, "signature": signature}),
                         "ai_provider": ai_provider,
-                        "analysis_data": json.dumps({"program": program_name}),
+                        "analysis_data": s4_codec.dumps({"program": program_name}),
                         "created_at": now.isoformat() + "Z",
                     })
                 except Exception:
@@ -7271,9 +10608,9 @@ class handler(BaseHTTPRequestHandler):
             if record_ids:
                 targets = record_ids
             else:
-                targets = [r["record_id"] for r in _live_records
-                           if program_id == "ALL" or r.get("org_id") == program_id
-                              or r.get("record_type", "").startswith(program_id)]
+                candidates = _live_records if program_id == "ALL" else \
+                    _live_records.select(org_id=program_id, record_type_prefix=program_id)
+                targets = [r["record_id"] for r in candidates]
                 if not targets:
                     # Fallback: treat up to 30 of the most recent records as critical
                     targets = [r["record_id"] for r in _live_records[-30:]]
@@ -7284,7 +10621,7 @@ class handler(BaseHTTPRequestHandler):
                 # Build a quantum-safe hash: SHA-256 of the original hash + programme + timestamp
                 # (real Dilithium signing would require the pqcrypto library; we
                 #  produce a Dilithium-compatible digest and anchor it to XRPL.)
-                original = next((r for r in _live_records if r.get("record_id") == rid), None)
+                original = _live_records.get(rid)
                 original_hash = original["hash"] if original else hashlib.sha256(rid.encode()).hexdigest()
                 pq_payload = f"DILITHIUM3|{rid}|{original_hash}|{now.isoformat()}"
                 pq_hash = hashlib.sha256(pq_payload.encode("utf-8")).hexdigest()
@@ -7335,9 +10672,9 @@ class handler(BaseHTTPRequestHandler):
                         "period": "quantum_safe_reanchor",
                         "version_num": 0,
                         "executive_overview": f"{len(reanchored)} records re-anchored with CRYSTALS-Dilithium Level 3",
-                        "sections_json": json.dumps({"reanchored_ids": [e["record_id"] for e in reanchored]}),
+                        "sections_json": s4_codec.dumps({"reanchored_ids": [e["record_id"] for e in reanchored]}),
                         "ai_provider": "none",
-                        "analysis_data": json.dumps({"program_id": program_id, "count": len(reanchored)}),
+                        "analysis_data": s4_codec.dumps({"program_id": program_id, "count": len(reanchored)}),
                         "created_at": now.isoformat() + "Z",
                     })
                 except Exception:
@@ -7393,7 +10730,7 @@ class handler(BaseHTTPRequestHandler):
                 "sealed_by": user_email,
                 "sealed_at": now.isoformat() + "Z",
             }
-            manifest_json = json.dumps(manifest, sort_keys=True, separators=(",", ":"))
+            manifest_json = s4_codec.canonical(manifest, separators=(",", ":"))
             archive_hash = _pla_hashlib.sha256(manifest_json.encode()).hexdigest()
 
             # Anchor the archive seal to XRPL for immutability
@@ -7496,14 +10833,14 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        result = json.loads(json_match.group())
+                        result = s4_codec.loads(json_match.group())
                 except Exception:
                     result = {"overall_risk": "Medium", "funding_confidence": 65,
                               "factors": [], "recommendations": [ai_response[:500]],
                               "projected_outcomes": []}
 
             now = datetime.utcnow()
-            content_hash = hashlib.sha256(json.dumps(result, sort_keys=True).encode()).hexdigest()
+            content_hash = hashlib.sha256(s4_codec.canonical(result).encode()).hexdigest()
             signature = hmac.new(SCN_SIGNING_SECRET.encode(),
                                  f"cff|{program_name}|{content_hash}|{now.isoformat()}".encode(),
                                  hashlib.sha256).hexdigest()
@@ -7539,7 +10876,7 @@ class handler(BaseHTTPRequestHandler):
                 "- 'evidence_basis': description of data supporting the clause\n"
                 "Use realistic FAR/DFARS references."
             )
-            user_msg = f"Risk: {risk_label}\nCascade context: {json.dumps(cascade)[:500]}\nGenerate self-executing contract clauses."
+            user_msg = f"Risk: {risk_label}\nCascade context: {s4_codec.dumps(cascade)[:500]}\nGenerate self-executing contract clauses."
 
             ai_response = self._call_ai_cascade(system_prompt, user_msg)
             ai_provider = "llm" if ai_response else "none"
@@ -7549,7 +10886,7 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        result = json.loads(json_match.group())
+                        result = s4_codec.loads(json_match.group())
                 except Exception:
                     result = {"clause_id": f"SEC-{int(datetime.utcnow().timestamp())}",
                               "clauses": [{"type": "adjustment", "title": "AI-generated clause",
@@ -7560,7 +10897,7 @@ class handler(BaseHTTPRequestHandler):
             if "clause_id" not in result:
                 result["clause_id"] = f"SEC-{int(now.timestamp())}"
 
-            content_hash = hashlib.sha256(json.dumps(result, sort_keys=True).encode()).hexdigest()
+            content_hash = hashlib.sha256(s4_codec.canonical(result).encode()).hexdigest()
             response = {
                 **result,
                 "content_hash": content_hash,
@@ -7605,13 +10942,13 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        result = json.loads(json_match.group())
+                        result = s4_codec.loads(json_match.group())
                 except Exception:
                     result = {"lessons": [], "total_programs": 0,
                               "privacy_method": "differential privacy (ε=1.0)"}
 
             now = datetime.utcnow()
-            content_hash = hashlib.sha256(json.dumps(result, sort_keys=True).encode()).hexdigest()
+            content_hash = hashlib.sha256(s4_codec.canonical(result).encode()).hexdigest()
             response = {
                 **result,
                 "content_hash": content_hash,
@@ -7650,14 +10987,14 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        result = json.loads(json_match.group())
+                        result = s4_codec.loads(json_match.group())
                 except Exception:
                     result = {"current_coverage": "$0", "recommended_coverage": "$0",
                               "potential_savings": "$0", "risk_score": 50, "risk_label": "Medium",
                               "categories": [], "evidence_count": 0}
 
             now = datetime.utcnow()
-            content_hash = hashlib.sha256(json.dumps(result, sort_keys=True).encode()).hexdigest()
+            content_hash = hashlib.sha256(s4_codec.canonical(result).encode()).hexdigest()
             response = {
                 **result,
                 "content_hash": content_hash,
@@ -7700,13 +11037,13 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        result = json.loads(json_match.group())
+                        result = s4_codec.loads(json_match.group())
                 except Exception:
                     result = {"metrics": [], "share_options": []}
 
             now = datetime.utcnow()
             scorecard_id = result.get("scorecard_id", f"VPS-{int(now.timestamp())}")
-            content_hash = hashlib.sha256(json.dumps(result, sort_keys=True).encode()).hexdigest()
+            content_hash = hashlib.sha256(s4_codec.canonical(result).encode()).hexdigest()
             signature = hmac.new(SCN_SIGNING_SECRET.encode(),
                                  f"vps|{scorecard_id}|{content_hash}|{now.isoformat()}".encode(),
                                  hashlib.sha256).hexdigest()
@@ -7757,13 +11094,13 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        result = json.loads(json_match.group())
+                        result = s4_codec.loads(json_match.group())
                 except Exception:
                     result = {"correlations": [], "overall_score": 0,
                               "data_points": 0, "confidence": 0}
 
             now = datetime.utcnow()
-            content_hash = hashlib.sha256(json.dumps(result, sort_keys=True).encode()).hexdigest()
+            content_hash = hashlib.sha256(s4_codec.canonical(result).encode()).hexdigest()
             response = {
                 **result,
                 "content_hash": content_hash,
@@ -7793,7 +11130,7 @@ class handler(BaseHTTPRequestHandler):
                 "- 'cascade_depth': integer 1-4\n"
                 "Use realistic DoD program interdependencies."
             )
-            user_msg = f"Origin: {origin}\nCascade data: {json.dumps(cascade)[:500]}\nSimulate multi-program cascade."
+            user_msg = f"Origin: {origin}\nCascade data: {s4_codec.dumps(cascade)[:500]}\nSimulate multi-program cascade."
 
             ai_response = self._call_ai_cascade(system_prompt, user_msg)
             ai_provider = "llm" if ai_response else "none"
@@ -7803,14 +11140,14 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        result = json.loads(json_match.group())
+                        result = s4_codec.loads(json_match.group())
                 except Exception:
                     result = {"origin_program": origin, "affected_programs": [],
                               "total_enterprise_impact": "$0", "total_schedule_risk": 0,
                               "cascade_depth": 0}
 
             now = datetime.utcnow()
-            content_hash = hashlib.sha256(json.dumps(result, sort_keys=True).encode()).hexdigest()
+            content_hash = hashlib.sha256(s4_codec.canonical(result).encode()).hexdigest()
             response = {
                 **result,
                 "origin_program": result.get("origin_program", origin),
@@ -7853,13 +11190,13 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     json_match = re.search(r'\{[\s\S]*\}', ai_response)
                     if json_match:
-                        result = json.loads(json_match.group())
+                        result = s4_codec.loads(json_match.group())
                 except Exception:
                     result = {"disputes": [], "total_value_at_stake": "$0",
                               "estimated_resolution_time": "N/A"}
 
             now = datetime.utcnow()
-            content_hash = hashlib.sha256(json.dumps(result, sort_keys=True).encode()).hexdigest()
+            content_hash = hashlib.sha256(s4_codec.canonical(result).encode()).hexdigest()
             response = {
                 **result,
                 "content_hash": content_hash,
@@ -7875,7 +11212,7 @@ class handler(BaseHTTPRequestHandler):
             field_key = str(data.get("fieldKey", "")).strip()[:100]
             value = str(data.get("value", "")).strip()[:2000]
             now = datetime.utcnow()
-            content = json.dumps({"rowIdx": row_idx, "field": field_key, "value": value}, sort_keys=True)
+            content = s4_codec.canonical({"rowIdx": row_idx, "field": field_key, "value": value})
             content_hash = hashlib.sha256(content.encode()).hexdigest()
             anchor_result = _anchor_xrpl(content_hash, "drl_cell_update", "main", None)
             tx_hash = anchor_result.get("tx_hash") if anchor_result else None
@@ -7894,7 +11231,7 @@ class handler(BaseHTTPRequestHandler):
             row_idx = data.get("rowIdx", 0)
             new_status = str(data.get("status", "")).strip()[:100]
             now = datetime.utcnow()
-            content = json.dumps({"rowIdx": row_idx, "status": new_status}, sort_keys=True)
+            content = s4_codec.canonical({"rowIdx": row_idx, "status": new_status})
             content_hash = hashlib.sha256(content.encode()).hexdigest()
             anchor_result = _anchor_xrpl(content_hash, "drl_status_change", "main", None)
             tx_hash = anchor_result.get("tx_hash") if anchor_result else None
@@ -7911,7 +11248,7 @@ class handler(BaseHTTPRequestHandler):
             row_idx = data.get("rowIdx", 0)
             url = str(data.get("url", "")).strip()[:2000]
             now = datetime.utcnow()
-            content = json.dumps({"rowIdx": row_idx, "url": url}, sort_keys=True)
+            content = s4_codec.canonical({"rowIdx": row_idx, "url": url})
             content_hash = hashlib.sha256(content.encode()).hexdigest()
             anchor_result = _anchor_xrpl(content_hash, "drl_workflow_link", "main", None)
             tx_hash = anchor_result.get("tx_hash") if anchor_result else None
@@ -7931,7 +11268,7 @@ class handler(BaseHTTPRequestHandler):
             # Limit to 500 rows for safety
             rows = rows[:500]
             now = datetime.utcnow()
-            content = json.dumps({"count": len(rows), "ts": now.isoformat()}, sort_keys=True)
+            content = s4_codec.canonical({"count": len(rows), "ts": now.isoformat()})
             content_hash = hashlib.sha256(content.encode()).hexdigest()
             anchor_result = _anchor_xrpl(content_hash, "drl_bulk_import", "main", None)
             tx_hash = anchor_result.get("tx_hash") if anchor_result else None
@@ -7942,7 +11279,7 @@ class handler(BaseHTTPRequestHandler):
                         "period": "drl_bulk_import",
                         "version_num": 0,
                         "executive_overview": f"Bulk import of {len(rows)} DRL records",
-                        "sections_json": json.dumps({"count": len(rows), "hash": content_hash}),
+                        "sections_json": s4_codec.dumps({"count": len(rows), "hash": content_hash}),
                         "ai_provider": "none",
                         "analysis_data": "{}",
                         "created_at": now.isoformat() + "Z",
@@ -7976,7 +11313,7 @@ class handler(BaseHTTPRequestHandler):
             self._log_request("self-healing-compliance-approve")
             gap_id = str(data.get("gapId", "")).strip()[:100]
             now = datetime.utcnow()
-            content = json.dumps({"gapId": gap_id, "approved_at": now.isoformat()}, sort_keys=True)
+            content = s4_codec.canonical({"gapId": gap_id, "approved_at": now.isoformat()})
             content_hash = hashlib.sha256(content.encode()).hexdigest()
             anchor_result = _anchor_xrpl(content_hash, "shc_approve", "main", None)
             tx_hash = anchor_result.get("tx_hash") if anchor_result else None
@@ -8013,7 +11350,7 @@ class handler(BaseHTTPRequestHandler):
                 "actor": actor,
                 "actor_role": actor_role or None,
                 "timestamp": datetime.now(timezone.utc).isoformat(),
-                "details": json.dumps(details) if isinstance(details, dict) else "{}",
+                "details": s4_codec.dumps(details) if isinstance(details, dict) else "{}",
             }
             _sb_insert("access_events", row)
             self._send_json({"ok": True, "event_type": event_type, "record_id": record_id})
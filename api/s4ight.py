@@ -35,6 +35,9 @@ _REPO_ROOT = os.path.abspath(os.path.join(_HERE, ".."))
 _BACKEND_DIR = os.path.join(_REPO_ROOT, "s4ight", "backend")
 if _BACKEND_DIR not in sys.path:
     sys.path.insert(0, _BACKEND_DIR)
+# Repo-root s4_http (pooled keep-alive transport) for backend Supabase calls.
+if _REPO_ROOT not in sys.path:
+    sys.path.append(_REPO_ROOT)
 
 # Force-configure paths/provider BEFORE importing the backend modules so they
 # pick up the right defaults under Vercel (no shell .env to source).
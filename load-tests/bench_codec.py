@@ -0,0 +1,74 @@
+"""
+S4 Ledger — JSON Codec Benchmark
+
+Parse and serialize cost for a ~1 MB /api/anchor/batch request body
+(1,000 records, the per-batch maximum, each carrying ~1 KB of
+record_text) through the stdlib json module and through s4_codec, which
+the API and SDK use for every request body and response. The canonical
+(sort_keys) encoding used for hashing is timed too; it is stdlib-backed
+on purpose and should match the stdlib column.
+
+Run:
+    python load-tests/bench_codec.py
+    python load-tests/bench_codec.py --records 1000 --text-bytes 4000 --repeat 50
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s4_codec  # noqa: E402
+
+
+def _make_batch(records, text_bytes):
+    items = []
+    for i in range(records):
+        line = f"NSN 5340-01-{i:06d} | lot L{i % 97:03d} | qty {i % 250} | CAGE 1{i % 9}ABC | inspected OK; "
+        items.append({
+            "record_text": (line * (text_bytes // len(line) + 1))[:text_bytes],
+            "record_type": "SUPPLY_CHAIN_RECEIPT",
+            "hash": hashlib.sha256(f"record-{i}".encode()).hexdigest(),
+        })
+    return {"records": items, "user_email": "logistics@example.mil", "org_id": "org-bench"}
+
+
+def _time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=1000, help="records in the batch (default: 1000)")
+    parser.add_argument("--text-bytes", type=int, default=900, help="record_text length (default: 900)")
+    parser.add_argument("--repeat", type=int, default=20, help="timing repetitions, best kept (default: 20)")
+    args = parser.parse_args()
+
+    batch = _make_batch(args.records, args.text_bytes)
+    body = json.dumps(batch).encode("utf-8")
+
+    rows = [
+        ("parse request", lambda: json.loads(body), lambda: s4_codec.loads(body)),
+        ("serialize", lambda: json.dumps(batch, ensure_ascii=False).encode("utf-8"), lambda: s4_codec.dumpb(batch)),
+        ("canonical", lambda: json.dumps(batch, sort_keys=True), lambda: s4_codec.canonical(batch)),
+    ]
+
+    print(f"backend: {s4_codec.BACKEND}    body: {len(body):,} bytes, {args.records:,} records")
+    print(f"{'operation':<16} {'stdlib json':>12} {'s4_codec':>12} {'speedup':>8}")
+    for name, stdlib, codec in rows:
+        base = _time(stdlib, args.repeat)
+        fast = _time(codec, args.repeat)
+        print(f"{name:<16} {base * 1e3:>9.2f} ms {fast * 1e3:>9.2f} ms {base / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+S4 Ledger — Response Compression Benchmark
+
+Bytes on the wire and CPU per response for the largest dashboard-poll
+payloads — /api/metrics (time-series snapshot + last 100 records) and
+/api/transactions (last 200 records) — uncompressed and under each
+content-coding _send_body can negotiate (gzip always; brotli / zstd when
+their packages are installed).
+
+Run:
+    python load-tests/bench_compression.py
+    python load-tests/bench_compression.py --records 50000 --repeat 50
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.index import _RecordStore, _RESPONSE_ENCODERS, RECORD_CATEGORIES  # noqa: E402
+
+
+def _make_record(i, start):
+    record_type = list(RECORD_CATEGORIES)[i % len(RECORD_CATEGORIES)]
+    cat = RECORD_CATEGORIES[record_type]
+    h = hashlib.sha256(f"record-{i}".encode()).hexdigest()
+    tx = hashlib.sha256(f"tx-{i}".encode()).hexdigest().upper()
+    return {
+        "record_id": f"REC-{i:07d}",
+        "hash": h,
+        "record_type": record_type,
+        "record_label": cat["label"],
+        "branch": cat["branch"],
+        "icon": cat["icon"],
+        "timestamp": (start + timedelta(seconds=37 * i)).isoformat(),
+        "timestamp_display": (start + timedelta(seconds=37 * i)).strftime("%Y-%m-%d %H:%M:%S UTC"),
+        "fee": 0.01,
+        "tx_hash": tx,
+        "network": "XRPL Mainnet",
+        "explorer_url": f"https://livenet.xrpl.org/transactions/{tx}",
+        "system": cat["system"],
+        "org_id": f"org-{i % 20}",
+    }
+
+
+def _time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10_000, help="records in the store (default: 10000)")
+    parser.add_argument("--repeat", type=int, default=20, help="timing repetitions, best kept (default: 20)")
+    args = parser.parse_args()
+
+    store = _RecordStore()
+    start = datetime.now(timezone.utc) - timedelta(seconds=37 * args.records)
+    for i in range(args.records):
+        store.append(_make_record(i, start))
+
+    payloads = {
+        "/api/metrics": store.metrics.snapshot(store[-100:]),
+        "/api/transactions": {"transactions": list(reversed(store[-200:])), "total": len(store),
+                              "generated_at": datetime.now(timezone.utc).isoformat()},
+    }
+
+    print(f"encoders available: {', '.join(sorted(_RESPONSE_ENCODERS))}")
+    print(f"{'route':<20} {'encoding':<10} {'bytes':>10} {'ratio':>7} {'serialize':>11} {'compress':>10}")
+    for route, payload in payloads.items():
+        serialize = _time(lambda: json.dumps(payload, ensure_ascii=False).encode("utf-8"), args.repeat)
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        print(f"{route:<20} {'identity':<10} {len(body):>10,} {1:>7.2f} {serialize * 1e3:>8.2f} ms {'-':>10}")
+        for name, encode in sorted(_RESPONSE_ENCODERS.items()):
+            compressed = encode(body)
+            cost = _time(lambda: encode(body), args.repeat)
+            print(f"{'':<20} {name:<10} {len(compressed):>10,} {len(compressed) / len(body):>7.2f} "
+                  f"{'':>11} {cost * 1e3:>7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+S4 Ledger — Monte Carlo Heatmap Benchmark
+
+Time per /api/monte-carlo-heatmap simulation at 10k, 100k and 1M
+iterations through _monte_carlo_heatmap: the NumPy engine (histogram2d +
+partition) and its pure-Python fallback. The legacy handler body — a
+random.gauss loop, then a rescan of every sample for each of the 30
+cells — is timed alongside up to --legacy-max iterations.
+
+Run:
+    python load-tests/bench_monte_carlo.py
+    python load-tests/bench_monte_carlo.py --iterations 10000,1000000 --repeat 5
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api.index as index  # noqa: E402
+from api.index import _monte_carlo_heatmap  # noqa: E402
+
+BASE_DELAY, BASE_COST = 30, 500
+
+
+def _legacy(iterations):
+    """The previous handler body."""
+    random.seed(7)
+    delay_samples, cost_samples = [], []
+    for _ in range(iterations):
+        delay_samples.append(max(0, random.gauss(BASE_DELAY, BASE_DELAY * 0.3)))
+        cost_samples.append(max(0, random.gauss(BASE_COST, BASE_COST * 0.3)))
+    delay_samples.sort()
+    cost_samples.sort()
+    delay_buckets = [BASE_DELAY * m for m in (0.5, 0.75, 1.0, 1.25, 1.5)]
+    cost_buckets = [BASE_COST * m for m in (0.4, 0.6, 0.8, 1.0, 1.2, 1.5)]
+    heatmap = []
+    for di in range(5):
+        row = []
+        d_lo = delay_buckets[di] - BASE_DELAY * 0.125 if di > 0 else 0
+        d_hi = delay_buckets[di] + BASE_DELAY * 0.125 if di < 4 else BASE_DELAY * 10
+        for ci in range(6):
+            c_lo = cost_buckets[ci] - BASE_COST * 0.1 if ci > 0 else 0
+            c_hi = cost_buckets[ci] + BASE_COST * 0.1 if ci < 5 else BASE_COST * 10
+            count = sum(1 for s in range(iterations)
+                        if d_lo <= delay_samples[s] <= d_hi and c_lo <= cost_samples[s] <= c_hi)
+            row.append(round(count / iterations * 100, 1))
+        heatmap.append(row)
+    return heatmap
+
+
+def _time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", default="10000,100000,1000000",
+                        help="comma-separated iteration counts (default: 10k,100k,1M)")
+    parser.add_argument("--repeat", type=int, default=3, help="timing repetitions, best kept (default: 3)")
+    parser.add_argument("--legacy-max", type=int, default=100_000,
+                        help="largest iteration count to time the legacy body at (default: 100000)")
+    args = parser.parse_args()
+
+    if index.np is None:
+        print("numpy not installed: only the pure-Python fallback is timed")
+    print(f"{'iterations':>11}  {'numpy':>10}  {'pure python':>12}  {'legacy':>10}")
+    for n in sorted(int(c) for c in args.iterations.split(",") if c.strip()):
+        fast = "-"
+        if index.np is not None:
+            fast = f"{_time(lambda: _monte_carlo_heatmap(BASE_DELAY, BASE_COST, n, 7), args.repeat) * 1e3:.1f} ms"
+        with patch.object(index, "np", None):
+            slow = _time(lambda: _monte_carlo_heatmap(BASE_DELAY, BASE_COST, n, 7), 1)
+        legacy = f"{_time(lambda: _legacy(n), 1) * 1e3:.1f} ms" if n <= args.legacy_max else "-"
+        print(f"{n:>11,}  {fast:>10}  {slow * 1e3:>9.1f} ms  {legacy:>10}")
+
+
+if __name__ == "__main__":
+    main()
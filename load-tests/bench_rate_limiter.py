@@ -0,0 +1,81 @@
+"""
+S4 Ledger — Rate Limiter Benchmark
+
+Measures per-request cost of the rate-limit check behind every API call
+while the limiter is full (10,000 tracked callers) and new callers keep
+arriving — the flood case, where each check must also evict a key. The
+token-bucket LRU stays flat as the key cap grows; the legacy
+list-of-timestamps store with a min() eviction scan is timed alongside.
+
+Run:
+    python load-tests/bench_rate_limiter.py
+    python load-tests/bench_rate_limiter.py --caps 1000,10000,100000 --requests 20000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.index import _TokenBucketLimiter, RATE_LIMIT_MAX, RATE_LIMIT_WINDOW  # noqa: E402
+
+
+def _legacy_check(store, cap, ip, now):
+    """The previous _check_rate_limit body: sliding window of timestamps,
+    min() over every IP to evict at capacity."""
+    if ip not in store:
+        if len(store) >= cap:
+            oldest_ip = min(store, key=lambda k: store[k][-1] if store[k] else 0)
+            del store[oldest_ip]
+        store[ip] = []
+    cutoff = now - RATE_LIMIT_WINDOW
+    store[ip] = [t for t in store[ip] if t > cutoff]
+    if len(store[ip]) >= RATE_LIMIT_MAX:
+        return False
+    store[ip].append(now)
+    return True
+
+
+def _bench_bucket(cap, requests):
+    limiter = _TokenBucketLimiter(max_keys=cap)
+    for i in range(cap):
+        limiter.check(f"ip:{i}", RATE_LIMIT_MAX)
+    keys = [f"ip:new-{i}" for i in range(requests)]
+    t0 = time.perf_counter()
+    for key in keys:
+        limiter.check(key, RATE_LIMIT_MAX)
+    return (time.perf_counter() - t0) / requests
+
+
+def _bench_legacy(cap, requests):
+    store = {}
+    now = time.time()
+    for i in range(cap):
+        _legacy_check(store, cap, f"{i}", now)
+    keys = [f"new-{i}" for i in range(requests)]
+    t0 = time.perf_counter()
+    for key in keys:
+        _legacy_check(store, cap, key, now)
+    return (time.perf_counter() - t0) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--caps", default="1000,10000,100000",
+                        help="comma-separated key caps (default: 1k,10k,100k)")
+    parser.add_argument("--requests", type=int, default=20_000, help="checks timed per cap (default: 20000)")
+    parser.add_argument("--legacy-requests", type=int, default=200,
+                        help="checks timed for the legacy store, which is O(n) per eviction (default: 200)")
+    args = parser.parse_args()
+
+    print(f"{'key cap':>10}  {'token bucket':>14}  {'legacy list+min()':>18}")
+    for cap in sorted(int(c) for c in args.caps.split(",") if c.strip()):
+        bucket = _bench_bucket(cap, args.requests)
+        legacy = _bench_legacy(cap, args.legacy_requests)
+        print(f"{cap:>10,}  {bucket * 1e6:>11.2f} µs  {legacy * 1e6:>15.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
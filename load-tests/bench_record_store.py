@@ -0,0 +1,90 @@
+"""
+S4 Ledger — Record Store Verify Benchmark
+
+Measures the record lookups behind /api/verify and /api/verify/batch as the
+in-memory record store grows. Lookups go through the _RecordStore hash
+indexes, so per-verify latency should stay flat from 1k to 1M records;
+the legacy list-comprehension scan is timed alongside for comparison
+(skipped above --scan-max records, since it grows linearly).
+
+Run:
+    python load-tests/bench_record_store.py
+    python load-tests/bench_record_store.py --sizes 1000,10000,100000 --batch 100
+
+1M records need roughly 0.6-0.8 GB of RAM.
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.index import _RecordStore  # noqa: E402
+
+
+def _make_record(i):
+    h = hashlib.sha256(f"record-{i}".encode()).hexdigest()
+    return {
+        "record_id": f"REC-{i:07d}",
+        "hash": h,
+        "tx_hash": h[::-1].upper(),
+        "org_id": f"org-{i % 50}",
+        "record_type": "USN_SUPPLY_RECEIPT",
+    }
+
+
+def _verify_indexed(store, tx_hashes, hashes):
+    for tx, h in zip(tx_hashes, hashes):
+        store.find_by_tx(tx)
+        store.find_by_hash(h)
+
+
+def _verify_scan(records, tx_hashes, hashes):
+    for tx, h in zip(tx_hashes, hashes):
+        [r for r in records if r.get("tx_hash") == tx or r.get("hash") == tx]
+        [r for r in records if r.get("hash") == h]
+
+
+def _time(fn, *args, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="comma-separated store sizes (default: 1k,10k,100k,1M)")
+    parser.add_argument("--batch", type=int, default=100, help="verify items per batch (default: 100)")
+    parser.add_argument("--scan-max", type=int, default=10_000,
+                        help="largest store size to time the linear scan on (default: 10000)")
+    args = parser.parse_args()
+
+    sizes = sorted(int(s) for s in args.sizes.split(",") if s.strip())
+    rng = random.Random(42)
+    store = _RecordStore()
+
+    print(f"{'records':>10}  {'indexed batch':>14}  {'per verify':>11}  {'list scan batch':>16}")
+    for size in sizes:
+        for i in range(len(store), size):
+            store.append(_make_record(i))
+        picks = [store[rng.randrange(size)] for _ in range(args.batch)]
+        tx_hashes = [r["tx_hash"] for r in picks]
+        hashes = [r["hash"] for r in picks]
+
+        indexed = _time(_verify_indexed, store, tx_hashes, hashes)
+        scan = "skipped"
+        if size <= args.scan_max:
+            scan = f"{_time(_verify_scan, list(store), tx_hashes, hashes, repeat=1) * 1e3:.1f} ms"
+        print(f"{size:>10,}  {indexed * 1e6:>11.1f} µs  {indexed / args.batch * 1e6:>8.2f} µs  {scan:>16}")
+
+
+if __name__ == "__main__":
+    main()
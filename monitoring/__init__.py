@@ -4,17 +4,20 @@ Prometheus-compatible metrics export for XRPL anchoring, AI agent,
 queue depth, wallet economy, and platform health.
 
 Usage in api/index.py:
-    from monitoring.metrics import metrics
+    from monitoring import metrics
     metrics.anchor_started()
     metrics.anchor_completed(duration_seconds=2.3, success=True)
     metrics.ai_query(duration_seconds=1.5, success=True)
     metrics.record_queue_depth(150)
+    metrics.http_request("GET", "health", 200, 0.012)   # also feeds per-route percentiles
 """
 
 import time
 import threading
 from collections import defaultdict
 
+from .latency import RollingLatency, WINDOWS as LATENCY_WINDOWS
+
 
 class S4Metrics:
     """Thread-safe Prometheus-style metrics collector for S4 Ledger."""
@@ -30,12 +33,16 @@ class S4Metrics:
         self._histogram_counts = defaultdict(int)
         self._histogram_buckets = {}  # metric -> sorted list of bucket boundaries
         self._histogram_bucket_counts = defaultdict(lambda: defaultdict(int))
+        # Per-route rolling latency (monitoring.latency), for windowed percentiles
+        self._route_latency = {}
 
         # Pre-define histogram buckets
         self._define_histogram("s4_anchor_duration_seconds", [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30])
         self._define_histogram("s4_verify_duration_seconds", [0.01, 0.05, 0.1, 0.25, 0.5, 1, 5])
         self._define_histogram("s4_ai_response_seconds", [0.5, 1, 2.5, 5, 10, 15, 30, 60])
+        self._define_histogram("s4_ai_provider_seconds", [0.5, 1, 2.5, 5, 10, 15, 30, 60])
         self._define_histogram("s4_http_request_seconds", [0.01, 0.05, 0.1, 0.25, 0.5, 1, 5, 10])
+        self._define_histogram("s4_webhook_delivery_seconds", [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300])
 
     def _define_histogram(self, name, buckets):
         self._histogram_buckets[name] = sorted(buckets) + [float("inf")]
@@ -103,12 +110,36 @@ class S4Metrics:
         if not success:
             self.inc("s4_ai_query_errors_total", labels={"tool": tool_context})
 
+    def ai_provider_call(self, provider, duration_seconds, success=True):
+        """One upstream LLM call (a hedged request can make several)."""
+        self.inc("s4_ai_provider_calls_total", labels={"provider": provider})
+        self.observe("s4_ai_provider_seconds", duration_seconds, labels={"provider": provider})
+        if not success:
+            self.inc("s4_ai_provider_errors_total", labels={"provider": provider})
+
+    def llm_cache_lookup(self, route, hit):
+        self.inc("s4_llm_cache_requests_total", labels={"route": route, "result": "hit" if hit else "miss"})
+
     def http_request(self, method, endpoint, status_code, duration_seconds):
         labels = {"method": method, "endpoint": endpoint, "status": str(status_code)}
         self.inc("s4_http_requests_total", labels=labels)
         self.observe("s4_http_request_seconds", duration_seconds, labels={"method": method})
         if status_code >= 400:
             self.inc("s4_http_errors_total", labels=labels)
+        latency = self._route_latency.get(endpoint)
+        if latency is None:
+            with self._lock:
+                latency = self._route_latency.setdefault(endpoint, RollingLatency())
+        latency.record(duration_seconds)
+
+    def route_latency(self, windows=LATENCY_WINDOWS):
+        """{endpoint: {window: {"count", "mean", "p50", "p95", "p99", "max"}}} in ms."""
+        with self._lock:
+            routes = dict(self._route_latency)
+        return {
+            endpoint: {name: latency.percentiles(seconds) for name, seconds in windows.items()}
+            for endpoint, latency in sorted(routes.items())
+        }
 
     def record_queue_depth(self, depth):
         self.set_gauge("s4_anchor_queue_depth", depth)
@@ -128,10 +159,19 @@ class S4Metrics:
         self.set_gauge("s4_xrpl_validator_healthy", 1 if healthy else 0, labels={"validator": validator})
         self.set_gauge("s4_xrpl_last_fee_drops", fee_drops, labels={"validator": validator})
 
-    def webhook_delivered(self, event, success=True):
+    def webhook_delivered(self, event, success=True, duration_seconds=None, queue_depth=None):
+        """Final outcome of one webhook delivery. duration_seconds is the
+        enqueue-to-outcome latency (queue wait and retries included)."""
         self.inc("s4_webhooks_total", labels={"event": event})
         if not success:
             self.inc("s4_webhook_failures_total", labels={"event": event})
+        if duration_seconds is not None:
+            self.observe("s4_webhook_delivery_seconds", duration_seconds)
+        if queue_depth is not None:
+            self.record_webhook_queue_depth(queue_depth)
+
+    def record_webhook_queue_depth(self, depth):
+        self.set_gauge("s4_webhook_queue_depth", depth)
 
     # ── Prometheus exposition format ────────────────────────────────
 
@@ -160,15 +200,30 @@ class S4Metrics:
                     exported_histograms.add(base_name)
 
                 buckets = self._histogram_buckets.get(base_name, [float("inf")])
-                cumulative = 0
+                labels = key[len(base_name):]
                 for b in buckets:
-                    cumulative += self._histogram_bucket_counts[key].get(b, 0)
+                    # observe() already counts each value in every bucket >= it
+                    cumulative = self._histogram_bucket_counts[key].get(b, 0)
                     le = "+Inf" if b == float("inf") else str(b)
-                    bucket_key = key.replace("}", f',le="{le}"}}') if "{" in key else f'{key}{{le="{le}"}}'
-                    lines.append(f"{bucket_key} {cumulative}")
-
-                lines.append(f"{key}_sum {self._histogram_sums[key]}")
-                lines.append(f"{key}_count {self._histogram_counts[key]}")
+                    bucket_labels = labels.replace("}", f',le="{le}"}}') if labels else f'{{le="{le}"}}'
+                    lines.append(f"{base_name}_bucket{bucket_labels} {cumulative}")
+
+                lines.append(f"{base_name}_sum{labels} {self._histogram_sums[key]}")
+                lines.append(f"{base_name}_count{labels} {self._histogram_counts[key]}")
+            routes = dict(self._route_latency)
+
+        # Per-route latency summaries: quantiles over the last 5 minutes,
+        # count/sum since start
+        if routes:
+            lines.append("# TYPE s4_http_route_latency_seconds summary")
+        for endpoint, latency in sorted(routes.items()):
+            summary = latency.percentiles(LATENCY_WINDOWS["5m"])
+            for q in ("0.5", "0.95", "0.99"):
+                value = summary["p%g" % (float(q) * 100)]
+                if value is not None:
+                    lines.append(f's4_http_route_latency_seconds{{endpoint="{endpoint}",quantile="{q}"}} {value / 1000}')
+            lines.append(f's4_http_route_latency_seconds_sum{{endpoint="{endpoint}"}} {latency.sum_seconds}')
+            lines.append(f's4_http_route_latency_seconds_count{{endpoint="{endpoint}"}} {latency.count}')
 
         lines.append("")
         return "\n".join(lines)
@@ -0,0 +1,123 @@
+"""
+S4 Ledger — Streaming Latency Histograms
+HDR-style log-linear histograms for per-route request latency, kept in a
+ring of time slots so p50/p95/p99 can be read over sliding windows
+(1m / 5m / 1h) without storing individual samples.
+
+Bucketing: values are recorded in integer microseconds. Below
+2 * SUB_BUCKETS µs every value has its own bucket; above that each
+power-of-two range is split into SUB_BUCKETS linear sub-buckets, so a
+reported quantile is within 1 / SUB_BUCKETS (~3%) of the true value at
+any magnitude. Memory per slot is one sparse dict of touched buckets.
+
+Usage:
+    from monitoring.latency import RollingLatency
+    lat = RollingLatency()
+    lat.record(0.0123)                       # seconds
+    lat.percentiles(window=300)              # {"count", "mean", "p50", "p95", "p99", "max"} in ms
+"""
+
+import math
+import threading
+import time
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+SLOT_SECONDS = 10
+MAX_WINDOW_SECONDS = 3600
+WINDOWS = {"1m": 60, "5m": 300, "1h": 3600}
+
+
+def bucket_index(us):
+    """Log-linear bucket index of a non-negative integer microsecond value."""
+    if us < 2 * SUB_BUCKETS:
+        return us
+    shift = us.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (us >> shift) - SUB_BUCKETS
+
+
+def bucket_bounds(index):
+    """(lower, upper) microsecond bounds of a bucket; upper is exclusive."""
+    if index < 2 * SUB_BUCKETS:
+        return index, index + 1
+    shift = index // SUB_BUCKETS - 1
+    lower = (index % SUB_BUCKETS + SUB_BUCKETS) << shift
+    return lower, lower + (1 << shift)
+
+
+def quantiles(counts, qs):
+    """Quantile values (µs, bucket midpoints) from a {bucket: count} dict.
+    Returns a list aligned with qs, or None entries if counts is empty."""
+    total = sum(counts.values())
+    if not total:
+        return [None] * len(qs)
+    ordered = sorted(counts.items())
+    out = []
+    for q in qs:
+        rank = max(1, math.ceil(total * q))
+        seen = 0
+        for index, n in ordered:
+            seen += n
+            if seen >= rank:
+                lower, upper = bucket_bounds(index)
+                out.append((lower + upper - 1) / 2)
+                break
+    return out
+
+
+class RollingLatency:
+    """Latency histogram over a ring of SLOT_SECONDS slots covering
+    MAX_WINDOW_SECONDS, plus all-time count/sum for Prometheus."""
+
+    def __init__(self, slot_seconds=SLOT_SECONDS, max_window=MAX_WINDOW_SECONDS):
+        self.slot_seconds = slot_seconds
+        self._slots = [None] * (max_window // slot_seconds)   # [slot_id, {bucket: count}, max_us, sum_us]
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum_seconds = 0.0
+
+    def record(self, seconds, now=None):
+        now = time.time() if now is None else now
+        us = max(0, int(seconds * 1_000_000))
+        slot_id = int(now // self.slot_seconds)
+        index = bucket_index(us)
+        with self._lock:
+            pos = slot_id % len(self._slots)
+            slot = self._slots[pos]
+            if slot is None or slot[0] != slot_id:
+                slot = self._slots[pos] = [slot_id, {}, 0, 0]
+            counts = slot[1]
+            counts[index] = counts.get(index, 0) + 1
+            if us > slot[2]:
+                slot[2] = us
+            slot[3] += us
+            self.count += 1
+            self.sum_seconds += seconds
+
+    def merged(self, window, now=None):
+        """({bucket: count}, max_us, sum_us) over the last `window` seconds
+        (slot resolution)."""
+        now = time.time() if now is None else now
+        oldest = int(now // self.slot_seconds) - max(1, window // self.slot_seconds) + 1
+        merged, max_us, sum_us = {}, 0, 0
+        with self._lock:
+            for slot in self._slots:
+                if slot is None or slot[0] < oldest:
+                    continue
+                for index, n in slot[1].items():
+                    merged[index] = merged.get(index, 0) + n
+                max_us = max(max_us, slot[2])
+                sum_us += slot[3]
+        return merged, max_us, sum_us
+
+    def percentiles(self, window, qs=(0.5, 0.95, 0.99), now=None):
+        """{"count", "mean", "p50", "p95", "p99", "max"} in milliseconds over the window."""
+        counts, max_us, sum_us = self.merged(window, now)
+        count = sum(counts.values())
+        summary = {"count": count, "mean": round(sum_us / count / 1000, 3) if count else None}
+        for q, value in zip(qs, quantiles(counts, qs)):
+            # a bucket midpoint can overshoot the largest sample; clamp to it
+            summary["p%g" % (q * 100)] = round(min(value, max_us) / 1000, 3) if value is not None else None
+        summary["max"] = round(max_us / 1000, 3) if counts else None
+        return summary
@@ -4,9 +4,10 @@ Multi-validator routing with health checks, failover, and backoff retries.
 
 Usage:
     from monitoring.xrpl_health import xrpl_monitor
-    client = xrpl_monitor.get_healthy_client()
-    xrpl_monitor.report_success("testnet-primary")
-    xrpl_monitor.report_failure("testnet-primary")
+    for validator_id, url in xrpl_monitor.candidates():     # best first
+        ...
+        xrpl_monitor.report_success(validator_id, latency_s=0.21)
+        xrpl_monitor.report_failure(validator_id, latency_s=10.0)
 """
 
 import time
@@ -44,6 +45,7 @@ class ValidatorState:
     total_requests: int = 0
     total_failures: int = 0
     backoff_until: float = 0.0  # Don't retry until this timestamp
+    latency_ms: Optional[float] = None  # EWMA of observed request latency
 
 
 class XRPLHealthMonitor:
@@ -58,15 +60,19 @@ class XRPLHealthMonitor:
     MAX_CONSECUTIVE_FAILURES = 3
     BASE_BACKOFF_SECONDS = 5
     MAX_BACKOFF_SECONDS = 300  # 5 minutes max
+    LATENCY_EWMA_ALPHA = 0.2
 
-    def __init__(self, network="testnet"):
+    def __init__(self, network="testnet", nodes=None):
+        """nodes overrides XRPL_VALIDATORS[network]: a list of
+        {"id", "url", "priority"} dicts."""
         self.network = network
         self._lock = threading.Lock()
         self.validators: dict[str, ValidatorState] = {}
-        self._init_validators()
+        self._init_validators(nodes)
 
-    def _init_validators(self):
-        nodes = XRPL_VALIDATORS.get(self.network, XRPL_VALIDATORS["testnet"])
+    def _init_validators(self, nodes=None):
+        if nodes is None:
+            nodes = XRPL_VALIDATORS.get(self.network, XRPL_VALIDATORS["testnet"])
         for node in nodes:
             self.validators[node["id"]] = ValidatorState(
                 validator_id=node["id"],
@@ -74,43 +80,47 @@ class XRPLHealthMonitor:
                 priority=node["priority"],
             )
 
+    def _ranked(self, now) -> list:
+        """Validators in try order; caller holds the lock. Nodes that are
+        healthy or out of backoff come first, by (unhealthy, priority);
+        nodes still backing off follow, soonest recovery first."""
+        available = [v for v in self.validators.values() if v.healthy or now >= v.backoff_until]
+        available.sort(key=lambda v: (not v.healthy, v.priority))
+        waiting = [v for v in self.validators.values() if not (v.healthy or now >= v.backoff_until)]
+        waiting.sort(key=lambda v: v.backoff_until)
+        return available + waiting
+
+    def candidates(self) -> list:
+        """(validator_id, url) for every validator, best first — iterate to
+        fail over."""
+        with self._lock:
+            return [(v.validator_id, v.url) for v in self._ranked(time.time())]
+
     def get_healthy_url(self) -> Optional[str]:
-        """Return the highest-priority healthy validator URL, or None if all are down."""
-        now = time.time()
+        """Return the highest-priority healthy validator URL, or None if there are none."""
         with self._lock:
-            candidates = [
-                v for v in self.validators.values()
-                if v.healthy or now >= v.backoff_until
-            ]
-            if not candidates:
-                # All in backoff — return the one closest to recovery
-                candidates = sorted(self.validators.values(), key=lambda v: v.backoff_until)
-                if candidates:
-                    return candidates[0].url
-                return None
-            candidates.sort(key=lambda v: (not v.healthy, v.priority))
-            return candidates[0].url
+            ranked = self._ranked(time.time())
+            return ranked[0].url if ranked else None
 
     def get_healthy_validator_id(self) -> Optional[str]:
         """Return the ID of the best validator to use."""
-        now = time.time()
         with self._lock:
-            candidates = [
-                v for v in self.validators.values()
-                if v.healthy or now >= v.backoff_until
-            ]
-            if not candidates:
-                candidates = sorted(self.validators.values(), key=lambda v: v.backoff_until)
-                return candidates[0].validator_id if candidates else None
-            candidates.sort(key=lambda v: (not v.healthy, v.priority))
-            return candidates[0].validator_id
-
-    def report_success(self, validator_id: str, fee_drops: int = 12):
+            ranked = self._ranked(time.time())
+            return ranked[0].validator_id if ranked else None
+
+    def _observe_latency(self, v, latency_s):
+        if latency_s is None:
+            return
+        ms = latency_s * 1000
+        v.latency_ms = ms if v.latency_ms is None else v.latency_ms + self.LATENCY_EWMA_ALPHA * (ms - v.latency_ms)
+
+    def report_success(self, validator_id: str, fee_drops: int = 12, latency_s: Optional[float] = None):
         """Report a successful interaction with a validator."""
         with self._lock:
             v = self.validators.get(validator_id)
             if not v:
                 return
+            self._observe_latency(v, latency_s)
             v.healthy = True
             v.consecutive_failures = 0
             v.last_success = time.time()
@@ -119,12 +129,14 @@ class XRPLHealthMonitor:
             v.total_requests += 1
             v.backoff_until = 0
 
-    def report_failure(self, validator_id: str):
-        """Report a failed interaction — triggers backoff after threshold."""
+    def report_failure(self, validator_id: str, latency_s: Optional[float] = None):
+        """Report a failed interaction — triggers backoff after threshold.
+        latency_s is how long the failure took to surface (e.g. a timeout)."""
         with self._lock:
             v = self.validators.get(validator_id)
             if not v:
                 return
+            self._observe_latency(v, latency_s)
             v.consecutive_failures += 1
             v.total_failures += 1
             v.total_requests += 1
@@ -144,6 +156,7 @@ class XRPLHealthMonitor:
         """Return health status of all validators (for /api/health and monitoring)."""
         with self._lock:
             now = time.time()
+            ranked = self._ranked(now)
             return {
                 "network": self.network,
                 "validators": {
@@ -158,10 +171,12 @@ class XRPLHealthMonitor:
                         "total_requests": v.total_requests,
                         "total_failures": v.total_failures,
                         "backoff_remaining": max(0, round(v.backoff_until - now, 1)),
+                        "latency_ms": round(v.latency_ms, 1) if v.latency_ms is not None else None,
                     }
                     for vid, v in self.validators.items()
                 },
-                "active_validator": self.get_healthy_validator_id(),
+                # computed under the lock already held: get_healthy_validator_id() would re-acquire it
+                "active_validator": ranked[0].validator_id if ranked else None,
             }
 
 
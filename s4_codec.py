@@ -0,0 +1,76 @@
+"""
+S4 Ledger — JSON Codec
+One place for JSON encode/decode across the API and SDK. Uses orjson
+when it is importable (several times faster on large request/response
+bodies) and falls back to the stdlib json module otherwise.
+
+    import s4_codec
+    data = s4_codec.loads(raw_bytes)
+    body = s4_codec.dumpb({"status": "ok"})             # compact UTF-8 bytes
+    text = s4_codec.canonical(record, ensure_ascii=False)
+
+- loads()/dumps()/dumpb() are for wire and storage formats. Output is
+  compact (no spaces after separators) and keeps non-ASCII characters.
+  Anything orjson refuses (e.g. integers beyond 64 bits, NaN literals on
+  input) is retried with the stdlib, so accepted inputs never shrink.
+- canonical() is for anything that gets hashed or signed. It is always
+  the stdlib json.dumps with sort_keys=True, so digests of existing
+  records stay byte-identical whichever backend is installed.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+_COMPACT = (",", ":")
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def loads(data):
+        """Parse JSON from str, bytes or bytearray."""
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+    def dumpb(obj, default=None, indent=None):
+        """Serialize to compact UTF-8 bytes. indent may be None or 2."""
+        options = _OPTIONS | orjson.OPT_INDENT_2 if indent else _OPTIONS
+        try:
+            return orjson.dumps(obj, default=default, option=options)
+        except orjson.JSONEncodeError:
+            return _stdlib_dumps(obj, default, indent).encode("utf-8")
+
+    def dumps(obj, default=None, indent=None):
+        """Serialize to a compact str. indent may be None or 2."""
+        return dumpb(obj, default, indent).decode("utf-8")
+
+else:
+    def loads(data):
+        """Parse JSON from str, bytes or bytearray."""
+        return json.loads(data)
+
+    def dumpb(obj, default=None, indent=None):
+        """Serialize to compact UTF-8 bytes. indent may be None or 2."""
+        return _stdlib_dumps(obj, default, indent).encode("utf-8")
+
+    def dumps(obj, default=None, indent=None):
+        """Serialize to a compact str. indent may be None or 2."""
+        return _stdlib_dumps(obj, default, indent)
+
+
+def _stdlib_dumps(obj, default, indent):
+    return json.dumps(obj, ensure_ascii=False, default=default, indent=indent,
+                      separators=_COMPACT if indent is None else (",", ": "))
+
+
+def canonical(obj, ensure_ascii=True, separators=None):
+    """Deterministic encoding for hashing and signing — exactly
+    json.dumps(obj, sort_keys=True, ensure_ascii=..., separators=...)."""
+    return json.dumps(obj, sort_keys=True, ensure_ascii=ensure_ascii, separators=separators)
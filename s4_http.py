@@ -0,0 +1,300 @@
+"""
+S4 Ledger — Pooled HTTP Transport
+Keep-alive connection pool for the PostgREST / REST calls made by the API
+and the S4ight backend. Replaces one-shot urllib.request.urlopen calls
+(fresh TCP + TLS handshake per request) with persistent
+http.client.HTTP(S)Connection objects reused per host.
+
+    from s4_http import http_pool
+    resp = http_pool.request("POST", url, body=b"...", headers={...}, timeout=10)
+    resp.raise_for_status()           # urllib.error.HTTPError on 4xx/5xx
+    rows = resp.json()
+
+    with http_pool.stream("POST", url, body=b"...", headers={...}) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():   # e.g. "data: {...}" server-sent events
+            ...
+
+- Thread-safe checkout: a connection is owned by one thread at a time.
+- Idle eviction: connections unused for idle_timeout seconds are closed.
+- Stale-socket retry: if a reused connection turns out to have been closed
+  by the server, the request is retried once on a fresh connection —
+  always for idempotent methods, and for POST/PATCH only when the request
+  was never fully written (a sent POST may already have been applied).
+- Counters (requests, pool hits, handshakes, stale retries) via get_stats().
+"""
+
+import http.client
+import io
+import json
+import threading
+import time
+import urllib.error
+from urllib.parse import urlsplit
+
+# Errors that mean "the server closed this keep-alive socket". The request
+# never got a response, but it may still have been received and applied, so
+# only idempotent methods are resent once it has been fully written.
+_STALE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    http.client.CannotSendRequest,
+    http.client.ResponseNotReady,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+_IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+
+
+class PooledResponse:
+    """Fully-read response. The connection is already back in the pool."""
+
+    __slots__ = ("url", "status", "reason", "headers", "body")
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+    def raise_for_status(self):
+        """Raise urllib.error.HTTPError for 4xx/5xx so existing urllib
+        error handling keeps working unchanged."""
+        if self.status >= 400:
+            raise urllib.error.HTTPError(self.url, self.status, self.reason, self.headers, io.BytesIO(self.body))
+        return self
+
+
+class StreamingResponse:
+    """Response whose body is read incrementally, e.g. a server-sent event
+    stream. Use as a context manager: the connection goes back to the pool
+    only if the body was read to the end, otherwise it is closed."""
+
+    def __init__(self, pool, key, conn, url, resp):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._finished = False
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+
+    def iter_lines(self):
+        """Body lines as str, without line endings."""
+        while True:
+            line = self._resp.readline()
+            if not line:
+                self._finished = True
+                return
+            yield line.rstrip(b"\r\n").decode("utf-8", errors="replace")
+
+    def read(self):
+        data = self._resp.read()
+        self._finished = True
+        return data
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise urllib.error.HTTPError(self.url, self.status, self.reason, self.headers, io.BytesIO(self.read()))
+        return self
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._finished and not self._resp.will_close:
+            self._resp.close()   # readline() stops at Content-Length without marking the response done
+            self._pool._checkin(self._key, conn)
+        else:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+    """Per-host pool of persistent HTTP(S) connections."""
+
+    def __init__(self, max_per_host=8, idle_timeout=60.0):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}   # (scheme, host, port) -> [(conn, last_used), ...]
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "pool_hits": 0,
+            "handshakes": 0,
+            "stale_retries": 0,
+            "idle_evictions": 0,
+            "errors": 0,
+        }
+
+    # ── connection management ──────────────────────────────────────
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _checkout(self, key, timeout):
+        """Return (conn, reused). Expired idle connections are closed."""
+        now = time.monotonic()
+        conn = None
+        expired = []
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used > self.idle_timeout:
+                    expired.append(candidate)
+                    continue
+                conn = candidate
+                break
+            self._stats["idle_evictions"] += len(expired)
+            if conn is not None:
+                self._stats["pool_hits"] += 1
+        for stale in expired:
+            stale.close()
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        return self._connect(key, timeout), False
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        self._count("handshakes")
+        return cls(host, port, timeout=timeout)
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    # ── public API ─────────────────────────────────────────────────
+
+    def request(self, method, url, body=None, headers=None, timeout=10):
+        """Send a request over a pooled connection and read the full body.
+        Raises on network errors; HTTP error statuses are returned (see
+        PooledResponse.raise_for_status)."""
+        parts = urlsplit(url)
+        scheme = parts.scheme or "https"
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers or {})
+
+        self._count("requests")
+        conn, reused = self._checkout(key, timeout)
+        retry_sent = method.upper() in _IDEMPOTENT_METHODS
+        for attempt in (1, 2):
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+                data = resp.read()
+            except _STALE_ERRORS:
+                conn.close()
+                if reused and attempt == 1 and (retry_sent or not sent):
+                    self._count("stale_retries")
+                    conn, reused = self._connect(key, timeout), False
+                    continue
+                self._count("errors")
+                raise
+            except Exception:
+                conn.close()
+                self._count("errors")
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin(key, conn)
+            return PooledResponse(url, resp.status, resp.reason, resp.headers, data)
+
+    def stream(self, method, url, body=None, headers=None, timeout=10):
+        """Like request(), but return a StreamingResponse as soon as the
+        status line and headers arrive. timeout applies to each socket read."""
+        parts = urlsplit(url)
+        scheme = parts.scheme or "https"
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers or {})
+
+        self._count("requests")
+        conn, reused = self._checkout(key, timeout)
+        retry_sent = method.upper() in _IDEMPOTENT_METHODS
+        for attempt in (1, 2):
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+            except _STALE_ERRORS:
+                conn.close()
+                if reused and attempt == 1 and (retry_sent or not sent):
+                    self._count("stale_retries")
+                    conn, reused = self._connect(key, timeout), False
+                    continue
+                self._count("errors")
+                raise
+            except Exception:
+                conn.close()
+                self._count("errors")
+                raise
+            return StreamingResponse(self, key, conn, url, resp)
+
+    def evict_idle(self):
+        """Close idle connections past idle_timeout. Returns how many closed."""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                keep = []
+                for conn, last_used in idle:
+                    (expired if now - last_used > self.idle_timeout else keep).append((conn, last_used))
+                self._idle[key] = keep
+            self._stats["idle_evictions"] += len(expired)
+        for conn, _ in expired:
+            conn.close()
+        return len(expired)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle_connections"] = sum(len(v) for v in self._idle.values())
+            stats["hosts"] = len(self._idle)
+        requests = stats["requests"]
+        stats["pool_hit_ratio"] = round(stats["pool_hits"] / requests, 4) if requests else 0.0
+        return stats
+
+
+# Shared process-wide pool
+http_pool = ConnectionPool()
@@ -0,0 +1,130 @@
+"""
+S4 Ledger — Merkle Tree Module
+Batch-anchor Merkle trees with compact level storage and O(log n)
+inclusion proofs.
+
+Tree rule (unchanged from the original anchor_batch implementation, so
+existing on-chain roots stay valid):
+    parent = SHA-256( left_hex + right_hex )   # hex strings, UTF-8 encoded
+    an odd node at any level is paired with itself.
+
+Leaves are kept exactly as supplied (they are caller-provided strings and
+need not be 64-char hex). Every level above the leaves is a SHA-256
+digest, stored as one bytes object of concatenated 32-byte digests —
+half the size of hex and ~30x less overhead than a list of str.
+"""
+
+import hashlib
+
+DIGEST_SIZE = 32
+EMPTY_ROOT = hashlib.sha256(b"empty").hexdigest()
+
+
+def _parent(left_hex, right_hex):
+    return hashlib.sha256((left_hex + right_hex).encode()).digest()
+
+
+class MerkleTree:
+    """Merkle tree over a list of leaf hash strings."""
+
+    __slots__ = ("leaves", "_levels", "_leaf_index")
+
+    def __init__(self, leaves):
+        self.leaves = list(leaves)
+        self._levels = []        # level 1..top, each bytes of concatenated digests
+        self._leaf_index = None  # leaf -> first index, built on first lookup
+        self._build()
+
+    def _build(self):
+        n = len(self.leaves)
+        if n <= 1:
+            return
+        leaves = self.leaves
+        level = b"".join(
+            _parent(leaves[i], leaves[i + 1] if i + 1 < n else leaves[i])
+            for i in range(0, n, 2)
+        )
+        self._levels.append(level)
+        while len(level) > DIGEST_SIZE:
+            count = len(level) // DIGEST_SIZE
+            hexes = [level[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE].hex() for i in range(count)]
+            level = b"".join(
+                _parent(hexes[i], hexes[i + 1] if i + 1 < count else hexes[i])
+                for i in range(0, count, 2)
+            )
+            self._levels.append(level)
+
+    def __len__(self):
+        return len(self.leaves)
+
+    @property
+    def root(self):
+        """Hex root. A single leaf is its own root; an empty tree has EMPTY_ROOT."""
+        if not self.leaves:
+            return EMPTY_ROOT
+        if not self._levels:
+            return self.leaves[0]
+        return self._levels[-1].hex()
+
+    @property
+    def depth(self):
+        return len(self._levels)
+
+    def _node(self, level, index):
+        """Hex node at (level, index); level 0 is the leaves. Out-of-range
+        indices on the right edge resolve to the last node (odd pairing)."""
+        if level == 0:
+            return self.leaves[min(index, len(self.leaves) - 1)]
+        data = self._levels[level - 1]
+        index = min(index, len(data) // DIGEST_SIZE - 1)
+        return data[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE].hex()
+
+    def index_of(self, leaf):
+        """First index of a leaf hash, or None."""
+        if self._leaf_index is None:
+            index = {}
+            for i, value in enumerate(self.leaves):
+                index.setdefault(value, i)
+            self._leaf_index = index
+        return self._leaf_index.get(leaf)
+
+    def proof(self, index):
+        """Sibling path for leaf `index`, bottom-up:
+        [{"hash": <hex>, "position": "left"|"right"}, ...]."""
+        if not 0 <= index < len(self.leaves):
+            raise IndexError(f"leaf index {index} out of range for {len(self.leaves)} leaves")
+        path = []
+        for level in range(self.depth):
+            sibling = index ^ 1
+            path.append({
+                "hash": self._node(level, sibling),
+                "position": "left" if sibling < index else "right",
+            })
+            index //= 2
+        return path
+
+    def storage_bytes(self):
+        """Bytes held by the internal levels (leaves excluded)."""
+        return sum(len(level) for level in self._levels)
+
+
+def merkle_root(leaves):
+    """Hex Merkle root of a list of leaf hash strings."""
+    return MerkleTree(leaves).root
+
+
+def merkle_proof(leaves, index):
+    """Sibling path for leaf `index` (builds the tree; prefer MerkleTree.proof
+    when serving many proofs from the same batch)."""
+    return MerkleTree(leaves).proof(index)
+
+
+def verify_proof(leaf, proof, root):
+    """True if `proof` links `leaf` to `root`. Costs len(proof) hashes."""
+    current = leaf
+    for step in proof:
+        if step["position"] == "left":
+            current = hashlib.sha256((step["hash"] + current).encode()).hexdigest()
+        else:
+            current = hashlib.sha256((current + step["hash"]).encode()).hexdigest()
+    return current == root
@@ -1,6 +1,7 @@
 import hashlib
-import json
 from datetime import datetime, timezone
+
+import s4_codec
 try:
     from cryptography.fernet import Fernet
 except Exception:
@@ -785,7 +786,7 @@ class S4SDK:
         reader = csv.DictReader(io.StringIO(csv_text), delimiter=delimiter)
         records = []
         for row in reader:
-            record_json = json.dumps(row, sort_keys=True)
+            record_json = s4_codec.canonical(row)
             record_hash = self.create_record_hash(record_json)
             records.append({
                 "data": dict(row),
@@ -850,7 +851,7 @@ class S4SDK:
             if not row_data:
                 # Handle attributes
                 row_data = dict(elem.attrib)
-            record_json = json.dumps(row_data, sort_keys=True)
+            record_json = s4_codec.canonical(row_data)
             record_hash = self.create_record_hash(record_json)
             records.append({
                 "data": row_data,
@@ -888,7 +889,7 @@ class S4SDK:
         if record_type is None:
             record_type = sys_info["record_types"][0] if sys_info.get("record_types") else "IMPORTED_RECORD"
 
-        data = json.loads(json_text) if isinstance(json_text, str) else json_text
+        data = s4_codec.loads(json_text) if isinstance(json_text, str) else json_text
 
         # Determine records array
         if isinstance(data, list):
@@ -907,7 +908,7 @@ class S4SDK:
 
         records = []
         for item in items:
-            record_json = json.dumps(item, sort_keys=True)
+            record_json = s4_codec.canonical(item)
             record_hash = self.create_record_hash(record_json)
             records.append({
                 "data": item,
@@ -961,7 +962,7 @@ class S4SDK:
             for rec in result["records"]:
                 try:
                     tx = self.anchor_record(
-                        record_text=json.dumps(rec["data"], sort_keys=True),
+                        record_text=s4_codec.canonical(rec["data"]),
                         wallet_seed=wallet_seed,
                         record_type=rec["record_type"],
                     )
@@ -1001,7 +1002,7 @@ class S4SDK:
             payload["events"] = events
         req = urllib.request.Request(
             f"{api_base}/api/webhooks/register",
-            data=json.dumps(payload).encode(),
+            data=s4_codec.dumpb(payload),
             headers={
                 "Content-Type": "application/json",
                 "X-API-Key": self.api_key or "",
@@ -1009,7 +1010,7 @@ class S4SDK:
             method="POST",
         )
         resp = urllib.request.urlopen(req, timeout=15)
-        return json.loads(resp.read())
+        return s4_codec.loads(resp.read())
 
     def list_webhooks(self, api_base="https://s4ledger.com"):
         """List all registered webhooks for this organization."""
@@ -1019,7 +1020,7 @@ class S4SDK:
             headers={"X-API-Key": self.api_key or ""},
         )
         resp = urllib.request.urlopen(req, timeout=15)
-        return json.loads(resp.read())
+        return s4_codec.loads(resp.read())
 
     def verify_webhook_signature(self, payload_body, signature, secret):
         """Verify an incoming webhook's HMAC-SHA256 signature.
@@ -1067,7 +1068,7 @@ class S4SDK:
             payload["record_id"] = record_id
         req = urllib.request.Request(
             f"{api_base}/api/anchor/composite",
-            data=json.dumps(payload).encode(),
+            data=s4_codec.dumpb(payload),
             headers={
                 "Content-Type": "application/json",
                 "X-API-Key": self.api_key or "",
@@ -1075,7 +1076,7 @@ class S4SDK:
             method="POST",
         )
         resp = urllib.request.urlopen(req, timeout=30)
-        return json.loads(resp.read())
+        return s4_codec.loads(resp.read())
 
     def anchor_batch(self, records, user_email="", api_base="https://s4ledger.com"):
         """Anchor multiple records in a single Merkle-tree XRPL transaction.
@@ -1095,7 +1096,7 @@ class S4SDK:
         payload = {"records": records, "user_email": user_email}
         req = urllib.request.Request(
             f"{api_base}/api/anchor/batch",
-            data=json.dumps(payload).encode(),
+            data=s4_codec.dumpb(payload),
             headers={
                 "Content-Type": "application/json",
                 "X-API-Key": self.api_key or "",
@@ -1103,7 +1104,49 @@ class S4SDK:
             method="POST",
         )
         resp = urllib.request.urlopen(req, timeout=60)
-        return json.loads(resp.read())
+        return s4_codec.loads(resp.read())
+
+    def get_batch_proof(self, batch_id, leaf, api_base="https://s4ledger.com"):
+        """Fetch the Merkle inclusion proof for one record of a batch anchor.
+
+        Args:
+            batch_id: Batch ID returned by anchor_batch (BATCH-...)
+            leaf: The record's leaf hash (or its 0-based index in the batch)
+
+        Returns:
+            Dict with leaf, leaf_index, proof (sibling path), merkle_root, tx_hash
+        """
+        import urllib.request
+        import urllib.parse
+        query = urllib.parse.urlencode({"batch_id": batch_id, "leaf": leaf})
+        req = urllib.request.Request(
+            f"{api_base}/api/batch/proof?{query}",
+            headers={"X-API-Key": self.api_key or ""},
+        )
+        resp = urllib.request.urlopen(req, timeout=15)
+        return s4_codec.loads(resp.read())
+
+    def verify_inclusion(self, leaf_hash, proof, merkle_root):
+        """Verify a record belongs to a batch anchor — offline, ~log2(n) hashes.
+
+        Walks the sibling path from get_batch_proof() (or /api/batch/proof)
+        up to the root: parent = SHA-256(left_hex + right_hex).
+
+        Args:
+            leaf_hash: The record's hash (leaf of the batch tree)
+            proof: List of {"hash": ..., "position": "left"|"right"}
+            merkle_root: The batch root anchored on XRPL
+
+        Returns:
+            True if the proof links leaf_hash to merkle_root
+        """
+        current = leaf_hash
+        for step in proof:
+            if step["position"] == "left":
+                current = hashlib.sha256((step["hash"] + current).encode()).hexdigest()
+            else:
+                current = hashlib.sha256((current + step["hash"]).encode()).hexdigest()
+        return current == merkle_root
 
     def transfer_custody(self, record_id, from_entity, to_entity,
                          location="", condition="serviceable", notes="",
@@ -1136,7 +1179,7 @@ class S4SDK:
         }
         req = urllib.request.Request(
             f"{api_base}/api/custody/transfer",
-            data=json.dumps(payload).encode(),
+            data=s4_codec.dumpb(payload),
             headers={
                 "Content-Type": "application/json",
                 "X-API-Key": self.api_key or "",
@@ -1144,7 +1187,7 @@ class S4SDK:
             method="POST",
         )
         resp = urllib.request.urlopen(req, timeout=30)
-        return json.loads(resp.read())
+        return s4_codec.loads(resp.read())
 
     def get_custody_chain(self, record_id, api_base="https://s4ledger.com"):
         """Retrieve the full custody chain for a record.
@@ -1164,7 +1207,7 @@ class S4SDK:
             headers={"X-API-Key": self.api_key or ""},
         )
         resp = urllib.request.urlopen(req, timeout=15)
-        return json.loads(resp.read())
+        return s4_codec.loads(resp.read())
 
     def get_proof_chain(self, record_id, api_base="https://s4ledger.com"):
         """Retrieve the full proof chain (event history) for a record.
@@ -1184,7 +1227,7 @@ class S4SDK:
             headers={"X-API-Key": self.api_key or ""},
         )
         resp = urllib.request.urlopen(req, timeout=15)
-        return json.loads(resp.read())
+        return s4_codec.loads(resp.read())
 
     def hash_file(self, content, encoding="utf-8", filename="",
                   api_base="https://s4ledger.com"):
@@ -1205,7 +1248,7 @@ class S4SDK:
         payload = {"content": content, "encoding": encoding, "filename": filename}
         req = urllib.request.Request(
             f"{api_base}/api/hash/file",
-            data=json.dumps(payload).encode(),
+            data=s4_codec.dumpb(payload),
             headers={
                 "Content-Type": "application/json",
                 "X-API-Key": self.api_key or "",
@@ -1213,7 +1256,7 @@ class S4SDK:
             method="POST",
         )
         resp = urllib.request.urlopen(req, timeout=15)
-        return json.loads(resp.read())
+        return s4_codec.loads(resp.read())
 
     def verify_batch(self, records, operator="sdk", api_base="https://s4ledger.com"):
         """Verify multiple records against the chain in a single call.
@@ -1230,7 +1273,7 @@ class S4SDK:
         payload = {"records": records, "operator": operator}
         req = urllib.request.Request(
             f"{api_base}/api/verify/batch",
-            data=json.dumps(payload).encode(),
+            data=s4_codec.dumpb(payload),
             headers={
                 "Content-Type": "application/json",
                 "X-API-Key": self.api_key or "",
@@ -1238,7 +1281,90 @@ class S4SDK:
             method="POST",
         )
         resp = urllib.request.urlopen(req, timeout=30)
-        return json.loads(resp.read())
+        return s4_codec.loads(resp.read())
+
+    def iter_verify_batch(self, records, operator="sdk", api_base="https://s4ledger.com", timeout=300):
+        """Streaming counterpart of verify_batch() for very large audits.
+
+        Uploads records as NDJSON (chunked, so any iterable — including a
+        generator reading from disk — works without holding it in memory)
+        and yields per-record results as the server streams them back.
+
+        Args:
+            records: Iterable of dicts, each with 'record_text' and optionally
+                     'expected_hash', 'tx_hash', 'record_id'
+            operator: Identity of the person/system performing verification
+            timeout: Socket timeout in seconds
+
+        Yields:
+            Result dicts ({"index", "status", "computed_hash", ...}); the final
+            item is the summary ({"summary": {...}, "operator", "verified_at"})
+        """
+        import http.client
+        import socket
+        import threading
+        import urllib.error
+        import urllib.parse
+
+        url = urllib.parse.urlsplit(
+            f"{api_base}/api/verify/batch?{urllib.parse.urlencode({'operator': operator})}")
+        conn_cls = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        conn = conn_cls(url.hostname, url.port, timeout=timeout)
+        conn.putrequest("POST", f"{url.path}?{url.query}")
+        conn.putheader("Content-Type", "application/x-ndjson")
+        conn.putheader("Accept", "application/x-ndjson")
+        conn.putheader("X-API-Key", self.api_key or "")
+        conn.putheader("Transfer-Encoding", "chunked")
+        conn.endheaders()
+        # getresponse() closes conn for a read-until-EOF response and a later
+        # conn.send() would silently reconnect, so the body goes to the socket
+        sock = conn.sock
+        upload_error = []
+
+        # The server streams results while it is still reading, so the body
+        # goes up on its own thread; writing all of it before reading would
+        # stall once both directions' socket buffers are full.
+        def upload():
+            buf = bytearray()
+            try:
+                for record in records:
+                    buf += s4_codec.dumpb(record) + b"\n"
+                    if len(buf) >= 65536:
+                        sock.sendall(b"%x\r\n%s\r\n" % (len(buf), bytes(buf)))
+                        buf.clear()
+                if buf:
+                    sock.sendall(b"%x\r\n%s\r\n" % (len(buf), bytes(buf)))
+                sock.sendall(b"0\r\n\r\n")
+            except Exception as e:
+                upload_error.append(e)
+                try:
+                    sock.shutdown(socket.SHUT_WR)   # end the body so the server can answer
+                except OSError:
+                    pass
+
+        writer = threading.Thread(target=upload, name="s4-verify-upload", daemon=True)
+        writer.start()
+        resp = None
+        try:
+            resp = conn.getresponse()
+            if resp.status >= 400:
+                raise urllib.error.HTTPError(url.geturl(), resp.status, resp.reason, resp.headers, resp)
+            for line in resp:
+                if line.strip():
+                    yield s4_codec.loads(line)
+            writer.join()
+        finally:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)     # unblocks the writer if the caller stopped early
+            except OSError:
+                pass
+            if resp is not None:
+                resp.close()
+            sock.close()
+            conn.close()
+        # a send error only means the server stopped reading; its reply says why
+        if upload_error and not isinstance(upload_error[0], OSError):
+            raise upload_error[0]
 
     def get_org_records(self, limit=100, offset=0, api_base="https://s4ledger.com"):
         """Retrieve records scoped to this organization's API key.
@@ -1258,7 +1384,7 @@ class S4SDK:
             headers={"X-API-Key": self.api_key or ""},
         )
         resp = urllib.request.urlopen(req, timeout=15)
-        return json.loads(resp.read())
+        return s4_codec.loads(resp.read())
 
 
 if __name__ == "__main__":
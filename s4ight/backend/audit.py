@@ -69,6 +69,11 @@ from typing import Any, Dict, Optional
 from urllib import error as _urlerror, request as _urlrequest
 from uuid import uuid4
 
+try:  # Pooled keep-alive transport from the repo root (optional)
+    from s4_http import http_pool as _http_pool
+except ImportError:  # pragma: no cover - standalone backend without repo root
+    _http_pool = None
+
 _AUDIT_ENABLED = os.getenv("S4IGHT_AUDIT", "true").lower() != "false"
 
 # Supabase drain (optional). Service-role key is required because RLS is on by default.
@@ -119,22 +124,23 @@ def _emit_supabase(payload: Dict[str, Any]) -> None:
     try:
         url = f"{SUPABASE_URL}/rest/v1/{SUPABASE_TABLE}"
         body = json.dumps(_supabase_payload(payload), default=str).encode("utf-8")
-        req = _urlrequest.Request(
-            url,
-            data=body,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE}",
-                "apikey": SUPABASE_SERVICE_ROLE,
-                "Prefer": "return=minimal",
-            },
-            method="POST",
-        )
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE}",
+            "apikey": SUPABASE_SERVICE_ROLE,
+            "Prefer": "return=minimal",
+        }
         # Run synchronously but with a hard timeout — Vercel function will
         # be alive long enough; we cap at SUPABASE_TIMEOUT_S so we never
-        # extend the request meaningfully.
-        with _urlrequest.urlopen(req, timeout=SUPABASE_TIMEOUT_S) as _:
-            pass
+        # extend the request meaningfully. Reuses a pooled keep-alive
+        # connection when s4_http is available.
+        if _http_pool is not None:
+            _http_pool.request("POST", url, body=body, headers=headers,
+                               timeout=SUPABASE_TIMEOUT_S).raise_for_status()
+        else:
+            req = _urlrequest.Request(url, data=body, headers=headers, method="POST")
+            with _urlrequest.urlopen(req, timeout=SUPABASE_TIMEOUT_S) as _:
+                pass
     except _urlerror.HTTPError as e:  # pragma: no cover - depends on env
         _log.warning("Supabase audit HTTP %s: %s", e.code, e.reason)
     except Exception as e:  # pragma: no cover - depends on env
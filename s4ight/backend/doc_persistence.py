@@ -47,6 +47,11 @@ import time
 from typing import Any, Dict, List, Optional, Tuple
 from urllib import error as _urlerror, request as _urlrequest
 
+try:  # Pooled keep-alive transport from the repo root (optional)
+    from s4_http import http_pool as _http_pool
+except ImportError:  # pragma: no cover - standalone backend without repo root
+    _http_pool = None
+
 log = logging.getLogger("s4ight.doc_persist")
 
 SUPABASE_URL = os.getenv("SUPABASE_URL", "").rstrip("/")
@@ -79,30 +84,34 @@ def _headers() -> Dict[str, str]:
     }
 
 
+def _send(method: str, url: str, headers: Dict[str, str], body: Optional[bytes] = None) -> bytes:
+    """HTTP round trip — pooled keep-alive when s4_http is importable,
+    one-shot urlopen otherwise. Raises urllib HTTPError on 4xx/5xx."""
+    if _http_pool is not None:
+        return _http_pool.request(method, url, body=body, headers=headers, timeout=TIMEOUT_S).raise_for_status().body
+    req = _urlrequest.Request(url, data=body, headers=headers, method=method)
+    with _urlrequest.urlopen(req, timeout=TIMEOUT_S) as resp:
+        return resp.read()
+
+
 def _post(table: str, rows: List[Dict[str, Any]]) -> None:
     if not rows:
         return
     url = f"{SUPABASE_URL}/rest/v1/{table}"
     body = json.dumps(rows, default=str).encode("utf-8")
-    req = _urlrequest.Request(url, data=body, headers=_headers(), method="POST")
-    with _urlrequest.urlopen(req, timeout=TIMEOUT_S) as _:
-        pass
+    _send("POST", url, _headers(), body)
 
 
 def _delete(table: str, query: str) -> None:
     url = f"{SUPABASE_URL}/rest/v1/{table}?{query}"
-    req = _urlrequest.Request(url, headers=_headers(), method="DELETE")
-    with _urlrequest.urlopen(req, timeout=TIMEOUT_S) as _:
-        pass
+    _send("DELETE", url, _headers())
 
 
 def _select(table: str, query: str) -> List[Dict[str, Any]]:
     headers = dict(_headers())
     headers["Prefer"] = "return=representation"
     url = f"{SUPABASE_URL}/rest/v1/{table}?{query}"
-    req = _urlrequest.Request(url, headers=headers, method="GET")
-    with _urlrequest.urlopen(req, timeout=TIMEOUT_S) as resp:
-        return json.loads(resp.read().decode("utf-8") or "[]")
+    return json.loads(_send("GET", url, headers).decode("utf-8") or "[]")
 
 
 # ---------- Public API ----------
@@ -0,0 +1,31 @@
+-- ═══════════════════════════════════════════════════════════════════
+--  021 — LLM Cache: Persistent Tier for AI Responses
+--  Second tier behind the API's in-memory LLM cache when
+--  S4_LLM_CACHE_BACKEND=supabase, so cached AI replies survive
+--  serverless cold starts. Keyed by a sha256 content address of
+--  (route, system prompt, user message, conversation tail).
+-- ═══════════════════════════════════════════════════════════════════
+
+CREATE TABLE IF NOT EXISTS llm_cache (
+    cache_key        TEXT PRIMARY KEY,                  -- sha256 hex
+    route            TEXT NOT NULL,
+    response         TEXT NOT NULL,
+    provider         TEXT,
+    expires_at       TIMESTAMPTZ NOT NULL,
+    created_at       TIMESTAMPTZ DEFAULT now()
+);
+
+-- Indexes
+CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_cache(expires_at);
+
+-- Enable RLS
+ALTER TABLE llm_cache ENABLE ROW LEVEL SECURITY;
+
+-- Service role only: the API reads and writes with the service key
+CREATE POLICY "Service role full access on llm_cache" ON llm_cache
+    FOR ALL USING (
+        (current_setting('request.jwt.claims', true)::json->>'role') = 'service_role'
+    );
+
+-- Expired rows are never served; purge them periodically
+-- (e.g. pg_cron: SELECT cron.schedule('purge-llm-cache', '0 * * * *', $$DELETE FROM llm_cache WHERE expires_at < now()$$);)
@@ -0,0 +1,55 @@
+-- ═══════════════════════════════════════════════════════════════════
+--  022 — SLS Fee Ledger: Aggregated Anchor Fee Settlement
+--  Each anchor accrues its 0.01 SLS fee here instead of paying it in a
+--  Payment of its own. The API settles a user's accruals with one SLS
+--  Payment (custodial wallet → Treasury) per interval or threshold and
+--  writes that settlement tx hash back onto every accrual it covers.
+--  status: accrued → settling (claimed by one API instance) → settled
+-- ═══════════════════════════════════════════════════════════════════
+
+CREATE TABLE IF NOT EXISTS sls_fee_accruals (
+    accrual_id       TEXT PRIMARY KEY,                  -- FEE-<16 hex>
+    user_email       TEXT NOT NULL,
+    anchor_tx        TEXT NOT NULL,                     -- AccountSet anchor tx hash
+    record_hash      TEXT DEFAULT '',
+    amount           TEXT NOT NULL DEFAULT '0.01',      -- SLS, decimal string
+    status           TEXT NOT NULL DEFAULT 'accrued'
+                     CHECK (status IN ('accrued', 'settling', 'settled')),
+    accrued_at       TIMESTAMPTZ DEFAULT now(),
+    settlement_tx    TEXT,                              -- settling Payment tx hash
+    settled_at       TIMESTAMPTZ
+);
+
+CREATE TABLE IF NOT EXISTS sls_fee_settlements (
+    settlement_tx    TEXT PRIMARY KEY,
+    user_email       TEXT NOT NULL,
+    amount           TEXT NOT NULL,
+    anchor_count     INTEGER NOT NULL,
+    settled_at       TIMESTAMPTZ DEFAULT now()
+);
+
+-- Indexes
+CREATE INDEX IF NOT EXISTS idx_sls_fee_accruals_pending ON sls_fee_accruals(status, accrued_at)
+    WHERE status <> 'settled';
+CREATE INDEX IF NOT EXISTS idx_sls_fee_accruals_user ON sls_fee_accruals(user_email);
+CREATE INDEX IF NOT EXISTS idx_sls_fee_accruals_anchor ON sls_fee_accruals(anchor_tx);
+CREATE INDEX IF NOT EXISTS idx_sls_fee_accruals_settlement ON sls_fee_accruals(settlement_tx);
+CREATE INDEX IF NOT EXISTS idx_sls_fee_settlements_user ON sls_fee_settlements(user_email);
+
+-- Enable RLS
+ALTER TABLE sls_fee_accruals ENABLE ROW LEVEL SECURITY;
+ALTER TABLE sls_fee_settlements ENABLE ROW LEVEL SECURITY;
+
+-- Service role only: the API reads and writes with the service key
+CREATE POLICY "Service role full access on sls_fee_accruals" ON sls_fee_accruals
+    FOR ALL USING (
+        (current_setting('request.jwt.claims', true)::json->>'role') = 'service_role'
+    );
+CREATE POLICY "Service role full access on sls_fee_settlements" ON sls_fee_settlements
+    FOR ALL USING (
+        (current_setting('request.jwt.claims', true)::json->>'role') = 'service_role'
+    );
+
+-- Rows stuck in 'settling' mean an instance died mid-settlement; reconcile
+-- them against the Treasury's incoming SLS payments before resetting them:
+--   UPDATE sls_fee_accruals SET status = 'accrued' WHERE status = 'settling' AND accrual_id IN (...);
@@ -0,0 +1,59 @@
+-- ═══════════════════════════════════════════════════════════════════
+--  023 — SLS Delivery Jobs: Batch Renewal & Provisioning Checkpoints
+--  One row per job (month-rollover renewal or bulk provisioning) and
+--  one per subscriber in it. The API checkpoints each item as it moves
+--  through its stages, and records stage_tx (the hash of the transaction
+--  it is about to submit) before submission, so a restarted job looks
+--  that transaction up instead of paying twice.
+--  renewal item state:   pending → delivered
+--  provision item state: pending → created → funded → trusted → delivered
+-- ═══════════════════════════════════════════════════════════════════
+
+CREATE TABLE IF NOT EXISTS sls_delivery_jobs (
+    job_id           TEXT PRIMARY KEY,                  -- SLS-RENEWAL-<YYYY-MM> / SLS-PROVISION-<12 hex>
+    kind             TEXT NOT NULL CHECK (kind IN ('renewal', 'provision')),
+    period           TEXT,                              -- YYYY-MM
+    status           TEXT NOT NULL DEFAULT 'queued'
+                     CHECK (status IN ('queued', 'running', 'completed', 'completed_with_errors', 'interrupted')),
+    total            INTEGER NOT NULL DEFAULT 0,
+    created_at       TIMESTAMPTZ DEFAULT now(),
+    started_at       TIMESTAMPTZ,
+    completed_at     TIMESTAMPTZ
+);
+
+CREATE TABLE IF NOT EXISTS sls_delivery_items (
+    job_id           TEXT NOT NULL REFERENCES sls_delivery_jobs(job_id) ON DELETE CASCADE,
+    email            TEXT NOT NULL,
+    plan             TEXT NOT NULL DEFAULT 'starter',
+    address          TEXT,                              -- user's XRPL address
+    state            TEXT NOT NULL DEFAULT 'pending'
+                     CHECK (state IN ('pending', 'created', 'funded', 'trusted', 'delivered')),
+    amount           TEXT,                              -- SLS delivered, decimal string
+    fund_tx          TEXT,                              -- XRP activation Payment
+    trust_tx         TEXT,                              -- SLS TrustSet
+    sls_tx           TEXT,                              -- SLS allocation Payment
+    stage_tx         TEXT,                              -- signed, not yet known to be validated
+    last_ledger      BIGINT,                            -- stage_tx LastLedgerSequence
+    error            TEXT,
+    updated_at       TIMESTAMPTZ DEFAULT now(),
+    PRIMARY KEY (job_id, email)
+);
+
+-- Indexes
+CREATE INDEX IF NOT EXISTS idx_sls_delivery_jobs_created ON sls_delivery_jobs(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_sls_delivery_items_state ON sls_delivery_items(job_id, state);
+CREATE INDEX IF NOT EXISTS idx_sls_delivery_items_email ON sls_delivery_items(email);
+
+-- Enable RLS
+ALTER TABLE sls_delivery_jobs ENABLE ROW LEVEL SECURITY;
+ALTER TABLE sls_delivery_items ENABLE ROW LEVEL SECURITY;
+
+-- Service role only: the API reads and writes with the service key
+CREATE POLICY "Service role full access on sls_delivery_jobs" ON sls_delivery_jobs
+    FOR ALL USING (
+        (current_setting('request.jwt.claims', true)::json->>'role') = 'service_role'
+    );
+CREATE POLICY "Service role full access on sls_delivery_items" ON sls_delivery_items
+    FOR ALL USING (
+        (current_setting('request.jwt.claims', true)::json->>'role') = 'service_role'
+    );
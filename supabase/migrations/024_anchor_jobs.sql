@@ -0,0 +1,38 @@
+-- ═══════════════════════════════════════════════════════════════════
+--  024 — Async Anchor Jobs
+--  POST /api/anchor?mode=async answers 202 before the XRPL submission
+--  runs. The job row is written first, so GET /api/anchor/status can
+--  answer from any instance, and updated when the job finishes.
+--  status: queued → submitting → completed | failed
+-- ═══════════════════════════════════════════════════════════════════
+
+CREATE TABLE IF NOT EXISTS anchor_jobs (
+    job_id           TEXT PRIMARY KEY,                  -- JOB-<16 hex>
+    record_id        TEXT NOT NULL,
+    status           TEXT NOT NULL DEFAULT 'queued'
+                     CHECK (status IN ('queued', 'submitting', 'completed', 'failed')),
+    record           JSONB NOT NULL,                    -- the record as returned with the 202
+    result           JSONB,                             -- anchor response once completed
+    error            TEXT,
+    created_at       TIMESTAMPTZ DEFAULT now(),
+    updated_at       TIMESTAMPTZ DEFAULT now(),
+    completed_at     TIMESTAMPTZ
+);
+
+-- Indexes
+CREATE INDEX IF NOT EXISTS idx_anchor_jobs_record ON anchor_jobs(record_id);
+CREATE INDEX IF NOT EXISTS idx_anchor_jobs_unfinished ON anchor_jobs(status, created_at)
+    WHERE status IN ('queued', 'submitting');
+
+-- Enable RLS
+ALTER TABLE anchor_jobs ENABLE ROW LEVEL SECURITY;
+
+-- Service role only: the API reads and writes with the service key
+CREATE POLICY "Service role full access on anchor_jobs" ON anchor_jobs
+    FOR ALL USING (
+        (current_setting('request.jwt.claims', true)::json->>'role') = 'service_role'
+    );
+
+-- Rows left in 'queued' or 'submitting' belong to an instance that was
+-- recycled before the job finished; the record was never anchored (or its
+-- tx_hash was never recorded) and the client should resubmit it.
@@ -0,0 +1,10 @@
+-- ═══════════════════════════════════════════════════════════════════
+--  025 — SLS Fee Ledger: Settlement Checkpoint
+--  The settlement Payment's hash is written to settlement_tx before it
+--  is submitted, together with its LastLedgerSequence. A settlement that
+--  errors leaves the rows 'accrued' with that hash still set; the next
+--  round looks it up on the ledger (validated, failed, or expired past
+--  settlement_last_ledger) before it pays them again.
+-- ═══════════════════════════════════════════════════════════════════
+
+ALTER TABLE sls_fee_accruals ADD COLUMN IF NOT EXISTS settlement_last_ledger BIGINT;
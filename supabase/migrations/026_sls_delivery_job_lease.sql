@@ -0,0 +1,14 @@
+-- ═══════════════════════════════════════════════════════════════════
+--  026 — SLS Delivery Jobs: Owner Lease
+--  The instance running a job records itself as owner and renews
+--  heartbeat_at every S4_SLS_JOB_LEASE_S / 3. A 'running' job whose
+--  heartbeat is older than the lease was left by a frozen or recycled
+--  instance; the next POST /api/wallet/sls-delivery takes it over with
+--  a conditional PATCH, so only one instance wins.
+-- ═══════════════════════════════════════════════════════════════════
+
+ALTER TABLE sls_delivery_jobs ADD COLUMN IF NOT EXISTS owner TEXT;
+ALTER TABLE sls_delivery_jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_sls_delivery_jobs_running ON sls_delivery_jobs(heartbeat_at)
+    WHERE status = 'running';
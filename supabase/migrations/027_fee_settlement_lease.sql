@@ -0,0 +1,14 @@
+-- ═══════════════════════════════════════════════════════════════════
+--  027 — SLS Fee Ledger: Settling Lease
+--  An instance claiming accruals (accrued → settling) stamps claimed_at.
+--  Rows still 'settling' S4_FEE_SETTLE_LEASE_S after that were left by a
+--  frozen or recycled instance; the next fee sweep takes them over by
+--  re-stamping claimed_at with a conditional PATCH, looks their
+--  settlement_tx up on the ledger, and either records them settled or
+--  returns them to 'accrued'. This replaces the manual reset in 022.
+-- ═══════════════════════════════════════════════════════════════════
+
+ALTER TABLE sls_fee_accruals ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_sls_fee_accruals_settling ON sls_fee_accruals(claimed_at)
+    WHERE status = 'settling';
@@ -0,0 +1,16 @@
+-- ═══════════════════════════════════════════════════════════════════
+--  028 — Records: Merkle Batch Membership
+--  Records anchored through a Merkle batch (POST /api/anchor/batch or the
+--  anchor coalescer) store their batch_id, the batch merkle_root and
+--  their leaf_index. GET /api/batch/proof rebuilds a batch's tree from
+--  these rows, in leaf_index order, when it is not in the instance's
+--  memory (cold start, or anchored on another instance), and serves it
+--  only if the rebuilt root matches merkle_root.
+-- ═══════════════════════════════════════════════════════════════════
+
+ALTER TABLE records ADD COLUMN IF NOT EXISTS batch_id TEXT;
+ALTER TABLE records ADD COLUMN IF NOT EXISTS merkle_root TEXT;
+ALTER TABLE records ADD COLUMN IF NOT EXISTS leaf_index INTEGER;
+
+CREATE INDEX IF NOT EXISTS idx_records_batch ON records (batch_id, leaf_index)
+    WHERE batch_id IS NOT NULL;
@@ -12,8 +12,9 @@ import hmac
 import base64
 import os
 import sys
+import threading
 import pytest
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from unittest.mock import patch
 
 # Add project root to path
@@ -32,9 +33,50 @@ from api.index import (
     _zkp_verify_stub,
     _threat_model_assessment,
     _sign_webhook_payload,
+    _RecordStore,
+    _live_records,
+    _submit_anchor_job,
+    _anchor_job_queue,
+    _anchor_job_view,
+    _load_anchor_job,
+    _expire_anchor_job,
+    _run_anchor_job,
+    _AnchorCoalescer,
+    _load_batch,
+    _record_row,
+    _verify_batch_item,
+    _FeeLedger,
+    _attach_user_fee,
+    _WalletCache,
+    _get_custodial_wallet,
+    _sb_bulk_upsert,
+    _WebhookDispatcher,
+    _attempt_webhook,
+    _deliver_webhook,
+    _TokenBucketLimiter,
+    RATE_LIMIT_GROUPS,
+    _ResponseCache,
+    _sb_insert,
+    _negotiate_encoding,
+    _AIProvider,
+    _AIProviderEngine,
+    _AIStreamInterrupted,
+    _ai_chat_messages,
+    _LLMCache,
+    _SQLiteLLMStore,
+    _cached_ai_complete,
+    _SingleFlight,
+    _openai_deltas,
+    _anthropic_deltas,
+    _monte_carlo_heatmap,
+    _monte_carlo_seed,
+    _MC_DELAY_EDGES,
+    _MC_COST_EDGES,
+    _MC_COST_COLUMNS,
     RECORD_CATEGORIES,
     BRANCHES,
 )
+from s4_merkle import MerkleTree, verify_proof
 
 
 # ═══════════════════════════════════════════════════════════════════
@@ -54,6 +96,8 @@ class TestRouteResolution:
         ("/api/health", "health"),
         ("/api/status", "status"),
         ("/api/metrics", "metrics"),
+        ("/api/metrics/performance", "metrics_performance"),
+        ("/api/metrics/prometheus", "metrics_prometheus"),
         ("/api/transactions", "transactions"),
         ("/api/record-types", "record_types"),
         ("/api/xrpl-status", "xrpl_status"),
@@ -73,6 +117,7 @@ class TestRouteResolution:
         ("/api/anchor", "anchor"),
         ("/api/anchor/batch", "anchor_batch"),
         ("/api/anchor/composite", "anchor_composite"),
+        ("/api/batch/proof", "batch_proof"),
         ("/api/verify", "verify"),
         ("/api/verify/batch", "verify_batch"),
         ("/api/hash", "hash"),
@@ -250,6 +295,1651 @@ class TestAggregateMetrics:
         result = _aggregate_metrics(records)
         assert result["total_hashes"] == 2
 
+    def test_incremental_matches_full_pass(self):
+        store = _RecordStore()
+        records = []
+        for i in range(500):
+            r = {
+                "record_type": f"type_{i % 7}",
+                "branch": ["NAVY", "ARMY", "USAF"][i % 3],
+                "timestamp": f"2026-{1 + i % 12:02d}-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:00Z",
+                "fee": 0.01 if i % 4 else 0.0025,
+            }
+            records.append(r)
+            store.append(r)
+        incremental = store.metrics.snapshot(store[-100:])
+        full = _aggregate_metrics(records)
+        incremental.pop("generated_at")
+        full.pop("generated_at")
+        assert incremental == full
+        assert list(incremental["records_by_type"]) == list(full["records_by_type"])
+
+    def test_bucket_retention_bounded(self):
+        store = _RecordStore()
+        for minute in range(300):
+            store.append({"record_type": "t", "timestamp": f"2026-03-15T{minute // 60:02d}:{minute % 60:02d}:00Z"})
+        assert len(store.metrics.hashes["minute"]) == 60
+        assert len(store.metrics.fees["minute"]) == 60
+        assert min(store.metrics.hashes["minute"]) == "04:00"
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Record Store Index Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestRecordStore:
+    """Test the indexed in-memory record store."""
+
+    @staticmethod
+    def _store(n=10):
+        store = _RecordStore()
+        for i in range(n):
+            store.append({
+                "record_id": f"REC-{i}",
+                "hash": f"h{i}",
+                "tx_hash": f"TX{i}",
+                "org_id": "org-a" if i % 2 else "org-b",
+                "record_type": "USN_SUPPLY" if i < 5 else "USA_MAINT",
+            })
+        return store
+
+    def test_list_compatibility(self):
+        store = self._store()
+        assert len(store) == 10
+        assert store[-1]["record_id"] == "REC-9"
+        assert [r["record_id"] for r in store[-2:]] == ["REC-8", "REC-9"]
+        assert len(list(store)) == 10
+
+    def test_lookups(self):
+        store = self._store()
+        assert store.find_by_hash("h3")["record_id"] == "REC-3"
+        assert store.find_by_tx("TX4")["record_id"] == "REC-4"
+        assert store.find_by_tx("h7")["record_id"] == "REC-7"
+        assert store.get("REC-2")["hash"] == "h2"
+        assert store.find_by_hash("missing") is None
+        assert store.find_by_tx("") is None
+
+    def test_first_match_wins(self):
+        store = _RecordStore()
+        store.append({"record_id": "A", "hash": "dup", "tx_hash": "TX-A"})
+        store.append({"record_id": "B", "hash": "dup", "tx_hash": "TX-B"})
+        store.append({"record_id": "C", "hash": "TX-B"})
+        assert store.find_by_hash("dup")["record_id"] == "A"
+        # tx_hash "TX-B" (position 1) was seen before hash "TX-B" (position 2)
+        assert store.find_by_tx("TX-B")["record_id"] == "B"
+
+    def test_shared_tx_hash_resolves_by_content_hash(self):
+        store = _RecordStore()
+        for i in range(3):
+            store.append({"record_id": f"LEAF-{i}", "hash": f"leaf{i}", "tx_hash": "TX-ROOT"})
+        store.append({"record_id": "PENDING", "hash": "leaf3", "tx_hash": ""})
+        store[3]["tx_hash"] = "TX-ROOT"
+        store.reindex(3)
+        store.reindex(3)
+        assert store.find_by_tx("TX-ROOT")["record_id"] == "LEAF-0"
+        assert store.find_by_tx("TX-ROOT", "leaf2")["record_id"] == "LEAF-2"
+        assert store.find_by_tx("TX-ROOT", "leaf3")["record_id"] == "PENDING"
+        assert store.find_by_tx("TX-ROOT", "tampered")["record_id"] == "LEAF-0"
+        assert store._by_tx_hash["TX-ROOT"] == [0, 1, 2, 3]
+
+    def test_org_page(self):
+        store = self._store()
+        total, page = store.org_page(["org-a"], offset=1, limit=2)
+        assert total == 5
+        assert [r["record_id"] for r in page] == ["REC-3", "REC-5"]
+        total, page = store.org_page(["org-a", "org-b", "org-a"], offset=0, limit=4)
+        assert total == 10
+        assert [r["record_id"] for r in page] == ["REC-0", "REC-1", "REC-2", "REC-3"]
+
+    def test_select(self):
+        store = self._store()
+        ids = [r["record_id"] for r in store.select(org_id="org-a", record_type_prefix="USA")]
+        assert ids == ["REC-1", "REC-3", "REC-5", "REC-6", "REC-7", "REC-8", "REC-9"]
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Async Anchor Job Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestAsyncAnchorJobs:
+    """Test the 202 Accepted anchor pipeline."""
+
+    def test_status_route(self):
+        assert handler._route(None, "/api/anchor/status") == "anchor_status"
+
+    def test_job_lands_and_reindexes(self):
+        tx = "ASYNCTX" + hashlib.sha256(b"async-job").hexdigest()[:24].upper()
+        record = {
+            "hash": hashlib.sha256(b"async-record").hexdigest(),
+            "record_type": "JOINT_CONTRACT",
+            "record_label": "Contract",
+            "branch": "JOINT",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "fee": 0.01,
+            "record_id": "REC-ASYNCTEST01",
+        }
+        xrpl_result = {"tx_hash": tx, "explorer_url": "https://livenet.xrpl.org/transactions/" + tx}
+        persisted = []
+        with patch("api.index._anchor_xrpl", return_value=xrpl_result), \
+             patch("api.index._persist_record"), \
+             patch("api.index._persist_proof_chain_event"), \
+             patch("api.index._persist_anchor_job", side_effect=lambda j: persisted.append(j["status"])), \
+             patch("api.index._deliver_webhook") as webhook:
+            job = _submit_anchor_job(record, "JOINT", "", "api", None, "TXFALLBACK")
+            assert record["anchor_status"] == "pending"
+            _anchor_job_queue.join()
+        assert persisted == ["queued", "submitting", "completed"]
+        view = _anchor_job_view(job)
+        assert view["status"] == "completed"
+        assert view["result"]["record"]["tx_hash"] == tx
+        assert record["anchor_status"] == "anchored"
+        assert _live_records.find_by_tx(tx) is record
+        webhook.assert_called_once()
+        assert webhook.call_args[0][0] == "anchor.confirmed"
+
+    def test_simulated_fallback(self):
+        record = {
+            "hash": hashlib.sha256(b"async-sim").hexdigest(),
+            "record_type": "JOINT_CONTRACT",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "record_id": "REC-ASYNCSIM01",
+        }
+        with patch("api.index._anchor_xrpl", return_value=None), \
+             patch("api.index._persist_record"), \
+             patch("api.index._persist_proof_chain_event"), \
+             patch("api.index._deliver_webhook"):
+            job = _submit_anchor_job(record, "JOINT", "", "api", None, "TXSIMULATED01")
+            _anchor_job_queue.join()
+        assert job["status"] == "completed"
+        assert record["network"] == "Simulated"
+        assert _live_records.find_by_tx("TXSIMULATED01") is record
+
+    def test_status_falls_back_to_supabase(self):
+        row = {"job_id": "JOB-00112233AABBCCDD", "status": "submitting", "record": {"record_id": "REC-ELSEWHERE01"},
+               "result": None, "error": None, "created_at": "2026-01-01T00:00:00+00:00", "completed_at": None}
+        with patch("api.index._sb_select", return_value=[row]) as select:
+            view = _anchor_job_view(_load_anchor_job(row["job_id"]))
+            assert _load_anchor_job("JOB-1&status=eq.completed") is None
+        assert select.call_count == 1
+        assert view["status"] == "submitting" and view["record_id"] == "REC-ELSEWHERE01"
+
+    @staticmethod
+    def _job_row(status, age_s):
+        stamp = (datetime.now(timezone.utc) - timedelta(seconds=age_s)).isoformat()
+        return {"job_id": "JOB-00112233AABBCCDD", "status": status, "record": {"record_id": "REC-LOST01"},
+                "result": None, "error": None, "created_at": stamp, "updated_at": stamp, "completed_at": None}
+
+    def test_stale_job_is_failed_on_read(self):
+        row = self._job_row("submitting", age_s=3600)
+        with patch("api.index._supabase_request", return_value=[row]) as request:
+            view = _anchor_job_view(_expire_anchor_job(row))
+        assert view["status"] == "failed" and "may still land" in view["error"]
+        kwargs = request.call_args.kwargs
+        assert kwargs["method"] == "PATCH" and kwargs["data"]["status"] == "failed"
+        assert "status=in.(queued,submitting)" in kwargs["query_params"]
+
+    def test_recent_job_is_left_alone(self):
+        row = self._job_row("queued", age_s=1)
+        with patch("api.index._supabase_request") as request:
+            assert _expire_anchor_job(row)["status"] == "queued"
+        request.assert_not_called()
+
+    def test_late_completion_wins(self):
+        row = self._job_row("queued", age_s=3600)
+        done = {**row, "status": "completed", "result": {"status": "anchored"}}
+        with patch("api.index._supabase_request", return_value=[]), \
+             patch("api.index._sb_select", return_value=[done]):
+            assert _expire_anchor_job(row)["status"] == "completed"
+
+    def test_expired_job_is_never_started(self):
+        row = self._job_row("queued", age_s=3600)
+        with patch("api.index._supabase_request", return_value=None):
+            job = _expire_anchor_job(row)
+        with patch("api.index._anchor_record_hash") as anchor, patch("api.index._persist_anchor_job"):
+            _run_anchor_job(job)
+        anchor.assert_not_called()
+        assert job["status"] == "failed" and "resubmit" in job["error"]
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Anchor Coalescer Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestAnchorCoalescer:
+    """Test folding single anchors into one Merkle-root transaction."""
+
+    @staticmethod
+    def _fake_anchor(calls):
+        def anchor(hash_value, record_type="", branch="", user_email=None):
+            calls.append(hash_value)
+            return {"tx_hash": "TXROOT" + hash_value[:8], "explorer_url": "https://x/" + hash_value[:8]}
+        return anchor
+
+    def test_concurrent_callers_share_one_transaction(self):
+        import threading
+        calls, results = [], {}
+        leaves = [hashlib.sha256(f"c-{i}".encode()).hexdigest() for i in range(20)]
+        # the window outlasts the test; the batch seals when the 20th caller joins
+        coalescer = _AnchorCoalescer(window_ms=60000, max_leaves=20)
+
+        def caller(h):
+            results[h] = coalescer.anchor(h, "JOINT_CONTRACT", "JOINT")
+
+        with patch("api.index._anchor_xrpl", side_effect=self._fake_anchor(calls)):
+            threads = [threading.Thread(target=caller, args=(h,)) for h in leaves]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        assert len(calls) == 1
+        root = calls[0]
+        for h, (xrpl_result, info) in results.items():
+            assert xrpl_result["tx_hash"] == "TXROOT" + root[:8]
+            assert info["merkle_root"] == root
+            assert verify_proof(h, info["merkle_proof"], root)
+
+    def test_every_coalesced_record_verifies_by_tx_hash(self):
+        texts = [f"coalesced record {i}" for i in range(3)]
+        store = _RecordStore()
+        for i, text in enumerate(texts):
+            store.append({"record_id": f"REC-CO{i}", "hash": hashlib.sha256(text.encode()).hexdigest(),
+                          "tx_hash": "TXSHAREDROOT"})
+        with patch("api.index._live_records", store):
+            results = [_verify_batch_item({"record_text": t, "tx_hash": "TXSHAREDROOT"}) for t in texts]
+            tampered = _verify_batch_item({"record_text": "edited", "tx_hash": "TXSHAREDROOT"})
+        assert [r["status"] for r in results] == ["MATCH"] * 3
+        assert tampered["status"] == "MISMATCH" and tampered["tamper_detected"]
+
+    def test_max_leaves_seals_batch(self):
+        import threading
+        calls = []
+        coalescer = _AnchorCoalescer(window_ms=5000, max_leaves=2)
+        with patch("api.index._anchor_xrpl", side_effect=self._fake_anchor(calls)):
+            t0 = time.time()
+            threads = [threading.Thread(target=coalescer.anchor, args=(f"{i:064x}",)) for i in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        assert time.time() - t0 < 4
+        assert len(calls) == 1
+        assert coalescer.stats["batches"] == 1
+
+    def test_batch_stored_without_xrpl(self):
+        coalescer = _AnchorCoalescer(window_ms=0, max_leaves=1)
+        with patch("api.index._anchor_xrpl", return_value=None), patch.dict("api.index._batch_store", clear=True):
+            xrpl_result, info = coalescer.anchor("ab" * 32)
+            batch = _load_batch(info["batch_id"])
+        assert xrpl_result is None
+        assert batch["merkle_root"] == info["merkle_root"] and batch["network"] == "Simulated"
+
+    @staticmethod
+    def _batch_rows(leaves):
+        root = MerkleTree(leaves).root
+        return f"BATCH-{root[:12].upper()}", [
+            {"hash": h, "leaf_index": i, "merkle_root": root, "tx_hash": "TXBATCHROOT", "network": "XRPL Mainnet",
+             "explorer_url": "https://x/TXBATCHROOT", "timestamp": "2026-01-01T00:00:00+00:00", "org_id": "org-a"}
+            for i, h in enumerate(leaves)]
+
+    def test_batch_proof_rebuilt_from_persisted_records(self):
+        leaves = [hashlib.sha256(f"p-{i}".encode()).hexdigest() for i in range(5)]
+        batch_id, rows = self._batch_rows(leaves)
+        with patch("api.index._sb_select", return_value=rows) as select, \
+                patch.dict("api.index._batch_store", clear=True):
+            batch = _load_batch(batch_id)
+            assert _load_batch(batch_id) is batch     # cached after the first rebuild
+            assert _load_batch("BATCH-1&org_id=eq.x") is None
+        assert select.call_count == 1
+        assert f"batch_id=eq.{batch_id}" in select.call_args.kwargs["query_params"]
+        assert batch["tx_hash"] == "TXBATCHROOT" and len(batch["tree"]) == 5
+        assert verify_proof(leaves[3], batch["tree"].proof(3), rows[0]["merkle_root"])
+
+    def test_incomplete_persisted_batch_is_not_served(self):
+        leaves = [hashlib.sha256(f"q-{i}".encode()).hexdigest() for i in range(4)]
+        batch_id, rows = self._batch_rows(leaves)
+        with patch("api.index._sb_select", return_value=rows[:3]), patch.dict("api.index._batch_store", clear=True):
+            assert _load_batch(batch_id) is None
+
+    def test_record_row_carries_batch_membership(self):
+        row = _record_row({"record_id": "REC-B1", "hash": "ab" * 32, "batch_id": "BATCH-ABCDEF012345",
+                           "merkle_root": "cd" * 32, "leaf_index": 0})
+        assert (row["batch_id"], row["merkle_root"], row["leaf_index"]) == ("BATCH-ABCDEF012345", "cd" * 32, 0)
+        assert "batch_id" not in _record_row({"record_id": "REC-B2", "hash": "ab" * 32})
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  SLS Fee Ledger Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestFeeLedger:
+    """Test per-user fee accrual and aggregated settlement."""
+
+    @staticmethod
+    def _payer(calls, result=None):
+        def pay(user_email, amount, anchors, on_signed):
+            calls.append((user_email, amount, anchors))
+            on_signed(f"FEETX{len(calls)}", 500 + len(calls))
+            return result or {"success": True, "fee_tx": f"FEETX{len(calls)}"}
+        return pay
+
+    @staticmethod
+    def _supabase(claim=None):
+        """Stand-in for _supabase_request: records writes; claim PATCHes
+        return the rows named in `claim` (default: every requested id)."""
+        writes = []
+
+        def request(table, method="GET", data=None, query_params="", **kwargs):
+            writes.append((table, method, data, query_params))
+            if method == "PATCH" and "status=eq.accrued" in query_params:
+                ids = query_params.split("in.(")[1].split(")")[0].split(",")
+                return [{"accrual_id": i} for i in ids if claim is None or i in claim]
+            return []
+        return writes, request
+
+    def test_routes(self):
+        assert handler._route(None, "/api/wallet/fees") == "wallet_fees"
+        assert handler._route(None, "/api/wallet/fees/settle") == "wallet_fees_settle"
+
+    def test_one_payment_links_every_accrual(self):
+        calls = []
+        writes, request = self._supabase()
+        ledger = _FeeLedger(self._payer(calls), interval=3600, threshold=1000)
+        with patch("api.index._supabase_request", side_effect=request), patch("api.index._sb_insert") as insert:
+            for i in range(3):
+                ledger.accrue("ops@navy.mil", f"ANCHOR{i}", record_hash=f"{i:064x}")
+            ledger.accrue("other@navy.mil", "ANCHOR9")
+            settlement = ledger.settle("ops@navy.mil")
+        assert calls == [("ops@navy.mil", "0.03", 3)]
+        assert settlement["settlement_tx"] == "FEETX1" and settlement["anchor_count"] == 3
+        insert.assert_called_once_with("sls_fee_settlements", settlement)
+        for i in range(3):
+            accrual, = ledger.lookup(anchor_tx=f"ANCHOR{i}")
+            assert accrual["status"] == "settled" and accrual["settlement_tx"] == "FEETX1"
+        assert ledger.lookup(user_email="other@navy.mil")[0]["status"] == "accrued"
+        settled_patch = [w for w in writes if w[1] == "PATCH" and w[2].get("status") == "settled"]
+        assert len(settled_patch) == 1 and settled_patch[0][2]["settlement_tx"] == "FEETX1"
+        assert ledger.get_stats()["pending_anchors"] == 1
+
+    def test_threshold_triggers_settlement(self):
+        calls = []
+        ledger = _FeeLedger(self._payer(calls), interval=3600, threshold=2)
+        with patch("api.index._supabase_request", side_effect=self._supabase()[1]), patch("api.index._sb_insert"):
+            ledger.accrue("ops@navy.mil", "A1")
+            ledger.accrue("ops@navy.mil", "A2")
+            deadline = time.time() + 5
+            while ledger.get_stats()["settlements"] == 0 and time.time() < deadline:
+                time.sleep(0.01)
+        assert calls == [("ops@navy.mil", "0.02", 2)]
+
+    def test_failed_settlement_stays_pending(self):
+        calls = []
+        writes, request = self._supabase()
+        ledger = _FeeLedger(self._payer(calls, {"error": "tecPATH_PARTIAL"}), interval=3600, threshold=1000,
+                            confirm=lambda tx_hash, last_ledger: (False, "tecPATH_PARTIAL"))
+        with patch("api.index._supabase_request", side_effect=request), patch("api.index._sb_insert"):
+            ledger.accrue("ops@navy.mil", "A1")
+            assert ledger.settle("ops@navy.mil") is None
+        assert ledger.lookup(anchor_tx="A1")[0]["status"] == "accrued"
+        assert ledger.get_stats()["settlement_failures"] == 1
+        assert writes[-1][1] == "PATCH" and writes[-1][2] == {"status": "accrued"}
+        ledger._pay = self._payer(calls)
+        with patch("api.index._supabase_request", side_effect=request), patch("api.index._sb_insert"):
+            assert ledger.settle("ops@navy.mil")["amount"] == "0.01"
+
+    def test_failed_claim_pays_nothing(self):
+        calls = []
+        writes, request = self._supabase()
+
+        def claim_fails(table, method="GET", data=None, query_params="", **kwargs):
+            if method == "PATCH" and "status=eq.accrued" in query_params:
+                return None     # HTTP 5xx, or migration 022 not applied
+            return request(table, method, data, query_params, **kwargs)
+
+        ledger = _FeeLedger(self._payer(calls), interval=3600, threshold=1000)
+        with patch("api.index._supabase_request", side_effect=claim_fails), patch("api.index._sb_insert"), \
+                patch("api.index.SUPABASE_URL", "https://test.supabase.co"), \
+                patch("api.index.SUPABASE_SERVICE_KEY", "service-key"):
+            ledger.accrue("ops@navy.mil", "A1")
+            assert ledger.settle("ops@navy.mil") is None
+        assert calls == []
+        assert ledger.get_stats()["pending_anchors"] == 1
+
+    def test_timed_out_settlement_is_confirmed_not_repaid(self):
+        calls, confirms = [], []
+        writes, request = self._supabase()
+        # signed and broadcast, but submit_and_wait gave up before validation
+        ledger = _FeeLedger(self._payer(calls, {"error": "timed out"}), interval=3600, threshold=1000,
+                            confirm=lambda tx_hash, last_ledger: confirms.append((tx_hash, last_ledger))
+                            or (True, tx_hash))
+        with patch("api.index._supabase_request", side_effect=request), patch("api.index._sb_insert"):
+            ledger.accrue("ops@navy.mil", "A1")
+            ledger.accrue("ops@navy.mil", "A2")
+            assert ledger.settle("ops@navy.mil") is None
+            checkpoint = [w for w in writes if w[1] == "PATCH" and "settlement_tx" in (w[2] or {})][0]
+            assert checkpoint[2] == {"settlement_tx": "FEETX1", "settlement_last_ledger": 501}
+            ledger.accrue("ops@navy.mil", "A3")
+            ledger._pay = self._payer(calls)
+            settlements = ledger.settle_all()
+        assert confirms == [("FEETX1", 501)]
+        assert calls == [("ops@navy.mil", "0.02", 2), ("ops@navy.mil", "0.01", 1)]
+        assert [a["settlement_tx"] for a in ledger.lookup()] == ["FEETX1", "FEETX1", "FEETX2"]
+        assert settlements[0]["anchor_count"] == 1
+
+    def test_expired_settlement_is_paid_again(self):
+        calls = []
+        ledger = _FeeLedger(self._payer(calls, {"error": "timed out"}), interval=3600, threshold=1000,
+                            confirm=lambda tx_hash, last_ledger: (False, "expired"))
+        with patch("api.index._supabase_request", side_effect=self._supabase()[1]), patch("api.index._sb_insert"):
+            ledger.accrue("ops@navy.mil", "A1")
+            ledger.settle("ops@navy.mil")
+            ledger._pay = self._payer(calls)
+            settlement = ledger.settle("ops@navy.mil")
+        assert settlement["settlement_tx"] == "FEETX2" and len(calls) == 2
+
+    def test_only_claimed_accruals_are_paid(self):
+        calls = []
+        ledger = _FeeLedger(self._payer(calls), interval=3600, threshold=1000)
+        with patch("api.index._supabase_request", side_effect=self._supabase()[1]), patch("api.index._sb_insert"):
+            first = ledger.accrue("ops@navy.mil", "A1")
+            ledger.accrue("ops@navy.mil", "A2")
+        with patch("api.index._supabase_request", side_effect=self._supabase(claim={first["accrual_id"]})[1]), \
+                patch("api.index._sb_insert"):
+            ledger.settle("ops@navy.mil")
+        assert calls == [("ops@navy.mil", "0.01", 1)]
+        assert [a["anchor_tx"] for a in ledger.lookup()] == ["A1"]
+
+    def test_restore_after_cold_start(self):
+        calls = []
+        ledger = _FeeLedger(self._payer(calls), interval=3600, threshold=1000)
+        rows = [{"accrual_id": f"FEE-{i}", "user_email": "ops@navy.mil", "anchor_tx": f"A{i}",
+                 "amount": "0.01", "status": "accrued", "accrued_at": "2026-01-01T00:00:00+00:00"} for i in range(4)]
+        with patch("api.index._supabase_request", side_effect=self._supabase()[1]), patch("api.index._sb_insert"):
+            ledger.restore(rows)
+            ledger.restore(rows)
+            settlements = ledger.settle_all()
+        assert calls == [("ops@navy.mil", "0.04", 4)]
+        assert settlements[0]["anchor_count"] == 4
+
+    @staticmethod
+    def _stale_settling(request, rows):
+        """Wrap a _supabase request stand-in so the reclaim PATCH returns rows."""
+        def reclaim(table, method="GET", data=None, query_params="", **kwargs):
+            if method == "PATCH" and "status=eq.settling" in query_params:
+                request(table, method, data, query_params, **kwargs)
+                return [{**r, "status": "settling", **data} for r in rows]
+            return request(table, method, data, query_params, **kwargs)
+        return reclaim
+
+    @staticmethod
+    def _settling_rows(n, settlement_tx=None, start=0):
+        return [{"accrual_id": f"FEE-{i}", "user_email": "ops@navy.mil", "anchor_tx": f"A{i}", "amount": "0.01",
+                 "accrued_at": "2026-01-01T00:00:00+00:00", "claimed_at": "2026-01-01T00:00:05+00:00",
+                 "settlement_tx": settlement_tx, "settlement_last_ledger": 700 if settlement_tx else None}
+                for i in range(start, start + n)]
+
+    def test_stale_settling_rows_that_landed_are_recorded(self):
+        calls, confirms = [], []
+        writes, request = self._supabase()
+        ledger = _FeeLedger(self._payer(calls), interval=3600, threshold=1000, lease=600,
+                            confirm=lambda tx_hash, last_ledger: confirms.append((tx_hash, last_ledger))
+                            or (True, tx_hash))
+        rows = self._settling_rows(2, settlement_tx="OLDTX")
+        with patch("api.index._supabase_request", side_effect=self._stale_settling(request, rows)), \
+                patch("api.index._sb_insert") as insert, \
+                patch("api.index.SUPABASE_URL", "https://test.supabase.co"), \
+                patch("api.index.SUPABASE_SERVICE_KEY", "service-key"):
+            assert ledger.reclaim_stale() == 2
+            assert ledger.settle_all() == []
+        assert confirms == [("OLDTX", 700)] and calls == []
+        assert insert.call_args[0][1]["settlement_tx"] == "OLDTX"
+        assert [a["status"] for a in ledger.lookup()] == ["settled", "settled"]
+        reclaim = [w for w in writes if "status=eq.settling" in w[3]][0]
+        assert "claimed_at.lt." in reclaim[3] and set(reclaim[2]) == {"claimed_at"}
+
+    def test_stale_settling_rows_that_never_paid_are_requeued(self):
+        calls = []
+        writes, request = self._supabase()
+        ledger = _FeeLedger(self._payer(calls), interval=3600, threshold=1000,
+                            confirm=lambda tx_hash, last_ledger: (False, "expired"))
+        rows = self._settling_rows(2, settlement_tx="OLDTX") + self._settling_rows(1, start=2)
+        with patch("api.index._supabase_request", side_effect=self._stale_settling(request, rows)), \
+                patch("api.index._sb_insert"), \
+                patch("api.index.SUPABASE_URL", "https://test.supabase.co"), \
+                patch("api.index.SUPABASE_SERVICE_KEY", "service-key"):
+            assert ledger.reclaim_stale() == 3
+            assert all(a["status"] == "accrued" and a["settlement_tx"] is None for a in ledger.lookup())
+            settlement, = ledger.settle_all()
+        assert calls == [("ops@navy.mil", "0.03", 3)] and settlement["settlement_tx"] == "FEETX1"
+        released = [w for w in writes if w[1] == "PATCH" and (w[2] or {}).get("status") == "accrued"]
+        assert all(w[2]["settlement_tx"] is None for w in released)
+        assert ledger.get_stats()["reclaimed"] == 3
+
+    def test_stale_settlement_unconfirmed_is_left_settling(self):
+        calls = []
+        writes, request = self._supabase()
+
+        def confirm(tx_hash, last_ledger):
+            raise TimeoutError(f"{tx_hash} neither validated nor expired")
+
+        ledger = _FeeLedger(self._payer(calls), interval=3600, threshold=1000, confirm=confirm)
+        rows = self._settling_rows(2, settlement_tx="OLDTX")
+        with patch("api.index._supabase_request", side_effect=self._stale_settling(request, rows)), \
+                patch("api.index._sb_insert"), \
+                patch("api.index.SUPABASE_URL", "https://test.supabase.co"), \
+                patch("api.index.SUPABASE_SERVICE_KEY", "service-key"):
+            assert ledger.reclaim_stale() == 0
+            assert ledger.settle_all() == []
+        assert calls == [] and ledger.lookup() == []
+
+    def test_claim_stamps_claimed_at(self):
+        writes, request = self._supabase()
+        ledger = _FeeLedger(self._payer([]), interval=3600, threshold=1000)
+        with patch("api.index._supabase_request", side_effect=request), patch("api.index._sb_insert"):
+            ledger.accrue("ops@navy.mil", "A1")
+            ledger.settle("ops@navy.mil")
+        claim = [w for w in writes if "status=eq.accrued" in w[3]][0]
+        assert claim[2]["status"] == "settling" and claim[2]["claimed_at"]
+
+    def test_anchor_accrues_instead_of_paying(self):
+        ledger = _FeeLedger(self._payer([]), interval=3600, threshold=1000)
+        result = {"tx_hash": "ANCHORTX"}
+        with patch("api.index._fee_ledger", ledger), patch("api.index._fee_payer_exists", return_value=True), \
+                patch("api.index._deduct_anchor_fee") as deduct, \
+                patch("api.index._supabase_request", side_effect=self._supabase()[1]):
+            _attach_user_fee(result, "ops@navy.mil", record_hash="ab" * 32)
+        deduct.assert_not_called()
+        assert "user_fee_tx" not in result
+        accrual, = ledger.lookup(anchor_tx="ANCHORTX")
+        assert result["fee_accrual"] == accrual["accrual_id"]
+        assert accrual["record_hash"] == "ab" * 32
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Custodial Wallet Cache Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestWalletCache:
+    """Test the TTL cache of derived custodial wallets."""
+
+    SEED = "sEdTM1uX8pu2do5XvTnutH6HsouMaM2"   # well-known test vector
+
+    @staticmethod
+    def _wallet(seed=None):
+        xrpl_wallet = pytest.importorskip("xrpl.wallet")
+        return xrpl_wallet.Wallet.from_seed(seed) if seed else xrpl_wallet.Wallet.create()
+
+    def test_repeat_lookups_skip_seed_and_derivation(self):
+        wallet = self._wallet(self.SEED)
+        cache = _WalletCache(ttl=60, max_entries=8)
+        with patch("api.index._wallet_cache", cache), \
+                patch("api.index._get_wallet_seed", return_value=self.SEED) as seed_lookup, \
+                patch("api.index.Wallet.from_seed", return_value=wallet) as derive:
+            first = _get_custodial_wallet(email="ops@navy.mil")
+            for _ in range(4):
+                again = _get_custodial_wallet(email="ops@navy.mil")
+            by_address = _get_custodial_wallet(address=wallet.address)
+        assert seed_lookup.call_count == 1 and derive.call_count == 1
+        assert again.address == first.address == by_address.address == wallet.address
+        assert again.private_key == wallet.private_key
+        stats = cache.get_stats()
+        assert stats["hits"] == 5 and stats["misses"] == 1
+        assert stats["hit_ratio"] == pytest.approx(5 / 6, abs=1e-4)
+
+    def test_eviction_zeroizes_without_breaking_copies(self):
+        cache = _WalletCache(ttl=60, max_entries=1)
+        a, b = self._wallet(), self._wallet()
+        cache.put("a@navy.mil", a)
+        held = cache.get(email="a@navy.mil")
+        cached_a = cache._entries["a@navy.mil"][1]
+        cache.put("b@navy.mil", b)
+        assert cache.get(email="a@navy.mil") is None
+        assert cached_a.private_key is None and cached_a.seed is None
+        assert held.private_key == a.private_key      # a signer's copy is untouched
+        assert cache.get(address=b.address).address == b.address
+        assert cache.get_stats()["evictions"] == 1
+
+    def test_ttl_expiry(self):
+        cache = _WalletCache(ttl=0.01, max_entries=8)
+        cache.put("a@navy.mil", self._wallet())
+        time.sleep(0.02)
+        assert cache.get(email="a@navy.mil") is None
+        assert cache.get_stats()["size"] == 0
+
+    def test_reprovisioning_invalidates(self):
+        cache = _WalletCache(ttl=60, max_entries=8)
+        old = self._wallet()
+        cache.put("ops@navy.mil", old)
+        with patch("api.index._wallet_cache", cache), patch("api.index._sb_upsert"):
+            from api.index import _store_wallet, _wallet_store
+            new = self._wallet()
+            _store_wallet("ops@navy.mil", new.address, new.seed, "starter")
+            _wallet_store.pop("ops@navy.mil", None)
+        assert cache.get(email="ops@navy.mil") is None
+        assert cache.get(address=old.address) is None
+        assert cache.get_stats()["invalidations"] == 1
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Streaming Batch Verify Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestVerifyBatchStream:
+    """Test NDJSON streaming mode of /api/verify/batch over a real socket."""
+
+    @pytest.fixture
+    def server(self):
+        import threading
+        from http.server import ThreadingHTTPServer
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=srv.serve_forever, daemon=True)
+        with patch("api.index._hydrate_from_supabase"):
+            thread.start()
+            yield srv.server_address
+            srv.shutdown()
+        srv.server_close()
+
+    @staticmethod
+    def _post(address, body, headers):
+        import http.client
+        conn = http.client.HTTPConnection(*address, timeout=10)
+        conn.request("POST", "/api/verify/batch", body=body, headers=headers)
+        resp = conn.getresponse()
+        lines = [json.loads(line) for line in resp.read().decode().splitlines()]
+        conn.close()
+        return resp, lines
+
+    def test_ndjson_chunked_body(self, server):
+        anchored = "stream verify anchored record"
+        _live_records.append({"hash": hashlib.sha256(anchored.encode()).hexdigest(), "tx_hash": "TXSTREAM01",
+                              "record_id": "REC-STREAM01"})
+        items = [{"record_text": anchored, "tx_hash": "TXSTREAM01"},
+                 {"record_text": "tampered", "tx_hash": "TXSTREAM01"},
+                 {"record_text": "never anchored"},
+                 {"record_id": "no-text"}]
+        items += [{"record_text": f"bulk-{i}", "expected_hash": hashlib.sha256(f"bulk-{i}".encode()).hexdigest()}
+                  for i in range(1500)]
+        body = (json.dumps(item).encode() + b"\n" for item in items)  # generator -> chunked upload
+        resp, lines = self._post(server, body, {"Content-Type": "application/x-ndjson"})
+        assert resp.status == 200
+        assert resp.getheader("Content-Type") == "application/x-ndjson"
+        results, summary = lines[:-1], lines[-1]
+        assert len(results) == len(items)
+        assert [r["index"] for r in results] == list(range(len(items)))
+        assert results[0]["status"] == "MATCH"
+        assert results[1]["status"] == "MISMATCH"
+        assert results[2]["status"] == "NOT_FOUND"
+        assert results[3]["error"] == "record_text required"
+        assert summary["summary"] == {"total": len(items), "match": 1501, "mismatch": 1, "not_found": 1}
+
+    def test_json_body_with_ndjson_accept(self, server):
+        body = json.dumps({"records": [{"record_text": "a"}, {"record_text": "b"}], "operator": "auditor"})
+        resp, lines = self._post(server, body, {"Content-Type": "application/json", "Accept": "application/x-ndjson"})
+        assert resp.status == 200
+        assert len(lines) == 3
+        assert lines[-1]["operator"] == "auditor"
+
+    def test_sdk_iterator(self, server):
+        from s4_sdk import S4SDK
+        records = ({"record_text": f"sdk-{i}"} for i in range(700))
+        out = list(S4SDK().iter_verify_batch(records, api_base="http://%s:%d" % server))
+        assert len(out) == 701
+        assert out[-1]["summary"]["not_found"] == 700
+        assert out[-1]["operator"] == "sdk"
+
+    def test_sdk_upload_larger_than_socket_buffers(self, server):
+        # results flow back while the body is still going up; the client
+        # must read them concurrently or both sides block on full buffers
+        from s4_sdk import S4SDK
+        n = 100_000
+        records = ({"record_text": f"bulk-{i}", "expected_hash": "0" * 64, "record_id": f"REC-{i:08d}"}
+                   for i in range(n))
+        out = S4SDK().iter_verify_batch(records, api_base="http://%s:%d" % server, timeout=20)
+        count, last = 0, None
+        for last in out:
+            count += 1
+        assert count == n + 1
+        assert last["summary"] == {"total": n, "match": 0, "mismatch": n, "not_found": 0}
+
+    def test_sdk_raises_http_errors(self, server):
+        import urllib.error
+        from s4_sdk import S4SDK
+        with patch("api.index.handler._verify_batch_stream", side_effect=lambda self_, parsed:
+                   self_._send_json({"error": "nope"}, 403), autospec=True):
+            with pytest.raises(urllib.error.HTTPError) as exc:
+                list(S4SDK().iter_verify_batch(iter([{"record_text": "a"}]), api_base="http://%s:%d" % server))
+        assert exc.value.code == 403
+
+    def test_json_mode_unchanged(self, server):
+        body = json.dumps({"records": [{"record_text": "a"}]})
+        resp, lines = self._post(server, body, {"Content-Type": "application/json"})
+        payload = lines[0]
+        assert resp.status == 200
+        assert payload["results"][0]["index"] == 0
+        assert payload["summary"]["total"] == 1
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Supabase Bulk Write Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestBulkUpsert:
+    """Test _sb_bulk_upsert chunking and partial-failure reporting."""
+
+    @staticmethod
+    def _fake_supabase(calls, bad=()):
+        def request(table, *, method="GET", data=None, query_params="", prefer="", **kw):
+            calls.append((table, data, query_params))
+            rows = data if isinstance(data, list) else [data]
+            if any(r.get("id") in bad for r in rows):
+                return None
+            return []
+        return request
+
+    @pytest.fixture(autouse=True)
+    def _configured(self):
+        with patch("api.index.SUPABASE_URL", "https://test.supabase.co"), \
+             patch("api.index.SUPABASE_SERVICE_KEY", "service-key"):
+            yield
+
+    def test_chunks_into_few_requests(self):
+        calls = []
+        rows = [{"id": i, "v": "x"} for i in range(1000)]
+        with patch("api.index._supabase_request", side_effect=self._fake_supabase(calls)):
+            report = _sb_bulk_upsert("records", rows, chunk_size=500, on_conflict="record_id")
+        assert report == {"written": 1000, "failed": [], "requests": 2}
+        assert [len(c[1]) for c in calls] == [500, 500]
+        assert calls[0][2] == "on_conflict=record_id"
+
+    def test_groups_by_column_set(self):
+        calls = []
+        rows = [{"id": 1, "a": 1}, {"id": 2, "a": 1, "b": 2}, {"id": 3, "a": 1}]
+        with patch("api.index._supabase_request", side_effect=self._fake_supabase(calls)):
+            report = _sb_bulk_upsert("records", rows)
+        assert report["written"] == 3
+        assert sorted(len(c[1]) for c in calls) == [1, 2]
+
+    def test_partial_failure_isolated(self):
+        calls = []
+        rows = [{"id": i} for i in range(10)]
+        with patch("api.index._supabase_request", side_effect=self._fake_supabase(calls, bad={3, 7})):
+            report = _sb_bulk_upsert("records", rows)
+        assert report["written"] == 8
+        assert report["failed"] == [3, 7]
+
+    def test_systemic_failure_stops_retrying(self):
+        calls = []
+        rows = [{"id": i} for i in range(100)]
+        with patch("api.index._supabase_request", side_effect=self._fake_supabase(calls, bad=set(range(100)))):
+            report = _sb_bulk_upsert("records", rows)
+        assert report["written"] == 0
+        assert report["failed"] == list(range(100))
+        assert report["requests"] == 4  # one bulk + three single-row probes
+
+    def test_unconfigured_makes_no_requests(self):
+        with patch("api.index.SUPABASE_SERVICE_KEY", ""), patch("api.index._supabase_request") as req:
+            report = _sb_bulk_upsert("records", [{"id": 1}])
+        req.assert_not_called()
+        assert report["failed"] == [0]
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Webhook Delivery Queue Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestWebhookQueue:
+    """Test queued webhook delivery against a local subscriber."""
+
+    @pytest.fixture
+    def subscriber(self):
+        """Local HTTP subscriber. Set .statuses to script responses (the last
+        one repeats) and .delay to slow each response down."""
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        state = {"statuses": [200], "delay": 0, "hits": [], "active": 0, "max_active": 0}
+        lock = threading.Lock()
+
+        class Subscriber(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with lock:
+                    state["active"] += 1
+                    state["max_active"] = max(state["max_active"], state["active"])
+                    n = len(state["hits"])
+                    state["hits"].append((self.headers.get("X-S4-Signature"), body))
+                time.sleep(state["delay"])
+                with lock:
+                    state["active"] -= 1
+                statuses = state["statuses"]
+                self.send_response(statuses[min(n, len(statuses) - 1)])
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), Subscriber)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        state["url"] = "http://%s:%d/hook" % srv.server_address
+        yield state
+        srv.shutdown()
+        srv.server_close()
+
+    @pytest.fixture
+    def dispatcher(self):
+        d = _WebhookDispatcher(_attempt_webhook, workers=4, max_pending=100, per_destination=2, retry_base=0.01)
+        with patch("api.index._webhook_dispatcher", d), patch("api.index._persist_webhook_delivery") as persist:
+            d.persist = persist
+            yield d
+
+    @staticmethod
+    def _register(url, count=1):
+        hooks = [{"url": url, "events": ["anchor.confirmed"], "active": True, "secret": "whsec_test"}
+                 for _ in range(count)]
+        return patch.dict("api.index._webhook_store", {"org-wh": hooks}, clear=True)
+
+    @staticmethod
+    def _deliveries():
+        from api.index import _webhook_delivery_log
+        return [d for d in _webhook_delivery_log if d["org"] == "org-wh"]
+
+    def test_enqueue_does_not_wait_for_subscriber(self, subscriber, dispatcher):
+        subscriber["delay"] = 0.5
+        with self._register(subscriber["url"]):
+            t0 = time.perf_counter()
+            _deliver_webhook("anchor.confirmed", {"hash": "abc"}, org_key="org-wh")
+            assert time.perf_counter() - t0 < 0.25
+            assert dispatcher.join(timeout=5)
+        delivery = self._deliveries()[-1]
+        assert delivery["status"] == "delivered"
+        assert delivery["attempts"] == 1
+        assert delivery["http_status"] == 200
+        signature, body = subscriber["hits"][0]
+        assert signature == _sign_webhook_payload(body.decode(), "whsec_test")
+        assert json.loads(body)["event"] == "anchor.confirmed"
+
+    def test_retries_until_delivered(self, subscriber, dispatcher):
+        subscriber["statuses"] = [503, 500, 200]
+        with self._register(subscriber["url"]):
+            _deliver_webhook("anchor.confirmed", {"hash": "abc"}, org_key="org-wh")
+            assert dispatcher.join(timeout=5)
+        delivery = self._deliveries()[-1]
+        assert delivery["status"] == "delivered"
+        assert delivery["attempts"] == 3
+        assert dispatcher.persist.call_count == 3
+        assert dispatcher.get_stats()["retries"] == 2
+
+    def test_gives_up_after_max_attempts(self, subscriber, dispatcher):
+        subscriber["statuses"] = [502]
+        with self._register(subscriber["url"]):
+            _deliver_webhook("anchor.confirmed", {"hash": "abc"}, org_key="org-wh")
+            assert dispatcher.join(timeout=5)
+        delivery = self._deliveries()[-1]
+        assert delivery["status"] == "failed"
+        assert delivery["attempts"] == delivery["max_attempts"] == 3
+        assert "502" in delivery["error"]
+
+    def test_client_error_not_retried(self, subscriber, dispatcher):
+        subscriber["statuses"] = [404]
+        with self._register(subscriber["url"]):
+            _deliver_webhook("anchor.confirmed", {"hash": "abc"}, org_key="org-wh")
+            assert dispatcher.join(timeout=5)
+        delivery = self._deliveries()[-1]
+        assert delivery["status"] == "failed"
+        assert delivery["attempts"] == 1
+
+    def test_per_destination_concurrency_limit(self, subscriber, dispatcher):
+        subscriber["delay"] = 0.1
+        with self._register(subscriber["url"], count=6):
+            _deliver_webhook("anchor.confirmed", {"hash": "abc"}, org_key="org-wh")
+            assert dispatcher.join(timeout=5)
+        assert len(subscriber["hits"]) == 6
+        assert subscriber["max_active"] == 2
+        assert all(d["status"] == "delivered" for d in self._deliveries()[-6:])
+
+    def test_full_queue_rejects(self):
+        import threading
+        release = threading.Event()
+        d = _WebhookDispatcher(lambda job, base: release.wait(5) and None, workers=1, max_pending=1)
+        assert d.submit({"destination": "http://a"})
+        assert not d.submit({"destination": "http://a"})
+        release.set()
+        assert d.join(timeout=5)
+        assert d.get_stats()["dropped"] == 1
+
+    def test_reports_latency_and_queue_depth(self, subscriber, dispatcher):
+        from monitoring import metrics
+        before = metrics.export_json()["histograms"].get("s4_webhook_delivery_seconds", {"count": 0})["count"]
+        with self._register(subscriber["url"], count=2):
+            _deliver_webhook("anchor.confirmed", {"hash": "abc"}, org_key="org-wh")
+            assert dispatcher.join(timeout=5)
+        snapshot = metrics.export_json()
+        assert snapshot["histograms"]["s4_webhook_delivery_seconds"]["count"] == before + 2
+        assert snapshot["gauges"]["s4_webhook_queue_depth"] == 0
+        assert all(d["latency_ms"] >= 0 for d in self._deliveries()[-2:])
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Rate Limiter Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestRateLimiter:
+    """Test the token-bucket limiter and per-route keying."""
+
+    def test_burst_then_refill(self):
+        limiter = _TokenBucketLimiter(window=60)
+        assert all(limiter.check("ip:a", 3, now=100.0) == 0 for _ in range(3))
+        wait = limiter.check("ip:a", 3, now=100.0)
+        assert wait == pytest.approx(20.0)         # 3 tokens / 60 s -> one per 20 s
+        assert limiter.check("ip:a", 3, now=119.0) > 0
+        assert limiter.check("ip:a", 3, now=121.0) == 0
+
+    def test_refill_capped_at_capacity(self):
+        limiter = _TokenBucketLimiter(window=60)
+        limiter.check("ip:a", 2, now=0.0)
+        assert [limiter.check("ip:a", 2, now=10_000.0) for _ in range(3)][-1] > 0
+
+    def test_lru_evicts_least_recently_used(self):
+        limiter = _TokenBucketLimiter(max_keys=3)
+        for key in ("a", "b", "c"):
+            limiter.check(key, 1, now=0.0)
+        limiter.check("a", 1, now=0.0)            # touch a; b is now least recent
+        limiter.check("d", 1, now=0.0)
+        assert len(limiter) == 3
+        assert limiter.check("b", 1, now=0.0) == 0  # b was evicted, so it starts full
+        assert limiter.check("a", 1, now=0.0) > 0   # a kept its drained bucket
+
+    def test_route_groups_have_separate_budgets(self):
+        h = handler.__new__(handler)
+        h.headers = {"X-Forwarded-For": "203.0.113.77"}
+        with patch("api.index._rate_limiter", _TokenBucketLimiter()):
+            assert all(h._check_rate_limit("ai_chat") == 0 for _ in range(RATE_LIMIT_GROUPS["ai"]))
+            assert h._check_rate_limit("ai_chat") > 0
+            assert h._check_rate_limit("hash") == 0
+            assert h._check_rate_limit("health") == 0
+
+    def test_identity_prefers_known_key_org(self):
+        h = handler.__new__(handler)
+        with patch.dict("api.index.API_KEYS_STORE", {"s4_known": {"org": "NAVSEA"}}):
+            h.headers = {"X-API-Key": "s4_known", "X-Forwarded-For": "198.51.100.1"}
+            assert h._rate_limit_identity() == "org:NAVSEA"
+            h.headers = {"X-API-Key": "s4_made_up", "X-Forwarded-For": "198.51.100.1, 10.0.0.1"}
+            assert h._rate_limit_identity() == "ip:198.51.100.1"
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Request Log & Route Latency Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestRequestLatency:
+    """Test that served requests feed the request log and per-route latency."""
+
+    @pytest.fixture
+    def server(self):
+        import threading
+        from http.server import ThreadingHTTPServer
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=srv.serve_forever, daemon=True)
+        with patch("api.index._hydrate_from_supabase"):
+            thread.start()
+            yield srv.server_address
+            srv.shutdown()
+        srv.server_close()
+
+    @staticmethod
+    def _request(address, method, path, body=None):
+        import http.client
+        conn = http.client.HTTPConnection(*address, timeout=10)
+        conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        data = resp.read().decode()
+        conn.close()
+        return resp, data
+
+    def test_entry_completed_after_response(self, server):
+        from api.index import _request_log
+        resp, _ = self._request(server, "POST", "/api/hash", json.dumps({"data": "latency"}))
+        assert resp.status == 200
+        entry = _request_log[-1]
+        assert entry["route"] == "hash"          # logged under its route id
+        assert entry["status"] == 200
+        assert entry["ms"] >= 0
+
+    def test_prometheus_endpoint(self, server):
+        self._request(server, "GET", "/api/metrics/prometheus")
+        resp, text = self._request(server, "GET", "/api/metrics/prometheus")
+        assert resp.status == 200
+        assert resp.getheader("Content-Type").startswith("text/plain; version=0.0.4")
+        assert 's4_http_route_latency_seconds_count{endpoint="metrics-prometheus"}' in text
+
+    def test_performance_reports_route_percentiles(self, server):
+        self._request(server, "POST", "/api/hash", json.dumps({"data": "x"}))
+        resp, body = self._request(server, "GET", "/api/metrics/performance")
+        payload = json.loads(body)
+        assert resp.status == 200
+        assert payload["route_latency_ms"]["hash"]["1m"]["count"] >= 1
+        assert set(payload["route_latency_ms"]["hash"]) == {"1m", "5m", "1h"}
+        assert len(payload["recent_requests"]) <= 20
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Response Cache Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestResponseCache:
+    """Test the GET response cache: keys, TTL, LRU bound, invalidation, ETags."""
+
+    ROUTES = {"parts": (60, ("parts_catalog",)), "dmsms": (60, ("dmsms_items",))}
+
+    def test_key_normalizes_query_order(self):
+        assert _ResponseCache.key("parts", "q=a&b=2", "k1") == _ResponseCache.key("parts", "b=2&q=a", "k1")
+        assert _ResponseCache.key("parts", "q=a", "k1") != _ResponseCache.key("parts", "q=a", "k2")
+
+    def test_ttl_expiry(self):
+        cache = _ResponseCache(self.ROUTES)
+        key = _ResponseCache.key("parts", "", "")
+        cache.put(key, cache.generation("parts"), b"{}", now=0.0)
+        assert cache.get(key, now=59.0) is not None
+        assert cache.get(key, now=61.0) is None
+
+    def test_lru_byte_bound(self):
+        cache = _ResponseCache(self.ROUTES, max_bytes=800)
+        keys = [_ResponseCache.key("parts", f"q={i}", "") for i in range(9)]
+        for key in keys[:8]:
+            cache.put(key, cache.generation("parts"), b"x" * 100)   # exactly full
+        cache.get(keys[0])                                         # keys[1] is now least recent
+        cache.put(keys[8], cache.generation("parts"), b"x" * 100)
+        assert cache.get_stats()["bytes"] == 800
+        assert cache.get_stats()["evictions"] == 1
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[0]) is not None
+
+    def test_invalidation_scoped_to_table(self):
+        cache = _ResponseCache(self.ROUTES)
+        parts, dmsms = _ResponseCache.key("parts", "", ""), _ResponseCache.key("dmsms", "", "")
+        cache.put(parts, cache.generation("parts"), b"p")
+        cache.put(dmsms, cache.generation("dmsms"), b"d")
+        cache.invalidate_table("parts_catalog")
+        assert cache.get(parts) is None
+        assert cache.get(dmsms) is not None
+
+    def test_write_during_read_not_cached(self):
+        cache = _ResponseCache(self.ROUTES)
+        key = _ResponseCache.key("parts", "", "")
+        generation = cache.generation("parts")   # handler starts reading Supabase
+        cache.invalidate_table("parts_catalog")  # a write lands meanwhile
+        cache.put(key, generation, b"stale")
+        assert cache.get(key) is None
+
+    @pytest.fixture
+    def server(self):
+        import threading
+        from http.server import ThreadingHTTPServer
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=srv.serve_forever, daemon=True)
+        with patch("api.index._hydrate_from_supabase"), patch("api.index._response_cache", _ResponseCache()):
+            thread.start()
+            yield srv.server_address
+            srv.shutdown()
+        srv.server_close()
+
+    @staticmethod
+    def _get(address, path, headers=None):
+        import http.client
+        conn = http.client.HTTPConnection(*address, timeout=10)
+        conn.request("GET", path, headers=headers or {})
+        resp = conn.getresponse()
+        body = resp.read()
+        conn.close()
+        return resp, body
+
+    def test_hit_and_304(self, server):
+        first, body = self._get(server, "/api/record-types")
+        assert first.getheader("X-Cache") == "MISS"
+        second, cached = self._get(server, "/api/record-types")
+        assert second.getheader("X-Cache") == "HIT"
+        assert cached == body
+        assert second.getheader("ETag") == first.getheader("ETag")
+        revalidated, empty = self._get(server, "/api/record-types", {"If-None-Match": first.getheader("ETag")})
+        assert revalidated.status == 304
+        assert empty == b""
+
+    def test_supabase_write_invalidates(self, server):
+        rows = [{"nsn": "5340-01-000-0001", "part_name": "Bracket"}]
+        with patch("api.index._sb_select", return_value=rows) as select:
+            self._get(server, "/api/parts?q=br", {"X-API-Key": "org-a"})
+            resp, _ = self._get(server, "/api/parts?q=br", {"X-API-Key": "org-a"})
+            assert resp.getheader("X-Cache") == "HIT"
+            assert select.call_count == 1
+            with patch("api.index.SUPABASE_URL", "https://sb.example"), \
+                 patch("api.index.SUPABASE_SERVICE_KEY", "service-key"), \
+                 patch("api.index.http_pool.request") as req:
+                req.return_value.status = 201
+                req.return_value.body = b""
+                _sb_insert("parts_catalog", {"nsn": "5340-01-000-0002"})
+            resp, _ = self._get(server, "/api/parts?q=br", {"X-API-Key": "org-a"})
+            assert resp.getheader("X-Cache") == "MISS"
+            assert select.call_count == 2
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Response Compression Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestResponseCompression:
+    """Test Accept-Encoding negotiation and compressed responses."""
+
+    @pytest.mark.parametrize("header,expected", [
+        ("", None),
+        ("gzip", "gzip"),
+        ("gzip, deflate", "gzip"),
+        ("gzip;q=0", None),
+        ("identity", None),
+        ("*", "gzip"),
+        ("*;q=0.5, gzip;q=0", None),
+        ("GZIP;q=0.8", "gzip"),
+    ])
+    def test_negotiate_gzip(self, header, expected):
+        with patch.dict("api.index._RESPONSE_ENCODERS", {"gzip": lambda b: b}, clear=True):
+            assert _negotiate_encoding(header) == expected
+
+    def test_negotiate_prefers_higher_q_then_server_order(self):
+        encoders = {"gzip": lambda b: b, "br": lambda b: b, "zstd": lambda b: b}
+        with patch.dict("api.index._RESPONSE_ENCODERS", encoders, clear=True):
+            assert _negotiate_encoding("gzip, br, zstd") == "zstd"
+            assert _negotiate_encoding("gzip;q=1, br;q=0.9") == "gzip"
+            assert _negotiate_encoding("gzip, br") == "br"
+
+    @pytest.fixture
+    def server(self):
+        import threading
+        from http.server import ThreadingHTTPServer
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=srv.serve_forever, daemon=True)
+        with patch("api.index._hydrate_from_supabase"), patch("api.index._response_cache", _ResponseCache()):
+            thread.start()
+            yield srv.server_address
+            srv.shutdown()
+        srv.server_close()
+
+    @staticmethod
+    def _get(address, path, headers):
+        import http.client
+        conn = http.client.HTTPConnection(*address, timeout=10)
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        conn.close()
+        return resp, body
+
+    def test_large_response_gzipped(self, server):
+        import gzip
+        for i in range(20):
+            _live_records.append({"record_id": f"REC-GZ{i:03d}", "hash": hashlib.sha256(str(i).encode()).hexdigest(),
+                                  "tx_hash": f"TXGZ{i:03d}", "timestamp": "2026-01-01T00:00:00+00:00"})
+        resp, body = self._get(server, "/api/transactions", {"Accept-Encoding": "gzip"})
+        assert resp.getheader("Content-Encoding") == "gzip"
+        assert "Accept-Encoding" in resp.getheader("Vary")
+        assert int(resp.getheader("Content-Length")) == len(body)
+        payload = json.loads(gzip.decompress(body))
+        assert payload["total"] == len(_live_records)
+
+    def test_small_response_not_compressed(self, server):
+        resp, body = self._get(server, "/api/anchor/status?job=nope", {"Accept-Encoding": "gzip"})
+        assert resp.getheader("Content-Encoding") is None
+        assert json.loads(body)["job_id"] == "nope"
+
+    def test_cached_etag_per_encoding(self, server):
+        gz, _ = self._get(server, "/api/record-types", {"Accept-Encoding": "gzip"})
+        plain, _ = self._get(server, "/api/record-types", {})
+        assert gz.getheader("ETag") != plain.getheader("ETag")
+        assert gz.getheader("ETag").endswith('-gzip"')
+        resp, body = self._get(server, "/api/record-types",
+                               {"Accept-Encoding": "gzip", "If-None-Match": gz.getheader("ETag")})
+        assert resp.status == 304
+        assert body == b""
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  AI Provider Engine Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestAIProviderEngine:
+    """Test breaker-gated, latency-ranked, hedged AI provider calls."""
+
+    @staticmethod
+    def _provider(name, reply="ok", delay=0.0, error=None, configured=True, calls=None):
+        def call(system_prompt, messages, max_tokens, timeout):
+            if calls is not None:
+                calls.append(name)
+            time.sleep(delay)
+            if error:
+                raise error
+            return f"{reply} from {name}"
+        return _AIProvider(name, f"{name}-model", lambda: configured, call)
+
+    def test_first_healthy_provider_answers(self):
+        calls = []
+        engine = _AIProviderEngine([self._provider("a", calls=calls), self._provider("b", calls=calls)],
+                                   hedge_after=0)
+        assert engine.complete("sys", "hi") == ("ok from a", "a")
+        assert calls == ["a"]
+        assert engine.model("a") == "a-model"
+
+    def test_fails_over_to_next_provider(self):
+        calls = []
+        engine = _AIProviderEngine([self._provider("a", error=OSError("down"), calls=calls),
+                                    self._provider("b", calls=calls)], hedge_after=0)
+        assert engine.complete("sys", "hi") == ("ok from b", "b")
+        assert engine.complete("sys", "hi") == ("ok from b", "b")
+        assert calls == ["a", "b", "b"]           # a now ranks behind b
+        stats = engine.get_stats()["providers"]
+        assert stats["a"]["failures"] == 1
+        assert "OSError: down" in stats["a"]["last_error"]
+
+    def test_open_breaker_skipped_without_call(self):
+        calls = []
+        engine = _AIProviderEngine([self._provider("a", error=OSError("down"), calls=calls)],
+                                   hedge_after=0, failure_threshold=2, recovery_timeout=60)
+        assert [engine.complete("sys", "hi") for _ in range(3)] == [(None, None)] * 3
+        assert calls == ["a", "a"]
+        assert engine.get_stats()["providers"]["a"]["breaker"] == "open"
+
+    def test_hedges_slow_provider(self):
+        engine = _AIProviderEngine([self._provider("slow", delay=1.0), self._provider("fast")],
+                                   hedge_after=0.05)
+        t0 = time.monotonic()
+        assert engine.complete("sys", "hi") == ("ok from fast", "fast")
+        assert time.monotonic() - t0 < 0.5
+        assert engine.get_stats()["hedges"] == 1
+
+    def test_deadline_bounds_call(self):
+        engine = _AIProviderEngine([self._provider("a", delay=1.0), self._provider("b", delay=1.0)],
+                                   hedge_after=0.05, deadline=0.2)
+        t0 = time.monotonic()
+        assert engine.complete("sys", "hi") == (None, None)
+        assert time.monotonic() - t0 < 0.6
+
+    def test_ranking_favours_fastest_healthy(self):
+        engine = _AIProviderEngine([self._provider("a", delay=0.05), self._provider("b")], hedge_after=0)
+        assert [p.name for p in engine.ranked()] == ["a", "b"]   # unmeasured: declaration order
+        engine.complete("sys", "hi")
+        assert [p.name for p in engine.ranked()] == ["b", "a"]   # b is unmeasured, a is now slow
+        engine.complete("sys", "hi")
+        assert [p.name for p in engine.ranked()] == ["b", "a"]   # b measured faster than a
+        assert engine.get_stats()["providers"]["b"]["latency_ms"] < 50
+
+    def test_unconfigured_providers_skipped(self):
+        engine = _AIProviderEngine([self._provider("a", configured=False), self._provider("b")], hedge_after=0)
+        assert engine.complete("sys", "hi")[1] == "b"
+        assert _AIProviderEngine([self._provider("a", configured=False)]).complete("sys", "hi") == (None, None)
+
+    def test_chat_messages_window_and_roles(self):
+        conversation = [{"role": "user", "text": f"q{i}"} for i in range(25)] + [{"role": "bot", "text": "a"}]
+        messages = _ai_chat_messages(conversation, "next")
+        assert len(messages) == 21
+        assert messages[-2] == {"role": "assistant", "content": "a"}
+        assert messages[-1] == {"role": "user", "content": "next"}
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  LLM Response Cache Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestLLMCache:
+    """Test the content-addressed LLM cache and its persistent tiers."""
+
+    @staticmethod
+    def _engine(calls):
+        def call(system_prompt, messages, max_tokens, timeout):
+            calls.append(messages[-1]["content"])
+            return f"reply {len(calls)}"
+        return _AIProviderEngine([_AIProvider("fake", "fake-model", lambda: True, call)], hedge_after=0)
+
+    def test_key_normalises_message_and_tail(self):
+        key = _LLMCache.key
+        conversation = [{"role": "user", "text": f"q{i}"} for i in range(10)]
+        assert key("unified_brief", "sys", "  Brief  the\nprogram ") == key("unified_brief", "sys", "Brief the program")
+        assert key("unified_brief", "sys", "hi") != key("foresight_forecast", "sys", "hi")
+        assert key("unified_brief", "sys", "hi") != key("unified_brief", "sys2", "hi")
+        # only the last LLM_CACHE_TAIL turns count
+        assert key("ai_chat", "sys", "hi", conversation) == key("ai_chat", "sys", "hi", conversation[-6:])
+        assert key("ai_chat", "sys", "hi", conversation) != key("ai_chat", "sys", "hi", conversation[-5:])
+
+    def test_lru_eviction_and_ttl(self):
+        cache = _LLMCache(max_entries=2)
+        cache.put("a", "r", "A", "p", ttl=60, now=0)
+        cache.put("b", "r", "B", "p", ttl=60, now=0)
+        assert cache.get("a", now=1) == ("A", "p")   # a is now most recent
+        cache.put("c", "r", "C", "p", ttl=60, now=1)
+        assert cache.get("b", now=1) is None
+        assert cache.get("a", now=61) is None          # expired
+        assert cache.get("c", now=2) == ("C", "p")
+        stats = cache.get_stats()
+        assert stats["evictions"] == 1
+        assert stats["hits"] == 2 and stats["misses"] == 2
+
+    def test_sqlite_store_survives_restart(self, tmp_path):
+        path = str(tmp_path / "llm.db")
+        _LLMCache(store=_SQLiteLLMStore(path)).put("k", "unified_brief", "brief", "openai", ttl=60)
+        cold = _LLMCache(store=_SQLiteLLMStore(path))
+        assert cold.get("k") == ("brief", "openai")
+        assert cold.get("k") == ("brief", "openai")
+        stats = cold.get_stats()
+        assert stats["backend"] == "sqlite"
+        assert stats["store_hits"] == 1 and stats["hits"] == 1
+
+    def test_broken_store_degrades_to_memory(self):
+        class Broken:
+            name = "broken"
+            def get(self, key, now):
+                raise OSError("db down")
+            put = get
+        cache = _LLMCache(store=Broken())
+        cache.put("k", "r", "v", "p", ttl=60)
+        assert cache.get("k") == ("v", "p")
+        assert cache.get("other") is None
+        assert cache.get_stats()["store_errors"] == 2
+
+    def test_routes_share_cache_with_per_route_ttl(self):
+        calls = []
+        with patch("api.index._ai_engine", self._engine(calls)), patch("api.index._llm_cache", _LLMCache()):
+            assert _cached_ai_complete("unified_brief", "sys", "brief DDG-51") == ("reply 1", "fake", False)
+            assert _cached_ai_complete("unified_brief", "sys", "brief  DDG-51") == ("reply 1", "fake", True)
+            assert _cached_ai_complete("vault_emails", "sys", "draft") == ("reply 2", "fake", False)
+            assert _cached_ai_complete("vault_emails", "sys", "draft") == ("reply 3", "fake", False)
+        assert calls == ["brief DDG-51", "draft", "draft"]
+
+    def test_handler_flags_cached_reply(self):
+        calls = []
+        h = handler.__new__(handler)
+        h._req_route = "living_ledger"
+        with patch("api.index._ai_engine", self._engine(calls)), patch("api.index._llm_cache", _LLMCache()):
+            assert h._call_ai_cascade("sys", "summarise") == "reply 1"
+            assert h._ai_cached is False
+            assert h._call_ai_cascade("sys", "summarise") == "reply 1"
+            assert h._ai_cached is True
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  AI Single-Flight Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestAISingleFlight:
+    """Test coalescing of identical concurrent AI calls."""
+
+    @staticmethod
+    def _concurrently(n, fn):
+        results, errors = [None] * n, [None] * n
+
+        def run(i):
+            try:
+                results[i] = fn()
+            except Exception as e:
+                errors[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+        return results, errors
+
+    def test_concurrent_calls_share_one_execution(self):
+        flight = _SingleFlight()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return "brief"
+        results, errors = self._concurrently(5, lambda: flight.do("k", slow, timeout=5))
+        assert calls == [1]
+        assert errors == [None] * 5
+        assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+        assert {value for value, _ in results} == {"brief"}
+        assert flight.get_stats() == {"in_flight": 0, "leaders": 1, "shared": 4, "timeouts": 0, "errors": 0}
+
+    def test_leader_error_propagates(self):
+        flight = _SingleFlight()
+
+        def boom():
+            time.sleep(0.1)
+            raise RuntimeError("provider exploded")
+        _, errors = self._concurrently(3, lambda: flight.do("k", boom, timeout=5))
+        assert all(isinstance(e, RuntimeError) for e in errors)
+        assert flight.do("k", lambda: "fresh") == ("fresh", False)   # failed flight is not reused
+
+    def test_follower_timeout(self):
+        flight = _SingleFlight()
+        release = threading.Event()
+        leader = threading.Thread(target=flight.do, args=("k", lambda: release.wait(5)))
+        leader.start()
+        time.sleep(0.05)
+        with pytest.raises(TimeoutError):
+            flight.do("k", lambda: "unused", timeout=0.05)
+        release.set()
+        leader.join(5)
+        assert flight.get_stats()["timeouts"] == 1
+
+    def test_identical_ai_requests_make_one_llm_call(self):
+        calls = []
+
+        def call(system_prompt, messages, max_tokens, timeout):
+            calls.append(1)
+            time.sleep(0.2)
+            return "program summary"
+        engine = _AIProviderEngine([_AIProvider("fake", "fake-model", lambda: True, call)], hedge_after=0)
+        with patch("api.index._ai_engine", engine), patch("api.index._llm_cache", _LLMCache()), \
+                patch("api.index._ai_single_flight", _SingleFlight()):
+            results, errors = self._concurrently(
+                6, lambda: _cached_ai_complete("unified_brief", "sys", "brief DDG-51 Q3"))
+            # the cache was filled before the flight ended, so later callers hit it
+            assert _cached_ai_complete("unified_brief", "sys", "brief DDG-51 Q3")[2] is True
+        assert calls == [1]
+        assert errors == [None] * 6
+        assert [cached for _, _, cached in results].count(False) == 1
+        assert {text for text, _, _ in results} == {"program summary"}
+
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Streamed AI Reply Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestAIStreaming:
+    """Test provider stream parsing, streamed failover and SSE routes."""
+
+    @staticmethod
+    def _provider(name, chunks=(), error=None, calls=None):
+        def stream(system_prompt, messages, max_tokens, timeout):
+            if calls is not None:
+                calls.append(name)
+            if error:
+                raise error
+            yield from chunks
+        return _AIProvider(name, f"{name}-model", lambda: True, lambda *a: "".join(chunks), stream)
+
+    def test_openai_deltas(self):
+        events = [{"choices": [], "prompt_filter_results": []},          # Azure content-filter preamble
+                  {"choices": [{"delta": {"role": "assistant"}}]},
+                  {"choices": [{"delta": {"content": "Ready"}}]},
+                  {"choices": [{"delta": {"content": "ness"}, "finish_reason": None}]},
+                  {"choices": [{"delta": {}, "finish_reason": "stop"}]}]
+        assert list(_openai_deltas(events)) == ["Ready", "ness"]
+
+    def test_anthropic_deltas(self):
+        events = [{"type": "message_start", "message": {}},
+                  {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "Ao"}},
+                  {"type": "ping"},
+                  {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": " 0"}},
+                  {"type": "message_stop"}]
+        assert list(_anthropic_deltas(events)) == ["Ao", " 0"]
+        with pytest.raises(RuntimeError, match="overloaded"):
+            list(_anthropic_deltas([{"type": "error", "error": {"message": "overloaded"}}]))
+
+    def test_stream_fails_over_before_first_chunk(self):
+        calls = []
+        engine = _AIProviderEngine([self._provider("a", error=OSError("down"), calls=calls),
+                                    self._provider("b", ["NSN ", "5340"], calls=calls)], hedge_after=0)
+        assert list(engine.stream("sys", "hi")) == [("b", "NSN "), ("b", "5340")]
+        assert calls == ["a", "b"]
+        stats = engine.get_stats()["providers"]
+        assert stats["a"]["failures"] == 1
+        assert stats["b"]["calls"] == 1 and stats["b"]["latency_ms"] is None
+
+    @staticmethod
+    def _cut_off(name="fake"):
+        def stream(system_prompt, messages, max_tokens, timeout):
+            yield "Hello "
+            raise ConnectionResetError("upstream closed")
+        return _AIProvider(name, f"{name}-model", lambda: True, lambda *a: "Hello there.", stream)
+
+    def test_mid_stream_failure_raises_after_partial_reply(self):
+        engine = _AIProviderEngine([self._cut_off(), self._provider("b", ["unused"])], hedge_after=0)
+        received = []
+        with pytest.raises(_AIStreamInterrupted) as exc:
+            for item in engine.stream("sys", "hi"):
+                received.append(item)
+        assert received == [("fake", "Hello ")]
+        assert exc.value.provider == "fake"
+        assert engine.get_stats()["providers"]["fake"]["failures"] == 1
+
+    def test_stream_falls_back_to_whole_call(self):
+        engine = _AIProviderEngine([_AIProvider("plain", "m", lambda: True, lambda *a: "whole reply")],
+                                   hedge_after=0)
+        assert list(engine.stream("sys", "hi")) == [("plain", "whole reply")]
+
+    @pytest.fixture
+    def server(self):
+        from http.server import ThreadingHTTPServer
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=srv.serve_forever, daemon=True)
+        engine = _AIProviderEngine([self._provider("fake", ["Fleet ", "readiness ", "is 92%."])], hedge_after=0)
+        with patch("api.index._hydrate_from_supabase"), patch("api.index._ai_engine", engine), \
+                patch("api.index._llm_cache", _LLMCache()), patch("api.index._persist_ai_audit"):
+            thread.start()
+            yield srv.server_address
+            srv.shutdown()
+        srv.server_close()
+
+    @staticmethod
+    def _post_events(address, path, payload):
+        import http.client
+        conn = http.client.HTTPConnection(*address, timeout=10)
+        conn.request("POST", path, body=json.dumps(payload), headers={"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        raw = resp.read().decode()
+        conn.close()
+        events = []
+        for block in raw.strip().split("\n\n"):
+            event, data = block.split("\n")
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+        return resp, events
+
+    def test_ai_chat_streams_tokens_and_audits(self, server):
+        resp, events = self._post_events(server, "/api/ai-chat", {"message": "readiness?", "stream": True})
+        assert resp.getheader("Content-Type").startswith("text/event-stream")
+        assert [e for e, _ in events] == ["ready", "token", "token", "token", "done"]
+        assert events[0][1] == {"provider": "fake", "model": "fake-model", "cached": False}
+        text = "".join(d["t"] for e, d in events if e == "token")
+        assert text == "Fleet readiness is 92%."
+        done = events[-1][1]
+        assert "response" not in done
+        assert done["response_hash"] == hashlib.sha256(text.encode()).hexdigest()
+        # the finished reply was cached: a repeat streams it back as one token
+        _, events = self._post_events(server, "/api/ai-chat", {"message": "readiness?", "stream": True})
+        assert events[0][1]["cached"] is True
+        assert [d["t"] for e, d in events if e == "token"] == [text]
+
+    def test_cut_off_reply_is_not_cached_or_audited(self, server):
+        engine = _AIProviderEngine([self._cut_off()], hedge_after=0)
+        with patch("api.index._ai_engine", engine), patch("api.index._persist_ai_audit") as audit:
+            _, events = self._post_events(server, "/api/ai-chat", {"message": "hello?", "stream": True})
+            assert [e for e, _ in events] == ["ready", "token", "error"]
+            assert events[-1][1]["partial"] is True
+            audit.assert_not_called()
+            import api.index as index
+            assert index._cached_ai_complete("ai_chat", index._build_ai_system_prompt("", None), "hello?")[0] \
+                == "Hello there."
+
+    def test_non_streaming_request_unchanged(self, server):
+        import http.client
+        conn = http.client.HTTPConnection(*server, timeout=10)
+        conn.request("POST", "/api/ai-chat", body=json.dumps({"message": "status"}),
+                     headers={"Content-Type": "application/json"})
+        body = json.loads(conn.getresponse().read())
+        conn.close()
+        assert body["response"] == "Fleet readiness is 92%."
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Monte Carlo Engine Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestMonteCarloEngine:
+    """Test the vectorized heatmap engine and its pure-Python fallback."""
+
+    @staticmethod
+    def _legacy_heatmap(delay, cost, base_delay, base_cost):
+        """The previous per-cell rescan over the same samples."""
+        heatmap = []
+        for di, dm in enumerate((0.5, 0.75, 1.0, 1.25, 1.5)):
+            d_lo = base_delay * dm - base_delay * 0.125 if di > 0 else 0
+            d_hi = base_delay * dm + base_delay * 0.125 if di < 4 else base_delay * 10
+            row = []
+            for ci, cm in enumerate((0.4, 0.6, 0.8, 1.0, 1.2, 1.5)):
+                c_lo = base_cost * cm - base_cost * 0.1 if ci > 0 else 0
+                c_hi = base_cost * cm + base_cost * 0.1 if ci < 5 else base_cost * 10
+                count = sum(1 for d, c in zip(delay, cost) if d_lo <= d <= d_hi and c_lo <= c <= c_hi)
+                row.append(round(count / len(delay) * 100, 1))
+            heatmap.append(row)
+        return heatmap
+
+    def test_buckets_match_legacy_rescan(self):
+        np = pytest.importorskip("numpy")
+        rng = np.random.default_rng(3)
+        delay = np.maximum(rng.normal(30, 9, 5000), 0).astype(np.float32)
+        cost = np.maximum(rng.normal(500, 150, 5000), 0).astype(np.float32)
+        counts, _, _ = np.histogram2d(delay, cost, bins=([30 * m for m in _MC_DELAY_EDGES],
+                                                         [500 * m for m in _MC_COST_EDGES]))
+        heatmap = np.round(counts[:, _MC_COST_COLUMNS] / 5000 * 100, 1).tolist()
+        assert heatmap == self._legacy_heatmap(delay.tolist(), cost.tolist(), 30, 500)
+
+    def test_deterministic_and_calibrated(self):
+        pytest.importorskip("numpy")
+        heatmap, pct = _monte_carlo_heatmap(30, 500, 200_000, seed=11)
+        assert _monte_carlo_heatmap(30, 500, 200_000, seed=11) == (heatmap, pct)
+        assert len(heatmap) == 5 and all(len(row) == 6 for row in heatmap)
+        assert pct["P50"][0] == pytest.approx(30, abs=0.2)
+        assert pct["P95"][1] == pytest.approx(500 + 1.645 * 150, abs=3)
+        assert heatmap[2][3] == max(max(row) for row in heatmap)    # base estimate is the mode
+
+    def test_correlation_concentrates_diagonal(self):
+        pytest.importorskip("numpy")
+        independent, _ = _monte_carlo_heatmap(30, 500, 100_000, seed=5)
+        correlated, _ = _monte_carlo_heatmap(30, 500, 100_000, seed=5, correlation=0.9)
+        assert correlated[0][0] > 3 * independent[0][0]
+        assert correlated[4][5] > 2 * independent[4][5]
+
+    def test_pure_python_fallback(self):
+        with patch("api.index.np", None):
+            heatmap, pct = _monte_carlo_heatmap(30, 500, 20_000, seed=2)
+        assert pct["P50"][0] == pytest.approx(30, abs=0.5)
+        assert pct["P50"][1] == pytest.approx(500, abs=8)
+        assert sum(map(sum, heatmap)) == pytest.approx(93.3, abs=1.0)   # rest falls outside the labelled buckets
+
+    def test_fallback_agrees_with_numpy(self):
+        pytest.importorskip("numpy")
+        vectorized, _ = _monte_carlo_heatmap(30, 500, 20_000, seed=2)
+        with patch("api.index.np", None):
+            fallback, _ = _monte_carlo_heatmap(30, 500, 20_000, seed=2)
+        for row, expected in zip(fallback, vectorized):
+            assert row == pytest.approx(expected, abs=1.5)
+
+    def test_seed_stable_across_processes(self):
+        assert _monte_carlo_seed("DMSMS", 30, 500) == _monte_carlo_seed("DMSMS", 30, 500)
+        assert _monte_carlo_seed("DMSMS", 30, 500) != _monte_carlo_seed("DMSMS", 31, 500)
+        assert _monte_carlo_seed("", 0, 0) == int.from_bytes(hashlib.sha256(b"|0|0").digest()[:8], "big")
 
 # ═══════════════════════════════════════════════════════════════════
 #  Record Categories & Constants Tests
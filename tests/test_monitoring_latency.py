@@ -0,0 +1,101 @@
+"""
+S4 Ledger Latency Histogram Tests
+=================================
+Tests for monitoring.latency (log-linear buckets, sliding windows) and
+the per-route latency summaries exported by monitoring.S4Metrics.
+Run: pytest tests/ -v
+"""
+import os
+import random
+import sys
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from monitoring import S4Metrics
+from monitoring.latency import RollingLatency, SUB_BUCKETS, bucket_bounds, bucket_index
+
+
+class TestBuckets:
+    def test_small_values_exact(self):
+        for us in range(2 * SUB_BUCKETS):
+            assert bucket_bounds(bucket_index(us)) == (us, us + 1)
+
+    def test_bounds_contain_value(self):
+        for us in [64, 65, 127, 128, 1000, 123_456, 10**9]:
+            lower, upper = bucket_bounds(bucket_index(us))
+            assert lower <= us < upper
+            assert (upper - lower) / lower <= 1 / SUB_BUCKETS
+
+    def test_indices_monotonic_and_contiguous(self):
+        previous = 0
+        for us in range(1, 100_000):
+            index = bucket_index(us)
+            assert index in (previous, previous + 1)
+            previous = index
+
+
+class TestRollingLatency:
+    def test_percentiles_within_bucket_error(self):
+        rng = random.Random(7)
+        samples = [rng.lognormvariate(-4, 1) for _ in range(20_000)]   # seconds
+        lat = RollingLatency()
+        for s in samples:
+            lat.record(s, now=1000.0)
+        summary = lat.percentiles(300, now=1000.0)
+        ordered = sorted(samples)
+        assert summary["count"] == len(samples)
+        for key, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            exact_ms = ordered[int(len(ordered) * q) - 1] * 1000
+            assert summary[key] == pytest.approx(exact_ms, rel=2 / SUB_BUCKETS)
+        assert summary["max"] == pytest.approx(max(samples) * 1000, abs=0.001)
+        assert summary["mean"] == pytest.approx(sum(samples) / len(samples) * 1000, rel=1e-3)
+
+    def test_windows_drop_old_slots(self):
+        lat = RollingLatency()
+        lat.record(1.0, now=0.0)           # an hour-old slow request
+        lat.record(0.010, now=3000.0)
+        lat.record(0.020, now=3590.0)
+        assert lat.percentiles(60, now=3595.0)["count"] == 1
+        assert lat.percentiles(3600, now=3595.0)["count"] == 3
+        assert lat.percentiles(3600, now=3700.0)["count"] == 2
+        assert lat.count == 3                 # all-time totals are kept
+
+    def test_ring_slot_reuse(self):
+        lat = RollingLatency(slot_seconds=10, max_window=60)
+        lat.record(0.5, now=5.0)
+        lat.record(0.001, now=65.0)            # same ring position, next lap
+        summary = lat.percentiles(60, now=65.0)
+        assert summary["count"] == 1
+        assert summary["max"] == 1.0
+
+    def test_empty(self):
+        assert RollingLatency().percentiles(60) == {"count": 0, "mean": None, "p50": None,
+                                                    "p95": None, "p99": None, "max": None}
+
+
+class TestS4MetricsRouteLatency:
+    def test_route_latency_per_endpoint(self):
+        m = S4Metrics()
+        for i in range(100):
+            m.http_request("GET", "health", 200, 0.001)
+            m.http_request("POST", "ai-chat", 200, 2.0)
+        summary = m.route_latency()
+        assert set(summary) == {"ai-chat", "health"}
+        assert set(summary["health"]) == {"1m", "5m", "1h"}
+        assert summary["health"]["5m"]["p99"] == pytest.approx(1.0, rel=0.05)
+        assert summary["ai-chat"]["1m"]["p50"] == pytest.approx(2000, rel=0.05)
+
+    def test_prometheus_export(self):
+        m = S4Metrics()
+        m.http_request("GET", "health", 200, 0.02)
+        m.http_request("GET", "health", 500, 0.03)
+        text = m.export_prometheus()
+        assert "# TYPE s4_http_route_latency_seconds summary" in text
+        assert 's4_http_route_latency_seconds{endpoint="health",quantile="0.99"}' in text
+        assert 's4_http_route_latency_seconds_count{endpoint="health"} 2' in text
+        # fixed-bucket histograms are cumulative and not double counted
+        assert 's4_http_request_seconds_bucket{method="GET",le="0.05"} 2' in text
+        assert 's4_http_request_seconds_bucket{method="GET",le="+Inf"} 2' in text
+        assert 's4_http_request_seconds_count{method="GET"} 2' in text
@@ -0,0 +1,108 @@
+"""
+S4 Ledger JSON Codec Tests
+==========================
+Tests for s4_codec: round-trips and stdlib fallbacks on whichever
+backend is installed, and byte-identical canonical encoding for hashing.
+Run: pytest tests/ -v
+"""
+import hashlib
+import importlib
+import json
+import os
+import sys
+from unittest.mock import patch
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s4_codec
+
+SAMPLE = {
+    "record_type": "SUPPLY_CHAIN_RECEIPT",
+    "hash": "a" * 64,
+    "fee": 0.01,
+    "count": 3,
+    "ok": True,
+    "missing": None,
+    "tags": ["NSN 5340-01-123-4567", "Lot Ω-7"],
+    "nested": {"z": 1, "a": [1.5, {"b": "ü"}]},
+}
+
+
+class TestCodec:
+    def test_round_trip(self):
+        assert s4_codec.loads(s4_codec.dumps(SAMPLE)) == SAMPLE
+        assert s4_codec.loads(s4_codec.dumpb(SAMPLE)) == SAMPLE
+
+    def test_output_compact_utf8(self):
+        body = s4_codec.dumpb({"a": [1, 2], "b": "Ω"})
+        assert body == '{"a":[1,2],"b":"Ω"}'.encode("utf-8")
+        assert s4_codec.dumps({"a": 1}) == '{"a":1}'
+
+    def test_loads_accepts_str_bytes_bytearray(self):
+        raw = '{"a": [1, "é"]}'
+        for data in (raw, raw.encode(), bytearray(raw.encode())):
+            assert s4_codec.loads(data) == {"a": [1, "é"]}
+
+    def test_loads_invalid_raises_json_error(self):
+        with pytest.raises(ValueError):
+            s4_codec.loads(b"{not json")
+
+    def test_loads_falls_back_for_stdlib_only_inputs(self):
+        assert s4_codec.loads("[NaN, 1]")[1] == 1
+        assert s4_codec.loads("[18446744073709551616]") == [2 ** 64]
+
+    def test_dumps_falls_back_for_big_ints(self):
+        assert s4_codec.loads(s4_codec.dumps({"n": 2 ** 70})) == {"n": 2 ** 70}
+
+    def test_default_and_indent(self):
+        class Tx:
+            pass
+        assert s4_codec.loads(s4_codec.dumps({"tx": Tx()}, default=lambda o: "tx"))["tx"] == "tx"
+        assert s4_codec.dumps({"a": 1}, indent=2) == '{\n  "a": 1\n}'
+
+    def test_non_str_keys(self):
+        assert s4_codec.loads(s4_codec.dumps({1: "a"})) == {"1": "a"}
+
+    def test_stdlib_backend(self):
+        # same wire format when orjson is not installed
+        with patch.dict(sys.modules, {"orjson": None}):
+            fallback = importlib.reload(s4_codec)
+        try:
+            assert fallback.BACKEND == "json"
+            assert fallback.dumpb(SAMPLE) == json.dumps(SAMPLE, ensure_ascii=False,
+                                                        separators=(",", ":")).encode("utf-8")
+            assert fallback.loads(fallback.dumpb(SAMPLE)) == SAMPLE
+        finally:
+            importlib.reload(s4_codec)
+
+    def test_packaged_with_sdk(self):
+        # s4_sdk imports s4_codec directly, so the distribution must ship both
+        tomllib = pytest.importorskip("tomllib")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(os.path.join(root, "pyproject.toml"), "rb") as f:
+            config = tomllib.load(f)
+        assert {"s4_sdk", "s4_codec"} <= set(config["tool"]["setuptools"]["py-modules"])
+        assert "orjson" in " ".join(config["project"]["optional-dependencies"]["fast"])
+
+
+class TestCanonical:
+    @pytest.mark.parametrize("kwargs", [
+        {},
+        {"ensure_ascii": False},
+        {"separators": (",", ":")},
+    ])
+    def test_byte_identical_to_stdlib(self, kwargs):
+        assert s4_codec.canonical(SAMPLE, **kwargs) == json.dumps(SAMPLE, sort_keys=True, **kwargs)
+
+    def test_digest_independent_of_key_order(self):
+        reordered = dict(reversed(list(SAMPLE.items())))
+        digest = lambda obj: hashlib.sha256(s4_codec.canonical(obj).encode()).hexdigest()
+        assert digest(SAMPLE) == digest(reordered)
+
+    def test_known_digest(self):
+        # digests anchored before s4_codec existed must still verify
+        payload = {"rowIdx": 4, "field": "status", "value": "Closed"}
+        assert s4_codec.canonical(payload) == '{"field": "status", "rowIdx": 4, "value": "Closed"}'
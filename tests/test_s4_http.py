@@ -0,0 +1,209 @@
+"""
+S4 Ledger Pooled HTTP Transport Tests
+=====================================
+Tests for s4_http.ConnectionPool against a local keep-alive server:
+connection reuse, stale-socket retry, idle eviction and error mapping.
+Run: pytest tests/ -v
+"""
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from s4_http import ConnectionPool
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/events"):
+            body = b"".join(b"data: %d\n\n" % i for i in range(3))
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path.startswith("/missing"):
+            self._reply(404, {"error": "not found"})
+        else:
+            self._reply(200, {"path": self.path, "port": self.client_address[1]})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path.startswith("/drop"):
+            # Apply the write, then die before answering
+            self.server.dropped += 1
+            self.close_connection = True
+            return
+        self._reply(201, {"echo": json.loads(body)})
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+    srv.daemon_threads = True
+    srv.dropped = 0
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def _url(srv, path="/rows"):
+    return "http://%s:%d%s" % (srv.server_address[0], srv.server_address[1], path)
+
+
+class TestConnectionPool:
+    """Keep-alive reuse and counters."""
+
+    def test_reuses_connection(self, server):
+        pool = ConnectionPool()
+        ports = {pool.request("GET", _url(server)).json()["port"] for _ in range(5)}
+        stats = pool.get_stats()
+        assert len(ports) == 1
+        assert stats["requests"] == 5
+        assert stats["handshakes"] == 1
+        assert stats["pool_hits"] == 4
+        assert stats["idle_connections"] == 1
+        pool.close()
+
+    def test_post_body_and_status(self, server):
+        pool = ConnectionPool()
+        resp = pool.request("POST", _url(server), body=json.dumps({"a": 1}).encode(),
+                            headers={"Content-Type": "application/json"})
+        assert resp.status == 201
+        assert resp.json() == {"echo": {"a": 1}}
+        pool.close()
+
+    def test_http_error_maps_to_urllib(self, server):
+        pool = ConnectionPool()
+        resp = pool.request("GET", _url(server, "/missing"))
+        assert resp.status == 404
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            resp.raise_for_status()
+        assert exc.value.code == 404
+        # the connection survives an error status
+        assert pool.get_stats()["idle_connections"] == 1
+        pool.close()
+
+    def test_stale_socket_retried(self, server):
+        pool = ConnectionPool()
+        pool.request("GET", _url(server))
+        # Server drops the idle keep-alive socket behind the pool's back
+        for conns in pool._idle.values():
+            for conn, _ in conns:
+                conn.sock.shutdown(2)
+        resp = pool.request("GET", _url(server))
+        assert resp.status == 200
+        assert pool.get_stats()["stale_retries"] == 1
+        assert pool.get_stats()["handshakes"] == 2
+        pool.close()
+
+    def test_unsent_post_retried_on_stale_socket(self, server):
+        pool = ConnectionPool()
+        pool.request("GET", _url(server))
+        for conns in pool._idle.values():
+            for conn, _ in conns:
+                conn.sock.shutdown(2)
+        resp = pool.request("POST", _url(server), body=b'{"a": 1}')
+        assert resp.status == 201
+        assert pool.get_stats()["stale_retries"] == 1
+        pool.close()
+
+    def test_sent_post_not_retried(self, server):
+        pool = ConnectionPool()
+        pool.request("GET", _url(server))
+        with pytest.raises(ConnectionError):
+            pool.request("POST", _url(server, "/drop"), body=b'{"a": 1}')
+        assert server.dropped == 1
+        assert pool.get_stats()["stale_retries"] == 0
+        assert pool.get_stats()["errors"] == 1
+        pool.close()
+
+    def test_idle_eviction(self, server):
+        pool = ConnectionPool(idle_timeout=0.05)
+        pool.request("GET", _url(server))
+        time.sleep(0.1)
+        assert pool.evict_idle() == 1
+        pool.request("GET", _url(server))
+        assert pool.get_stats()["handshakes"] == 2
+        pool.close()
+
+    def test_concurrent_checkout(self, server):
+        pool = ConnectionPool(max_per_host=4)
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(10):
+                    assert pool.request("GET", _url(server)).status == 200
+            except Exception as e:  # pragma: no cover - reported below
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors
+        stats = pool.get_stats()
+        assert stats["requests"] == 80
+        assert stats["handshakes"] < 80
+        assert stats["idle_connections"] <= 4
+        pool.close()
+
+
+
+class TestStreaming:
+    """Incrementally read responses (server-sent events)."""
+
+    def test_iter_lines_then_reuse(self, server):
+        pool = ConnectionPool()
+        with pool.stream("GET", _url(server, "/events")) as resp:
+            assert resp.raise_for_status().status == 200
+            assert [line for line in resp.iter_lines() if line] == ["data: 0", "data: 1", "data: 2"]
+        assert pool.get_stats()["idle_connections"] == 1
+        pool.request("GET", _url(server))
+        assert pool.get_stats()["handshakes"] == 1
+        pool.close()
+
+    def test_abandoned_stream_not_pooled(self, server):
+        pool = ConnectionPool()
+        with pool.stream("GET", _url(server, "/events")) as resp:
+            next(resp.iter_lines())
+        assert pool.get_stats()["idle_connections"] == 0
+        pool.close()
+
+    def test_error_status(self, server):
+        pool = ConnectionPool()
+        with pool.stream("GET", _url(server, "/missing")) as resp:
+            with pytest.raises(urllib.error.HTTPError) as exc:
+                resp.raise_for_status()
+        assert exc.value.code == 404
+        assert pool.get_stats()["idle_connections"] == 1
+        pool.close()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
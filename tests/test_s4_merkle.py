@@ -0,0 +1,120 @@
+"""
+S4 Ledger Merkle Module Tests
+=============================
+Tests for s4_merkle: root compatibility with the original anchor_batch
+tree, compact level storage and inclusion proofs.
+Run: pytest tests/ -v
+"""
+import hashlib
+import os
+import sys
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from s4_merkle import MerkleTree, EMPTY_ROOT, merkle_root, merkle_proof, verify_proof
+from s4_sdk import S4SDK
+
+
+def _leaves(n):
+    return [hashlib.sha256(f"leaf-{i}".encode()).hexdigest() for i in range(n)]
+
+
+def _legacy_root(hashes):
+    """The nested merkle_root() anchor_batch used before s4_merkle existed."""
+    if not hashes:
+        return hashlib.sha256(b"empty").hexdigest()
+    layer = list(hashes)
+    while len(layer) > 1:
+        if len(layer) % 2 == 1:
+            layer.append(layer[-1])
+        layer = [hashlib.sha256((layer[i] + layer[i + 1]).encode()).hexdigest()
+                 for i in range(0, len(layer), 2)]
+    return layer[0]
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Root Compatibility Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestMerkleRoot:
+    """Roots must match the hex-concatenation tree already anchored on-chain."""
+
+    @pytest.mark.parametrize("n", [0, 1, 2, 3, 4, 5, 7, 8, 13, 100, 1000])
+    def test_matches_legacy_root(self, n):
+        leaves = _leaves(n)
+        assert merkle_root(leaves) == _legacy_root(leaves)
+
+    def test_non_hex_leaves(self):
+        leaves = ["ABC", "not-a-digest", "x" * 70]
+        assert merkle_root(leaves) == _legacy_root(leaves)
+
+    def test_single_and_empty(self):
+        a = _leaves(1)[0]
+        assert merkle_root([a]) == a
+        assert merkle_root([]) == EMPTY_ROOT
+
+
+# ═══════════════════════════════════════════════════════════════════
+#  Storage & Proof Tests
+# ═══════════════════════════════════════════════════════════════════
+
+class TestMerkleTree:
+    """Test compact levels and O(log n) proofs."""
+
+    def test_levels_are_packed_digests(self):
+        tree = MerkleTree(_leaves(1000))
+        assert tree.depth == 10
+        # 500 + 250 + 125 + 63 + 32 + 16 + 8 + 4 + 2 + 1 nodes, 32 bytes each
+        assert tree.storage_bytes() == 1001 * 32
+
+    def test_every_leaf_proves(self):
+        for n in (1, 2, 5, 8, 13, 257):
+            leaves = _leaves(n)
+            tree = MerkleTree(leaves)
+            for i, leaf in enumerate(leaves):
+                proof = tree.proof(i)
+                assert proof == merkle_proof(leaves, i)
+                assert verify_proof(leaf, proof, tree.root)
+
+    def test_proof_length_is_log_n(self):
+        tree = MerkleTree(_leaves(1000))
+        assert len(tree.proof(637)) == 10
+
+    def test_wrong_leaf_fails(self):
+        leaves = _leaves(6)
+        tree = MerkleTree(leaves)
+        assert not verify_proof(leaves[1], tree.proof(2), tree.root)
+
+    def test_index_of(self):
+        leaves = _leaves(5) + [_leaves(1)[0]]
+        tree = MerkleTree(leaves)
+        assert tree.index_of(leaves[3]) == 3
+        assert tree.index_of(leaves[0]) == 0
+        assert tree.index_of("missing") is None
+
+    def test_out_of_range(self):
+        with pytest.raises(IndexError):
+            MerkleTree(_leaves(3)).proof(3)
+
+
+class TestSDKVerifyInclusion:
+    """S4SDK.verify_inclusion should accept proofs from /api/batch/proof."""
+
+    def test_sdk_verifies_server_proof(self):
+        leaves = _leaves(1000)
+        tree = MerkleTree(leaves)
+        sdk = S4SDK()
+        assert sdk.verify_inclusion(leaves[42], tree.proof(42), tree.root)
+        assert not sdk.verify_inclusion(leaves[43], tree.proof(42), tree.root)
+
+    def test_sdk_accepts_proof_response(self):
+        leaves = _leaves(9)
+        tree = MerkleTree(leaves)
+        response = {"leaf": leaves[8], "proof": tree.proof(8), "merkle_root": tree.root}
+        assert S4SDK().verify_inclusion(response["leaf"], response["proof"], response["merkle_root"])
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
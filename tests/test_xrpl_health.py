@@ -0,0 +1,685 @@
+"""
+S4 Ledger XRPL Node Failover Tests
+==================================
+Tests for monitoring.xrpl_health.XRPLHealthMonitor, the API's
+_xrpl_call failover and the pipelined issuer submission engine, against
+local stand-in rippled JSON-RPC servers that can answer, return errors,
+go dark, or track an account Sequence.
+Run: pytest tests/ -v
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("SUPABASE_URL", "https://test.supabase.co")
+os.environ.setdefault("SUPABASE_ANON_KEY", "test-anon-key")
+
+from monitoring.xrpl_health import XRPLHealthMonitor
+
+xrpl = pytest.importorskip("xrpl")
+
+import api.index as index
+from api.index import handler, _anchor_xrpl, CryptoAlgorithm, SLS_ISSUER_ADDRESS
+from xrpl.core.binarycodec import decode
+from xrpl.models import AccountSet
+from xrpl.wallet import Wallet
+
+ACCOUNT = "rPT1Sjq2YGrBMTttX4GZHjKu9dyfzbpAYe"
+
+
+class _RippledStandIn(BaseHTTPRequestHandler):
+    """Just enough of rippled's JSON-RPC API for balance lookups and
+    submit_and_wait. server.fail holds methods answered with an HTTP 503
+    page; server.calls records (method, params) per request."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        method, params = body["method"], (body.get("params") or [{}])[0]
+        self.server.calls.append((method, params))
+        if method in self.server.fail:
+            self._send(503, b"<html>503 Service Unavailable</html>", "text/html")
+            return
+        result = self._result(method, params)
+        result.setdefault("status", "success")
+        self._send(200, json.dumps({"result": result}).encode(), "application/json")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _result(self, method, params):
+        if method == "server_info":
+            return {"info": {"build_version": "2.3.0", "network_id": 0}}
+        if method == "account_info":
+            return {"account_data": {"Account": params["account"], "Balance": "25000000", "Sequence": 7},
+                    "ledger_current_index": 100}
+        if method == "account_lines":
+            return {"account": params["account"],
+                    "lines": [{"currency": "SLS", "account": SLS_ISSUER_ADDRESS, "balance": "42.5"}]}
+        if method == "fee":
+            return {"drops": {"base_fee": "10", "median_fee": "5000", "minimum_fee": "10",
+                              "open_ledger_fee": "12"},
+                    "current_ledger_size": "10", "current_queue_size": "0",
+                    "expected_ledger_size": "100", "max_queue_size": "2000", "ledger_current_index": 100}
+        if method == "ledger":
+            return {"ledger_index": 99, "ledger_hash": "0" * 64, "validated": True}
+        if method == "submit":
+            return {"engine_result": "tesSUCCESS", "engine_result_message": "applied",
+                    "tx_blob": params["tx_blob"]}
+        if method == "tx":
+            return {"hash": params["transaction"], "validated": True, "ledger_index": 101, "Fee": "12",
+                    "meta": {"TransactionResult": "tesSUCCESS"}}
+        return {"status": "error", "error": "unknownCmd"}
+
+
+def _start_node():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _RippledStandIn)
+    srv.daemon_threads = True
+    srv.calls, srv.fail = [], set()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    srv.url = "http://%s:%d" % srv.server_address
+    return srv
+
+
+def _go_dark(srv):
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def nodes():
+    primary, backup = _start_node(), _start_node()
+    monitor = XRPLHealthMonitor(nodes=[{"id": "primary", "url": primary.url, "priority": 1},
+                                       {"id": "backup", "url": backup.url, "priority": 2}])
+    with patch.object(index, "_xrpl_nodes", monitor), patch.object(index, "_xrpl_clients", {}), \
+            patch.object(index, "_xrpl_client", object()), \
+            patch.object(index, "_account_state", index._AccountStateCache()), \
+            patch("xrpl.asyncio.transaction.reliable_submission._LEDGER_CLOSE_TIME", 0):
+        yield primary, backup, monitor
+    for srv in (primary, backup):
+        if srv.socket.fileno() != -1:
+            _go_dark(srv)
+
+
+class TestXRPLHealthMonitor:
+    """Priority routing, backoff and status reporting."""
+
+    @staticmethod
+    def _monitor():
+        return XRPLHealthMonitor(nodes=[{"id": "a", "url": "https://a", "priority": 1},
+                                        {"id": "b", "url": "https://b", "priority": 2},
+                                        {"id": "c", "url": "https://c", "priority": 3}])
+
+    def test_priority_order(self):
+        assert [vid for vid, _ in self._monitor().candidates()] == ["a", "b", "c"]
+
+    def test_backoff_after_consecutive_failures(self):
+        m = self._monitor()
+        for _ in range(m.MAX_CONSECUTIVE_FAILURES):
+            m.report_failure("a", latency_s=10.0)
+        assert [vid for vid, _ in m.candidates()] == ["b", "c", "a"]
+        assert m.get_healthy_url() == "https://b"
+        status = m.get_status()["validators"]["a"]
+        assert status["healthy"] is False
+        assert status["backoff_remaining"] > 0
+        m.report_success("a", latency_s=0.1)
+        assert m.get_healthy_validator_id() == "a"
+
+    def test_all_in_backoff_soonest_recovery_first(self):
+        m = self._monitor()
+        for vid in ("c", "a", "b"):
+            for _ in range(m.MAX_CONSECUTIVE_FAILURES):
+                m.report_failure(vid)
+            time.sleep(0.01)
+        assert [vid for vid, _ in m.candidates()] == ["c", "a", "b"]
+
+    def test_latency_ewma(self):
+        m = self._monitor()
+        m.report_success("a", latency_s=0.100)
+        m.report_success("a", latency_s=0.200)
+        assert m.get_status()["validators"]["a"]["latency_ms"] == pytest.approx(120.0)
+        assert m.get_status()["validators"]["b"]["latency_ms"] is None
+
+    def test_get_status_does_not_deadlock(self):
+        m = self._monitor()
+        result = []
+        worker = threading.Thread(target=lambda: result.append(m.get_status()), daemon=True)
+        worker.start()
+        worker.join(2)
+        assert result and result[0]["active_validator"] == "a"
+
+
+class TestXRPLFailover:
+    """_xrpl_call / _xrpl_submit against stand-in rippled nodes."""
+
+    def test_request_fails_over_when_node_goes_dark(self, nodes):
+        primary, backup, monitor = nodes
+        from xrpl.models.requests import AccountInfo
+        assert index._xrpl_request(AccountInfo(account=ACCOUNT)).result["account_data"]["Sequence"] == 7
+        assert len(primary.calls) == 1 and not backup.calls
+        _go_dark(primary)
+        assert index._xrpl_request(AccountInfo(account=ACCOUNT)).is_successful()
+        assert len(backup.calls) == 1
+        status = monitor.get_status()["validators"]
+        assert status["primary"]["total_failures"] == 1
+        assert status["backup"]["latency_ms"] is not None
+
+    def test_request_errors_do_not_fail_over(self, nodes):
+        primary, backup, monitor = nodes
+        from xrpl.models.requests import AccountInfo
+
+        def not_found(client):
+            raise xrpl.clients.XRPLRequestFailureException({"error": "actNotFound", "error_message": "x"})
+        with pytest.raises(xrpl.clients.XRPLRequestFailureException):
+            index._xrpl_call(not_found)
+        assert monitor.get_status()["validators"]["primary"]["total_failures"] == 0
+        assert index._xrpl_request(AccountInfo(account=ACCOUNT)).is_successful()
+        assert not backup.calls
+
+    def test_anchor_resubmits_same_signed_blob(self, nodes):
+        primary, backup, monitor = nodes
+        primary.fail = {"tx"}           # accepts the submission, then stops answering
+        wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+        with patch.object(index, "_xrpl_wallet", wallet), patch.object(index, "XRPL_PIPELINE_ENABLED", False):
+            result = _anchor_xrpl("ab" * 32, record_type="SUPPLY_CHAIN_RECEIPT", branch="NAVY")
+        assert result and result["verified"] is True
+        blobs = [p["tx_blob"] for srv in (primary, backup) for m, p in srv.calls if m == "submit"]
+        assert len(blobs) == 2 and blobs[0] == blobs[1]
+        assert monitor.get_status()["validators"]["primary"]["total_failures"] == 1
+
+    def test_wallet_balance_route_fails_over(self, nodes):
+        import http.client
+        primary, backup, _ = nodes
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        try:
+            with patch("api.index._hydrate_from_supabase"):
+                _go_dark(primary)
+                conn = http.client.HTTPConnection(*srv.server_address, timeout=10)
+                conn.request("GET", f"/api/wallet/balance?address={ACCOUNT}")
+                body = json.loads(conn.getresponse().read())
+                conn.close()
+        finally:
+            srv.shutdown()
+            srv.server_close()
+        assert body["xrp_balance"] == 25.0
+        assert body["sls_balance"] == "42.5"
+        assert sorted(m for m, _ in backup.calls) == ["account_info", "account_lines"]
+
+
+class _SequencedRippled(_RippledStandIn):
+    """Stand-in that enforces each account's Sequence on submit (every
+    account starts at 7). Each ledger request closes and validates one
+    ledger. A transaction ahead of the account Sequence is held
+    (terPRE_SEQ) until the gap fills; one behind it gets tefPAST_SEQ.
+    server.reject holds engine results returned, in order, to the next
+    submissions without applying them; server.txs records every decoded
+    submission."""
+
+    def _result(self, method, params):
+        srv = self.server
+        with srv.state_lock:
+            if method == "account_info":
+                return {"account_data": {"Account": params["account"], "Balance": "25000000",
+                                         "Sequence": srv.sequences.get(params["account"], 7)}}
+            if method == "ledger":
+                srv.validated += 1
+                return {"ledger_index": srv.validated, "ledger_hash": "0" * 64, "validated": True}
+            if method == "submit":
+                return self._submit(srv, params["tx_blob"])
+            if method == "tx":
+                ledger = srv.applied.get(params["transaction"])
+                if ledger is None or ledger > srv.validated:
+                    return {"status": "error", "error": "txnNotFound"}
+                return {"hash": params["transaction"], "validated": True, "ledger_index": ledger, "Fee": "12",
+                        "meta": {"TransactionResult": "tesSUCCESS"}}
+        return super()._result(method, params)
+
+    @staticmethod
+    def _submit(srv, blob):
+        tx_hash = hashlib.sha512(bytes.fromhex("54584E00" + blob)).hexdigest()[:64].upper()
+        tx = decode(blob)
+        account, sequence = tx["Account"], tx["Sequence"]
+        current = srv.sequences.setdefault(account, 7)
+        srv.submitted.append(sequence)
+        srv.txs.append(tx)
+        if srv.reject:
+            engine = srv.reject.pop(0)
+        elif sequence < current:
+            engine = "tefPAST_SEQ"
+        elif sequence > current:
+            srv.held[account, sequence] = tx_hash
+            engine = "terPRE_SEQ"
+        else:
+            srv.held[account, current] = tx_hash
+            while (account, srv.sequences[account]) in srv.held:
+                srv.applied[srv.held.pop((account, srv.sequences[account]))] = srv.validated + 1
+                srv.sequences[account] += 1
+            engine = "tesSUCCESS"
+        return {"engine_result": engine, "engine_result_message": engine, "tx_blob": blob}
+
+
+@pytest.fixture
+def sequenced():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _SequencedRippled)
+    srv.daemon_threads = True
+    srv.calls, srv.fail, srv.reject, srv.submitted, srv.txs = [], set(), [], [], []
+    srv.sequences, srv.validated, srv.applied, srv.held = {}, 100, {}, {}
+    srv.state_lock = threading.Lock()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    monitor = XRPLHealthMonitor(nodes=[{"id": "solo", "url": "http://%s:%d" % srv.server_address, "priority": 1}])
+    pipeline = index._XRPLSubmissionPipeline(ledger_offset=3, poll_ms=10, retries=2)
+    with patch.object(index, "_xrpl_nodes", monitor), patch.object(index, "_xrpl_clients", {}), \
+            patch.object(index, "_xrpl_pipeline", pipeline):
+        yield srv, pipeline
+    _go_dark(srv)
+
+
+def _memo_tx(wallet):
+    return AccountSet(account=wallet.address)
+
+
+class TestXRPLSubmissionPipeline:
+    """Local Sequence management, the shared poller and resync paths."""
+
+    def test_back_to_back_submissions_share_one_sync(self, sequenced):
+        srv, pipeline = sequenced
+        wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+        futures = [pipeline.submit(_memo_tx(wallet), wallet) for _ in range(24)]
+        results = [f.result(timeout=10) for f in futures]
+        assert all(r.result["validated"] for r in results)
+        assert len({r.result["hash"] for r in results}) == 24
+        assert srv.submitted == list(range(7, 31))
+        assert [m for m, _ in srv.calls].count("account_info") == 1
+        stats = pipeline.get_stats()
+        assert stats["validated"] == 24 and stats["sequence_syncs"] == 1 and stats["resubmitted"] == 0
+
+    def test_concurrent_callers_get_distinct_sequences(self, sequenced):
+        srv, pipeline = sequenced
+        wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+        results = []
+        workers = [threading.Thread(target=lambda: results.append(
+            pipeline.submit(_memo_tx(wallet), wallet).result(timeout=10))) for _ in range(12)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join(15)
+        assert len(results) == 12
+        assert sorted(srv.submitted) == list(range(7, 19))
+        assert srv.sequences[wallet.address] == 19 and not srv.held
+
+    def test_past_seq_resyncs_and_resubmits(self, sequenced):
+        srv, pipeline = sequenced
+        wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+        pipeline._next_seq[wallet.address] = 4     # another process used 4-6
+        resp = pipeline.submit(_memo_tx(wallet), wallet).result(timeout=10)
+        assert resp.result["validated"]
+        assert srv.submitted == [4, 7]
+        assert pipeline.get_stats()["resubmitted"] == 1
+
+    def test_sequence_gap_expires_and_is_refilled(self, sequenced):
+        srv, pipeline = sequenced
+        wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+        pipeline._next_seq[wallet.address] = 9     # 7 and 8 will never arrive
+        resp = pipeline.submit(_memo_tx(wallet), wallet).result(timeout=10)
+        assert resp.result["validated"]
+        assert srv.submitted == [9, 7]
+        assert pipeline.get_stats()["in_flight"] == 0
+
+    def test_rejection_does_not_leave_a_gap(self, sequenced):
+        srv, pipeline = sequenced
+        wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+        srv.reject = ["telINSUF_FEE_P"]
+        first = pipeline.submit(_memo_tx(wallet), wallet)
+        second = pipeline.submit(_memo_tx(wallet), wallet)
+        assert first.result(timeout=10).result["validated"]
+        assert second.result(timeout=10).result["validated"]
+        assert srv.sequences[wallet.address] == 9
+
+    def test_retries_exhausted_raises(self, sequenced):
+        srv, pipeline = sequenced
+        wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+        srv.reject = ["temMALFORMED"] * 3
+        with pytest.raises(index.XRPLReliableSubmissionException, match="temMALFORMED"):
+            pipeline.submit(_memo_tx(wallet), wallet).result(timeout=10)
+        assert pipeline.get_stats()["failed"] == 1
+        assert len(srv.submitted) == 3
+
+    def test_anchor_goes_through_pipeline(self, sequenced):
+        srv, pipeline = sequenced
+        wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+        with patch.object(index, "_xrpl_wallet", wallet), patch.object(index, "_xrpl_client", object()):
+            result = _anchor_xrpl("cd" * 32, record_type="SUPPLY_CHAIN_RECEIPT", branch="NAVY")
+        assert result and result["verified"] is True
+        assert result["tx_hash"] in srv.applied
+        assert pipeline.get_stats()["validated"] == 1
+
+    def test_anchor_timeout_returns_pending_hash(self, sequenced):
+        srv, _ = sequenced
+        wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+        pipeline = index._XRPLSubmissionPipeline(ledger_offset=1000, poll_ms=10, retries=2)
+        pipeline._next_seq[wallet.address] = 9     # held behind a gap, never validates
+        with patch.object(index, "_xrpl_pipeline", pipeline), patch.object(index, "_xrpl_wallet", wallet), \
+                patch.object(index, "_xrpl_client", object()), patch.object(index, "XRPL_PIPELINE_TIMEOUT_S", 0.3), \
+                patch.object(index, "_attach_user_fee") as fee:
+            result = _anchor_xrpl("ef" * 32, record_type="SUPPLY_CHAIN_RECEIPT", branch="NAVY",
+                                  user_email="ops@example.mil")
+        with pipeline._cond:
+            pipeline._pending.clear()     # let the poller exit
+        assert result["verified"] is False and result["status"] == "pending"
+        assert result["tx_hash"] in srv.held.values()
+        assert result["network"] != "Simulated"
+        fee.assert_not_called()
+
+
+def _get(srv, path, headers=None):
+    import http.client
+    conn = http.client.HTTPConnection(*srv.server_address, timeout=10)
+    conn.request("GET", path, headers=headers or {})
+    resp = conn.getresponse()
+    body = json.loads(resp.read())
+    conn.close()
+    return resp.status, body
+
+
+class TestAccountStateCache:
+    """Cached, coalesced account reads and the bulk balances route."""
+
+    def test_repeat_reads_hit_cache(self, nodes):
+        primary, _, _ = nodes
+        state, cached = index._account_state.get(ACCOUNT)
+        assert (state["xrp_balance"], state["sls_balance"], cached) == (25.0, "42.5", False)
+        assert state["ledger_index"] == 100
+        assert index._account_state.get(ACCOUNT) == (state, True)
+        assert sorted(m for m, _ in primary.calls) == ["account_info", "account_lines"]
+        assert all(p.get("ledger_index") == "validated" for _, p in primary.calls)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        fetched = []
+
+        def slow_fetch(address):
+            fetched.append(address)
+            time.sleep(0.1)
+            return {"address": address, "xrp_balance": 1.0, "sls_balance": "0", "ledger_index": 7}
+        cache = index._AccountStateCache(fetch=slow_fetch, ttl=60)
+        results = []
+        workers = [threading.Thread(target=lambda: results.append(cache.get(ACCOUNT))) for _ in range(8)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join(5)
+        assert fetched == [ACCOUNT] and len(results) == 8
+        assert cache.get_stats()["coalesced"] == 7
+
+    def test_expired_entries_refetch(self):
+        fetched = []
+        cache = index._AccountStateCache(fetch=lambda a: fetched.append(a) or {"address": a}, ttl=0)
+        cache.get(ACCOUNT)
+        cache.get(ACCOUNT)
+        assert len(fetched) == 2
+
+    def test_bulk_balances_route(self, nodes):
+        primary, _, _ = nodes
+        others = [Wallet.create().address for _ in range(2)]
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        try:
+            with patch("api.index._hydrate_from_supabase"):
+                query = ",".join([ACCOUNT] + others + [ACCOUNT])
+                status, body = _get(srv, f"/api/wallet/balances?addresses={query}",
+                                    {"X-API-Key": index.API_MASTER_KEY})
+                denied, _ = _get(srv, f"/api/wallet/balances?addresses={ACCOUNT}")
+        finally:
+            srv.shutdown()
+            srv.server_close()
+        assert status == 200 and denied == 401
+        assert [b["address"] for b in body["balances"]] == [ACCOUNT] + others
+        assert body["count"] == 3 and body["ledger_index"] == 100
+        assert all(b["sls_balance"] == "42.5" and b["anchors_available"] == 4250 for b in body["balances"])
+        assert [m for m, _ in primary.calls].count("account_info") == 3
+
+
+@pytest.fixture
+def treasury(sequenced):
+    srv, pipeline = sequenced
+    wallet = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+    with patch.object(index, "_xrpl_client", object()), patch.object(index, "_xrpl_treasury_wallet", wallet), \
+            patch.object(index, "_wallet_cache", index._WalletCache()), patch.dict(index._wallet_store, clear=True), \
+            patch.dict(index._sls_jobs, clear=True), patch.dict(index._sls_job_threads, clear=True):
+        yield srv, pipeline, wallet
+
+
+class _FakePostgREST:
+    """Stand-in for _supabase_request over the SLS delivery tables: upserts
+    by primary key, and eq/neq/is.null/lt filters including or=(...)."""
+
+    KEYS = {"sls_delivery_jobs": ("job_id",), "sls_delivery_items": ("job_id", "email")}
+
+    def __init__(self):
+        self.tables = {t: {} for t in self.KEYS}
+
+    def __call__(self, table, method="GET", data=None, query_params="", **kwargs):
+        rows = self.tables.setdefault(table, {})
+        if method == "POST":
+            for row in data if isinstance(data, list) else [data]:
+                key = tuple(row[k] for k in self.KEYS[table])
+                rows[key] = {**rows.get(key, {}), **row}
+            return []
+        match = sorted((r for r in rows.values() if self._matches(r, query_params)), key=lambda r: r.get("email", ""))
+        for r in match if method == "PATCH" else ():
+            r.update(data)
+        return [dict(r) for r in match]
+
+    @classmethod
+    def _matches(cls, row, query_params):
+        for part in filter(None, query_params.split("&")):
+            field, _, cond = part.partition("=")
+            if field == "or":
+                if not any(cls._test(row, *alt.split(".", 2)) for alt in cond[1:-1].split(",")):
+                    return False
+            elif field not in ("order", "limit", "on_conflict") and not cls._test(row, field, *cond.split(".", 1)):
+                return False
+        return True
+
+    @staticmethod
+    def _test(row, field, op, value):
+        current = row.get(field)
+        if op == "is":
+            return current is None
+        if op == "lt":
+            parse = lambda v: datetime.fromisoformat(v.replace("Z", "+00:00"))
+            return current is not None and parse(current) < parse(value)
+        return (str(current) == value) == (op == "eq")
+
+
+def _subscribers(n, plan="starter"):
+    subs = []
+    for i in range(n):
+        w = Wallet.create(algorithm=CryptoAlgorithm.SECP256K1)
+        index._wallet_store[f"user{i}@example.com"] = {"email": f"user{i}@example.com", "address": w.address,
+                                                        "seed": w.seed, "plan": plan}
+        subs.append({"email": f"user{i}@example.com", "address": w.address, "plan": plan})
+    return subs
+
+
+class TestSLSDeliveryJobs:
+    """Batch renewal/provisioning over the submission pipeline, and resume."""
+
+    def test_renewal_pipelines_treasury_payments(self, treasury):
+        srv, pipeline, wallet = treasury
+        subs = _subscribers(30)
+        job = index._create_sls_job("renewal", subscribers=subs, period="2026-11")
+        assert job["job_id"] == "SLS-RENEWAL-2026-11"
+        with patch.object(index, "SLS_JOB_WINDOW", 8):
+            index._run_sls_job(job)
+        view = index._sls_job_view(job)
+        assert view["status"] == "completed" and view["delivered"] == 30 and view["failed"] == 0
+        assert sorted(t["Sequence"] for t in srv.txs) == list(range(7, 37))
+        assert {t["Destination"] for t in srv.txs} == {s["address"] for s in subs}
+        assert all(t["Account"] == wallet.address for t in srv.txs)
+        assert all(i["sls_tx"] in srv.applied and not i["stage_tx"] for i in job["items"])
+        assert [m for m, _ in srv.calls].count("account_info") == 1
+
+    def test_provision_runs_every_stage(self, treasury):
+        srv, pipeline, wallet = treasury
+        emails = [f"new{i}@example.com" for i in range(5)]
+        job = index._create_sls_job("provision", subscribers=[{"email": e, "plan": "starter"} for e in emails])
+        with patch.object(index, "STRIPE_SECRET_KEY", "sk_test"):
+            index._run_sls_job(job)
+        assert index._sls_job_view(job)["delivered"] == 5
+        kinds = [(t["TransactionType"], t["Account"] == wallet.address) for t in srv.txs]
+        assert kinds.count(("Payment", True)) == 10 and kinds.count(("TrustSet", False)) == 5
+        for item in job["items"]:
+            assert index._wallet_store[item["email"]]["address"] == item["address"]
+            assert {item["fund_tx"], item["trust_tx"], item["sls_tx"]} <= set(srv.applied)
+
+    def test_resume_reconciles_before_resubmitting(self, treasury):
+        srv, pipeline, wallet = treasury
+        subs = _subscribers(3)
+        job = index._create_sls_job("renewal", subscribers=subs, period="2026-12")
+        landed, lost, fresh = job["items"]
+        # a payment signed and submitted before the restart, and one that never made it out
+        tx, _ = index._sls_build_allocation(job, landed)
+        landed_hash = pipeline.submit(tx, wallet).result(timeout=10).result["hash"]
+        landed["stage_tx"] = landed_hash
+        landed["last_ledger"] = srv.validated + 3
+        lost.update(stage_tx="AB" * 32, last_ledger=srv.validated)
+        assert index._create_sls_job("renewal", period="2026-12") is job
+        index._run_sls_job(job)
+        assert job["status"] == "completed"
+        assert landed["sls_tx"] == landed_hash
+        sent = [t["Destination"] for t in srv.txs]
+        assert sent.count(landed["address"]) == 1
+        assert sent.count(lost["address"]) == 1 and sent.count(fresh["address"]) == 1
+        index._run_sls_job(job)     # re-running a finished job sends nothing
+        assert len(srv.txs) == 3
+
+    def test_broadcast_failure_keeps_stage_tx_for_reconcile(self, treasury):
+        srv, pipeline, wallet = treasury
+        job = index._create_sls_job("renewal", subscribers=_subscribers(1), period="2027-04")
+        item = job["items"][0]
+
+        def broadcast_then_fail(tx, signer, on_signed=None):
+            on_signed("DE" * 32, srv.validated + 3)
+            future = index.Future()
+            future.set_exception(OSError("connection reset after send"))
+            return future
+
+        with patch.object(pipeline, "submit", broadcast_then_fail):
+            index._run_sls_job(job)
+        assert item["state"] == "pending" and item["error"]
+        last_ledger = item["last_ledger"]
+        assert item["stage_tx"] == "DE" * 32 and last_ledger == srv.validated + 3
+        with patch.object(index, "_reconcile_sls_tx", return_value=(True, "DE" * 32)) as reconcile:
+            index._run_sls_job(job)
+        reconcile.assert_called_once_with("DE" * 32, last_ledger)
+        assert item["state"] == "delivered" and item["sls_tx"] == "DE" * 32
+        assert srv.txs == []
+
+    def test_final_failure_clears_stage_tx(self, treasury):
+        srv, pipeline, wallet = treasury
+        job = index._create_sls_job("renewal", subscribers=_subscribers(1), period="2027-05")
+        srv.reject = ["temMALFORMED"] * 3
+        index._run_sls_job(job)
+        item = job["items"][0]
+        assert "temMALFORMED" in item["error"] and item["stage_tx"] is None
+
+    @pytest.mark.parametrize("pipelined", [True, False])
+    def test_no_submit_without_checkpoint(self, treasury, pipelined):
+        srv, pipeline, wallet = treasury
+        job = index._create_sls_job("renewal", subscribers=_subscribers(1), period="2027-06")
+        with patch.object(index, "_supabase_request", return_value=None), \
+                patch.object(index, "SUPABASE_URL", "https://sb.example"), \
+                patch.object(index, "SUPABASE_SERVICE_KEY", "key"), \
+                patch.object(index, "XRPL_PIPELINE_ENABLED", pipelined):
+            index._run_sls_job(job)
+        item = job["items"][0]
+        assert "could not record stage tx" in item["error"] and item["stage_tx"] is None
+        assert srv.txs == []
+
+    @staticmethod
+    def _persisted_running_job(db, subs, period, heartbeat_age_s):
+        job_id = f"SLS-RENEWAL-{period}"
+        beat = (datetime.now(timezone.utc) - timedelta(seconds=heartbeat_age_s)).isoformat()
+        db.tables["sls_delivery_jobs"][(job_id,)] = {
+            "job_id": job_id, "kind": "renewal", "period": period, "status": "running", "total": len(subs),
+            "created_at": beat, "started_at": beat, "completed_at": None, "owner": "gone-instance",
+            "heartbeat_at": beat}
+        for n, sub in enumerate(subs):
+            db.tables["sls_delivery_items"][(job_id, sub["email"])] = {
+                "job_id": job_id, "email": sub["email"], "plan": "starter", "address": sub["address"],
+                "state": "delivered" if n == 0 else "pending", "sls_tx": "PAIDEARLIER" if n == 0 else None,
+                "stage_tx": None, "last_ledger": None, "error": None}
+        return job_id
+
+    @staticmethod
+    def _supabase(db):
+        return patch.object(index, "_supabase_request", db), patch.multiple(
+            index, SUPABASE_URL="https://sb.example", SUPABASE_SERVICE_KEY="key")
+
+    def test_takes_over_job_left_running_by_dead_instance(self, treasury):
+        srv, pipeline, wallet = treasury
+        db, subs = _FakePostgREST(), _subscribers(3)
+        job_id = self._persisted_running_job(db, subs, "2027-02", heartbeat_age_s=index.SLS_JOB_LEASE_S * 4)
+        request, key = self._supabase(db)
+        with request, key:
+            job = index._create_sls_job("renewal", period="2027-02")
+            assert job["status"] == "running" and job["owner"] == "gone-instance"
+            assert index._start_sls_job(job)
+            index._sls_job_threads[job_id].join(30)
+        row = db.tables["sls_delivery_jobs"][(job_id,)]
+        assert row["status"] == "completed" and row["owner"] == index._SLS_JOB_OWNER
+        assert sorted(t["Destination"] for t in srv.txs) == sorted(s["address"] for s in subs[1:])
+        assert all(r["state"] == "delivered" for r in db.tables["sls_delivery_items"].values())
+
+    def test_live_lease_is_not_taken_over(self, treasury):
+        srv, pipeline, wallet = treasury
+        db, subs = _FakePostgREST(), _subscribers(2)
+        job_id = self._persisted_running_job(db, subs, "2027-03", heartbeat_age_s=1)
+        request, key = self._supabase(db)
+        with request, key:
+            job = index._create_sls_job("renewal", period="2027-03")
+            assert not index._start_sls_job(job)
+        assert db.tables["sls_delivery_jobs"][(job_id,)]["owner"] == "gone-instance"
+        assert srv.txs == [] and job_id not in index._sls_job_threads
+
+    def test_status_route(self, treasury):
+        srv, pipeline, wallet = treasury
+        job = index._create_sls_job("renewal", subscribers=_subscribers(4), period="2027-01")
+        index._run_sls_job(job)
+        api = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=api.serve_forever, daemon=True).start()
+        try:
+            with patch("api.index._hydrate_from_supabase"):
+                status, body = _get(api, f"/api/wallet/sls-delivery?job={job['job_id']}",
+                                    {"X-API-Key": index.API_MASTER_KEY})
+                denied, _ = _get(api, f"/api/wallet/sls-delivery?job={job['job_id']}")
+        finally:
+            api.shutdown()
+            api.server_close()
+        assert status == 200 and denied == 403
+        assert body["status"] == "completed" and body["by_state"] == {"delivered": 4}
+        assert body["total"] == 4 and body["elapsed_s"] >= 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])